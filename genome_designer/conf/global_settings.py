@@ -235,6 +235,12 @@ LOGGING = {
             'propagate': True,
         },
 
+        'vcf_parser': {
+            'handlers':['console'],
+            'level':'INFO',
+            'propagate': True,
+        },
+
         # Uncomment to see SQL logs on the console.
         # 'django.db.backends': {
         #     'handlers':['console'],
@@ -300,6 +306,7 @@ CELERY_IMPORTS = (
         'pipeline.read_alignment',
         'pipeline.variant_calling',
         'pipeline.variant_calling.freebayes',
+        'utils.data_export_util',
         'utils.import_util',
         'genome_finish.assembly_runner'
 )
@@ -308,6 +315,37 @@ CELERY_IMPORTS = (
 # to have a celery server running.
 CELERY_ALWAYS_EAGER = False
 
+# Report the STARTED state for tasks that are running, rather than leaving
+# them PENDING until they finish. Project exports rely on it to tell a
+# long-running export from one whose task was lost.
+CELERY_TRACK_STARTED = True
+
+# Queue that the sample import tasks (copying reads, FastQC and phred
+# encoding detection) are routed to.
+SAMPLE_IMPORT_QUEUE = 'sample_import'
+
+# Number of sample import tasks that run at once. Enforced by the worker that
+# scripts/run_celery.sh starts for SAMPLE_IMPORT_QUEUE, so that a large plate
+# import doesn't take over the workers that run alignments. A worker started
+# without -Q consumes both queues, without the cap.
+SAMPLE_IMPORT_CONCURRENCY = 4
+
+from kombu import Queue
+CELERY_DEFAULT_QUEUE = 'celery'
+CELERY_QUEUES = (
+    Queue(CELERY_DEFAULT_QUEUE),
+    Queue(SAMPLE_IMPORT_QUEUE),
+)
+CELERY_ROUTES = dict(
+        ('utils.import_util.' + task_name, {'queue': SAMPLE_IMPORT_QUEUE})
+        for task_name in (
+                'copy_experiment_sample_fastq',
+                'start_experiment_sample_qc',
+                'run_fastqc_on_sample_fastq',
+                'detect_phred_encoding',
+                'persist_experiment_sample_qc',
+                'mark_datasets_failed'))
+
 
 ###############################################################################
 # External tools
@@ -363,6 +401,30 @@ JBROWSE_MAX_ALIGN_TRACKS = 5
 JBROWSE_MAX_COVERAGE_TRACKS = 10
 
 
+###############################################################################
+# Read Alignment
+###############################################################################
+
+# Number of threads each alignment task passes to bwa mem and samtools sort.
+# If None, the cores on the machine are divided evenly among the celery worker
+# processes (see CELERYD_CONCURRENCY) so concurrent alignments don't
+# oversubscribe the machine.
+ALIGNMENT_THREADS = None
+
+# Stream bwa mem output through sort, rmdup and fillmd in a single shell
+# pipeline, rather than writing an intermediate BAM to disk after each step.
+ALIGNMENT_STREAMING = True
+
+# Directory in which bwa indexes are cached by the hash of the reference fasta,
+# so that fastas with the same sequence are only indexed once. If None, indexes
+# are built next to each fasta.
+BWA_INDEX_CACHE_DIR = os.path.join(MEDIA_ROOT, 'bwa_index_cache')
+
+# Size in bytes above which the least recently used bwa index cache entries are
+# evicted. Indexes already linked next to a fasta are unaffected.
+BWA_INDEX_CACHE_MAX_BYTES = 10 * 1024 ** 3
+
+
 ###############################################################################
 # Variant Calling
 ###############################################################################
@@ -395,6 +457,18 @@ FREEBAYES_PARALLEL = True
 # TODO: perhaps this should be determined dynamically based on genome size.
 FREEBAYES_REGION_SIZE = 200000
 
+# How to split the genome for parallel freebayes:
+#     'fixed': Windows of FREEBAYES_REGION_SIZE bases.
+#     'coverage': Shards of roughly equal read depth, estimated once from the
+#         bam indexes when alignments are done and stored with the
+#         AlignmentGroup. There is one shard per FREEBAYES_REGION_SIZE bases
+#         of genome.
+FREEBAYES_REGION_SHARDING = 'coverage'
+
+# If True, don't create more freebayes regions than there are Celery workers.
+# Avoids flooding the broker with tiny tasks on small genomes.
+FREEBAYES_LIMIT_REGIONS_TO_CONCURRENCY = False
+
 # SNPEff can be multithreaded but for simplicity, let's always keep this at 1.
 SNPEFF_THREADS = 1
 
@@ -404,6 +478,64 @@ SNPEFF_BUILD_DEBUG = True
 # Names of SnpEff summary files, which we want to delete after running.
 SNPEFF_SUMMARY_FILES = ['snpEff_genes.txt', 'snpEff_summary.html']
 
+###############################################################################
+# VCF Parsing
+###############################################################################
+
+# Buffer vcf records and write Variants and their related rows in batches
+# instead of with several queries per record. See
+# variants.vcf_parser.BulkVariantWriter.
+VCF_PARSER_BULK_INGEST = True
+
+# Number of vcf records buffered before each batch write.
+VCF_PARSER_BULK_BATCH_SIZE = 5000
+
+# Minimum number of seconds between progress messages while parsing a vcf.
+VCF_PARSER_PROGRESS_INTERVAL = 10
+
+###############################################################################
+# Variant Filtering
+###############################################################################
+
+# Store the key-value data columns of the melted variant view as jsonb
+# (requires Postgresql 9.4+) so they aren't parsed by every filter.
+MATERIALIZED_VIEW_JSONB = False
+
+# Keys in ReferenceGenome.variant_key_map to create expression indexes for on
+# the melted variant view, so filters on them don't parse the json of every
+# row. Only keys with a single value per row can be indexed. Every index slows
+# down refreshes of the view, so list only keys that are filtered on often,
+# e.g. ['GT_TYPE', 'DP'].
+MATERIALIZED_VIEW_INDEXED_KEYS = []
+
+# Cache for variant list results, keyed by the version of the melted variant
+# view so that entries are dropped as soon as the view's data changes. Point
+# the 'variant_list' cache at memcached to share entries between processes.
+VARIANT_LIST_CACHE = 'variant_list'
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    VARIANT_LIST_CACHE: {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'variant_list',
+        'TIMEOUT': 60 * 60,
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000
+        }
+    }
+}
+
+# Variant filter queries that take longer than this many seconds are sampled
+# and recorded as SlowVariantFilterQuery objects, along with their query
+# plans. See the slow_variant_filters management command. None to disable.
+SLOW_VARIANT_FILTER_QUERY_THRESHOLD = 2.0
+
+# Fraction of slow queries that are sampled. Getting the plan runs the query
+# again with EXPLAIN ANALYZE, so this bounds the extra load.
+SLOW_VARIANT_FILTER_QUERY_SAMPLE_RATE = 0.2
+
 ###############################################################################
 # Callable Loci
 ###############################################################################
@@ -426,6 +558,11 @@ CL__MAX_LOWMAP_FRAC = 0.5
 # Distance between adjacent features, below which to merge them
 CL__MERGE_DIST = 25
 
+# Number of chromosomes whose callable loci are computed in parallel
+# processes. If None, the cores on the machine are divided evenly among the
+# celery worker processes.
+CL__NUM_PROCESSES = None
+
 ###############################################################################
 # Coverage-based Deletion Detection
 ###############################################################################
@@ -503,6 +640,21 @@ S3_TEST_BUCKET = S3_BUCKET
 # Maximum file size for user upload
 S3_FILE_MAX_SIZE = 1024 ** 3  # 1GB
 
+# Host, port and whether to use https for an S3-compatible server to use
+# instead of AWS, e.g. a local stand-in for testing. None for AWS.
+S3_HOST = None
+S3_PORT = None
+S3_IS_SECURE = True
+
+# Number of files transferred at once when syncing a project with S3.
+S3_SYNC_THREADS = 8
+
+# If True, tasks that need project files only fetch the project's S3
+# manifest up front. Tasks then fetch the model data dirs they read from,
+# e.g. the reference genome and sample being aligned, through
+# main.s3.ensure_local_file(). Other files of the project aren't fetched.
+S3_SYNC_LAZY = False
+
 
 ###############################################################################
 # Testing
@@ -525,3 +677,15 @@ south_logger.setLevel(logging.INFO)
 
 # Directory where profiler logs will be stored. See README.md.
 PROFILE_LOG_BASE = None
+
+
+###############################################################################
+# Benchmarking
+###############################################################################
+
+# simNGS, used to simulate reads for benchmark datasets of arbitrary size.
+# See scripts/benchmark_pipeline.py. Without it, benchmarks use the reads
+# checked into test_data/full_vcf_test_set.
+SIM_NGS_BIN = os.path.join(TOOLS_DIR, 'simNGS', 'bin')
+SIM_NGS_NOISE_SOURCE = os.path.join(PWD, 'tool-data', 'simNGS', 'HiSeq',
+        's_1_4x.runfile')
@@ -7,6 +7,8 @@ of the events that we are dealing with.
 import os
 import sys
 
+import pysam
+
 # Setup Django environment.
 sys.path.append(
         os.path.join(os.path.dirname(os.path.realpath(__file__)), '../'))
@@ -28,14 +30,14 @@ def filter_pEVOL_reads():
     sample_alignments = ExperimentSampleToAlignment.objects.filter(
             alignment_group__reference_genome__project=p)
 
-    def is_pEVOL(line):
-        parts = line.split('\t')
-        rnext_col = parts[2]
-        return rnext_col == 'pEVOL-bipA'
-
     for sa in sample_alignments:
         bam_dataset = get_dataset_with_type(sa, Dataset.TYPE.BWA_ALIGN)
         bam_path = bam_dataset.get_absolute_location()
+        pEVOL_tid = pysam.AlignmentFile(bam_path, 'rb').gettid('pEVOL-bipA')
+
+        def is_pEVOL(read):
+            return read.reference_id == pEVOL_tid
+
         pEVOL_bam_path = get_pEVOL_bam_path(bam_path)
         filter_bam_file_by_row(bam_path, is_pEVOL, pEVOL_bam_path)
 
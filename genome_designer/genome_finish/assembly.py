@@ -1,7 +1,6 @@
 import datetime
 import os
 import pickle
-import pyinter
 import re
 import shutil
 import subprocess
@@ -17,27 +16,27 @@ from genome_finish.insertion_placement_read_trkg import make_contig_reads_to_ref
 from genome_finish.millstone_de_novo_fns import add_paired_mates
 from genome_finish.millstone_de_novo_fns import filter_low_qual_read_pairs
 from genome_finish.millstone_de_novo_fns import filter_out_unpaired_reads
-from genome_finish.millstone_de_novo_fns import get_altalign_reads
 from genome_finish.millstone_de_novo_fns import get_avg_genome_coverage
-from genome_finish.millstone_de_novo_fns import get_clipped_reads_smart
-from genome_finish.millstone_de_novo_fns import get_piled_reads
-from genome_finish.millstone_de_novo_fns import get_unmapped_reads
 from main.model_utils import get_dataset_with_type
 from main.models import Contig
 from main.models import Dataset
 from main.models import ExperimentSampleToAlignment
 from main.models import VariantCallerCommonData
 from pipeline.read_alignment import get_insert_size_mean_and_stdev
-from pipeline.read_alignment_util import extract_discordant_read_pairs
-from pipeline.read_alignment_util import extract_split_reads
-from utils.bam_utils import concatenate_bams
 from utils.bam_utils import index_bam
-from utils.bam_utils import rmdup
 from utils.bam_utils import sort_bam_by_coordinate
 from utils.bam_utils import sort_bam_by_name
 from utils.data_export_util import export_contig_list_as_vcf
 from utils.data_export_util import export_var_dict_list_as_vcf
+from utils.genbank_util import load_gbk_feature_index
 from utils.import_util import add_dataset_to_entity
+from utils.sv_read_util import classify_sv_reads
+from utils.sv_read_util import READ_CLASS__ALTALIGN
+from utils.sv_read_util import READ_CLASS__CLIPPED
+from utils.sv_read_util import READ_CLASS__DISCORDANT
+from utils.sv_read_util import READ_CLASS__PILED
+from utils.sv_read_util import READ_CLASS__SPLIT
+from utils.sv_read_util import READ_CLASS__UNMAPPED
 from variants.filter_key_map_constants import MAP_KEY__COMMON_DATA
 from variants.vcf_parser import parse_vcf
 
@@ -92,6 +91,17 @@ STRUCTURAL_VARIANT_BAM_DATASETS = [
         Dataset.TYPE.BWA_UNMAPPED,
         Dataset.TYPE.BWA_DISCORDANT]
 
+# Read classes, as written by utils.sv_read_util, of the bam datasets. These
+# are also the filename suffixes of the bams.
+SV_INDICANT_CLASS_TO_READ_CLASS = {
+        Dataset.TYPE.BWA_ALTALIGN: READ_CLASS__ALTALIGN,
+        Dataset.TYPE.BWA_PILED: READ_CLASS__PILED,
+        Dataset.TYPE.BWA_CLIPPED: READ_CLASS__CLIPPED,
+        Dataset.TYPE.BWA_SPLIT: READ_CLASS__SPLIT,
+        Dataset.TYPE.BWA_UNMAPPED: READ_CLASS__UNMAPPED,
+        Dataset.TYPE.BWA_DISCORDANT: READ_CLASS__DISCORDANT
+}
+
 FAILURE_REPORT__CONTIG = 'generate_contigs_failure_stats.txt'
 FAILURE_REPORT__DETECT_DELETION = 'detect_deletions_failure_stats.txt'
 FAILURE_REPORT__PARSE_VARIANTS = 'parse_variants_from_vcf_failure_stats.txt'
@@ -239,28 +249,6 @@ def get_sv_indicating_reads(sample_alignment, input_sv_indicant_classes={},
 
     sv_indicant_keys = STRUCTURAL_VARIANT_BAM_DATASETS
 
-    sv_indicant_class_to_filename_suffix = {
-            Dataset.TYPE.BWA_ALTALIGN: 'altalign',
-            Dataset.TYPE.BWA_PILED: 'piled',
-            Dataset.TYPE.BWA_CLIPPED: 'clipped',
-            Dataset.TYPE.BWA_SPLIT: 'split',
-            Dataset.TYPE.BWA_UNMAPPED: 'unmapped',
-            Dataset.TYPE.BWA_DISCORDANT: 'discordant'
-    }
-
-    sv_indicant_class_to_generator = {
-            Dataset.TYPE.BWA_ALTALIGN: get_altalign_reads,
-            Dataset.TYPE.BWA_PILED: get_piled_reads,
-            Dataset.TYPE.BWA_CLIPPED: lambda i, o: get_clipped_reads_smart(
-                    i, o,
-                    phred_encoding=sample_alignment.experiment_sample.data.get(
-                            'phred_encoding', None)),
-            Dataset.TYPE.BWA_SPLIT: extract_split_reads,
-            Dataset.TYPE.BWA_UNMAPPED: lambda i, o: get_unmapped_reads(
-                    i, o, avg_phred_cutoff=20),
-            Dataset.TYPE.BWA_DISCORDANT: extract_discordant_read_pairs
-    }
-
     default_sv_indicant_classes = {
             Dataset.TYPE.BWA_ALTALIGN: False,
             Dataset.TYPE.BWA_PILED: False,
@@ -270,6 +258,31 @@ def get_sv_indicating_reads(sample_alignment, input_sv_indicant_classes={},
             Dataset.TYPE.BWA_DISCORDANT: True
     }
     default_sv_indicant_classes.update(input_sv_indicant_classes)
+    requested_keys = [key for key in sv_indicant_keys
+            if default_sv_indicant_classes[key]]
+
+    alignment_file_prefix = os.path.join(
+            sample_alignment.get_model_data_dir(),
+            'bwa_align')
+
+    # Create compilation filename prefix
+    suffixes = [SV_INDICANT_CLASS_TO_READ_CLASS[k] for k in requested_keys]
+    suffix_string = '_'.join(sorted(suffixes))
+    compilation_prefix = '.'.join([
+            alignment_file_prefix,
+            suffix_string])
+    SV_indicants_bam = compilation_prefix + '.bam'
+
+    SV_indicants_filtered = compilation_prefix + '.with_pairs.filtered.bam'
+    if os.path.exists(SV_indicants_filtered) and not overwrite:
+        print ('WARNING: Requested SV indicants bam file: ' +
+                SV_indicants_filtered +
+                ' already exists and will be returned by this function.  ' +
+                'To overwrite this file pass the keyword overwrite=True')
+        return SV_indicants_filtered
+    if overwrite:
+        print ('WARNING: overwrite is True, so SV read bam datasets ' +
+                'are being overwritten')
 
     # Grab alignment bam file-path
     alignment_bam = get_dataset_with_type(
@@ -286,47 +299,38 @@ def get_sv_indicating_reads(sample_alignment, input_sv_indicant_classes={},
     # Index it
     index_bam(alignment_bam)
 
-    # Get SV indicating reads
-    sv_bams_list = []
-    alignment_file_prefix = os.path.join(
-            sample_alignment.get_model_data_dir(),
-            'bwa_align')
-
-    # Helper function for getting sv read datasets
-    def _get_or_create_sv_dataset(key):
+    # Reuse read class datasets from previous runs unless overwriting.
+    keys_to_generate = []
+    for key in requested_keys:
         dataset_query = sample_alignment.dataset_set.filter(type=key)
-
-        if dataset_query.exists() and not overwrite or (
-                dataset_query.exists() and
-                key not in sv_indicant_class_to_generator):
-            assert len(dataset_query) == 1
-            return dataset_query[0]
-        elif dataset_query.exists() and overwrite and (
-                key in sv_indicant_class_to_generator):
+        if dataset_query.exists():
             assert len(dataset_query) == 1
+            if not overwrite:
+                continue
             dataset_query[0].delete()
+        keys_to_generate.append(key)
 
-        if (overwrite and key in sv_indicant_class_to_generator) or (
-                not dataset_query.exists()):
-            dataset_path = '.'.join([
+    # Classify the reads of all requested classes in a single pass over the
+    # alignment, which writes the aggregate of SV indicants, each read once,
+    # and a bam for each class that doesn't have a Dataset yet.
+    key_to_path = dict(
+            (key, '.'.join([
                     alignment_file_prefix,
-                    sv_indicant_class_to_filename_suffix[key],
-                    'bam'
-                    ])
-            generator = sv_indicant_class_to_generator[key]
-            generator(alignment_bam, dataset_path)
-
-            return add_dataset_to_entity(
-                    sample_alignment,
-                    key,
-                    key,
-                    filesystem_location=dataset_path)
-
-    # Aggregate SV indicants
-    for key in sv_indicant_keys:
-        if default_sv_indicant_classes[key]:
-            dataset = _get_or_create_sv_dataset(key)
-            sv_bams_list.append(dataset.get_absolute_location())
+                    SV_INDICANT_CLASS_TO_READ_CLASS[key],
+                    'bam']))
+            for key in keys_to_generate)
+    classify_sv_reads(alignment_bam,
+            dict((SV_INDICANT_CLASS_TO_READ_CLASS[key], key_to_path.get(key))
+                    for key in requested_keys),
+            combined_output_path=SV_indicants_bam,
+            phred_encoding=sample_alignment.experiment_sample.data.get(
+                    'phred_encoding', None))
+    for key, path in key_to_path.iteritems():
+        add_dataset_to_entity(
+                sample_alignment,
+                key,
+                key,
+                filesystem_location=path)
 
     # TODO(dbgoodman): Maybe fix.
     # # Make some bam tracks for read classes
@@ -339,39 +343,6 @@ def get_sv_indicating_reads(sample_alignment, input_sv_indicant_classes={},
     #     add_bam_file_track(reference_genome,
     #     sample_alignment, dataset_type)
 
-    # Create compilation filename prefix
-    suffixes = [sv_indicant_class_to_filename_suffix[k]
-            for k in sv_indicant_keys
-            if default_sv_indicant_classes[k]]
-
-    suffix_string = '_'.join(sorted(suffixes))
-    compilation_prefix = '.'.join([
-            alignment_file_prefix,
-            suffix_string])
-
-    SV_indicants_filtered = compilation_prefix + '.with_pairs.filtered.bam'
-    if os.path.exists(SV_indicants_filtered) and not overwrite:
-        print ('WARNING: Requested SV indicants bam file: ' +
-                SV_indicants_filtered +
-                ' already exists and will be returned by this function.  ' +
-                'To overwrite this file pass the keyword overwrite=True')
-        return SV_indicants_filtered
-    if overwrite:
-        print ('WARNING: overwrite is True, so SV read bam datasets ' +
-                'are being overwritten')
-
-    # Aggregate SV indicants
-    print 'concatenating sv indicants'
-    SV_indicants_bam = compilation_prefix + '.bam'
-    concatenate_bams(
-            sv_bams_list,
-            SV_indicants_bam)
-
-    # Remove duplicates
-    print 'removing duplicates'
-    SV_indicants_no_dups_bam = compilation_prefix + '.no_dups.bam'
-    rmdup(SV_indicants_bam, SV_indicants_no_dups_bam)
-
     # Add mate pairs to SV indicants sam
     print 'adding mate pairs'
     SV_indicants_with_pairs_bam = compilation_prefix + '.with_pairs.bam'
@@ -380,7 +351,6 @@ def get_sv_indicating_reads(sample_alignment, input_sv_indicant_classes={},
 
     # Filter low quality reads
     print 'filtering out low quality reads_subdir'
-    SV_indicants_filtered = compilation_prefix + '.with_pairs.filtered.bam'
     filter_low_qual_read_pairs(
             SV_indicants_with_pairs_bam, SV_indicants_filtered)
 
@@ -824,29 +794,25 @@ def _extract_node_from_contig_reassembly(contig):
 
 def get_features_at_locations(ref_genome, intervals, chromosome=None):
     """
-    Use the genbank index dataset and return gene or mobile element names
-    that are within these intervals.
+    Use the genbank index dataset and return gene or mobile element features
+    that overlap these [start, end) intervals.
+
+    Returns:
+        Dictionary from interval to list of GenbankFeature objects.
     """
     feature_index_path = get_dataset_with_type(ref_genome,
             Dataset.TYPE.FEATURE_INDEX).get_absolute_location()
+    feature_index = load_gbk_feature_index(feature_index_path)
 
-    with open(feature_index_path, 'r') as fh:
-
-        gbk_feature_list = pickle.load(fh)
-
-        # Dictionary of features to return, for each interval.
-        return_features = {}
-
-        # For each input interval, return a list of feature names that
-        # overlap.
-        for interval in intervals:
-            q_ivl = pyinter.closedopen(*interval)
-            features = [f_ivl for f_ivl in gbk_feature_list if
-                    q_ivl.intersect(f_ivl)]
+    # Dictionary of features to return, for each interval.
+    return_features = {}
 
-            return_features[interval] = features
+    # For each input interval, return a list of features that overlap.
+    for interval in intervals:
+        return_features[interval] = feature_index.get_overlapping_features(
+                interval[0], interval[1], chromosome=chromosome)
 
-        return return_features
+    return return_features
 
 
 def annotate_contig_junctions(contig_uid_list, ref_genome, dist=0):
@@ -897,7 +863,7 @@ def annotate_contig_junctions(contig_uid_list, ref_genome, dist=0):
         # a junction interval:
         if j_ivl_to_f_ivl[j_ivl]:
             named_feats = [(feat.type, feat.name) for feat in
-                    j_ivl_to_f_ivl[j_ivl] if hasattr(feat, 'name')]
+                    j_ivl_to_f_ivl[j_ivl] if feat.name is not None]
 
             if not named_feats:
                 continue
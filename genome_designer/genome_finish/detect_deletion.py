@@ -2,17 +2,17 @@ import os
 
 from Bio import SeqIO
 import numpy as np
-import pysam
 
 from django.conf import settings
 
 from genome_finish.celery_task_decorator import set_assembly_status
 from genome_finish.constants import CUSTOM_SV_METHOD__COVERAGE
 from genome_finish.graph_contig_placement import get_fasta
-from genome_finish.millstone_de_novo_fns import get_altalign_reads
 from main.models import Dataset
 from main.models import ExperimentSampleToAlignment
-from utils.bam_utils import index_bam
+from utils.coverage_util import COVERAGE_FIELD__ALTALIGN_DEPTH
+from utils.coverage_util import COVERAGE_FIELD__DEPTH
+from utils.coverage_util import get_per_base_coverage
 from utils.data_export_util import export_var_dict_list_as_vcf
 from utils.import_util import add_dataset_to_entity
 
@@ -217,88 +217,23 @@ def smoothed_deletions(unique_arr, low_cov_regions):
     return regions
 
 
-def make_altalign_dataset(sample_alignment):
-
-    sample_alignment_bam = sample_alignment.dataset_set.get(
-                type=Dataset.TYPE.BWA_ALIGN).get_absolute_location()
-    alignment_file_prefix = os.path.join(
-        sample_alignment.get_model_data_dir(),
-        'bwa_align')
-    altalign_bam = '.'.join([
-                alignment_file_prefix,
-                'altalign',
-                'bam'
-                ])
-    get_altalign_reads(sample_alignment_bam, altalign_bam)
-
-    return add_dataset_to_entity(
-                sample_alignment,
-                Dataset.TYPE.BWA_ALTALIGN,
-                Dataset.TYPE.BWA_ALTALIGN,
-                filesystem_location=altalign_bam)
-
-
 def per_base_cov_stats_opt(sample_alignment):
+    """Returns dictionary from chromosome to a dictionary with per-base
+    'depths' and 'altaligns' arrays for the sample alignment.
 
+    Reads from the shared per-base coverage of the alignment, computing it if
+    necessary.
+    """
     sample_alignment_bam = sample_alignment.dataset_set.get(
             type=Dataset.TYPE.BWA_ALIGN).get_absolute_location()
-    bamfile = pysam.AlignmentFile(sample_alignment_bam, 'rb')
-
-    chrom_list = bamfile.references
-    chrom_lens = bamfile.lengths
-    c_starts = [0] * len(chrom_list)
-    c_ends = chrom_lens
 
     chrom_to_cov_list = {}
-
-    for chrom, c_start, c_end in zip(chrom_list, c_starts, c_ends):
-
-        depth_arr = np.zeros(c_end)
-        for pileup_col in bamfile.pileup(chrom,
-                start=c_start, end=c_end, truncate=True):
-
-            # number of segments aligned to this position
-            depth = pileup_col.nsegments
-            depth_arr[pileup_col.reference_pos] = depth
-
+    for chrom, coverage in get_per_base_coverage(
+            sample_alignment_bam).iteritems():
         chrom_to_cov_list[chrom] = {
-                'depths': depth_arr
+                'depths': coverage[COVERAGE_FIELD__DEPTH].astype(np.int64),
+                'altaligns': coverage[COVERAGE_FIELD__ALTALIGN_DEPTH].astype(
+                        np.int64)
         }
 
-
-    # Do altaligns
-    altalign_dataset_query = sample_alignment.dataset_set.filter(
-            type=Dataset.TYPE.BWA_ALTALIGN)
-
-    if altalign_dataset_query.count():
-        assert altalign_dataset_query.count() == 1
-        altalign_dataset = altalign_dataset_query[0]
-    else:
-        print "Writing bam dataset of alternative alignment reads\n"
-        altalign_dataset = make_altalign_dataset(sample_alignment)
-
-    altalign_bam_path = altalign_dataset.get_absolute_location()
-    index_bam(altalign_bam_path)
-
-    bamfile = pysam.AlignmentFile(
-            altalign_dataset.get_absolute_location(), 'rb')
-
-    chrom_list = bamfile.references
-    chrom_lens = bamfile.lengths
-    c_starts = [0] * len(chrom_list)
-    c_ends = chrom_lens
-
-
-    for chrom, c_start, c_end in zip(chrom_list, c_starts, c_ends):
-        depth_arr = np.zeros(c_end)
-
-        for pileup_col in bamfile.pileup(chrom,
-                start=c_start, end=c_end, truncate=True):
-
-            # number of segments aligned to this position
-            depth = pileup_col.nsegments
-            depth_arr[pileup_col.reference_pos] = depth
-
-        chrom_to_cov_list[chrom]['altaligns'] = depth_arr
-
     return chrom_to_cov_list
@@ -10,6 +10,7 @@ from settings import S3_BUCKET
 
 from main.model_utils import get_dataset_with_type
 from main.models import Dataset
+from pipeline.read_alignment_util import ensure_bwa_index
 from utils.bam_utils import sort_bam_by_coordinate
 from utils.bam_utils import index_bam
 from utils.import_util import add_dataset_to_entity
@@ -127,12 +128,7 @@ def simple_align_paired_with_bwa_mem(reads_fq, reference_fasta,
         output_bam_path):
 
     # Ensure reference fasta is indexed
-    subprocess.call(' '.join([
-            '%s/bwa/bwa' % settings.TOOLS_DIR,
-            'index',
-            reference_fasta
-            ]),
-            shell=True, executable=settings.BASH_PATH)
+    ensure_bwa_index(reference_fasta)
 
     # Align the fastqs to the reference
     align_input_args = [
@@ -3,6 +3,7 @@ Methods for interfacing with the Celery task queue management library.
 """
 
 from errno import errorcode
+import multiprocessing
 
 from celery.task.control import inspect
 from django.conf import settings
@@ -42,3 +43,15 @@ def assert_celery_running():
     celery_status = get_celery_worker_status()
     assert not CELERY_ERROR_KEY in celery_status, celery_status[CELERY_ERROR_KEY]
 
+
+
+def get_celery_worker_concurrency():
+    """Returns the number of processes each celery worker runs tasks in.
+
+    Celery defaults CELERYD_CONCURRENCY to the number of cores on the machine
+    when it's not configured.
+    """
+    concurrency = getattr(settings, 'CELERYD_CONCURRENCY', None)
+    if not concurrency:
+        concurrency = multiprocessing.cpu_count()
+    return concurrency
@@ -25,3 +25,26 @@ def ensure_all_ref_genome_variant_set_consistency(reference_genome):
     for vs in reference_genome.variantset_set.all():
         ensure_variant_set_consistency(vs)
     reference_genome.invalidate_materialized_view()
+
+
+def ensure_variant_set_consistency_for_variants(reference_genome, variant_ids):
+    """Like ensure_all_ref_genome_variant_set_consistency(), but only touches
+    the VariantSet memberships of the given Variants.
+
+    Used by incremental materialized view refreshes, so unlike the full
+    version this does not invalidate the materialized view.
+    """
+    variants = reference_genome.variant_set.filter(
+            id__in=variant_ids).prefetch_related(
+                    'varianttovariantset_set',
+                    'variantcallercommondata_set__variantevidence_set__experiment_sample')
+    for variant in variants:
+        for vtvs in variant.varianttovariantset_set.all():
+            for vccd in variant.variantcallercommondata_set.all():
+                for ve in vccd.variantevidence_set.all():
+                    if 'GT_TYPE' in ve.data and ve.data['GT_TYPE'] == 2:
+                        vtvs.sample_variant_set_association.add(
+                                ve.experiment_sample)
+                    else:
+                        vtvs.sample_variant_set_association.remove(
+                                ve.experiment_sample)
@@ -7,6 +7,14 @@ import json
 from django.db import models
 
 from psycopg2.extras import Json as psycopg2_Json
+from psycopg2.extras import register_json
+
+
+# Type oids of jsonb and jsonb[] (Postgresql 9.4+). psycopg2 only parses json
+# values into Python objects out of the box, so register jsonb as well.
+JSONB_OID = 3802
+JSONB_ARRAY_OID = 3807
+register_json(globally=True, oid=JSONB_OID, array_oid=JSONB_ARRAY_OID)
 
 
 class PostgresJsonField(models.Field):
@@ -21,13 +29,23 @@ class PostgresJsonField(models.Field):
     abstraction in the Python code, but store the underlying value as a
     TextField equivalent. We specifically need the Postgresql 9.3
     json field so we implement it our own way here.
+
+    Pass jsonb=True to store the value in a Postgresql 9.4+ jsonb column
+    instead, which is parsed once on write rather than on every read, and
+    supports GIN indexes.
     """
 
     # Require for to_python() to work.
     # See: https://docs.djangoproject.com/en/1.5/howto/custom-model-fields/#the-subfieldbase-metaclass
     __metaclass__ = models.SubfieldBase
 
+    def __init__(self, *args, **kwargs):
+        self.jsonb = kwargs.pop('jsonb', False)
+        super(PostgresJsonField, self).__init__(*args, **kwargs)
+
     def db_type(self, connection):
+        if self.jsonb:
+            return 'jsonb'
         return 'json'
 
     def to_python(self, value):
@@ -59,4 +77,6 @@ class PostgresJsonField(models.Field):
         from south.modelsinspector import introspector
         name = '%s.%s' % (self.__class__.__module__, self.__class__.__name__)
         args, kwargs = introspector(self)
+        if self.jsonb:
+            kwargs['jsonb'] = 'True'
         return name, args, kwargs
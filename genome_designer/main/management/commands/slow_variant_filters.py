@@ -0,0 +1,98 @@
+"""
+Command that lists the slow variant filter queries sampled by
+VariantFilterEvaluator, along with their query plans.
+
+Usage:
+    ./manage.py slow_variant_filters [--limit N] [--ref-genome UID] [--plans]
+    ./manage.py slow_variant_filters --summary
+    ./manage.py slow_variant_filters --clear
+"""
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db.models import Avg
+from django.db.models import Count
+from django.db.models import Max
+
+from main.models import SlowVariantFilterQuery
+
+
+class Command(BaseCommand):
+
+    help = 'Lists sampled slow variant filter queries and their query plans.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--limit',
+            type='int',
+            dest='limit',
+            default=20,
+            help='Maximum number of queries to list, slowest first.'),
+        make_option('--ref-genome',
+            dest='ref_genome_uid',
+            default=None,
+            help='Only list queries against the ReferenceGenome with this uid.'),
+        make_option('--plans',
+            action='store_true',
+            dest='show_plans',
+            default=False,
+            help='Include the EXPLAIN (ANALYZE, BUFFERS) output.'),
+        make_option('--summary',
+            action='store_true',
+            dest='summary',
+            default=False,
+            help='Group queries by filter string.'),
+        make_option('--clear',
+            action='store_true',
+            dest='clear',
+            default=False,
+            help='Delete the matching recorded queries.'),
+    )
+
+    def handle(self, *args, **options):
+        slow_queries = SlowVariantFilterQuery.objects.all()
+        if options['ref_genome_uid'] is not None:
+            slow_queries = slow_queries.filter(
+                    reference_genome__uid=options['ref_genome_uid'])
+
+        if options['clear']:
+            num_queries = slow_queries.count()
+            slow_queries.delete()
+            self.stdout.write('Deleted %d slow queries.' % num_queries)
+        elif options['summary']:
+            self._write_summary(slow_queries, options['limit'])
+        else:
+            self._write_queries(slow_queries, options['limit'],
+                    options['show_plans'])
+
+    def _write_summary(self, slow_queries, limit):
+        filter_stats = (slow_queries
+                .values('filter_string')
+                .annotate(
+                        num_queries=Count('id'),
+                        avg_duration=Avg('duration'),
+                        max_duration=Max('duration'))
+                .order_by('-max_duration'))[:limit]
+        self.stdout.write('%8s %10s %10s  %s' % (
+                'COUNT', 'AVG (s)', 'MAX (s)', 'FILTER'))
+        for stats in filter_stats:
+            self.stdout.write('%8d %10.2f %10.2f  %s' % (
+                    stats['num_queries'], stats['avg_duration'],
+                    stats['max_duration'], stats['filter_string']))
+
+    def _write_queries(self, slow_queries, limit, show_plans):
+        slow_queries = slow_queries.select_related('reference_genome')
+        for slow_query in slow_queries.order_by('-duration')[:limit]:
+            self.stdout.write('%s  %.2fs  %d rows  %s  %s' % (
+                    slow_query.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+                    slow_query.duration,
+                    slow_query.num_rows,
+                    slow_query.reference_genome.label,
+                    'melted' if slow_query.is_melted else 'cast'))
+            self.stdout.write('  Filter: %s' % slow_query.filter_string)
+            self.stdout.write('  SQL: %s' % slow_query.sql)
+            if show_plans:
+                self.stdout.write('  Plan:')
+                for line in slow_query.query_plan.splitlines():
+                    self.stdout.write('    ' + line)
+            self.stdout.write('')
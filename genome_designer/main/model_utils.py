@@ -6,6 +6,7 @@ import hashlib
 from uuid import uuid4
 
 from django.conf import settings
+from django.db import connection
 from django.db import IntegrityError
 from django.db import models
 from django.db import transaction
@@ -138,6 +139,71 @@ class UniqueUidModelMixin(models.Model):
     objects = SafeCreateModelManager()
 
 
+###############################################################################
+# Bulk writes
+###############################################################################
+
+# Number of rows per statement when writing in bulk.
+BULK_WRITE_BATCH_SIZE = 1000
+
+
+def reserve_ids(model, count):
+    """Returns a list of count new primary keys from the model's id sequence.
+
+    Django's bulk_create() doesn't set ids on the created objects, so clients
+    that need to link rows across tables assign ids reserved here before
+    calling bulk_create().
+    """
+    if count <= 0:
+        return []
+    cursor = connection.cursor()
+    cursor.execute(
+            "SELECT nextval(pg_get_serial_sequence(%s, 'id')) "
+            "FROM generate_series(1, %s)",
+            [model._meta.db_table, count])
+    return [row[0] for row in cursor.fetchall()]
+
+
+def bulk_update_field(model, field_name, id_to_value_map):
+    """Sets field_name for many rows of model, using one UPDATE ... FROM
+    VALUES statement per BULK_WRITE_BATCH_SIZE rows.
+
+    Doesn't commit. Callers should run it in a transaction, e.g. with
+    transaction.commit_on_success().
+
+    Args:
+        model: The Model class to update.
+        field_name: Name of the field to set.
+        id_to_value_map: Dictionary from row id to the new value of the field.
+    """
+    if not id_to_value_map:
+        return
+
+    field = model._meta.get_field(field_name)
+    db_table = model._meta.db_table
+    column = field.column
+    column_type = field.db_type(connection)
+
+    cursor = connection.cursor()
+    items = id_to_value_map.items()
+    for batch_start in range(0, len(items), BULK_WRITE_BATCH_SIZE):
+        batch = items[batch_start:batch_start + BULK_WRITE_BATCH_SIZE]
+        values_sql = ', '.join(['(%s, %s)'] * len(batch))
+        params = []
+        for row_id, value in batch:
+            params.append(row_id)
+            params.append(field.get_db_prep_save(value, connection))
+        cursor.execute(
+                'UPDATE {table} AS t SET "{column}" = v.value::{column_type} '
+                'FROM (VALUES {values_sql}) AS v(id, value) '
+                'WHERE t.id = v.id'.format(
+                        table=db_table,
+                        column=column,
+                        column_type=column_type,
+                        values_sql=values_sql),
+                params)
+
+
 ###############################################################################
 # Misc helpers
 ###############################################################################
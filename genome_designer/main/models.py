@@ -740,6 +740,23 @@ class ReferenceGenome(UniqueUidModelMixin):
     def invalidate_materialized_view(self):
         self.is_materialized_variant_view_valid = False
         self.save(update_fields=['is_materialized_variant_view_valid'])
+        mvm = MeltedVariantMaterializedViewManager(self)
+        mvm.bump_version()
+
+    def invalidate_materialized_view_for_variants(self, variant_ids):
+        """Marks only the given Variants stale so the materialized view can
+        be refreshed incrementally rather than rebuilt.
+        """
+        mvm = MeltedVariantMaterializedViewManager(self)
+        mvm.mark_variants_stale(variant_ids)
+
+    def invalidate_materialized_view_for_alignment_group(self,
+            alignment_group):
+        """Marks Variants called in the AlignmentGroup stale so the
+        materialized view can be refreshed incrementally.
+        """
+        mvm = MeltedVariantMaterializedViewManager(self)
+        mvm.mark_alignment_group_stale(alignment_group)
 
     def drop_materialized_view(self):
         """Deletes associated materialized view.
@@ -1694,13 +1711,41 @@ class VariantEvidence(
         super(VariantEvidence, self).__init__(*args, **kwargs)
 
     def create_variant_alternate_association(self):
-        gt_bases = self.data['GT_BASES']
-        gt_nums = self.data['GT_NUMS']
+        called_alt_values = self.get_called_alt_values(self.data)
 
         # If this variant evidence is a non-call, no need to add alt alleles.
-        if gt_bases is None:
+        if not called_alt_values:
             return
 
+        variant = self.variant_caller_common_data.variant
+        for normalized_alt_value in called_alt_values:
+            try:
+                self.variantalternate_set.add(
+                        VariantAlternate.objects.get(
+                            variant=variant,
+                            alt_value=normalized_alt_value
+                ))
+
+            except VariantAlternate.DoesNotExist:
+                # Should not happen.
+                print ('Attempt to add a SampleEvidence with an alternate ' +
+                        'allele that is not present for this variant!')
+                raise
+
+    @staticmethod
+    def get_called_alt_values(data):
+        """Returns the normalized alt values called in the given evidence data.
+
+        Shared by create_variant_alternate_association() and the bulk vcf
+        parser, which links evidence to alternates without saving each
+        VariantEvidence individually.
+        """
+        gt_bases = data['GT_BASES']
+        gt_nums = data['GT_NUMS']
+
+        if gt_bases is None:
+            return []
+
         assert ('|' not in gt_bases), (
                 'GT bases string is phased;' +
                 'this is not handled and should never happen...')
@@ -1709,28 +1754,16 @@ class VariantEvidence(
         gt_bases_split = gt_bases.split('/')
         gt_nums_split = gt_nums.split('/')
 
+        called_alt_values = []
         for i in range(len(gt_bases_split)):
             gt_base = str(gt_bases_split[i])
             gt_num = int(gt_nums_split[i])
             if gt_num == 0:
                 # This refers to ref allele, thus no alt to create.
                 continue
-            try:
-                variant = self.variant_caller_common_data.variant
-
-                normalized_alt_value = get_normalized_alt_representation(gt_base)
-
-                self.variantalternate_set.add(
-                        VariantAlternate.objects.get(
-                            variant=variant,
-                            alt_value=normalized_alt_value
-                ))
-
-            except VariantAlternate.DoesNotExist:
-                # Should not happen.
-                print ('Attempt to add a SampleEvidence with an alternate ' +
-                        'allele that is not present for this variant!')
-                raise
+            called_alt_values.append(
+                    get_normalized_alt_representation(gt_base))
+        return called_alt_values
 
     @property
     def sample_uid(self):
@@ -1894,6 +1927,34 @@ class SavedVariantFilterQuery(UniqueUidModelMixin):
     text = models.TextField()
 
 
+class SlowVariantFilterQuery(Model):
+    """Sample of a variant filter query that took longer than
+    settings.SLOW_VARIANT_FILTER_QUERY_THRESHOLD, along with its query plan.
+
+    See the slow_variant_filters management command.
+    """
+    reference_genome = models.ForeignKey('ReferenceGenome')
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    # The filter as entered by the user.
+    filter_string = models.TextField(blank=True)
+
+    is_melted = models.BooleanField(default=True)
+
+    # The compiled query, with arguments filled in.
+    sql = models.TextField()
+
+    # Wall-clock time of the original query, in seconds.
+    duration = models.FloatField()
+
+    # Number of rows the original query returned.
+    num_rows = models.IntegerField()
+
+    # Output of EXPLAIN (ANALYZE, BUFFERS) for the query.
+    query_plan = models.TextField()
+
+
 class S3File(Model):
     """Model for keeping track of all files in S3 bucket.
     """
@@ -1,29 +1,106 @@
 from django.conf import settings
 import logging
 import hashlib
+import json
 import os
 from models import Project
 from functools import wraps
 from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 import tempfile
+import threading
 
 logger = logging.getLogger('s3')
 
 if not settings.S3_ENABLED:
     logger.debug("Set settings.S3_ENABLED to True to enable S3 persistance")
 
+# Index of the path, size and md5 of every file in a synced directory, stored
+# in the directory on S3 so that syncing doesn't need to list the bucket or
+# fetch the md5 of each key.
+MANIFEST_FILENAME = '.s3_manifest.json'
+
+# Same, for the local copy of the directory, plus the mtime of each file so
+# md5s only need recomputing for files that changed.
+LOCAL_MANIFEST_FILENAME = '.s3_manifest.local.json'
+
+SYNC_IGNORED_FILENAMES = set([
+    '.DS_Store',
+    MANIFEST_FILENAME,
+    LOCAL_MANIFEST_FILENAME,
+])
+
+# S3DirectorySyncs that fetch files lazily, active in the current thread.
+_active_lazy_syncs = threading.local()
+
 def calc_file_md5(filepath):
     md5 = hashlib.md5()
-    with open(filepath,'rb') as f: 
-        for chunk in iter(lambda: f.read(128*md5.block_size), b''): 
+    with open(filepath,'rb') as f:
+        for chunk in iter(lambda: f.read(128*md5.block_size), b''):
             md5.update(chunk)
     return md5.hexdigest()
 
+def build_local_manifest(local_dir, cached_manifest=None):
+    """Returns the manifest of the files in local_dir, as a dictionary from
+    path relative to local_dir to a dictionary with the 'size', 'md5' and
+    'mtime' of the file.
+
+    The md5 of files whose size and mtime match cached_manifest is reused
+    rather than recomputed.
+    """
+    if cached_manifest is None:
+        cached_manifest = {}
+    manifest = {}
+    for dirname, dirnames, filenames in os.walk(local_dir):
+        for filename in filenames:
+            if filename in SYNC_IGNORED_FILENAMES:
+                continue
+            filepath = os.path.join(dirname, filename)
+            relpath = os.path.relpath(filepath, local_dir)
+            stat = os.stat(filepath)
+            cached = cached_manifest.get(relpath)
+            if (cached and cached['size'] == stat.st_size and
+                    cached['mtime'] == stat.st_mtime):
+                md5 = cached['md5']
+            else:
+                md5 = calc_file_md5(filepath)
+            manifest[relpath] = {
+                'size': stat.st_size,
+                'md5': md5,
+                'mtime': stat.st_mtime,
+            }
+    return manifest
+
+def diff_manifests(source_manifest, target_manifest):
+    """Returns sorted list of paths in source_manifest that are missing from
+    target_manifest or differ in size or md5.
+    """
+    changed = []
+    for relpath, entry in source_manifest.iteritems():
+        target_entry = target_manifest.get(relpath)
+        if (target_entry is None or
+                target_entry['size'] != entry['size'] or
+                target_entry['md5'] != entry['md5']):
+            changed.append(relpath)
+    return sorted(changed)
+
+def ensure_local_file(path):
+    """Makes sure path, and any files whose paths start with it such as its
+    indexes or the files in it if it is a directory, are fetched if they are
+    in a directory that this thread is lazily syncing from S3. Otherwise does
+    nothing.
+
+    Tasks wrapped in project_files_needed must call this for every existing
+    file or directory they read, as nothing else fetches lazily synced files.
+    """
+    for sync in getattr(_active_lazy_syncs, 'syncs', []):
+        sync.ensure_local(path)
+
 def project_files_needed(func):
     """A decorator function to wrap function to make sure the availability and
     persistance of project files for the period of function execution.
 
-    NOTE: Either 1st argument or kwargs['project'] of function 
+    NOTE: Either 1st argument or kwargs['project'] of function
           must be models.Project instance
     """
     @wraps(func)
@@ -45,21 +122,223 @@ def project_files_needed(func):
 
 @contextmanager
 def project_s3_persisted(project):
+    """Syncs the project's data dir from S3 on entry and back to S3 on exit.
+
+    With settings.S3_SYNC_LAZY, only the manifest is fetched on entry, and
+    files are only fetched when passed to ensure_local_file().
+    """
     project = project
     assert isinstance(project, Project)
-    call_s3_put = False
+    sync = None
 
     if project.is_s3_backed():
         if settings.S3_ENABLED:
-            call_s3_put = True
-            s3_get_directory(project.get_s3_model_data_dir(), project.get_model_data_dir())
+            sync = S3DirectorySync(aws_bucket,
+                    project.get_s3_model_data_dir(),
+                    project.get_model_data_dir())
+            sync.get(lazy=settings.S3_SYNC_LAZY)
         else:
             logger.warning("%r.is_s3_backed() is True but S3 is disabled globally." % project)
 
-    yield project
+    if sync and settings.S3_SYNC_LAZY:
+        if not hasattr(_active_lazy_syncs, 'syncs'):
+            _active_lazy_syncs.syncs = []
+        _active_lazy_syncs.syncs.append(sync)
+        try:
+            yield project
+        finally:
+            _active_lazy_syncs.syncs.remove(sync)
+    else:
+        yield project
+
+    if sync:
+        sync.put()
+
+class S3DirectorySync(object):
+    """Syncs a local directory with a directory in an S3 bucket through
+    manifests of the files on each side (see MANIFEST_FILENAME and
+    LOCAL_MANIFEST_FILENAME).
+
+    Only files that are missing or differ on the other side are transferred,
+    settings.S3_SYNC_THREADS at a time. boto connections aren't thread-safe,
+    so each transfer thread uses a bucket on its own connection (see
+    get_thread_bucket()).
+    """
+
+    def __init__(self, bucket, s3_dir, local_dir):
+        self.bucket = bucket
+        self.s3_dir = s3_dir
+        self.local_dir = local_dir
+
+        # Manifest of the S3 directory, read by get().
+        self.remote_manifest = None
+        self.remote_manifest_exists = False
+
+        # Local manifest when lazily synced, since local files that weren't
+        # fetched may be older than those on S3.
+        self.lazy_local_manifest = None
+
+        # Paths fetched by ensure_local().
+        self.fetched = set()
+        self.fetched_lock = threading.Lock()
+
+    def get(self, lazy=False):
+        """Fetches files that are missing or out of date locally.
+
+        If lazy, only reads the S3 manifest. Files are then fetched by
+        ensure_local().
+        """
+        logger.info("Getting s3://%s/%s to file://%s" % (
+            self.bucket.name, self.s3_dir, os.path.abspath(self.local_dir)) +
+                (" (DRY RUN)" if settings.S3_DRY_RUN else ""))
+        self._read_remote_manifest()
+        if lazy:
+            self.lazy_local_manifest = self._update_local_manifest()
+            return
 
-    if call_s3_put:
-        s3_put_directory(project.get_s3_model_data_dir(), project.get_model_data_dir())
+        local_manifest = self._update_local_manifest()
+        self._transfer(self._get_file,
+                diff_manifests(self.remote_manifest, local_manifest))
+        self._update_local_manifest()
+
+    def ensure_local(self, path):
+        """Fetches path, and any files whose paths start with it, if they are
+        in the S3 directory and weren't already fetched or up to date locally.
+        """
+        local_root = os.path.abspath(self.local_dir)
+        path = os.path.abspath(path)
+        if not path.startswith(local_root + os.sep):
+            return
+        relpath = os.path.relpath(path, local_root)
+
+        with self.fetched_lock:
+            needed = []
+            for candidate, entry in self.remote_manifest.iteritems():
+                if not candidate.startswith(relpath):
+                    continue
+                if candidate in self.fetched:
+                    continue
+                local_entry = self.lazy_local_manifest.get(candidate)
+                if (local_entry and local_entry['size'] == entry['size'] and
+                        local_entry['md5'] == entry['md5']):
+                    continue
+                needed.append(candidate)
+            self._transfer(self._get_file, sorted(needed))
+            self.fetched.update(needed)
+
+    def put(self):
+        """Uploads files that are new or changed locally, and updates the
+        S3 manifest.
+
+        Files in the S3 manifest that aren't local, e.g. because they were
+        never fetched, are kept. If lazily synced, only files modified since
+        get() or missing from S3 are uploaded, since other local files may be
+        out of date.
+        """
+        logger.info("Putting file://%s to s3://%s/%s" % (
+            os.path.abspath(self.local_dir), self.bucket.name, self.s3_dir) +
+                (" (DRY RUN)" if settings.S3_DRY_RUN else ""))
+        if self.remote_manifest is None:
+            self._read_remote_manifest()
+
+        local_manifest = self._update_local_manifest()
+        changed = diff_manifests(local_manifest, self.remote_manifest)
+        if self.lazy_local_manifest is not None:
+            modified = set(diff_manifests(local_manifest,
+                    self.lazy_local_manifest))
+            changed = [relpath for relpath in changed if relpath in modified
+                    or relpath not in self.remote_manifest]
+        self._transfer(self._put_file, changed)
+
+        if settings.S3_DRY_RUN:
+            return
+        if changed or not self.remote_manifest_exists:
+            # Another task may have synced the same directory in the
+            # meantime, so apply our changes to the latest manifest.
+            self._read_remote_manifest()
+            for relpath in changed:
+                self.remote_manifest[relpath] = {
+                    'size': local_manifest[relpath]['size'],
+                    'md5': local_manifest[relpath]['md5'],
+                }
+            Key(self.bucket, self._get_s3_key_name(MANIFEST_FILENAME)
+                    ).set_contents_from_string(
+                            json.dumps(self.remote_manifest))
+            self.remote_manifest_exists = True
+
+    def _read_remote_manifest(self):
+        """Reads the S3 manifest, or builds it by listing the S3 directory
+        for directories synced before manifests existed.
+        """
+        manifest_key = self.bucket.get_key(
+                self._get_s3_key_name(MANIFEST_FILENAME))
+        if manifest_key:
+            self.remote_manifest = json.loads(
+                    manifest_key.get_contents_as_string())
+            self.remote_manifest_exists = True
+            return
+
+        self.remote_manifest = {}
+        self.remote_manifest_exists = False
+        for key in self.bucket.list(self.s3_dir + '/'):
+            relpath = os.path.relpath(key.name, self.s3_dir)
+            if os.path.basename(relpath) in SYNC_IGNORED_FILENAMES:
+                continue
+            # NOTE: The etag is only the md5 for keys not uploaded in parts.
+            self.remote_manifest[relpath] = {
+                'size': key.size,
+                'md5': key.etag.strip("\""),
+            }
+
+    def _update_local_manifest(self):
+        """Returns the manifest of the local directory, and caches it there.
+        """
+        if not os.path.exists(self.local_dir):
+            return {}
+        local_manifest_path = os.path.join(self.local_dir,
+                LOCAL_MANIFEST_FILENAME)
+        cached_manifest = None
+        if os.path.exists(local_manifest_path):
+            with open(local_manifest_path) as fh:
+                cached_manifest = json.load(fh)
+        local_manifest = build_local_manifest(self.local_dir, cached_manifest)
+        if local_manifest != cached_manifest:
+            with open(local_manifest_path, 'w') as fh:
+                json.dump(local_manifest, fh)
+        return local_manifest
+
+    def _transfer(self, transfer_file_fn, relpaths):
+        if not relpaths or settings.S3_DRY_RUN:
+            return
+        pool = ThreadPool(min(settings.S3_SYNC_THREADS, len(relpaths)))
+        try:
+            pool.map(transfer_file_fn, relpaths)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _get_file(self, relpath):
+        filepath = os.path.join(self.local_dir, relpath)
+        directory = os.path.dirname(filepath)
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Created by another thread in the meantime.
+                if not os.path.isdir(directory):
+                    raise
+        aws_key = Key(get_thread_bucket(self.bucket.name),
+                self._get_s3_key_name(relpath))
+        aws_key.get_contents_to_filename(filepath)
+
+    def _put_file(self, relpath):
+        filepath = os.path.join(self.local_dir, relpath)
+        aws_key = Key(get_thread_bucket(self.bucket.name),
+                self._get_s3_key_name(relpath))
+        aws_key.set_contents_from_filename(filepath, policy='public-read')
+
+    def _get_s3_key_name(self, relpath):
+        return os.path.join(self.s3_dir, relpath)
 
 @contextmanager
 def s3_temp_get(s3file):
@@ -77,55 +356,52 @@ def s3_temp_get(s3file):
         raise RuntimeWarning("Trying to call s3_temp_get(%r) but S3 is disabled globally." % s3file)
 
 if settings.S3_ENABLED:
-    from boto.s3.connection import Key, S3Connection
+    from boto.s3.connection import Key, OrdinaryCallingFormat, S3Connection
     import boto
     boto.set_stream_logger('boto')
     logging.getLogger('boto').setLevel(logging.INFO)
 
-    S3 = S3Connection(settings.AWS_SERVER_PUBLIC_KEY, settings.AWS_SERVER_SECRET_KEY)
+    # Optionally connect to an S3-compatible server other than AWS, e.g. a
+    # local stand-in for testing.
+    s3_connection_kwargs = {}
+    if settings.S3_HOST:
+        s3_connection_kwargs = {
+            'host': settings.S3_HOST,
+            'port': settings.S3_PORT,
+            'is_secure': settings.S3_IS_SECURE,
+            'calling_format': OrdinaryCallingFormat(),
+        }
+
+    def connect_s3():
+        return S3Connection(settings.AWS_SERVER_PUBLIC_KEY,
+                settings.AWS_SERVER_SECRET_KEY, **s3_connection_kwargs)
+
+    S3 = connect_s3()
     aws_bucket = S3.get_bucket(settings.S3_BUCKET)
 
-    def s3_get_directory(s3_dir, local_dir):
-        logger.info("Getting s3://%s/%s to file://%s" % (
-            aws_bucket.name, s3_dir, os.path.abspath(local_dir)) +
-                " (DRY RUN)" if settings.S3_DRY_RUN else "")
-        rs = aws_bucket.list(s3_dir)
+    # Connection and buckets of each thread, since boto connections can't be
+    # shared between threads.
+    _thread_s3 = threading.local()
 
-        if not settings.S3_DRY_RUN:
-            for key in rs:
-                relpath = os.path.relpath(key.name, s3_dir)
-                filepath = os.path.join(local_dir, relpath)
-                directory = os.path.dirname(filepath)
-                if not os.path.exists(directory):
-                    os.makedirs(directory)
-
-                if os.path.isfile(filepath):
-                    if key.etag.strip("\"") == calc_file_md5(filepath):
-                        continue  # already fetched.
-                key.get_contents_to_filename(filepath)
+    def get_thread_bucket(bucket_name):
+        """Returns the bucket with the given name on an S3Connection of the
+        current thread's own.
+        """
+        if not hasattr(_thread_s3, 'connection'):
+            _thread_s3.connection = connect_s3()
+            _thread_s3.buckets = {}
+        if bucket_name not in _thread_s3.buckets:
+            # The bucket was already validated on the shared connection.
+            _thread_s3.buckets[bucket_name] = (
+                    _thread_s3.connection.get_bucket(
+                            bucket_name, validate=False))
+        return _thread_s3.buckets[bucket_name]
 
-    def s3_put_directory(s3_dir, local_dir):
-        logger.info("Putting file://%s to s3://%s/%s" % (
-            os.path.abspath(local_dir), aws_bucket.name, s3_dir) +
-                " (DRY RUN)" if settings.S3_DRY_RUN else "")
+    def s3_get_directory(s3_dir, local_dir):
+        S3DirectorySync(aws_bucket, s3_dir, local_dir).get()
 
-        if not settings.S3_DRY_RUN:
-            for dirname, dirnames, filenames in os.walk(local_dir):
-                for filename in filenames:
-                    if filename == ".DS_Store":
-                        continue
-                    filepath = os.path.join(dirname, filename)
-                    relpath = os.path.relpath(filepath, local_dir)
-                    key = os.path.join(s3_dir, relpath)
-                    aws_key = aws_bucket.get_key(key)
-                    if aws_key:
-                        # assume the content of file did not change if md5 hashes are consistent.
-                        if aws_key.etag.strip("\"") == calc_file_md5(filepath):
-                            continue
-                    else:
-                        aws_key = Key(aws_bucket, key)
-                    aws_key.set_contents_from_filename(filepath)
-                    aws_key.set_acl('public-read')
+    def s3_put_directory(s3_dir, local_dir):
+        S3DirectorySync(aws_bucket, s3_dir, local_dir).put()
 
     def s3_delete(key):
         logging.info("Deleting s3://%s/%s" % (aws_bucket.name, key.name))
@@ -144,4 +420,3 @@ if settings.S3_ENABLED:
     def s3_get(key, location):
         aws_key = aws_bucket.get_key(key)
         return aws_key.get_contents_to_filename(location)
-
@@ -259,13 +259,15 @@ pre_delete.connect(pre_alignment_group_delete, sender=AlignmentGroup,
 
 
 def post_vtvs_save(sender, instance, created, **kwargs):
-    instance.variant.reference_genome.invalidate_materialized_view()
+    instance.variant.reference_genome.invalidate_materialized_view_for_variants(
+            [instance.variant_id])
 post_save.connect(post_vtvs_save, sender=VariantToVariantSet,
         dispatch_uid='vtvs_save')
 
 
 def post_vtvs_delete(sender, instance, **kwargs):
-    instance.variant.reference_genome.invalidate_materialized_view()
+    instance.variant.reference_genome.invalidate_materialized_view_for_variants(
+            [instance.variant_id])
 pre_delete.connect(post_vtvs_delete, sender=VariantToVariantSet,
         dispatch_uid='vtvs_delete')
 
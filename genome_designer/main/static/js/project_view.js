@@ -35,10 +35,29 @@ gd.ProjectView = Backbone.View.extend({
     $('#gd-projects-export-btn').addClass('disabled');
     this.setUIStartLoadingState();
 
-    $.get('/_/projects/export', data, _.bind(function(responseData) {
-      this.setUIDoneLoadingState();
+    // The archive is written in the background, so poll until it's ready.
+    $.get('/_/projects/export', data,
+        _.bind(this.handleExportStatus, this));
+  },
+
+  /** Handles the status of a running export, polling until it's done. */
+  handleExportStatus: function(responseData) {
+    if (responseData.status == 'RUNNING') {
+      window.setTimeout(_.bind(function() {
+        $.get('/_/projects/export/status',
+            {'project_uid': this.model.get('uid')},
+            _.bind(this.handleExportStatus, this));
+      }, this), 2000);
+      return;
+    }
+
+    this.setUIDoneLoadingState();
+    $('#gd-projects-export-btn').removeClass('disabled');
+    if (responseData.status == 'COMPLETED') {
       window.location.href = responseData.downloadUrl;
-    }, this));
+    } else {
+      alert('Export failed: ' + responseData.error);
+    }
   },
 
   /** Show loading feedback while loading. */
@@ -213,6 +213,22 @@ gd.ServerSideDataTableComponent = gd.AbstractDataTableComponent.extend({
   customServerDataFn: function(sUrl, aoData, fnCallback, oSettings) {
     this.trigger('START_LOADING');
 
+    // If this is the page right after the last one fetched for the same
+    // query, pass the key of that page's last row so the server can seek
+    // to this page rather than skip over all the preceding rows.
+    var displayStart = Number(this.getServerParam(aoData, 'iDisplayStart'));
+    var displayLength = Number(this.getServerParam(aoData, 'iDisplayLength'));
+    var querySignature = this.getQuerySignature(aoData);
+    if (this.nextPage &&
+        this.nextPage.displayStart == displayStart &&
+        this.nextPage.querySignature == querySignature) {
+      aoData.push({
+        'name': 'paginationKey',
+        'value': JSON.stringify(this.nextPage.paginationKey)
+      });
+    }
+    this.nextPage = null;
+
     oSettings.jqXHR = $.ajax({
       'url':  sUrl,
       'data': aoData,
@@ -230,6 +246,13 @@ gd.ServerSideDataTableComponent = gd.AbstractDataTableComponent.extend({
           fnCallback({aaData: []});
           this.trigger('DATA_FETCH_ERROR', json.error);
         } else {
+          if (json.next_pagination_key) {
+            this.nextPage = {
+              displayStart: displayStart + displayLength,
+              querySignature: querySignature,
+              paginationKey: json.next_pagination_key
+            };
+          }
           fnCallback(this.cleanServerResponse(json, oSettings));
           this.trigger('DONE_LOADING');
         }
@@ -249,6 +272,30 @@ gd.ServerSideDataTableComponent = gd.AbstractDataTableComponent.extend({
   },
 
 
+  /**
+   * Returns the value of the named parameter in the DataTables server
+   * request data, or undefined.
+   */
+  getServerParam: function(aoData, name) {
+    var param = _.find(aoData, function(param) {
+      return param.name == name;
+    });
+    return param ? param.value : undefined;
+  },
+
+
+  /**
+   * Returns a string identifying the query in the DataTables server request
+   * data, ignoring the page offset and request counter, so that consecutive
+   * pages of the same query can be matched up.
+   */
+  getQuerySignature: function(aoData) {
+    return JSON.stringify(_.reject(aoData, function(param) {
+      return _.contains(['iDisplayStart', 'sEcho'], param.name);
+    }));
+  },
+
+
   /**
    * Takes the server response json and creates an object that Datatables
    * can use to redraw itself.
@@ -8,7 +8,10 @@ from django.test.utils import override_settings
 import logging
 import tempfile
 import glob
+import json
 import os
+import shutil
+import threading
 from main.s3 import *
 
 class TestS3(TestCase):
@@ -23,6 +26,42 @@ class TestS3(TestCase):
         md5 = calc_file_md5(t.name)
         self.assertEqual(md5, "2047e9836570e1cd4eaf82b8c67fa5a1")
 
+    def test_build_and_diff_manifests(self):
+        local_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(local_dir, 'a.txt'), 'w') as fh:
+                fh.write('A')
+            os.makedirs(os.path.join(local_dir, 'sub'))
+            with open(os.path.join(local_dir, 'sub', 'b.txt'), 'w') as fh:
+                fh.write('BB')
+            with open(os.path.join(local_dir, LOCAL_MANIFEST_FILENAME),
+                    'w') as fh:
+                fh.write('{}')
+
+            manifest = build_local_manifest(local_dir)
+            self.assertEqual(set(['a.txt', 'sub/b.txt']), set(manifest))
+            self.assertEqual(2, manifest['sub/b.txt']['size'])
+            self.assertEqual(calc_file_md5(os.path.join(local_dir, 'a.txt')),
+                    manifest['a.txt']['md5'])
+
+            # Cached md5s are reused if size and mtime match.
+            cached_manifest = dict(manifest)
+            cached_manifest['a.txt'] = dict(manifest['a.txt'], md5='cached')
+            self.assertEqual('cached', build_local_manifest(
+                    local_dir, cached_manifest)['a.txt']['md5'])
+
+            remote_manifest = {
+                'a.txt': {'size': 1, 'md5': manifest['a.txt']['md5']},
+                'sub/b.txt': {'size': 2, 'md5': 'stale'},
+                'c.txt': {'size': 3, 'md5': 'remote only'},
+            }
+            self.assertEqual(['sub/b.txt'],
+                    diff_manifests(manifest, remote_manifest))
+            self.assertEqual(['c.txt', 'sub/b.txt'],
+                    diff_manifests(remote_manifest, manifest))
+        finally:
+            shutil.rmtree(local_dir)
+
     @override_settings(S3_DRY_RUN=False)
     def test_s3_put_get_string(self):
         if settings.TEST_S3:
@@ -72,6 +111,83 @@ class TestS3(TestCase):
             for key in aws_bucket.list(s3_test_directory):
                 key.delete()
 
+    def test_thread_buckets(self):
+        """Each thread transfers through a connection of its own.
+        """
+        if settings.TEST_S3:
+            bucket = get_thread_bucket(aws_bucket.name)
+            self.assertTrue(bucket is get_thread_bucket(aws_bucket.name))
+            self.assertFalse(bucket.connection is aws_bucket.connection)
+
+            other_thread_buckets = []
+            thread = threading.Thread(target=lambda: other_thread_buckets.append(
+                    get_thread_bucket(aws_bucket.name)))
+            thread.start()
+            thread.join()
+            self.assertEqual(aws_bucket.name, other_thread_buckets[0].name)
+            self.assertFalse(
+                    other_thread_buckets[0].connection is bucket.connection)
+
+    @override_settings(S3_DRY_RUN=False)
+    def test_s3_directory_sync(self):
+        if settings.TEST_S3:
+            s3_test_directory = "__tests__/test_data/sync"
+            local_dir = tempfile.mkdtemp()
+            with open(os.path.join(local_dir, 'reads.fq'), 'w') as fh:
+                fh.write('reads')
+            with open(os.path.join(local_dir, 'reads.fq.idx'), 'w') as fh:
+                fh.write('index')
+            with open(os.path.join(local_dir, 'other.txt'), 'w') as fh:
+                fh.write('other')
+            os.mkdir(os.path.join(local_dir, 'sample'))
+            with open(os.path.join(local_dir, 'sample', 'qc.html'), 'w') as fh:
+                fh.write('qc')
+
+            s3_put_directory(s3_test_directory, local_dir)
+            manifest = json.loads(s3_get_string(
+                    s3_test_directory + '/' + MANIFEST_FILENAME))
+            self.assertEqual(set(['reads.fq', 'reads.fq.idx', 'other.txt',
+                    os.path.join('sample', 'qc.html')]), set(manifest))
+
+            # Lazily synced files are only fetched when asked for.
+            out_dir = tempfile.mkdtemp()
+            with open(os.path.join(out_dir, 'local_only.txt'), 'w') as fh:
+                fh.write('local only')
+            sync = S3DirectorySync(aws_bucket, s3_test_directory, out_dir)
+            sync.get(lazy=True)
+            self.assertFalse(os.path.exists(os.path.join(out_dir, 'reads.fq')))
+            sync.ensure_local(os.path.join(out_dir, 'reads.fq'))
+            self.assertTrue(os.path.isfile(os.path.join(out_dir, 'reads.fq')))
+            self.assertTrue(os.path.isfile(
+                    os.path.join(out_dir, 'reads.fq.idx')))
+            self.assertFalse(os.path.exists(
+                    os.path.join(out_dir, 'other.txt')))
+
+            # Asking for a directory fetches the files in it.
+            self.assertFalse(os.path.exists(os.path.join(out_dir, 'sample')))
+            sync.ensure_local(os.path.join(out_dir, 'sample'))
+            self.assertTrue(os.path.isfile(
+                    os.path.join(out_dir, 'sample', 'qc.html')))
+
+            # Only changed files are uploaded, and files never fetched are
+            # kept in the manifest.
+            with open(os.path.join(out_dir, 'reads.fq'), 'w') as fh:
+                fh.write('new reads')
+            sync.put()
+            manifest = json.loads(s3_get_string(
+                    s3_test_directory + '/' + MANIFEST_FILENAME))
+            self.assertEqual(
+                    calc_file_md5(os.path.join(out_dir, 'reads.fq')),
+                    manifest['reads.fq']['md5'])
+            self.assertTrue('other.txt' in manifest)
+
+            # Local files missing from S3 are uploaded even though they
+            # weren't modified since get(), e.g. output of unwrapped tasks.
+            self.assertTrue('local_only.txt' in manifest)
+
+            shutil.rmtree(local_dir)
+            shutil.rmtree(out_dir)
+
     @override_settings(S3_DRY_RUN=False)
     def tearDown(self):
         if settings.TEST_S3:
@@ -302,6 +302,60 @@ class TestGetVariantList(TestCase):
                 for obj in variant_obj_list])
         self.assertEqual(set(range(TOTAL_NUM_VARIANTS)), variant_position_set)
 
+    def test_cached_until_invalidated(self):
+        """Results are cached until the materialized view is invalidated.
+        """
+        alignment_group = AlignmentGroup.objects.create(
+            label='Alignment 1',
+            reference_genome=self.ref_genome,
+            aligner=AlignmentGroup.ALIGNER.BWA)
+
+        TOTAL_NUM_VARIANTS = 5
+        for pos in range(TOTAL_NUM_VARIANTS):
+            variant = Variant.objects.create(
+                    type=Variant.TYPE.TRANSITION,
+                    reference_genome=self.ref_genome,
+                    chromosome=self.chromosome,
+                    position=pos,
+                    ref_value='A')
+
+            VariantAlternate.objects.create(
+                variant=variant,
+                alt_value='G')
+
+            common_data_obj = VariantCallerCommonData.objects.create(
+                variant=variant,
+                source_dataset=self.vcf_dataset,
+                alignment_group=alignment_group)
+
+            VariantEvidence.objects.create(
+                experiment_sample=self.sample_obj_1,
+                variant_caller_common_data=common_data_obj)
+
+        request_data = {
+            'refGenomeUid': self.ref_genome.uid,
+            'projectUid': self.project.uid,
+            VARIANT_LIST_REQUEST_KEY__FILTER_STRING: 'position < 3'
+        }
+
+        def _get_total():
+            response = self.client.get(self.url, request_data)
+            self.assertEqual(STATUS_CODE__SUCCESS, response.status_code)
+            response_data = json.loads(response.content)
+            return response_data[VARIANT_LIST_RESPONSE_KEY__TOTAL]
+
+        self.assertEqual(3, _get_total())
+
+        # Updating without invalidating the view serves the cached result.
+        Variant.objects.filter(reference_genome=self.ref_genome,
+                position=4).update(position=2)
+        self.assertEqual(3, _get_total())
+
+        # Invalidating the view drops cached results.
+        ReferenceGenome.objects.get(id=self.ref_genome.id).\
+                invalidate_materialized_view()
+        self.assertEqual(4, _get_total())
+
     def test_does_not_throw_500_on_server_error(self):
         """For user input errors, get_variant_list should not throw a 500 error.
 
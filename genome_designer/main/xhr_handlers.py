@@ -5,7 +5,6 @@ This module was created in response to views.py getting quite big, and so a
 reasonable separation point is to separate page actions from Ajax actions.
 """
 
-import copy
 from datetime import datetime
 import json
 import os
@@ -56,9 +55,16 @@ from utils import generate_safe_filename_prefix_from_label
 from utils.combine_reference_genomes import combine_list_allformats
 from utils.data_export_util import export_contigs_as_csv
 from utils.data_export_util import export_melted_variant_view
-from utils.data_export_util import export_project_as_zip
+from utils.data_export_util import get_project_export_status
+from utils.data_export_util import PROJECT_EXPORT_FORMAT__TAR_GZ
+from utils.data_export_util import PROJECT_EXPORT_FORMAT__ZIP
+from utils.data_export_util import PROJECT_EXPORT_FORMATS
+from utils.data_export_util import start_project_export
+from utils.data_export_util import stream_project_archive
+from utils.data_export_util import TAR_EXPORT_FORMAT_TO_STREAM_MODE
 from utils.import_util import create_samples_from_row_data
 from utils.import_util import create_sample_models_for_eventual_upload
+from utils.import_util import detect_phred_encoding
 from utils.import_util import import_reference_genome_from_local_file
 from utils.import_util import import_reference_genome_from_ncbi
 from utils.import_util import import_samples_from_targets_file
@@ -74,6 +80,9 @@ from variants.filter_key_map_constants import MAP_KEY__EVIDENCE
 from variants.gene_query import lookup_genes
 from variants.materialized_variant_filter import lookup_variants
 from variants.materialized_view_manager import MeltedVariantMaterializedViewManager
+from variants.variant_list_cache import get_variant_list_cache
+from variants.variant_list_cache import get_num_total_variants_cache_key
+from variants.variant_list_cache import get_variant_list_cache_key
 from variants.variant_sets import update_variant_in_set_memberships
 from variants.variant_sets import update_variant_in_set_memberships__all_matching_filter
 
@@ -651,9 +660,13 @@ def samples_upload_through_browser_sample_data(request):
     # Start async fastq.
     dataset.status = Dataset.STATUS.QC
     dataset.save(update_fields=['status'])
-    run_fastqc_on_sample_fastq.delay(
+    fastqc_task = run_fastqc_on_sample_fastq.si(
             experiment_sample, dataset, rev=rev,
             source_dataset_status_on_success=Dataset.STATUS.READY)
+    if not rev:
+        fastqc_task = fastqc_task | detect_phred_encoding.si(
+                experiment_sample, dataset)
+    fastqc_task.apply_async()
 
     return HttpResponse(json.dumps({}), content_type='application/json')
 
@@ -704,6 +717,7 @@ def samples_delete(request):
 VARIANT_LIST_REQUEST_KEY__FILTER_STRING = 'variantFilterString'
 VARIANT_LIST_REQUEST_KEY__PROJECT_UID = 'projectUid'
 VARIANT_LIST_REQUEST_KEY__REF_GENOME_UID = 'refGenomeUid'
+VARIANT_LIST_REQUEST_KEY__PAGINATION_KEY = 'paginationKey'
 
 VARIANT_LIST_RESPONSE_KEY__LIST = 'variant_list_json'
 VARIANT_LIST_RESPONSE_KEY__TOTAL = 'num_total_variants'
@@ -711,6 +725,7 @@ VARIANT_LIST_RESPONSE_KEY__TIME = 'time_for_last_result'
 VARIANT_LIST_RESPONSE_KEY__SET_LIST = 'variant_set_list_json'
 VARIANT_LIST_RESPONSE_KEY__KEY_MAP = 'variant_key_filter_map_json'
 VARIANT_LIST_RESPONSE_KEY__ERROR = 'error'
+VARIANT_LIST_RESPONSE_KEY__NEXT_PAGINATION_KEY = 'next_pagination_key'
 
 
 # Uncomment this and @profile statement to profile. This is the entry point
@@ -767,6 +782,12 @@ def get_variant_list(request):
     # Of course, it is possible that we have our bugs right now so devs should
     # be wary of this big try-except.
     try:
+        # Key of the last row of the previous page, if the client is paging
+        # forward, so that the query can seek to the page.
+        if VARIANT_LIST_REQUEST_KEY__PAGINATION_KEY in request.GET:
+            query_args['pagination_key'] = json.loads(request.GET.get(
+                    VARIANT_LIST_REQUEST_KEY__PAGINATION_KEY))
+
         field_select_keys = json.loads(request.GET.get(
                 VARIANT_LIST_REQUEST_KEY__VISIBLE_KEYS, json.dumps([])))
         query_args['visible_key_names'] = determine_visible_field_names(
@@ -790,16 +811,39 @@ def get_variant_list(request):
 
         query_start_time = datetime.now()
 
-        # Get the list of Variants (or melted representation) to display.
-        lookup_variant_result = lookup_variants(query_args, reference_genome,
+        # Results are cached against the current version of the materialized
+        # view, so re-running a query is free until the data changes.
+        variant_list_cache = get_variant_list_cache()
+        cache_key = get_variant_list_cache_key(reference_genome, query_args,
                 alignment_group=alignment_group)
-        variant_list = lookup_variant_result.result_list
-        num_total_variants = lookup_variant_result.num_total_variants
-
-        # Adapt the Variants to display for the frontend.
-        variant_list_json = adapt_variant_to_frontend(variant_list,
-                reference_genome, query_args['visible_key_names'],
-                melted=query_args['is_melted'])
+        cached_result = variant_list_cache.get(cache_key)
+        if cached_result is None:
+            # The total doesn't depend on the page, so it is only counted for
+            # the first page requested and then shared by all pages.
+            num_total_variants_cache_key = get_num_total_variants_cache_key(
+                    reference_genome, query_args,
+                    alignment_group=alignment_group)
+            num_total_variants = variant_list_cache.get(
+                    num_total_variants_cache_key)
+
+            # Get the list of Variants (or melted representation) to display.
+            lookup_variant_result = lookup_variants(query_args,
+                    reference_genome, alignment_group=alignment_group,
+                    num_total_variants=num_total_variants)
+            variant_list_cache.set(num_total_variants_cache_key,
+                    lookup_variant_result.num_total_variants)
+
+            # Adapt the Variants to display for the frontend.
+            cached_result = {
+                'variant_list_json': adapt_variant_to_frontend(
+                        lookup_variant_result.result_list, reference_genome,
+                        query_args['visible_key_names'],
+                        melted=query_args['is_melted']),
+                'num_total_variants': lookup_variant_result.num_total_variants,
+                'next_pagination_key':
+                        lookup_variant_result.next_pagination_key
+            }
+            variant_list_cache.set(cache_key, cached_result)
 
         # Get all VariantSets that exist for this ReferenceGenome.
         variant_set_list = VariantSet.objects.filter(
@@ -808,18 +852,21 @@ def get_variant_list(request):
         # Query the keys valid for ReferenceGenome, and mark the ones that
         # will be displayed so that the checkmarks in the visible field select
         # are pre-filled in case the user wishes to change these.
-        variant_key_map_with_active_fields_marked = copy.deepcopy(
-                reference_genome.variant_key_map)
-        _mark_active_keys_in_variant_key_map(
-                variant_key_map_with_active_fields_marked,
-                query_args['visible_key_names'])
+        variant_key_map_with_active_fields_marked = (
+                _mark_active_keys_in_variant_key_map(
+                        reference_genome.variant_key_map,
+                        query_args['visible_key_names']))
 
         time_for_last_result = (datetime.now() - query_start_time).total_seconds()
 
         # Package up the response.
         response_data = {
-            VARIANT_LIST_RESPONSE_KEY__LIST: variant_list_json,
-            VARIANT_LIST_RESPONSE_KEY__TOTAL: num_total_variants,
+            VARIANT_LIST_RESPONSE_KEY__LIST:
+                    cached_result['variant_list_json'],
+            VARIANT_LIST_RESPONSE_KEY__TOTAL:
+                    cached_result['num_total_variants'],
+            VARIANT_LIST_RESPONSE_KEY__NEXT_PAGINATION_KEY:
+                    cached_result['next_pagination_key'],
             VARIANT_LIST_RESPONSE_KEY__TIME: time_for_last_result,
             VARIANT_LIST_RESPONSE_KEY__SET_LIST: adapt_model_to_frontend(VariantSet,
                     obj_list=variant_set_list),
@@ -843,17 +890,23 @@ VARIANT_LIST_REQUEST_KEY__VISIBLE_KEYS = 'visibleKeyNames'
 
 
 def _mark_active_keys_in_variant_key_map(variant_key_map, visible_key_names):
-    """Mutates variant_key_map to mark fields that should be active based
-    on model class defaults.
+    """Returns a copy of variant_key_map with fields that should be active
+    based on model class defaults marked.
+
+    Only the marked fields are copied, since the map can be large.
     """
     # In the current implementation, we mark the fields that are included
     # in the relevant models' get_field_order() method.
+    marked_variant_key_map = dict(variant_key_map)
 
-    def _update_model_class_key_map(model_class, variant_key_submap):
+    def _update_model_class_key_map(model_class, submap_name):
         """Helper method."""
+        variant_key_submap = dict(variant_key_map[submap_name])
         for key in visible_key_names:
             if key in variant_key_submap:
-                variant_key_submap[key]['checked'] = True
+                variant_key_submap[key] = dict(variant_key_submap[key],
+                        checked=True)
+        marked_variant_key_map[submap_name] = variant_key_submap
 
         # TODO: Do we want to bring back this old default?
         # default_keys = [el['field'] for el in model_class.get_field_order()]
@@ -861,14 +914,13 @@ def _mark_active_keys_in_variant_key_map(variant_key_map, visible_key_names):
         #     if key in variant_key_submap:
         #         variant_key_submap[key]['checked'] = True
 
-    _update_model_class_key_map(VariantCallerCommonData,
-            variant_key_map[MAP_KEY__COMMON_DATA])
+    _update_model_class_key_map(VariantCallerCommonData, MAP_KEY__COMMON_DATA)
+
+    _update_model_class_key_map(VariantAlternate, MAP_KEY__ALTERNATE)
 
-    _update_model_class_key_map(VariantAlternate,
-            variant_key_map[MAP_KEY__ALTERNATE])
+    _update_model_class_key_map(VariantEvidence, MAP_KEY__EVIDENCE)
 
-    _update_model_class_key_map(VariantEvidence,
-            variant_key_map[MAP_KEY__EVIDENCE])
+    return marked_variant_key_map
 
 
 @login_required
@@ -1069,17 +1121,72 @@ def export_variants_as_csv(request):
 @login_required
 def export_project(request):
     """Handles a request to export project.
+
+    The archive is written in the background. Returns the status of the
+    export, which the client polls with export_project_status until the
+    download url is ready.
     """
-    print request.GET
     p_uid = request.GET.get('project_uid')
     project = get_object_or_404(
             Project, owner=request.user.get_profile(), uid=p_uid)
-    download_url = export_project_as_zip(project)
-    response_data = {'downloadUrl': download_url}
+    archive_format = request.GET.get('format', PROJECT_EXPORT_FORMAT__ZIP)
+    if archive_format not in PROJECT_EXPORT_FORMATS:
+        return HttpResponseBadRequest("Invalid export format.")
+    response_data = _adapt_project_export_status(
+            start_project_export(project, archive_format))
     return HttpResponse(json.dumps(response_data),
             content_type='application/json')
 
 
+@require_GET
+@login_required
+def export_project_status(request):
+    """Returns the status of the latest export of the project.
+    """
+    p_uid = request.GET.get('project_uid')
+    project = get_object_or_404(
+            Project, owner=request.user.get_profile(), uid=p_uid)
+    export_status = get_project_export_status(project)
+    if export_status is None:
+        raise Http404
+    response_data = _adapt_project_export_status(export_status)
+    return HttpResponse(json.dumps(response_data),
+            content_type='application/json')
+
+
+def _adapt_project_export_status(export_status):
+    return {
+        'status': export_status['status'],
+        'bytesDone': export_status['bytes_done'],
+        'totalBytes': export_status['total_bytes'],
+        'downloadUrl': export_status['download_url'],
+        'error': export_status['error']
+    }
+
+
+@require_GET
+@login_required
+def export_project_stream(request):
+    """Streams a tar archive of the project as it is written, rather than
+    waiting for a background export to finish.
+    """
+    p_uid = request.GET.get('project_uid')
+    project = get_object_or_404(
+            Project, owner=request.user.get_profile(), uid=p_uid)
+    archive_format = request.GET.get('format', PROJECT_EXPORT_FORMAT__TAR_GZ)
+    if archive_format not in TAR_EXPORT_FORMAT_TO_STREAM_MODE:
+        return HttpResponseBadRequest("Invalid export format.")
+    response = StreamingHttpResponse(
+            stream_project_archive(project, archive_format=archive_format),
+            content_type='application/x-tar')
+    response['Content-Disposition'] = (
+            'attachment; filename="{name}.{ext}"'.format(
+                    name=generate_safe_filename_prefix_from_label(
+                            project.title),
+                    ext=archive_format))
+    return response
+
+
 @login_required
 @require_GET
 def get_alignment_groups(request):
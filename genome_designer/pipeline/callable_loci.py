@@ -1,9 +1,17 @@
-import pysam
-import itertools
+import multiprocessing
+import os
+import subprocess
 import sys
-from collections import defaultdict
+import tempfile
 
 from django.conf import settings
+import numpy as np
+
+from main.celery_util import get_celery_worker_concurrency
+from utils.coverage_util import COVERAGE_FIELD__ALTALIGN_DEPTH
+from utils.coverage_util import COVERAGE_FIELD__DEPTH
+from utils.coverage_util import COVERAGE_FIELD__LOW_MAPQ_DEPTH
+from utils.coverage_util import get_per_base_coverage
 
 MIN_MAPQ = settings.CL__MIN_MAPQ
 MAX_DEPTH = settings.CL__MAX_DEPTH
@@ -12,160 +20,225 @@ MIN_LOWMAPQ_DEPTH = settings.CL__MIN_LOWMAPQ_DEPTH
 MAX_LOWMAP_FRAC = settings.CL__MAX_LOWMAP_FRAC
 MERGE_DIST = settings.CL__MERGE_DIST
 
+# Per-base states. Bases whose depth is between MIN_DEPTH and
+# MIN_LOWMAPQ_DEPTH are too shallow to judge mapping quality, so they continue
+# the state of the bases before them.
+STATE__CALLABLE = 0
+STATE__NO_COVERAGE = 1
+STATE__LOW_COVERAGE = 2
+STATE__POOR_MAP_QUALITY = 3
+STATE__NONUNIQUE_ALIGNMENTS = 4
+STATE__CONTINUE = 5
+
+# Bed feature names of the states that are written out.
+STATE_TO_BED_FLAG = {
+    STATE__NO_COVERAGE: 'NO_COVERAGE',
+    STATE__LOW_COVERAGE: 'LOW_COVERAGE',
+    STATE__POOR_MAP_QUALITY: 'POOR_MAP_QUALITY',
+    STATE__NONUNIQUE_ALIGNMENTS: 'NONUNIQUE_ALIGNMENTS',
+}
+
+
 def get_callable_loci(
         bam_filename,
         bed_output,
         chrom=None,
         start=None,
-        end=None):
-
-    # all bed lines, grouped by flag
-    bed_lines = defaultdict(list)
-
-    def _save_bed_line(chrom, bed_start, bed_end, flag):
-        if not flag: return
-
-        new_bed_line = {
-            'chrom': chrom,
-            'start': bed_start,
-            'end': bed_end,
-            'name': flag
-        }
-
-        # merge with previous if within MERGE_DIST:
-        try:
-            prev_bed_line = bed_lines[flag][-1]
-
-            same_chrom = prev_bed_line['chrom'] == chrom
-            within_merge = prev_bed_line['end'] + MERGE_DIST > bed_start
-
-            if same_chrom and within_merge:
-                prev_bed_line['end'] = bed_end
-            else:
-                bed_lines[flag].append(new_bed_line)
-
-        # can't merge if this is the first bed line
-        except IndexError:
-            bed_lines[flag].append(new_bed_line)
-
-    bamfile = pysam.AlignmentFile(bam_filename, 'rb')
-
-    chrom_list = bamfile.references
-    chrom_lens = bamfile.lengths
+        end=None,
+        num_processes=None):
+    """Writes a bed of the regions of the bam that aren't callable, with the
+    reason as the feature name.
+
+    States are computed for all bases at once from the per-base counts in
+    utils.coverage_util, then run-length encoded into bed features. Features
+    with the same flag less than MERGE_DIST apart are merged.
+
+    Args:
+        bam_filename: Path to sorted and indexed bam.
+        bed_output: Path to write the bed to.
+        chrom: If provided, only this chromosome, optionally limited to
+            [start, end), is processed.
+        num_processes: Number of chromosomes to process in parallel. Defaults
+            to get_callable_loci_process_count().
+    """
+    # Compute coverage up front so that parallel workers only read it.
+    chrom_to_coverage = get_per_base_coverage(bam_filename, MIN_MAPQ)
 
     if chrom:
-        chrom_dict = dict(zip(chrom_list, chrom_lens))
-        chrom_list = [chrom]
-        if not start:
-            c_starts = [0]
-        else:
-            c_starts = [start]
-        if not end:
-            c_ends = chrom_dict[chrom]
-        else:
-            c_ends = [end]
+        chrom_len = len(chrom_to_coverage[chrom][COVERAGE_FIELD__DEPTH])
+        regions = [(chrom, start or 0, end or chrom_len)]
     else:
-        c_starts = [0]*len(chrom_list)
-        c_ends = chrom_lens
-
-    for chrom, c_start, c_end in zip(chrom_list, c_starts, c_ends):
-
-        # holds the name of the bed flag we are currently walking through,
-        # if there is one, else None.
-        curr_flag = None
-
-        # holds the expected next bed position
-        next_pos = c_start
-
-        # holds the start of the current bed record.
-        bed_start = c_start
-
-        for pileup_col in bamfile.pileup(chrom,
-                start=c_start, end=c_end, truncate=True):
-
-            # number of segments aligned to this position
-            depth = pileup_col.nsegments
-            # number of poorly mapped segments
-            badmapq = 0
-            # number of segments who also map somewhere else
-            altaligns = 0
-
-            # fill in badmapq & altaligns
-            for p in pileup_col.pileups:
-                a = p.alignment
-                tag_as = a.get_tag('AS')
-                tag_xs = a.get_tag('XS')
-                badmapq += a.mapping_quality < MIN_MAPQ
-                altaligns += tag_as <= tag_xs
-
-            # NO_COVERAGE
-            # if we've previously skipped from next_pos to the current pileup_col.pos,
-            # then end previous flag at next_pos-1 and fill in a NO_COVERAGE bed flag
-            # from next_pos to the current pileup_col.pos.
-            if next_pos != pileup_col.pos:
-                if curr_flag != 'NO_COVERAGE':
-                    _save_bed_line(chrom, bed_start, next_pos-1, curr_flag)
-                _save_bed_line(chrom, next_pos, pileup_col.pos-1, 'NO_COVERAGE')
-                curr_flag = None
-
-            # LOW_COVERAGE
-            # if we're starting a new LOW_COVERAGE, then write the last flag
-            # and start a new one here by setting bed_start and curr_flag
-            if depth < MIN_DEPTH:
-                if curr_flag != 'LOW_COVERAGE':
-                    _save_bed_line(
-                            chrom, bed_start, pileup_col.pos-1, curr_flag)
-                    bed_start = pileup_col.pos
-                    curr_flag = 'LOW_COVERAGE'
-
-            # GOOD COVERAGE - either POOR_MAPQ, NONUNIQUE, or no flag
-            elif depth >= MIN_LOWMAPQ_DEPTH:
-                # POOR_MAPQ
-                # if we're starting a new POOR_MAPQ, then write the last flag
-                # and start a new one here by setting bed_start and curr_flag
-                if badmapq >= MAX_LOWMAP_FRAC*depth:
-                    if curr_flag != 'POOR_MAP_QUALITY':
-                        _save_bed_line(
-                                chrom, bed_start, pileup_col.pos-1, curr_flag)
-                        bed_start = pileup_col.pos
-                        curr_flag = 'POOR_MAP_QUALITY'
-
-                # NONUNIQUE
-                # if we're starting a new NONUNIQUE, then write the last flag
-                # and start a new one here by setting bed_start and curr_flag
-                elif altaligns >= MAX_LOWMAP_FRAC*depth:
-                    if curr_flag != 'NONUNIQUE_ALIGNMENTS':
-                        _save_bed_line(
-                                chrom, bed_start, pileup_col.pos-1, curr_flag)
-                        bed_start = pileup_col.pos
-                        curr_flag = 'NONUNIQUE_ALIGNMENTS'
-
-                # NO FLAG
-                # If depth > MIN_LOWMAPQ_DEPTH and alignments are sufficiently
-                # unique, then end the current flag
-                elif curr_flag:
-                    _save_bed_line(chrom, bed_start, pileup_col.pos, curr_flag)
-                    curr_flag = None
-
-            next_pos = pileup_col.pos +1
-
-        # END LAST FLAG
-        _save_bed_line(chrom, bed_start, c_end, curr_flag)
-
-    # combine and sort all bed lines by position
-    all_bed_lines = list(itertools.chain(*bed_lines.values()))
-    all_bed_lines.sort(key=lambda l: l['start'])
+        regions = [(c, 0, len(cov[COVERAGE_FIELD__DEPTH]))
+                for c, cov in chrom_to_coverage.iteritems()]
 
-    with open(bed_output, 'w') as fh:
-        for line in all_bed_lines:
+    if num_processes is None:
+        num_processes = get_callable_loci_process_count()
+
+    if num_processes > 1 and len(regions) > 1:
+        _write_callable_loci_in_subprocesses(
+                bam_filename, bed_output, regions, num_processes)
+        return
 
-                assert line['start'] <= line['end']
+    with open(bed_output, 'w') as fh:
+        for region_chrom, region_start, region_end in regions:
+            _write_bed_lines(fh, region_chrom, compute_callable_loci_features(
+                    chrom_to_coverage[region_chrom], region_start, region_end))
+
+
+def get_callable_loci_process_count():
+    """Returns the number of processes get_callable_loci() should use.
+
+    Uses settings.CL__NUM_PROCESSES if set, otherwise splits the cores on this
+    machine evenly among the celery worker processes.
+    """
+    if settings.CL__NUM_PROCESSES:
+        return settings.CL__NUM_PROCESSES
+    return max(1,
+            multiprocessing.cpu_count() // get_celery_worker_concurrency())
+
+
+def compute_callable_loci_features(coverage, start, end):
+    """Computes the bed features for [start, end) of a chromosome.
+
+    Args:
+        coverage: Dictionary from COVERAGE_FIELDS to per-base count arrays
+            for the chromosome, as from get_per_base_coverage().
+
+    Returns:
+        Tuple of numpy arrays (starts, ends, states) of the features, sorted
+        by start. Ends are exclusive.
+    """
+    states = _compute_states(
+            coverage[COVERAGE_FIELD__DEPTH][start:end],
+            coverage[COVERAGE_FIELD__LOW_MAPQ_DEPTH][start:end],
+            coverage[COVERAGE_FIELD__ALTALIGN_DEPTH][start:end])
+    if not len(states):
+        empty = np.zeros(0, dtype=np.int64)
+        return (empty, empty, empty)
+
+    # Run-length encode the states.
+    run_starts = np.concatenate(
+            ([0], np.flatnonzero(np.diff(states)) + 1))
+    run_ends = np.append(run_starts[1:], len(states))
+    run_states = states[run_starts]
+
+    # Merge nearby runs with the same flag, ignoring any runs between them.
+    feature_starts = []
+    feature_ends = []
+    feature_states = []
+    for state in STATE_TO_BED_FLAG:
+        is_state = run_states == state
+        state_starts = run_starts[is_state]
+        state_ends = run_ends[is_state]
+        if not len(state_starts):
+            continue
+        gaps = state_starts[1:] - state_ends[:-1]
+        is_new_feature = np.concatenate(([True], gaps >= MERGE_DIST))
+        is_feature_end = np.append(is_new_feature[1:], True)
+        feature_starts.append(state_starts[is_new_feature])
+        feature_ends.append(state_ends[is_feature_end])
+        feature_states.append(
+                np.repeat(state, np.count_nonzero(is_new_feature)))
+
+    if not feature_starts:
+        empty = np.zeros(0, dtype=np.int64)
+        return (empty, empty, empty)
+
+    feature_starts = np.concatenate(feature_starts) + start
+    feature_ends = np.concatenate(feature_ends) + start
+    feature_states = np.concatenate(feature_states)
+    order = np.argsort(feature_starts, kind='mergesort')
+    return (feature_starts[order], feature_ends[order], feature_states[order])
+
+
+def _compute_states(depths, badmapqs, altaligns):
+    """Returns an array of the STATE__* of each base.
+    """
+    depths = np.asarray(depths, dtype=np.int64)
+    states = np.full(len(depths), STATE__CONTINUE, dtype=np.int8)
+
+    is_deep = depths >= MIN_LOWMAPQ_DEPTH
+    max_lowmap = MAX_LOWMAP_FRAC * depths
+    is_poor_mapq = is_deep & (badmapqs >= max_lowmap)
+    is_nonunique = is_deep & ~is_poor_mapq & (altaligns >= max_lowmap)
+
+    states[is_deep] = STATE__CALLABLE
+    states[is_nonunique] = STATE__NONUNIQUE_ALIGNMENTS
+    states[is_poor_mapq] = STATE__POOR_MAP_QUALITY
+    states[depths < MIN_DEPTH] = STATE__LOW_COVERAGE
+    states[depths == 0] = STATE__NO_COVERAGE
+
+    # Fill in continuing bases with the state of the last base before them
+    # that has one. A run only continues through bases with coverage.
+    is_continue = states == STATE__CONTINUE
+    if is_continue.any():
+        if is_continue[0]:
+            states[0] = STATE__CALLABLE
+            is_continue[0] = False
+        last_set_idx = np.where(is_continue, 0, np.arange(len(states)))
+        np.maximum.accumulate(last_set_idx, out=last_set_idx)
+        filled = states[last_set_idx]
+        filled[filled == STATE__NO_COVERAGE] = STATE__CALLABLE
+        states[is_continue] = filled[is_continue]
+
+    return states
+
+
+def _write_bed_lines(fh, chrom, features):
+    for feature_start, feature_end, state in zip(*features):
+        print >> fh, '{}\t{}\t{}\t{}'.format(
+                chrom, feature_start, feature_end, STATE_TO_BED_FLAG[state])
+
+
+def _write_callable_loci_in_subprocesses(bam_filename, bed_output, regions,
+        num_processes):
+    """Runs get_callable_loci() for each region in a separate process, at
+    most num_processes at a time, and concatenates the results in order.
+
+    Workers are started as subprocesses rather than with multiprocessing,
+    since celery worker processes aren't allowed to have children.
+    """
+    output_dir = os.path.dirname(os.path.abspath(bed_output))
+    env = dict(os.environ)
+    env.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+    region_bed_fns = []
+    running = []
+    try:
+        for region_chrom, region_start, region_end in regions:
+            fd, region_bed_fn = tempfile.mkstemp(suffix='.bed',
+                    prefix='.callable_loci_', dir=output_dir)
+            os.close(fd)
+            region_bed_fns.append(region_bed_fn)
+
+            if len(running) >= num_processes:
+                _wait_for_worker(running.pop(0))
+            running.append(subprocess.Popen([
+                    sys.executable, '-m', 'pipeline.callable_loci',
+                    bam_filename, region_bed_fn, region_chrom,
+                    str(region_start), str(region_end)],
+                    cwd=settings.PWD, env=env))
+        while running:
+            _wait_for_worker(running.pop(0))
+
+        with open(bed_output, 'w') as fh:
+            for region_bed_fn in region_bed_fns:
+                with open(region_bed_fn) as region_fh:
+                    for line in region_fh:
+                        fh.write(line)
+    finally:
+        for worker in running:
+            worker.kill()
+            worker.wait()
+        for region_bed_fn in region_bed_fns:
+            if os.path.exists(region_bed_fn):
+                os.remove(region_bed_fn)
+
+
+def _wait_for_worker(worker):
+    returncode = worker.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, 'pipeline.callable_loci')
 
-                print >> fh, '{}\t{}\t{}\t{}'.format(
-                    line['chrom'],
-                    line['start'],
-                    line['end'],
-                    line['name'])
 
 if __name__ == '__main__':
     args = sys.argv[1:]
@@ -175,5 +248,4 @@ if __name__ == '__main__':
     if len(args) >= 5:
         args[4] = int(args[4])
 
-    get_callable_loci(*args)
-
+    get_callable_loci(*args, num_processes=1)
@@ -8,8 +8,8 @@ cleaning, snv calling, and effect prediction.
 
 from datetime import datetime
 import os
-import time
 
+from celery import chord
 from celery import group
 from celery import task
 from django.conf import settings
@@ -28,6 +28,8 @@ from pipeline.variant_calling import TOOL_PINDEL
 from pipeline.variant_calling.common import get_or_create_vcf_output_dir
 from pipeline.variant_calling.freebayes import merge_freebayes_parallel
 from pipeline.variant_calling.freebayes import freebayes_regions
+from pipeline.variant_calling.freebayes import get_freebayes_num_shards
+from pipeline.variant_calling.freebayes import write_freebayes_shards
 from pipeline.variant_calling.lumpy import merge_lumpy_vcf
 from pipeline.variant_calling.pindel import merge_pindel_vcf
 
@@ -60,7 +62,10 @@ def run_pipeline(alignment_group_label, ref_genome, sample_list,
         variant_calling_options: Control aspects of calling variants.
 
     Returns:
-        Tuple pair (alignment_group, async_result).
+        Tuple (alignment_group, alignment_async_result,
+        variant_calling_async_result). alignment_async_result is None if
+        there were no alignments to run. variant_calling_async_result is the
+        result of the last task of the pipeline.
     """
     if not skip_alignment:
         _assert_pipeline_is_safe_to_run(alignment_group_label, sample_list)
@@ -81,11 +86,10 @@ def run_pipeline(alignment_group_label, ref_genome, sample_list,
     #         for all alignments to be complete before starting.
     #
 
-    # NOTE: Nested chords in celery don't work so we need to break up the
-    # pipeline into # two separate pipelines: 1) alignment and 2) variant
-    # calling. This task is the first task in the variant calling pipeline which
-    # polls the database until all alignments are complete before kicking off
-    # parallel variant calling tasks.
+    # NOTE: The alignments are the header of a chord whose callback,
+    # start_variant_calling_pipeline_task, is triggered by the last alignment
+    # completing. The variant calling group is its own chord later in the
+    # chain, since nested chords in celery don't work.
 
     # NOTE: Since we don't want results to be passed as arguments in the
     # chain, use .si(...) and not .s(...)
@@ -105,17 +109,26 @@ def run_pipeline(alignment_group_label, ref_genome, sample_list,
     # Now we aggregate the alignments that need to be run, collecting their
     # signatures in a Celery group so that these alignments can be run in
     # parallel.
+    # If an alignment task raises, the chord callback never runs, so each
+    # alignment task gets an errback that marks the AlignmentGroup FAILED
+    # rather than leaving it stuck in ALIGNING.
     alignment_task_signatures = []
     for sample_alignment in sample_alignments_to_run:
-        alignment_task_signatures.append(
-                align_with_bwa_mem.si(
-                        alignment_group, sample_alignment,
-                        project=ref_genome.project))
+        alignment_task_signature = align_with_bwa_mem.si(
+                alignment_group, sample_alignment,
+                project=ref_genome.project)
+        alignment_task_signature.link_error(
+                alignment_failed_task.si(alignment_group))
+        alignment_task_signatures.append(alignment_task_signature)
 
     if len(alignment_task_signatures) > 0:
         alignment_task_group = group(alignment_task_signatures)
-        alignment_task_group_async_result = alignment_task_group.apply_async()
+
+        # Assign task ids up front so we can return a result for the
+        # alignments, which are applied as part of the pipeline below.
+        alignment_task_group_async_result = alignment_task_group.freeze()
     else:
+        alignment_task_group = None
         alignment_task_group_async_result = None
 
     # HACK(gleb): Force ALIGNING so that UI starts refreshing. This should be
@@ -129,14 +142,20 @@ def run_pipeline(alignment_group_label, ref_genome, sample_list,
     # Aggregate variant callers, which run in parallel once all alignments
     # are done.
     if perform_variant_calling:
-        variant_caller_group = _construct_variant_caller_group(
-                alignment_group, variant_calling_options)
+        variant_caller_group, freebayes_num_shards = (
+                _construct_variant_caller_group(
+                        alignment_group, variant_calling_options))
     else:
         variant_caller_group = None
+        freebayes_num_shards = None
 
-    # Put together the whole pipeline.
+    # Put together the whole pipeline. Variant calling starts once all
+    # alignments are done.
     variant_calling_pipeline = start_variant_calling_pipeline_task.si(
-            alignment_group)
+            alignment_group, freebayes_num_shards=freebayes_num_shards)
+    if alignment_task_group is not None:
+        variant_calling_pipeline = chord(alignment_task_group,
+                variant_calling_pipeline)
     if variant_caller_group is not None:
         variant_calling_pipeline = (variant_calling_pipeline |
                 variant_caller_group)
@@ -148,8 +167,8 @@ def run_pipeline(alignment_group_label, ref_genome, sample_list,
     # TODO(gleb): We had this to deal with race conditions. Do we still need it?
     ref_genome.save()
 
-    # Run the pipeline. This is a non-blocking call when celery is running so
-    # the rest of code proceeds immediately.
+    # Run the pipeline, including alignments. This is a non-blocking call when
+    # celery is running so the rest of code proceeds immediately.
     variant_calling_async_result = variant_calling_pipeline.apply_async()
 
     return (
@@ -220,6 +239,11 @@ def _get_or_create_sample_alignment_datasets(alignment_group, sample_list):
 def _construct_variant_caller_group(alignment_group, variant_calling_options):
     """Returns celery Group of variant calling tasks that can be run
     in parallel.
+
+    Returns:
+        Tuple of the celery Group and the number of coverage-aware freebayes
+        shards its tasks expect, or None if freebayes isn't sharded by
+        coverage. See start_variant_calling_pipeline_task().
     """
     # Get fresh copy of ReferenceGenome to avoid potential issues with
     # race conditions.
@@ -237,12 +261,30 @@ def _construct_variant_caller_group(alignment_group, variant_calling_options):
     # single celery.group.
     parallel_tasks = []
 
+    freebayes_num_shards = None
+
     # Iterate through tools and kick off tasks.
     for tool in effective_variant_callers:
         # Common params for this tool.
         tool_params = VARIANT_TOOL_PARAMS_MAP[tool]
 
-        if settings.FREEBAYES_PARALLEL and tool == TOOL_FREEBAYES:
+        if (settings.FREEBAYES_PARALLEL and tool == TOOL_FREEBAYES and
+                settings.FREEBAYES_REGION_SHARDING == 'coverage'):
+            # Alignments don't exist yet, so only decide the number of
+            # shards here. start_variant_calling_pipeline_task() computes
+            # the shards once alignments are done, and each task reads its
+            # own.
+            freebayes_num_shards = get_freebayes_num_shards(ref_genome)
+            for region_num in range(freebayes_num_shards):
+                region_params = dict(tool_params)
+                region_params['tool_kwargs'] = {
+                    'num_shards': freebayes_num_shards,
+                    'region_num': region_num
+                }
+                parallel_tasks.append(find_variants_with_tool.si(
+                        alignment_group, region_params,
+                        project=ref_genome.project))
+        elif settings.FREEBAYES_PARALLEL and tool == TOOL_FREEBAYES:
             # Special handling for freebayes if running parallel. Break up
             # ReferenceGenome into regions and create separate job for each.
             fb_regions = freebayes_regions(ref_genome)
@@ -290,62 +332,79 @@ def _construct_variant_caller_group(alignment_group, variant_calling_options):
 
     variant_calling_pipeline = (group(parallel_tasks) |
             merge_variant_data.si(alignment_group))
-    return variant_calling_pipeline
+    return variant_calling_pipeline, freebayes_num_shards
 
 
 @task
-def start_variant_calling_pipeline_task(alignment_group):
-    """First task in variant calling pipeline which waits for all alignments
-    to be complete.
-
-    Nested chords in celery don't work so we need to break up the pipeline into
-    two separate pipelines: 1) alignment and 2) variant calling. This task is
-    the first task in the variant calling pipeline which polls the database
-    until all alignments are complete.
+def start_variant_calling_pipeline_task(alignment_group,
+        freebayes_num_shards=None):
+    """First task in variant calling pipeline, called once all alignments
+    are complete.
+
+    Runs as the callback of the chord of alignment tasks (see run_pipeline()),
+    so rather than waiting on alignments, it only checks that they all
+    succeeded.
+
+    Args:
+        alignment_group: The AlignmentGroup whose alignments are done.
+        freebayes_num_shards: If given, the number of coverage-aware shards
+            to compute for the freebayes tasks that follow.
     """
-    print 'START VARIANT CALLING PIPELINE. WAITING FOR ALIGNMENTS TO COMPLETE.'
-
-    POLL_INTERVAL_SEC = 5
-
-    sample_alignment_list = ExperimentSampleToAlignment.objects.filter(
-            alignment_group=alignment_group)
-
-    all_samples_ready = False
-    failed = False
-    while not all_samples_ready:
-        all_samples_ready = True
-        for sa in sample_alignment_list:
-            sa_fresh = ExperimentSampleToAlignment.objects.get(id=sa.id)
-            bwa_dataset = sa_fresh.dataset_set.get(label=Dataset.TYPE.BWA_ALIGN)
-            if bwa_dataset.status == Dataset.STATUS.FAILED:
-                failed = True
-                # # DEBUG: Uncomment to see alignment error output
-                # print '---------------ALIGNMENT ERROR OUTPUT---------------\n'
-                # error_dataset = sa_fresh.dataset_set.get(
-                #         label=Dataset.TYPE.BWA_ALIGN_ERROR)
-                # with open(error_dataset.get_absolute_location(),'r') as fh:
-                #     for line in fh:
-                #         print line
-                break
-
-            if not bwa_dataset.status == Dataset.STATUS.READY:
-                all_samples_ready = False
-                break
-
-        if failed:
+    print 'START VARIANT CALLING PIPELINE.'
+
+    bwa_dataset_statuses = list(Dataset.objects.filter(
+            experimentsampletoalignment__alignment_group=alignment_group,
+            label=Dataset.TYPE.BWA_ALIGN).values_list('status', flat=True))
+    num_sample_alignments = (
+            alignment_group.experimentsampletoalignment_set.count())
+
+    # Every sample alignment must have a READY BWA_ALIGN Dataset.
+    all_samples_ready = (
+            num_sample_alignments > 0 and
+            len(bwa_dataset_statuses) == num_sample_alignments and
+            all(status == Dataset.STATUS.READY
+                    for status in bwa_dataset_statuses))
+
+    if not all_samples_ready:
+        # NOTE: Alignment error output is in the BWA_ALIGN_ERROR Dataset of
+        # each ExperimentSampleToAlignment.
+        alignment_group = AlignmentGroup.objects.get(id=alignment_group.id)
+        alignment_group.status = AlignmentGroup.STATUS.FAILED
+        alignment_group.save(update_fields=['status'])
+        raise Exception("Alignment failed.")
+
+    # Compute the freebayes shards once here, rather than in every freebayes
+    # task, since each needs to read all the bam indexes.
+    if freebayes_num_shards is not None:
+        try:
+            write_freebayes_shards(alignment_group, freebayes_num_shards,
+                    project=alignment_group.reference_genome.project)
+        except:
             alignment_group = AlignmentGroup.objects.get(id=alignment_group.id)
             alignment_group.status = AlignmentGroup.STATUS.FAILED
             alignment_group.save(update_fields=['status'])
-            raise Exception("Alignment failed.")
-
-        if not all_samples_ready:
-            time.sleep(POLL_INTERVAL_SEC)
+            raise
 
     # All ready. Set VARIANT_CALLING.
     alignment_group.status = AlignmentGroup.STATUS.VARIANT_CALLING
     alignment_group.save(update_fields=['status'])
 
 
+@task
+def alignment_failed_task(alignment_group):
+    """Errback for the alignment tasks in run_pipeline().
+
+    align_with_bwa_mem() records most failures on its BWA_ALIGN Dataset and
+    lets start_variant_calling_pipeline_task() fail the group, but anything
+    it raises (e.g. while syncing project files) skips the chord callback
+    entirely. Mark the AlignmentGroup FAILED here in that case.
+    """
+    alignment_group = AlignmentGroup.objects.get(id=alignment_group.id)
+    alignment_group.status = AlignmentGroup.STATUS.FAILED
+    alignment_group.end_time = datetime.now()
+    alignment_group.save(update_fields=['status', 'end_time'])
+
+
 @task
 def merge_variant_data(alignment_group):
     """Merges results of variant caller data after pipeline is complete.
@@ -4,6 +4,7 @@ Methods for aligning raw fastq reads to a reference genome.
 
 import copy
 from datetime import datetime
+import multiprocessing
 import os
 import subprocess
 from subprocess import PIPE
@@ -12,20 +13,23 @@ from subprocess import Popen
 from celery import task
 from django.conf import settings
 
+from main.celery_util import get_celery_worker_concurrency
 from main.models import AlignmentGroup
 from main.models import Dataset
 from main.models import ExperimentSampleToAlignment
 from main.model_utils import clean_filesystem_location
 from main.model_utils import get_dataset_with_type
+from main.s3 import ensure_local_file
 from main.s3 import project_files_needed
 from pipeline.read_alignment_util import ensure_bwa_index
 from pipeline.callable_loci import get_callable_loci
 from pipeline.read_alignment_util import index_bam_file
-from pipeline.read_alignment_util import extract_split_reads
-from pipeline.read_alignment_util import extract_discordant_read_pairs
 from utils.import_util import add_dataset_to_entity
 from utils.jbrowse_util import add_bam_file_track
 from utils.jbrowse_util import add_bed_file_track
+from utils.sv_read_util import classify_sv_reads
+from utils.sv_read_util import READ_CLASS__DISCORDANT
+from utils.sv_read_util import READ_CLASS__SPLIT
 from utils import titlecase_spaces
 
 
@@ -48,6 +52,10 @@ def align_with_bwa_mem(alignment_group, sample_alignment):
     experiment_sample = sample_alignment.experiment_sample
     alignment_group = AlignmentGroup.objects.get(id=alignment_group.id)
 
+    # Fetch the inputs, in case the project is being lazily synced from S3.
+    ensure_local_file(
+            alignment_group.reference_genome.get_model_data_dir())
+    ensure_local_file(experiment_sample.get_model_data_dir())
 
     # Grab the reference genome fasta for the alignment.
     ref_genome_fasta = get_dataset_with_type(
@@ -110,10 +118,12 @@ def align_with_bwa_mem(alignment_group, sample_alignment):
         # 1. Generate SA coordinates.
         read_fq_1_path, read_fq_1_fn = os.path.split(input_reads_1_fq_path)
 
+        num_threads = get_alignment_thread_count()
+
         align_input_args = ' '.join([
             '%s/bwa/bwa' % settings.TOOLS_DIR,
             'mem',
-            '-t', '1', # threads
+            '-t', str(num_threads),
             '-R', '"'+read_group_string(experiment_sample)+'"',
             # uncomment this to keep secondary alignments (for finding and marking paralogy regions)
             # But before we can uncomment we need to fix de novo assembly code
@@ -126,14 +136,51 @@ def align_with_bwa_mem(alignment_group, sample_alignment):
             read_fq_2_path, read_fq_2_fn = os.path.split(input_reads_2_fq_path)
             align_input_args += ' ' + input_reads_2_fq
 
-        # To skip saving the SAM file to disk directly, pipe output directly to
-        # make a BAM file.
-        align_input_args += ' | ' + settings.SAMTOOLS_BINARY + ' view -bS -'
+        # Set processing mask to not compute insert metrics if reads are
+        # not paired end, as the lumpy script only works on paired end reads
+        opt_processing_mask = {}
+        if not is_paired_end:
+            opt_processing_mask['compute_insert_metrics'] = False
+
+        effective_mask = copy.copy(DEFAULT_PROCESSING_MASK)
+        effective_mask.update(opt_processing_mask)
+
+        # Streaming always sorts, so process the bam on disk if the mask
+        # skips sorting.
+        use_streaming = (settings.ALIGNMENT_STREAMING and
+                effective_mask['sort'])
+
+        if use_streaming:
+            # Sort, and rmdup and fillmd if the mask asks for them, happen
+            # on the stream so the only BAM written to disk is the final one.
+            # Insert metrics have to be computed before fillmd though (see
+            # finalize_sorted_bam_file()), so in that case fillmd runs on the
+            # sorted BAM afterwards.
+            stream_mask = copy.copy(effective_mask)
+            if effective_mask['compute_insert_metrics']:
+                stream_mask['withmd'] = False
+            output_bam_name = 'bwa_align.sorted.bam'
+            if stream_mask['withmd']:
+                output_bam_name = 'bwa_align.sorted.withmd.bam'
+            output_bam = os.path.join(sample_alignment.get_model_data_dir(),
+                    output_bam_name)
+            align_input_args = _build_streaming_alignment_cmd(
+                    align_input_args, ref_genome_fasta,
+                    os.path.splitext(output_bam)[0], num_threads,
+                    stream_mask)
+
+            # Only what's left of fillmd happens after the stream.
+            opt_processing_mask['withmd'] = (effective_mask['withmd'] and
+                    not stream_mask['withmd'])
+        else:
+            # To skip saving the SAM file to disk directly, pipe output
+            # directly to make a BAM file.
+            align_input_args += ' | ' + settings.SAMTOOLS_BINARY + ' view -bS -'
 
-        ### 2. Generate SAM output.
-        output_bam = os.path.join(sample_alignment.get_model_data_dir(),
-                'bwa_align.bam')
+            output_bam = os.path.join(sample_alignment.get_model_data_dir(),
+                    'bwa_align.bam')
 
+        ### 2. Generate SAM output.
         error_output.write(align_input_args)
 
         # Flush the output here so it gets written before the alignments.
@@ -144,16 +191,15 @@ def align_with_bwa_mem(alignment_group, sample_alignment):
                     stdout=fh, stderr=error_output,
                     shell=True, executable=settings.BASH_PATH)
 
-        # Set processing mask to not compute insert metrics if reads are
-        # not paired end, as the lumpy script only works on paired end reads
-        opt_processing_mask = {}
-        if not is_paired_end:
-            opt_processing_mask['compute_insert_metrics'] = False
-
         # Do several layers of processing on top of the initial alignment.
-        result_bam_file = process_sam_bam_file(sample_alignment,
-                alignment_group.reference_genome, output_bam, error_output,
-                opt_processing_mask=opt_processing_mask)
+        if use_streaming:
+            result_bam_file = finalize_sorted_bam_file(sample_alignment,
+                    alignment_group.reference_genome, output_bam,
+                    error_output, opt_processing_mask=opt_processing_mask)
+        else:
+            result_bam_file = process_sam_bam_file(sample_alignment,
+                    alignment_group.reference_genome, output_bam,
+                    error_output, opt_processing_mask=opt_processing_mask)
 
         # Add the resulting file to the dataset.
         bwa_dataset.filesystem_location = clean_filesystem_location(
@@ -161,8 +207,7 @@ def align_with_bwa_mem(alignment_group, sample_alignment):
         bwa_dataset.save()
 
         # Isolate split and discordant reads for SV calling.
-        get_discordant_read_pairs(sample_alignment)
-        get_split_reads(sample_alignment)
+        get_discordant_and_split_reads(sample_alignment)
 
         # Add track to JBrowse.
         add_bam_file_track(alignment_group.reference_genome, sample_alignment,
@@ -266,6 +311,7 @@ def process_sam_bam_file(sample_alignment, reference_genome,
                 ' '.join([
                         settings.SAMTOOLS_BINARY,
                         'sort',
+                        '-@', str(get_alignment_thread_count()),
                         '-o',
                         bam_file_location,
                         sorted_output_name + '.tmp.bam']),
@@ -277,29 +323,53 @@ def process_sam_bam_file(sample_alignment, reference_genome,
 
         subprocess.check_call(sort_rmdup_cmd, shell=True, stderr=error_output)
 
-        # 2b. Index the sorted result.
-        index_bam_file(sorted_bam_file_location, error_output)
-
     elif effective_mask['sort']:
         # 2a. Perform the actual sorting.
         subprocess.check_call([
             settings.SAMTOOLS_BINARY,
             'sort',
+            '-@', str(get_alignment_thread_count()),
             bam_file_location,
             sorted_output_name
         ], stderr=error_output)
 
-        # 2b. Index the sorted result.
-        index_bam_file(sorted_bam_file_location, error_output)
+    return finalize_sorted_bam_file(sample_alignment, reference_genome,
+            sorted_bam_file_location, error_output, effective_mask)
 
-    # 3. Compute insert size metrics
+
+def finalize_sorted_bam_file(sample_alignment, reference_genome,
+        sorted_bam_file_location, error_output=None,
+        opt_processing_mask=DEFAULT_PROCESSING_MASK):
+    """Computes insert metrics for a sorted .bam file, adds back MD tags,
+    indexes the result and computes the per-sample metrics that depend on it.
+
+    This is the tail of process_sam_bam_file(), shared with the streaming
+    alignment mode where sorting and rmdup, and fillmd unless insert metrics
+    are needed, already happened on the stream coming out of bwa.
+
+    Args:
+        sample_alignment: The relationship between a sample and an alignment
+        sorted_bam_file_location: The full path to the sorted .bam file.
+        error_output: File handle that can be passed as stderr to subprocess
+            calls.
+        opt_processing_mask: See process_sam_bam_file(). Only the 'index',
+            'compute_insert_metrics', 'withmd' and 'compute_callable_loci'
+            keys are relevant here.
+
+    Returns:
+        The path of the final .bam file.
+    """
+    effective_mask = copy.copy(DEFAULT_PROCESSING_MASK)
+    effective_mask.update(opt_processing_mask)
+
+    # 1. Compute insert size metrics
     # Subsequent steps screw up pairing info so this has to
     # be done here.
     if effective_mask['compute_insert_metrics']:
         compute_insert_metrics(sorted_bam_file_location,
                 sample_alignment, error_output)
 
-    # 4. Add back MD tags for visualization of mismatches by Jbrowse
+    # 2. Add back MD tags for visualization of mismatches by Jbrowse
     if effective_mask['withmd']:
         final_bam_location = (
                 os.path.splitext(sorted_bam_file_location)[0] +
@@ -319,24 +389,81 @@ def process_sam_bam_file(sample_alignment, reference_genome,
                 ref_genome_fasta_location
             ], stderr=error_output, stdout=fh)
 
-        # Re-index this new bam file.
-        index_bam_file(final_bam_location, error_output)
-
     else:
         final_bam_location = sorted_bam_file_location
 
-    # 5. Compute callable loci
+    # 3. Create index. Callable loci needs it for random access.
+    if effective_mask['index']:
+        index_bam_file(final_bam_location, error_output)
+
+    # 4. Compute callable loci
     if effective_mask['compute_callable_loci']:
         compute_callable_loci(reference_genome, sample_alignment,
                 final_bam_location, error_output)
 
-    # 6. Create index.
-    if effective_mask['index']:
-        index_bam_file(final_bam_location, error_output)
-
     return final_bam_location
 
 
+def get_alignment_thread_count():
+    """Returns the number of threads a single alignment task should use.
+
+    Uses settings.ALIGNMENT_THREADS if set, otherwise splits the cores on this
+    machine evenly among the celery worker processes.
+    """
+    if settings.ALIGNMENT_THREADS:
+        return settings.ALIGNMENT_THREADS
+    return max(1,
+            multiprocessing.cpu_count() // get_celery_worker_concurrency())
+
+
+def _build_streaming_alignment_cmd(bwa_cmd, ref_genome_fasta, output_prefix,
+        num_threads, processing_mask=DEFAULT_PROCESSING_MASK):
+    """Returns a shell command that pipes bwa output through sort, rmdup and
+    fillmd, writing the final .bam to stdout.
+
+    Only the uncompressed stream between steps is kept in memory, so no
+    intermediate .bam files are written to disk except for temporary sort
+    chunks.
+
+    Args:
+        bwa_cmd: The bwa mem command string, writing sam to stdout.
+        ref_genome_fasta: Path to the reference fasta, needed by fillmd.
+        output_prefix: Path prefix used for samtools sort temporary files.
+        num_threads: Number of threads to give samtools sort.
+        processing_mask: See process_sam_bam_file(). The 'rmdup' and 'withmd'
+            keys determine whether those steps are part of the stream.
+            Sorting always is.
+    """
+    effective_mask = copy.copy(DEFAULT_PROCESSING_MASK)
+    effective_mask.update(processing_mask)
+
+    cmds = [
+            bwa_cmd,
+            ' '.join([
+                    settings.SAMTOOLS_BINARY,
+                    'view', '-Su', '-']),
+            ' '.join([
+                    settings.SAMTOOLS_BINARY,
+                    'sort',
+                    '-@', str(num_threads),
+                    '-o',
+                    '-',
+                    output_prefix + '.tmp'])]
+    if effective_mask['rmdup']:
+        cmds.append(' '.join([
+                settings.SAMTOOLS_BINARY,
+                'rmdup',
+                '-',
+                '-']))
+    if effective_mask['withmd']:
+        cmds.append(' '.join([
+                settings.SAMTOOLS_BINARY,
+                'fillmd', '-b',
+                '-',
+                ref_genome_fasta]))
+    return 'set -o pipefail; ' + ' | '.join(cmds)
+
+
 def read_group_string(experiment_sample):
     """
     Generate a SAM header string for the read group.
@@ -591,82 +718,77 @@ def get_insert_size_mean_and_stdev(sample_alignment, stderr=None, _iteration=0):
             return tuple([int(p) for p in parts])
 
 
+# Read class and file name of the Datasets of SV indicating reads that are
+# extracted from every sample alignment.
+SV_READ_DATASET_TYPE_TO_READ_CLASS_AND_FILENAME = {
+    Dataset.TYPE.BWA_DISCORDANT: (
+            READ_CLASS__DISCORDANT, 'bwa_discordant_pairs.bam'),
+    Dataset.TYPE.BWA_SPLIT: (READ_CLASS__SPLIT, 'bwa_split_reads.bam'),
+}
+
+
 def get_discordant_read_pairs(sample_alignment):
     """Isolate discordant pairs of reads from a sample alignment.
     """
-    # First, check if completed dataset already exists.
-    bwa_disc_dataset = get_dataset_with_type(
-            sample_alignment, Dataset.TYPE.BWA_DISCORDANT)
-    if bwa_disc_dataset is not None:
-        if (bwa_disc_dataset.status == Dataset.STATUS.READY and
-                os.path.exists(bwa_disc_dataset.get_absolute_location())):
-            return bwa_disc_dataset
-    else:
-        bwa_disc_dataset = Dataset.objects.create(
-                label=Dataset.TYPE.BWA_DISCORDANT,
-                type=Dataset.TYPE.BWA_DISCORDANT)
-        sample_alignment.dataset_set.add(bwa_disc_dataset)
-
-    # If here, we are going to run or re-run the Dataset.
-    bwa_disc_dataset.status = Dataset.STATUS.NOT_STARTED
-    bwa_disc_dataset.save(update_fields=['status'])
-
-    bam_dataset = get_dataset_with_type(sample_alignment, Dataset.TYPE.BWA_ALIGN)
-    bam_filename = bam_dataset.get_absolute_location()
+    return _get_sv_read_datasets(sample_alignment,
+            [Dataset.TYPE.BWA_DISCORDANT])[Dataset.TYPE.BWA_DISCORDANT]
 
-    assert os.path.exists(bam_filename), "BAM file '%s' is missing." % (
-            bam_filename)
 
-    # NOTE: This assumes the index just adds at .bai, w/ same path otherwise
-    # - will this always be true?
-    if not os.path.exists(bam_filename+'.bai'):
-        index_bam_file(bam_filename)
-
-    bam_discordant_filename = os.path.join(sample_alignment.get_model_data_dir(),
-            'bwa_discordant_pairs.bam')
-
-    try:
-        bwa_disc_dataset.status = Dataset.STATUS.COMPUTING
-        bwa_disc_dataset.save(update_fields=['status'])
-        extract_discordant_read_pairs(bam_filename, bam_discordant_filename)
+def get_split_reads(sample_alignment):
+    """Isolate split reads from a sample alignment, as lumpy's
+    extractSplitReads_BwaMem script does.
 
-    except subprocess.CalledProcessError:
-        bwa_disc_dataset.filesystem_location = ''
-        bwa_disc_dataset.status = Dataset.STATUS.FAILED
-    finally:
-        bwa_disc_dataset.status = Dataset.STATUS.READY
-        bwa_disc_dataset.filesystem_location = clean_filesystem_location(
-                bam_discordant_filename)
+    NOTE THAT THIS ONLY WORKS WITH BWA MEM.
+    """
+    return _get_sv_read_datasets(sample_alignment,
+            [Dataset.TYPE.BWA_SPLIT])[Dataset.TYPE.BWA_SPLIT]
 
-    bwa_disc_dataset.save()
 
-    return bwa_disc_dataset
+def get_discordant_and_split_reads(sample_alignment):
+    """Isolate discordant pairs of reads and split reads from a sample
+    alignment, in a single pass over its bam.
 
+    Returns:
+        Tuple of the BWA_DISCORDANT and BWA_SPLIT Datasets.
+    """
+    dataset_type_to_dataset = _get_sv_read_datasets(sample_alignment,
+            [Dataset.TYPE.BWA_DISCORDANT, Dataset.TYPE.BWA_SPLIT])
+    return (dataset_type_to_dataset[Dataset.TYPE.BWA_DISCORDANT],
+            dataset_type_to_dataset[Dataset.TYPE.BWA_SPLIT])
 
-def get_split_reads(sample_alignment):
-    """Isolate split reads from a sample alignment.
 
-    This uses a python script supplied with Lumpy that is run as a
-    separate process.
+def _get_sv_read_datasets(sample_alignment, dataset_types):
+    """Returns a dictionary from each of dataset_types, keys of
+    SV_READ_DATASET_TYPE_TO_READ_CLASS_AND_FILENAME, to its Dataset for the
+    sample alignment.
 
-    NOTE THAT THIS SCRIPT ONLY WORKS WITH BWA MEM.
+    Datasets that aren't READY are computed together, in a single pass over
+    the alignment bam.
     """
-    bwa_split_dataset = get_dataset_with_type(
-            sample_alignment, Dataset.TYPE.BWA_SPLIT)
-    if bwa_split_dataset is not None:
-        if (bwa_split_dataset.status == Dataset.STATUS.READY and
-                os.path.exists(bwa_split_dataset.get_absolute_location())):
-            return bwa_split_dataset
-    else:
-        bwa_split_dataset = Dataset.objects.create(
-                label=Dataset.TYPE.BWA_SPLIT,
-                type=Dataset.TYPE.BWA_SPLIT,
-                status=Dataset.STATUS.NOT_STARTED)
-        sample_alignment.dataset_set.add(bwa_split_dataset)
+    dataset_type_to_dataset = {}
+    datasets_to_compute = []
+    for dataset_type in dataset_types:
+        # First, check if completed dataset already exists.
+        dataset = get_dataset_with_type(sample_alignment, dataset_type)
+        if dataset is not None:
+            if (dataset.status == Dataset.STATUS.READY and
+                    os.path.exists(dataset.get_absolute_location())):
+                dataset_type_to_dataset[dataset_type] = dataset
+                continue
+        else:
+            dataset = Dataset.objects.create(
+                    label=dataset_type,
+                    type=dataset_type)
+            sample_alignment.dataset_set.add(dataset)
+
+        # If here, we are going to run or re-run the Dataset.
+        dataset.status = Dataset.STATUS.NOT_STARTED
+        dataset.save(update_fields=['status'])
+        dataset_type_to_dataset[dataset_type] = dataset
+        datasets_to_compute.append(dataset)
 
-    # If here, we are going to run or re-run the Dataset.
-    bwa_split_dataset.status = Dataset.STATUS.NOT_STARTED
-    bwa_split_dataset.save(update_fields=['status'])
+    if not datasets_to_compute:
+        return dataset_type_to_dataset
 
     bam_dataset = get_dataset_with_type(sample_alignment, Dataset.TYPE.BWA_ALIGN)
     bam_filename = bam_dataset.get_absolute_location()
@@ -674,27 +796,41 @@ def get_split_reads(sample_alignment):
     assert os.path.exists(bam_filename), "BAM file '%s' is missing." % (
             bam_filename)
 
-    bam_split_filename = os.path.join(sample_alignment.get_model_data_dir(),
-            'bwa_split_reads.bam')
+    # NOTE: This assumes the index just adds at .bai, w/ same path otherwise
+    # - will this always be true?
+    if not os.path.exists(bam_filename+'.bai'):
+        index_bam_file(bam_filename)
 
+    dataset_to_filename = {}
+    read_class_to_output_path = {}
+    for dataset in datasets_to_compute:
+        read_class, filename = SV_READ_DATASET_TYPE_TO_READ_CLASS_AND_FILENAME[
+                dataset.type]
+        output_path = os.path.join(sample_alignment.get_model_data_dir(),
+                filename)
+        dataset_to_filename[dataset] = output_path
+        read_class_to_output_path[read_class] = output_path
+        dataset.status = Dataset.STATUS.COMPUTING
+        dataset.save(update_fields=['status'])
+
+    # If there are no reads of a class, its bam is empty, but still valid
+    # input for lumpy. Anything else that goes wrong fails the Datasets.
     try:
-        bwa_split_dataset.status = Dataset.STATUS.COMPUTING
-        bwa_split_dataset.save(update_fields=['status'])
-        extract_split_reads(bam_filename, bam_split_filename)
-
-    except subprocess.CalledProcessError:
-        # if there are no split reads, then fail.
-        bwa_split_dataset.filesystem_location = ''
-        bwa_split_dataset.status = Dataset.STATUS.FAILED
-    finally:
-        bwa_split_dataset.status = Dataset.STATUS.READY
-        bwa_split_dataset.filesystem_location = clean_filesystem_location(
-                bam_split_filename)
-
-
-    bwa_split_dataset.save()
-
-    return bwa_split_dataset
+        classify_sv_reads(bam_filename, read_class_to_output_path)
+    except:
+        for dataset in datasets_to_compute:
+            dataset.filesystem_location = ''
+            dataset.status = Dataset.STATUS.FAILED
+            dataset.save()
+        raise
+
+    for dataset in datasets_to_compute:
+        dataset.status = Dataset.STATUS.READY
+        dataset.filesystem_location = clean_filesystem_location(
+                dataset_to_filename[dataset])
+        dataset.save()
+
+    return dataset_type_to_dataset
 
 ##############################################################################
 # Clean-ups
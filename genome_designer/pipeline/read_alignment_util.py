@@ -12,10 +12,16 @@ This module was created because of a circular import issue with celery.
 ImportError: cannot import name ensure_bwa_index
 """
 
+import errno
+import hashlib
 import os
+import shutil
 import subprocess
+import tempfile
 
-from utils.bam_utils import filter_bam_file_by_row
+from utils.sv_read_util import classify_sv_reads
+from utils.sv_read_util import READ_CLASS__DISCORDANT
+from utils.sv_read_util import READ_CLASS__SPLIT
 
 from django.conf import settings
 
@@ -23,6 +29,20 @@ SAMTOOLS_BINARY = settings.SAMTOOLS_BINARY
 TOOLS_DIR = settings.TOOLS_DIR
 
 
+# Files that make up a bwa index, by extension appended to the index prefix.
+BWA_INDEX_EXTENSIONS = ('.amb', '.ann', '.bwt', '.pac', '.sa')
+
+# Extension appended to the fasta of the file recording the hash, size and
+# mtime of the fasta that its bwa index was built from.
+BWA_INDEX_HASH_EXTENSION = '.bwt.sha1'
+
+# Number of bytes read at a time when hashing a fasta.
+FASTA_HASH_CHUNK_SIZE = 1 << 20
+
+# Prefix of the temp dirs in the bwa index cache that indexes are built in.
+BWA_INDEX_CACHE_BUILD_PREFIX = '.building_'
+
+
 def has_bwa_index(ref_genome_fasta):
     return os.path.exists(ref_genome_fasta + '.bwt')
 
@@ -32,13 +52,53 @@ def ensure_bwa_index(ref_genome_fasta, error_output=None):
     already.
 
     We rely on the convention that the index file location is the fasta
-    location with the extension '.bwt' appended to it.
+    location with the extension '.bwt' appended to it. The hash, size and
+    mtime of the fasta the index was built from are recorded next to it. The
+    fasta is only hashed again when its size or mtime change, and the index is
+    rebuilt when its contents change.
+
+    If settings.BWA_INDEX_CACHE_DIR is set, indexes are built there, keyed by
+    the hash of the fasta, and linked next to the fasta. Fastas with the same
+    sequence, e.g. a contig aligned to repeatedly during genome finishing, are
+    then only indexed once.
     """
-    if not has_bwa_index(ref_genome_fasta):
-        build_bwa_index(ref_genome_fasta, error_output)
+    fasta_stat = os.stat(ref_genome_fasta)
+    recorded = _read_bwa_index_hash(ref_genome_fasta)
+
+    if recorded is None:
+        # Indexes from before hashes were recorded are trusted as long as
+        # they are newer than the fasta, as they were before.
+        is_index_current = (has_bwa_index(ref_genome_fasta) and
+                os.stat(ref_genome_fasta + '.bwt').st_mtime >=
+                        fasta_stat.st_mtime)
+        fasta_hash = _hash_file(ref_genome_fasta)
+    elif (recorded[1], recorded[2]) == _stat_key(fasta_stat):
+        is_index_current = has_bwa_index(ref_genome_fasta)
+        fasta_hash = recorded[0]
+    else:
+        fasta_hash = _hash_file(ref_genome_fasta)
+        is_index_current = (has_bwa_index(ref_genome_fasta) and
+                recorded[0] == fasta_hash)
+
+    if not is_index_current:
+        if settings.BWA_INDEX_CACHE_DIR:
+            index_prefix = get_or_build_cached_bwa_index(ref_genome_fasta,
+                    error_output, fasta_hash=fasta_hash)
+            try:
+                _link_bwa_index(index_prefix, ref_genome_fasta)
+            except OSError as e:
+                # The entry was evicted by another task in the meantime.
+                if e.errno != errno.ENOENT:
+                    raise
+                build_bwa_index(ref_genome_fasta, error_output)
+        else:
+            build_bwa_index(ref_genome_fasta, error_output)
+
+    if recorded is None or recorded != (fasta_hash,) + _stat_key(fasta_stat):
+        _write_bwa_index_hash(ref_genome_fasta, fasta_hash, fasta_stat)
 
     # Also build the fasta index.
-    if not os.path.exists(ref_genome_fasta + '.fai'):
+    if not is_index_current or not os.path.exists(ref_genome_fasta + '.fai'):
         subprocess.check_call([
             SAMTOOLS_BINARY,
             'faidx',
@@ -46,19 +106,165 @@ def ensure_bwa_index(ref_genome_fasta, error_output=None):
         ], stderr=error_output)
 
 
-def build_bwa_index(ref_genome_fasta, error_output=None):
+def _stat_key(fasta_stat):
+    return (str(fasta_stat.st_size), repr(fasta_stat.st_mtime))
+
+
+def _read_bwa_index_hash(ref_genome_fasta):
+    """Returns the (hash, size, mtime) recorded for the fasta's index, as
+    strings, or None if there is no record.
+
+    Records with only a hash, as written before sizes and mtimes were
+    recorded, have empty size and mtime, so the fasta is hashed again.
+    """
+    hash_file = ref_genome_fasta + BWA_INDEX_HASH_EXTENSION
+    if not os.path.exists(hash_file):
+        return None
+    with open(hash_file) as fh:
+        fields = fh.read().split()
+    if not fields:
+        return None
+    return tuple((fields + ['', ''])[:3])
+
+
+def _write_bwa_index_hash(ref_genome_fasta, fasta_hash, fasta_stat):
+    with open(ref_genome_fasta + BWA_INDEX_HASH_EXTENSION, 'w') as fh:
+        fh.write(' '.join((fasta_hash,) + _stat_key(fasta_stat)) + '\n')
+
+
+def get_or_build_cached_bwa_index(ref_genome_fasta, error_output=None,
+        fasta_hash=None):
+    """Returns the prefix of the cached bwa index for the fasta's contents,
+    building it first if there is none.
+
+    Once a new entry is added, the least recently used entries are evicted
+    until the cache is within settings.BWA_INDEX_CACHE_MAX_BYTES. Indexes
+    linked next to fastas are unaffected.
+    """
+    if fasta_hash is None:
+        fasta_hash = _hash_file(ref_genome_fasta)
+    cache_dir = settings.BWA_INDEX_CACHE_DIR
+    cache_entry_dir = os.path.join(cache_dir, fasta_hash)
+    index_prefix = os.path.join(cache_entry_dir, 'index')
+    if os.path.exists(cache_entry_dir):
+        # Mark the entry as recently used.
+        try:
+            os.utime(cache_entry_dir, None)
+            return index_prefix
+        except OSError as e:
+            # Evicted concurrently.
+            if e.errno != errno.ENOENT:
+                raise
+
+    if not os.path.exists(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # Created concurrently.
+            if not os.path.isdir(cache_dir):
+                raise
+
+    # Build in a temp dir and move it into place, so that concurrent tasks
+    # never see a partial index.
+    temp_dir = tempfile.mkdtemp(prefix=BWA_INDEX_CACHE_BUILD_PREFIX,
+            dir=cache_dir)
+    try:
+        build_bwa_index(ref_genome_fasta, error_output,
+                index_prefix=os.path.join(temp_dir, 'index'))
+        try:
+            os.rename(temp_dir, cache_entry_dir)
+        except OSError:
+            # Another task built the same index first.
+            if not os.path.isdir(cache_entry_dir):
+                raise
+    finally:
+        if os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir)
+
+    _evict_bwa_index_cache_entries(keep=fasta_hash)
+    return index_prefix
+
+
+def _evict_bwa_index_cache_entries(keep):
+    """Removes the least recently used entries of the bwa index cache until
+    it fits in settings.BWA_INDEX_CACHE_MAX_BYTES, sparing the entry named
+    keep.
+    """
+    cache_dir = settings.BWA_INDEX_CACHE_DIR
+    entries = []
+    total_bytes = 0
+    for name in os.listdir(cache_dir):
+        if name.startswith(BWA_INDEX_CACHE_BUILD_PREFIX):
+            continue
+        entry_dir = os.path.join(cache_dir, name)
+        try:
+            entry_bytes = sum(os.path.getsize(os.path.join(entry_dir, f))
+                    for f in os.listdir(entry_dir))
+            last_used = os.path.getmtime(entry_dir)
+        except OSError:
+            # Evicted concurrently.
+            continue
+        total_bytes += entry_bytes
+        if name != keep:
+            entries.append((last_used, entry_bytes, entry_dir))
+
+    for last_used, entry_bytes, entry_dir in sorted(entries):
+        if total_bytes <= settings.BWA_INDEX_CACHE_MAX_BYTES:
+            break
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total_bytes -= entry_bytes
+
+
+def _link_bwa_index(index_prefix, ref_genome_fasta):
+    """Hard links the index files next to the fasta, where bwa expects them,
+    copying them if the cache is on a different filesystem.
+    """
+    for ext in BWA_INDEX_EXTENSIONS:
+        index_file = ref_genome_fasta + ext
+        if os.path.lexists(index_file):
+            os.remove(index_file)
+        try:
+            os.link(index_prefix + ext, index_file)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.copyfile(index_prefix + ext, index_file)
+
+
+def _hash_file(path):
+    file_hash = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(FASTA_HASH_CHUNK_SIZE), ''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def build_bwa_index(ref_genome_fasta, error_output=None, index_prefix=None):
     """Calls the command that builds the bwa index required for alignment.
 
     This creates a file in the same directory as ref_genome_fasta, appending
-    the extension '.bwt' to the name of the fasta.
+    the extension '.bwt' to the name of the fasta, unless index_prefix is
+    given.
     """
-    subprocess.check_call([
+    if index_prefix is None:
+        index_prefix = ref_genome_fasta
+
+    # Existing index files may be hard links into the cache, which bwa would
+    # write through to if they were left in place.
+    for ext in BWA_INDEX_EXTENSIONS:
+        if os.path.lexists(index_prefix + ext):
+            os.remove(index_prefix + ext)
+
+    cmd = [
         '%s/bwa/bwa' % TOOLS_DIR,
         'index',
         '-a',
         'is',
+        '-p',
+        index_prefix,
         ref_genome_fasta
-    ], stderr=error_output)
+    ]
+    subprocess.check_call(cmd, stderr=error_output)
 
 
 def index_bam_file(bam_file, error_output=None):
@@ -70,82 +276,26 @@ def index_bam_file(bam_file, error_output=None):
 
 def extract_split_reads(bam_filename, bam_split_filename):
     """
-    Isolate split reads from a bam file.
-    This uses a python script supplied with Lumpy that is run as a
-    separate process.
+    Isolate split reads from a bam file, as lumpy's extractSplitReads_BwaMem
+    script does. Only split reads whose mate is on the same chromosome are
+    kept.
 
     This is an internal function that works directly with files, and
     is called separately by both SV calling and read ref alignment.
 
-    NOTE THAT THIS SCRIPT ONLY WORKS WITH BWA MEM.
+    NOTE THAT THIS ONLY WORKS WITH BWA MEM.
     """
     assert os.path.exists(bam_filename), "BAM file '%s' is missing." % (
             bam_filename)
 
-    # Use lumpy bwa-mem split read script to pull out split reads.
-    filter_split_reads = ' | '.join([
-            '{samtools} view -h {bam_filename}',
-            'python {lumpy_bwa_mem_sr_script} -i stdin',
-            '{samtools} view -Sb -']).format(
-                    samtools=settings.SAMTOOLS_BINARY,
-                    bam_filename=bam_filename,
-                    lumpy_bwa_mem_sr_script=
-                            settings.LUMPY_EXTRACT_SPLIT_READS_BWA_MEM)
-
-    with open(bam_split_filename, 'w') as fh:
-        subprocess.check_call(filter_split_reads,
-                stdout=fh,
-                shell=True,
-                executable=settings.BASH_PATH)
-
-    # sort the split reads, overwrite the old file
-    subprocess.check_call([settings.SAMTOOLS_BINARY, 'sort',
-            bam_split_filename,
-            os.path.splitext(bam_split_filename)[0]])
-
-    _filter_out_interchromosome_reads(bam_split_filename)
+    classify_sv_reads(bam_filename, {READ_CLASS__SPLIT: bam_split_filename})
+
 
 def extract_discordant_read_pairs(bam_filename, bam_discordant_filename):
     """Isolate discordant pairs of reads from a sample alignment.
-    """
-    # Use bam read alignment flags to pull out discordant pairs only
-    filter_discordant = ' | '.join([
-            '{samtools} view -u -F 0x0002 {bam_filename} ',
-            '{samtools} view -u -F 0x0100 - ',
-            '{samtools} view -u -F 0x0004 - ',
-            '{samtools} view -u -F 0x0008 - ',
-            '{samtools} view -b -F 0x0400 - ']).format(
-                    samtools=settings.SAMTOOLS_BINARY,
-                    bam_filename=bam_filename)
-
-    with open(bam_discordant_filename, 'w') as fh:
-        subprocess.check_call(filter_discordant,
-                stdout=fh, shell=True, executable=settings.BASH_PATH)
-
-    # sort the discordant reads, overwrite the old file
-    subprocess.check_call([settings.SAMTOOLS_BINARY, 'sort', 
-            bam_discordant_filename,
-            os.path.splitext(bam_discordant_filename)[0]])
-
-    _filter_out_interchromosome_reads(bam_discordant_filename)
-
-
-def _filter_out_interchromosome_reads(bam_filename, overwrite_input=True):
-    """Filters out read pairs which lie on different chromosomes.
-
-    Args:
-        bam_filename: Path to bam file.
-        overwrite_input: If True, overwrite the input file.
-    """
-    def is_rnext_same(line):
-        parts = line.split('\t')
-        rnext_col = parts[6]
-        return rnext_col == '='
-
-    if overwrite_input:
-        output_bam_path = bam_filename
-    else:
-        output_bam_path = os.path.splitext(bam_filename)[0] + '.nointerchrom.bam'
-
-    filter_bam_file_by_row(bam_filename, is_rnext_same, output_bam_path)
 
+    Keeps mapped, non-duplicate primary alignments of pairs that aren't
+    properly paired and whose mates are mapped to the same chromosome.
+    """
+    classify_sv_reads(bam_filename,
+            {READ_CLASS__DISCORDANT: bam_discordant_filename})
@@ -0,0 +1,63 @@
+"""
+Tests for callable_loci.py.
+"""
+
+from django.test import TestCase
+import numpy as np
+
+from pipeline.callable_loci import compute_callable_loci_features
+from pipeline.callable_loci import MERGE_DIST
+from pipeline.callable_loci import STATE_TO_BED_FLAG
+from utils.coverage_util import COVERAGE_FIELD__ALTALIGN_DEPTH
+from utils.coverage_util import COVERAGE_FIELD__DEPTH
+from utils.coverage_util import COVERAGE_FIELD__LOW_MAPQ_DEPTH
+
+
+class TestComputeCallableLociFeatures(TestCase):
+
+    def _features(self, depths, low_mapq_depths, altalign_depths, start=0,
+            end=None):
+        coverage = {
+            COVERAGE_FIELD__DEPTH: np.array(depths),
+            COVERAGE_FIELD__LOW_MAPQ_DEPTH: np.array(low_mapq_depths),
+            COVERAGE_FIELD__ALTALIGN_DEPTH: np.array(altalign_depths),
+        }
+        if end is None:
+            end = len(depths)
+        return [(int(s), int(e), STATE_TO_BED_FLAG[state])
+                for s, e, state in zip(
+                        *compute_callable_loci_features(coverage, start, end))]
+
+    def test_states(self):
+        depths = [0] * 10 + [2] * 10 + [20] * 10 + [20] * 10 + [20] * 10
+        low_mapq_depths = [0] * 30 + [15] * 10 + [0] * 10
+        altalign_depths = [0] * 40 + [15] * 10
+        self.assertEqual([
+                (0, 10, 'NO_COVERAGE'),
+                (10, 20, 'LOW_COVERAGE'),
+                (30, 40, 'POOR_MAP_QUALITY'),
+                (40, 50, 'NONUNIQUE_ALIGNMENTS')],
+                self._features(depths, low_mapq_depths, altalign_depths))
+
+    def test_intermediate_depth_continues_run(self):
+        # Depth 6 is enough to not be LOW_COVERAGE but too low to judge
+        # mapping quality, so it continues the run before it.
+        depths = [20] * 5 + [6] * 5 + [20] * 5
+        low_mapq_depths = [20] * 5 + [0] * 10
+        self.assertEqual([(0, 10, 'POOR_MAP_QUALITY')],
+                self._features(depths, low_mapq_depths, [0] * 15))
+
+    def test_merge(self):
+        gap = MERGE_DIST - 1
+        depths = [0] * 5 + [20] * gap + [0] * 5 + [20] * (MERGE_DIST + 5) + [0]
+        zeros = [0] * len(depths)
+        self.assertEqual([
+                (0, 10 + gap, 'NO_COVERAGE'),
+                (len(depths) - 1, len(depths), 'NO_COVERAGE')],
+                self._features(depths, zeros, zeros))
+
+    def test_region(self):
+        depths = [0] * 10 + [20] * 10
+        zeros = [0] * 20
+        self.assertEqual([(5, 10, 'NO_COVERAGE')],
+                self._features(depths, zeros, zeros, start=5, end=15))
@@ -11,10 +11,12 @@ from django.test import TransactionTestCase
 from main.models import AlignmentGroup
 from main.models import Dataset
 from main.models import ExperimentSample
+from main.models import ExperimentSampleToAlignment
 from main.models import Project
 from main.models import Variant
 from main.testing_util import FullVCFTestSet
 from pipeline.pipeline_runner import run_pipeline
+from pipeline.pipeline_runner import start_variant_calling_pipeline_task
 from utils.import_util import copy_and_add_dataset_source
 from utils.import_util import import_reference_genome_from_local_file
 
@@ -279,3 +281,18 @@ class TestAlignmentPipeline(TransactionTestCase):
         # for a failed alignment to the user.
         with self.assertRaises(Exception):
             run_pipeline('name_placeholder', ref_genome, sample_list)
+
+    def test_start_variant_calling__missing_alignment_dataset(self):
+        """A sample alignment without a BWA_ALIGN Dataset fails the group
+        rather than passing vacuously.
+        """
+        alignment_group = AlignmentGroup.objects.create(
+                label='test alignment', reference_genome=self.reference_genome)
+        ExperimentSampleToAlignment.objects.create(
+                alignment_group=alignment_group,
+                experiment_sample=self.experiment_sample)
+
+        with self.assertRaises(Exception):
+            start_variant_calling_pipeline_task(alignment_group)
+        self.assertEqual(AlignmentGroup.STATUS.FAILED,
+                AlignmentGroup.objects.get(id=alignment_group.id).status)
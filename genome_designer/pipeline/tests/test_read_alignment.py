@@ -9,6 +9,7 @@ import subprocess
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.test import TestCase
+from django.test.utils import override_settings
 
 from main.models import AlignmentGroup
 from main.models import Dataset
@@ -18,8 +19,10 @@ from main.models import ExperimentSampleToAlignment
 from main.models import Project
 from main.model_utils import clean_filesystem_location
 from main.testing_util import create_sample_and_alignment
+from pipeline.read_alignment import _build_streaming_alignment_cmd
 from pipeline.read_alignment import align_with_bwa_mem
 from pipeline.read_alignment import compute_callable_loci
+from pipeline.read_alignment import get_discordant_and_split_reads
 from pipeline.read_alignment import get_discordant_read_pairs
 from pipeline.read_alignment import get_split_reads
 from pipeline.read_alignment import get_read_length
@@ -132,6 +135,13 @@ class TestAlignmentPipeline(TestCase):
         self.assertTrue(os.path.exists(bwa_align_dataset_path,), (
                 "No file at location %s" % bwa_align_dataset_path))
 
+        # Insert metrics come from the sorted bam, before fillmd.
+        insert_metrics_dataset = get_dataset_with_type(
+                experiment_sample_alignment,
+                Dataset.TYPE.LUMPY_INSERT_METRICS_MEAN_STDEV)
+        self.assertEqual('bwa_align.sorted.insert_size_mean_stdev.txt',
+                os.path.basename(insert_metrics_dataset.filesystem_location))
+
         # compile the tracklist
         compile_tracklist_json(self.reference_genome)
 
@@ -159,6 +169,46 @@ class TestAlignmentPipeline(TestCase):
                     break
             self.assertTrue(found_bam_track)
 
+    @override_settings(ALIGNMENT_STREAMING=False, ALIGNMENT_THREADS=2)
+    def test_bwa_align_mem__not_streaming(self):
+        """Test a single BWA alignment that writes intermediate bams.
+        """
+        alignment_group = AlignmentGroup.objects.create(
+                label='test alignment', reference_genome=self.reference_genome)
+
+        sample_alignment = ExperimentSampleToAlignment.objects.create(
+                alignment_group=alignment_group,
+                experiment_sample=self.experiment_sample)
+        bwa_dataset = Dataset.objects.create(
+                    label=Dataset.TYPE.BWA_ALIGN,
+                    type=Dataset.TYPE.BWA_ALIGN,
+                    status=Dataset.STATUS.NOT_STARTED)
+        sample_alignment.dataset_set.add(bwa_dataset)
+        sample_alignment.save()
+
+        experiment_sample_alignment = align_with_bwa_mem(
+                alignment_group, sample_alignment, project=self.project)
+
+        bwa_align_dataset = get_dataset_with_type(
+                experiment_sample_alignment, Dataset.TYPE.BWA_ALIGN)
+        self.assertEqual(Dataset.STATUS.READY, bwa_align_dataset.status)
+
+        bwa_align_dataset_path = bwa_align_dataset.get_absolute_location()
+        self.assertTrue(os.path.exists(bwa_align_dataset_path,), (
+                "No file at location %s" % bwa_align_dataset_path))
+        self.assertTrue(os.path.exists(bwa_align_dataset_path + '.bai'))
+
+    def test_streaming_alignment_cmd__processing_mask(self):
+        cmd = _build_streaming_alignment_cmd('bwa mem', 'ref.fa', 'out', 1)
+        self.assertTrue(' rmdup ' in cmd)
+        self.assertTrue(' fillmd ' in cmd)
+
+        cmd = _build_streaming_alignment_cmd('bwa mem', 'ref.fa', 'out', 1,
+                {'rmdup': False, 'withmd': False})
+        self.assertTrue(' sort ' in cmd)
+        self.assertFalse(' rmdup ' in cmd)
+        self.assertFalse(' fillmd ' in cmd)
+
     def test_compressed_bwa_align(self):
         """Test a single BWA alignment.
         """
@@ -302,6 +352,36 @@ class TestAlignmentPieces(TestCase):
                 stdout=subprocess.PIPE)
         self.assertEqual(134, sum([1 for line in p.stdout]))
 
+    def test_get_discordant_read_pairs__bad_bam(self):
+        with open(self.bwa_dataset.get_absolute_location(), 'w') as fh:
+            fh.write('not a bam')
+
+        with self.assertRaises((IOError, ValueError)):
+            get_discordant_read_pairs(self.sample_alignment)
+
+        bwa_disc_dataset = get_dataset_with_type(
+                self.sample_alignment, Dataset.TYPE.BWA_DISCORDANT)
+        self.assertEqual(Dataset.STATUS.FAILED, bwa_disc_dataset.status)
+        self.assertEqual('', bwa_disc_dataset.filesystem_location)
+
+    def test_get_discordant_and_split_reads(self):
+        bwa_disc_dataset, bwa_sr_dataset = get_discordant_and_split_reads(
+                self.sample_alignment)
+
+        for dataset, num_reads in ((bwa_disc_dataset, 134),
+                (bwa_sr_dataset, 3)):
+            self.assertEqual(Dataset.STATUS.READY, dataset.status)
+            p = subprocess.Popen(
+                    [SAMTOOLS_BINARY, 'view', dataset.get_absolute_location()],
+                    stdout=subprocess.PIPE)
+            self.assertEqual(num_reads, sum([1 for line in p.stdout]))
+
+        # Datasets that are READY are reused.
+        self.assertEqual(bwa_disc_dataset.id,
+                get_discordant_read_pairs(self.sample_alignment).id)
+        self.assertEqual(bwa_sr_dataset.id,
+                get_split_reads(self.sample_alignment).id)
+
     def test_callable_loci(self):
         callable_loci_bed_fn = compute_callable_loci(
                 self.reference_genome,
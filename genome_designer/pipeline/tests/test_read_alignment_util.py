@@ -0,0 +1,92 @@
+"""
+Tests for read_alignment_util.py.
+"""
+
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from pipeline.read_alignment_util import ensure_bwa_index
+from pipeline.read_alignment_util import has_bwa_index
+
+
+TEST_FASTA = os.path.join(settings.PWD, 'test_data', 'fake_genome_and_reads',
+        'test_genome.fa')
+
+
+class TestEnsureBwaIndex(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.temp_dir, 'bwa_index_cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _copy_fasta(self, name):
+        fasta = os.path.join(self.temp_dir, name)
+        shutil.copyfile(TEST_FASTA, fasta)
+        return fasta
+
+    def test_cached_index_is_shared(self):
+        fasta_1 = self._copy_fasta('genome_1.fa')
+        fasta_2 = self._copy_fasta('genome_2.fa')
+        with override_settings(BWA_INDEX_CACHE_DIR=self.cache_dir):
+            ensure_bwa_index(fasta_1)
+            ensure_bwa_index(fasta_2)
+
+        self.assertTrue(has_bwa_index(fasta_1))
+        self.assertTrue(os.path.exists(fasta_1 + '.fai'))
+        self.assertEqual(1, len(os.listdir(self.cache_dir)))
+        self.assertEqual(os.stat(fasta_1 + '.bwt').st_ino,
+                os.stat(fasta_2 + '.bwt').st_ino)
+
+    def test_changed_fasta_is_reindexed(self):
+        fasta = self._copy_fasta('genome.fa')
+        with override_settings(BWA_INDEX_CACHE_DIR=self.cache_dir):
+            ensure_bwa_index(fasta)
+            original_bwt_ino = os.stat(fasta + '.bwt').st_ino
+
+            # Rewriting the same contents doesn't invalidate the index.
+            shutil.copyfile(TEST_FASTA, fasta)
+            ensure_bwa_index(fasta)
+            self.assertEqual(original_bwt_ino, os.stat(fasta + '.bwt').st_ino)
+
+            with open(fasta, 'a') as fh:
+                fh.write('>extra\nACGTACGTACGTACGTACGT\n')
+            ensure_bwa_index(fasta)
+
+        self.assertEqual(2, len(os.listdir(self.cache_dir)))
+        self.assertNotEqual(original_bwt_ino, os.stat(fasta + '.bwt').st_ino)
+
+    def test_index_without_recorded_hash_is_kept(self):
+        fasta = self._copy_fasta('genome.fa')
+        with override_settings(BWA_INDEX_CACHE_DIR=None):
+            ensure_bwa_index(fasta)
+            original_bwt_ino = os.stat(fasta + '.bwt').st_ino
+
+            # Indexes from before hashes were recorded aren't rebuilt.
+            os.remove(fasta + '.bwt.sha1')
+            ensure_bwa_index(fasta)
+
+        self.assertEqual(original_bwt_ino, os.stat(fasta + '.bwt').st_ino)
+        self.assertTrue(os.path.exists(fasta + '.bwt.sha1'))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        fasta_1 = self._copy_fasta('genome_1.fa')
+        fasta_2 = self._copy_fasta('genome_2.fa')
+        with open(fasta_2, 'a') as fh:
+            fh.write('>extra\nACGTACGTACGTACGTACGT\n')
+        with override_settings(BWA_INDEX_CACHE_DIR=self.cache_dir,
+                BWA_INDEX_CACHE_MAX_BYTES=0):
+            ensure_bwa_index(fasta_1)
+            ensure_bwa_index(fasta_2)
+
+        # Only the newest entry is kept, but both fastas keep their index.
+        self.assertEqual(1, len(os.listdir(self.cache_dir)))
+        self.assertTrue(has_bwa_index(fasta_1))
+        self.assertTrue(has_bwa_index(fasta_2))
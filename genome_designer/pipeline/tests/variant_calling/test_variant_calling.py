@@ -18,8 +18,11 @@ from main.models import User
 from main.models import Variant
 from pipeline.variant_calling import find_variants_with_tool
 from pipeline.variant_calling import VARIANT_TOOL_PARAMS_MAP
+from pipeline.variant_calling.freebayes import freebayes_region_shards
 from pipeline.variant_calling.freebayes import freebayes_regions
 from pipeline.variant_calling.freebayes import merge_freebayes_parallel
+from pipeline.variant_calling.freebayes import read_freebayes_shard
+from pipeline.variant_calling.freebayes import write_freebayes_shards
 from utils.import_util import add_dataset_to_entity
 from utils.import_util import copy_and_add_dataset_source
 from utils.import_util import copy_dataset_to_entity_data_dir
@@ -135,6 +138,37 @@ class TestSNPCallers(TestCase):
         regions = freebayes_regions(self.reference_genome, region_size=100)
         self.assertEqual(len(regions), 20)
 
+    def test_freebayes_region_shards(self):
+        shards = freebayes_region_shards(self.REFERENCE_GENOME,
+                [self.FAKE_READS_BAM], 3)
+        self.assertEqual(3, len(shards))
+
+        # Shards are contiguous and together cover the whole genome.
+        chromosome = self.REFERENCE_GENOME.chromosome_set.get()
+        intervals = [interval for shard in shards for interval in shard]
+        self.assertEqual(3, len(intervals))
+        self.assertEqual(0, intervals[0][1])
+        for prev_interval, interval in zip(intervals, intervals[1:]):
+            self.assertEqual(prev_interval[2], interval[1])
+        self.assertEqual(chromosome.num_bases, intervals[-1][2])
+
+    def test_write_freebayes_shards(self):
+        """Shards are computed once and each task reads its own.
+        """
+        self._create_alignment()
+        bam_file = get_dataset_with_type(
+                self.alignment_group.experimentsampletoalignment_set.get(),
+                Dataset.TYPE.BWA_ALIGN).get_absolute_location()
+        shards = freebayes_region_shards(self.REFERENCE_GENOME, [bam_file], 3)
+
+        write_freebayes_shards(self.alignment_group, 3, project=self.project)
+        for region_num, shard in enumerate(shards):
+            self.assertEqual(shard,
+                    read_freebayes_shard(self.alignment_group, region_num, 3))
+
+        with self.assertRaises(AssertionError):
+            read_freebayes_shard(self.alignment_group, 0, 4)
+
     def test_call_snvs(self):
         """Test running the pipeline that calls SNPS.
 
@@ -9,6 +9,7 @@ from celery import task
 from main.models import AlignmentGroup
 from main.models import Dataset
 from main.models import ensure_exists_0775_dir
+from main.s3 import ensure_local_file
 from main.s3 import project_files_needed
 from pipeline.variant_effects import run_snpeff
 from pipeline.variant_calling.common import add_vcf_dataset
@@ -75,6 +76,11 @@ def find_variants_with_tool(alignment_group, variant_params_dict):
     Returns:
         Boolean indicating whether we made it through this entire function.
     """
+    # Fetch the reference genome and alignments, in case the project is being
+    # lazily synced from S3.
+    ensure_local_file(alignment_group.reference_genome.get_model_data_dir())
+    ensure_local_file(alignment_group.get_model_data_dir())
+
     # TODO: More informative failure information.
     try:
         common_params = get_common_tool_params(alignment_group)
@@ -5,6 +5,8 @@ import collections
 import errno
 import fileinput
 import glob
+import json
+import math
 import tempfile
 import os
 import shutil
@@ -13,29 +15,215 @@ import vcf
 
 from django.conf import settings
 
+from main.celery_util import get_celery_worker_concurrency
 from main.models import Dataset
 from main.model_utils import get_dataset_with_type
+from main.s3 import ensure_local_file
+from main.s3 import project_files_needed
 from pipeline.read_alignment_util import ensure_bwa_index
 from pipeline.variant_calling.common import add_vcf_dataset
+from pipeline.variant_calling.common import get_or_create_vcf_output_dir
 from pipeline.variant_calling.common import process_vcf_dataset
 from pipeline.variant_calling.common import get_common_tool_params
 from pipeline.variant_calling.constants import TOOL_FREEBAYES
 
 from pipeline.variant_effects import run_snpeff
 from utils import uppercase_underscore
+from utils.bam_utils import BAM_INDEX_LINEAR_WINDOW_SIZE
+from utils.bam_utils import estimate_read_depth_from_bam_index
 
 
 VCF_AF_HEADER = '##FORMAT=<ID=AF,Number=1,Type=Float,Description="Alternate allele observation frequency, AO/(RO+AO)">'
 
 
-def freebayes_regions(ref_genome,
-        region_size=settings.FREEBAYES_REGION_SIZE):
+def freebayes_regions(ref_genome, region_size=None):
     """
     Use bamtools (installed as part of freebayes) to intelligently
     generate regions that will be run in freebayes in parallel.
 
     ref_genome: the reference genome object
-    region_size: how many bases each parallelized region 'chunk' will be
+    region_size: how many bases each parallelized region 'chunk' will be.
+        Defaults to settings.FREEBAYES_REGION_SIZE, grown if necessary so that
+        there are no more regions than Celery workers when
+        settings.FREEBAYES_LIMIT_REGIONS_TO_CONCURRENCY is set.
+    """
+    chromosome_lengths = _get_chromosome_lengths(ref_genome)
+
+    if region_size is None:
+        region_size = settings.FREEBAYES_REGION_SIZE
+        if settings.FREEBAYES_LIMIT_REGIONS_TO_CONCURRENCY:
+            genome_size = sum(chr_len for _, chr_len in chromosome_lengths)
+            region_size = max(region_size, int(math.ceil(
+                    genome_size / float(get_celery_worker_concurrency()))))
+
+    regions = []
+
+    for chr_name, chr_len in chromosome_lengths:
+        end = 0
+
+        while end < chr_len:
+            start = end
+            end = start + region_size
+            if end > chr_len:
+                end = chr_len
+            regions.append(_format_region((chr_name, start, end)))
+            start = end
+
+    return regions
+
+
+def get_freebayes_num_shards(ref_genome):
+    """Returns the number of coverage-aware shards to split freebayes into.
+
+    There is one shard per settings.FREEBAYES_REGION_SIZE bases of genome, or
+    at most one per Celery worker when
+    settings.FREEBAYES_LIMIT_REGIONS_TO_CONCURRENCY is set.
+    """
+    genome_size = sum(chr_len for _, chr_len in
+            _get_chromosome_lengths(ref_genome))
+    num_shards = int(math.ceil(
+            genome_size / float(settings.FREEBAYES_REGION_SIZE)))
+    if settings.FREEBAYES_LIMIT_REGIONS_TO_CONCURRENCY:
+        num_shards = min(num_shards, get_celery_worker_concurrency())
+    return max(num_shards, 1)
+
+
+def freebayes_region_shards(ref_genome, bam_files, num_shards):
+    """Splits the genome into num_shards shards of roughly equal read depth,
+    as estimated from the bam indexes of the given alignments.
+
+    Unlike freebayes_regions(), which splits by number of bases, this keeps
+    amplified or high-coverage stretches from making a few shards much slower
+    than the rest. Each shard is a contiguous stretch of the genome, and may
+    span the end of one chromosome and the start of the next.
+
+    See write_freebayes_shards(), which computes the shards once for all of
+    the parallel freebayes tasks.
+
+    Returns:
+        List of num_shards lists of (chromosome, start, end) tuples. A shard
+        may be empty when a single base carries more reads than a shard
+        should.
+    """
+    chromosome_lengths = _get_chromosome_lengths(ref_genome)
+
+    # Sum estimated read depth per linear index window across alignments.
+    window_weights = collections.defaultdict(float)
+    for bam_file in bam_files:
+        bam_weights = estimate_read_depth_from_bam_index(bam_file)
+        for chr_name, chr_len in chromosome_lengths:
+            for window, weight in enumerate(bam_weights.get(chr_name, [])):
+                if window * BAM_INDEX_LINEAR_WINDOW_SIZE >= chr_len:
+                    break
+                window_weights[(chr_name, window)] += weight
+
+    # Weighted segments covering the genome, in order.
+    segments = []
+    for chr_name, chr_len in chromosome_lengths:
+        for start in range(0, chr_len, BAM_INDEX_LINEAR_WINDOW_SIZE):
+            end = min(start + BAM_INDEX_LINEAR_WINDOW_SIZE, chr_len)
+            window = start / BAM_INDEX_LINEAR_WINDOW_SIZE
+            segments.append(
+                    (chr_name, start, end, window_weights[(chr_name, window)]))
+
+    # Without any reads, fall back to splitting by length.
+    total_weight = sum(segment[3] for segment in segments)
+    if not total_weight:
+        segments = [(seg_chr_name, seg_start, seg_end, seg_end - seg_start)
+                for seg_chr_name, seg_start, seg_end, _ in segments]
+        total_weight = sum(segment[3] for segment in segments)
+
+    # Walk the genome and cut whenever a shard has accumulated its share,
+    # treating weight as uniform within each window.
+    target_weight = total_weight / float(num_shards)
+    shards = [[]]
+    shard_weight = 0.0
+    for chr_name, start, end, weight in segments:
+        density = weight / float(end - start)
+        pos = start
+        while pos < end:
+            remaining_weight = density * (end - pos)
+            if (len(shards) == num_shards or
+                    shard_weight + remaining_weight < target_weight):
+                _append_interval(shards[-1], (chr_name, pos, end))
+                shard_weight += remaining_weight
+                break
+            cut = min(end, pos + int(math.ceil(
+                    (target_weight - shard_weight) / density)))
+            _append_interval(shards[-1], (chr_name, pos, cut))
+            shards.append([])
+            shard_weight = 0.0
+            pos = cut
+
+    while len(shards) < num_shards:
+        shards.append([])
+    return shards
+
+
+@project_files_needed
+def write_freebayes_shards(alignment_group, num_shards):
+    """Computes coverage-aware shards from the alignments of the
+    AlignmentGroup, and stores them in its vcf dir for the parallel freebayes
+    tasks to read with read_freebayes_shard().
+
+    Must be called once all alignments are done, before any freebayes task
+    runs.
+    """
+    ref_genome = alignment_group.reference_genome
+    ensure_local_file(ref_genome.get_model_data_dir())
+
+    bam_files = []
+    for sample_alignment in (
+            alignment_group.experimentsampletoalignment_set.all()):
+        bam_file = get_dataset_with_type(sample_alignment,
+                Dataset.TYPE.BWA_ALIGN).get_absolute_location()
+        ensure_local_file(bam_file)
+        bam_files.append(bam_file)
+
+    shards = freebayes_region_shards(ref_genome, bam_files, num_shards)
+    with open(_get_freebayes_shards_path(alignment_group), 'w') as shards_fh:
+        json.dump(shards, shards_fh)
+
+
+def read_freebayes_shard(alignment_group, region_num, num_shards):
+    """Returns shard number region_num, as a list of (chromosome, start, end)
+    tuples, of those stored by write_freebayes_shards().
+    """
+    with open(_get_freebayes_shards_path(alignment_group)) as shards_fh:
+        shards = json.load(shards_fh)
+    assert len(shards) == num_shards, (
+            "Expected %d freebayes shards, found %d." % (
+                    num_shards, len(shards)))
+    return [(str(chr_name), start, end)
+            for chr_name, start, end in shards[region_num]]
+
+
+def _get_freebayes_shards_path(alignment_group):
+    return os.path.join(get_or_create_vcf_output_dir(alignment_group),
+            'freebayes_shards.json')
+
+
+def _append_interval(interval_list, interval):
+    """Appends interval to interval_list, merging it with the last interval
+    if they are adjacent on the same chromosome.
+    """
+    if interval_list:
+        last_chr_name, last_start, last_end = interval_list[-1]
+        if last_chr_name == interval[0] and last_end == interval[1]:
+            interval_list[-1] = (last_chr_name, last_start, interval[2])
+            return
+    interval_list.append(interval)
+
+
+def _format_region(interval):
+    return '{chr_name}:{start}-{end}'.format(
+            chr_name=interval[0],
+            start=interval[1],
+            end=interval[2])
+
+
+def _get_chromosome_lengths(ref_genome):
+    """Returns list of (chromosome name, length) pairs read from the .fai.
     """
     ref_genome_fasta = get_dataset_with_type(ref_genome,
             Dataset.TYPE.REFERENCE_GENOME_FASTA).get_absolute_location()
@@ -45,38 +233,28 @@ def freebayes_regions(ref_genome,
 
     ref_genome_faidx = ref_genome_fasta + '.fai'
 
-    regions = []
-
+    chromosome_lengths = []
     with open(ref_genome_faidx) as faidx_fh:
         # faidx has one line per chromosome
         for line in faidx_fh:
             fields = line.strip().split('\t')
             chr_name, chr_len = fields[:2]
-            chr_len = int(chr_len)
-            end = 0
-
-            while end < chr_len:
-                start = end
-                end = start + region_size
-                if end > chr_len:
-                    end = chr_len
-                regions.append('{chr_name}:{start}-{end}'.format(
-                        chr_name=chr_name,
-                        start=start,
-                        end=end))
-                start = end
-
-    return regions
+            chromosome_lengths.append((chr_name, int(chr_len)))
+    return chromosome_lengths
 
 
 def run_freebayes(fasta_ref, sample_alignments, vcf_output_dir,
-        vcf_output_filename, alignment_type, region=None, **kwargs):
+        vcf_output_filename, alignment_type, region=None, num_shards=None,
+        **kwargs):
     """Run freebayes using the bam alignment files keyed by the alignment_type
     for all Genomes of the passed in ReferenceGenome.
 
     NOTE: If a Genome doesn't have a bam alignment file with this
     alignment_type, then it won't be used.
 
+    If num_shards is given, freebayes is run on shard number region_num of
+    those stored by write_freebayes_shards() rather than on region.
+
     Returns:
         Boolean, True if successfully made it to the end, else False.
     """
@@ -86,6 +264,21 @@ def run_freebayes(fasta_ref, sample_alignments, vcf_output_dir,
             get_dataset_with_type(sa, alignment_type).get_absolute_location()
             for sa in sample_alignments]
 
+    targets_bed = None
+    if num_shards is not None:
+        shard = read_freebayes_shard(sample_alignments[0].alignment_group,
+                kwargs['region_num'], num_shards)
+        if not shard:
+            # Nothing to call in this shard.
+            return True
+        if len(shard) == 1:
+            region = _format_region(shard[0])
+        else:
+            targets_bed = vcf_output_filename + '.targets.bed'
+            with open(targets_bed, 'w') as targets_bed_fh:
+                for interval in shard:
+                    targets_bed_fh.write('%s\t%d\t%d\n' % interval)
+
     # Build up the bam part of the freebayes binary call.
     bam_part = []
     for bam_file in bam_files:
@@ -113,6 +306,8 @@ def run_freebayes(fasta_ref, sample_alignments, vcf_output_dir,
 
     if region:
         other_args_part.extend(['--region', region])
+    elif targets_bed:
+        other_args_part.extend(['--targets', targets_bed])
 
     # Build the full command and execute it for all bam files at once.
     full_command = (
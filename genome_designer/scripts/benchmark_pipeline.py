@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks the main stages of the pipeline on generated data of a given size:
+alignment, variant calling, vcf parsing, materialized view creation and
+variant filtering.
+
+Reports wall time, peak RSS and number of queries of each stage as json, so
+that runs can be compared to catch performance regressions. See
+utils/benchmark_util.py for what is measured.
+
+With --simulate, reads are simulated with simNGS (see settings.SIM_NGS_BIN)
+as in test_data/full_vcf_test_set, otherwise the checked-in reads of that
+test set are reused. The vcf parsing stage parses the first
+--num-vcf-records records of the vcf that
+scripts/bootstrap_large_vcf_example.py bootstraps from, and is skipped if
+that vcf isn't present.
+
+Celery tasks are run eagerly in this process so that their queries are
+counted.
+
+Usage:
+    ./scripts/benchmark_pipeline.py --num-samples 6 --output bench.json
+"""
+
+import argparse
+import imp
+import os
+import shutil
+import sys
+import tempfile
+
+# Setup Django environment.
+sys.path.append(
+        os.path.join(os.path.dirname(os.path.realpath(__file__)), '../'))
+os.environ['DJANGO_SETTINGS_MODULE'] = 'settings'
+
+from django.conf import settings
+
+from main.models import AlignmentGroup
+from main.models import Dataset
+from main.models import ExperimentSample
+from main.models import Project
+from main.models import Variant
+from main.testing_util import FullVCFTestSet
+from pipeline.pipeline_runner import run_pipeline
+from scripts.bootstrap_data import get_or_create_user
+from scripts.bootstrap_large_vcf_example import create_large_vcf_alignment_group
+from scripts.bootstrap_large_vcf_example import LARGE_VCF
+from scripts.bootstrap_large_vcf_example import MG1655_REF_GENOME
+from scripts.bootstrap_large_vcf_example import write_vcf_subset
+from utils.benchmark_util import BenchmarkReport
+from utils.import_util import copy_and_add_dataset_source
+from utils.import_util import import_reference_genome_from_local_file
+from variants.materialized_variant_filter import lookup_variants
+from variants.materialized_view_manager import MeltedVariantMaterializedViewManager
+from variants.vcf_parser import parse_alignment_group_vcf
+
+
+BENCHMARK_PROJECT_NAME = 'Benchmark'
+
+GENERATOR_MODULE_PATH = os.path.join(FullVCFTestSet.TEST_DIR,
+        'generate_full_vcf_test_set.py')
+
+# Filters looked up in the variant filtering stage, each both melted and cast.
+BENCHMARK_FILTERS = [
+    '',
+    'position > 1000',
+    'GT_TYPE = 2',
+    'position > 1000 & GT_TYPE = 2',
+]
+
+VARIANT_FILTERING_PAGE_SIZE = 100
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Benchmark the pipeline on generated data.')
+    parser.add_argument('--num-samples', type=int,
+            default=FullVCFTestSet.NUM_SAMPLES,
+            help='Number of samples to align and call variants for.')
+    parser.add_argument('--simulate', action='store_true',
+            help='Simulate new reads with simNGS rather than reusing the '
+                    'checked-in reads.')
+    parser.add_argument('--num-snps', type=int, default=100,
+            help='With --simulate, number of SNPs to choose from.')
+    parser.add_argument('--coverage', type=int, default=50,
+            help='With --simulate, read coverage of each sample.')
+    parser.add_argument('--num-vcf-records', type=int, default=10000,
+            help='Number of records of the large vcf to parse.')
+    parser.add_argument('--output',
+            help='File to write the json report to. Defaults to stdout.')
+    parser.add_argument('--keep-data', action='store_true',
+            help="Don't delete the benchmark project afterwards.")
+    args = parser.parse_args()
+
+    # Run tasks in this process, as in tests.
+    settings.CELERY_EAGER_PROPAGATES_EXCEPTIONS = True
+    settings.CELERY_ALWAYS_EAGER = True
+    settings.BROKER_BACKEND = 'memory'
+
+    report = BenchmarkReport(config=vars(args))
+    work_dir = tempfile.mkdtemp(prefix='benchmark_')
+    user = get_or_create_user()
+    project = Project.objects.create(
+            title=BENCHMARK_PROJECT_NAME, owner=user.get_profile())
+    try:
+        run_benchmark(report, project, work_dir, args)
+    finally:
+        if args.output:
+            with open(args.output, 'w') as output_fh:
+                report.write(output_fh)
+        else:
+            report.write(sys.stdout)
+        shutil.rmtree(work_dir)
+        if not args.keep_data:
+            project.delete()
+
+
+def run_benchmark(report, project, work_dir, args):
+    """Runs each stage in turn, recording it in the report.
+    """
+    with report.stage('dataset_generation', num_samples=args.num_samples,
+            simulated=args.simulate):
+        fastq_pairs = generate_fastq_pairs(work_dir, args)
+
+    ref_genome = import_reference_genome_from_local_file(project,
+            'mg1655_tolC_through_zupT', FullVCFTestSet.TEST_GENBANK,
+            'genbank', move=False)
+    samples = []
+    for i, (fastq1, fastq2) in enumerate(fastq_pairs):
+        sample = ExperimentSample.objects.create(
+                project=project, label='Sample %d' % i)
+        copy_and_add_dataset_source(sample, Dataset.TYPE.FASTQ1,
+                Dataset.TYPE.FASTQ1, fastq1)
+        copy_and_add_dataset_source(sample, Dataset.TYPE.FASTQ2,
+                Dataset.TYPE.FASTQ2, fastq2)
+        samples.append(sample)
+
+    with report.stage('alignment', num_samples=len(samples)):
+        alignment_group, _, _ = run_pipeline('benchmark', ref_genome,
+                samples, perform_variant_calling=False)
+
+    with report.stage('variant_calling', num_samples=len(samples)):
+        run_pipeline('benchmark', ref_genome, samples, skip_alignment=True)
+        alignment_group = AlignmentGroup.objects.get(id=alignment_group.id)
+        assert alignment_group.status != AlignmentGroup.STATUS.FAILED, (
+                'Variant calling failed.')
+
+    # The materialized view and filtering stages use the reference genome
+    # with the most variants available.
+    filter_ref_genome = ref_genome
+
+    if not (os.path.exists(LARGE_VCF) and os.path.exists(MG1655_REF_GENOME)):
+        report.skip('vcf_parsing', '%s not found' % LARGE_VCF)
+    else:
+        vcf_subset = os.path.join(work_dir, 'large_vcf_subset.vcf')
+        num_records = write_vcf_subset(LARGE_VCF, vcf_subset,
+                args.num_vcf_records)
+        large_vcf_alignment_group = create_large_vcf_alignment_group(
+                project, vcf_path=vcf_subset)
+        with report.stage('vcf_parsing', num_records=num_records):
+            parse_alignment_group_vcf(large_vcf_alignment_group,
+                    Dataset.TYPE.VCF_FREEBAYES_SNPEFF)
+        filter_ref_genome = large_vcf_alignment_group.reference_genome
+
+    with report.stage('materialized_view_creation',
+            num_variants=Variant.objects.filter(
+                    reference_genome=filter_ref_genome).count()):
+        MeltedVariantMaterializedViewManager(filter_ref_genome).create()
+
+    for filter_string in BENCHMARK_FILTERS:
+        for is_melted in [True, False]:
+            query_args = {
+                'filter_string': filter_string,
+                'is_melted': is_melted,
+                'pagination_start': 0,
+                'pagination_len': VARIANT_FILTERING_PAGE_SIZE,
+            }
+            with report.stage('variant_filtering',
+                    filter_string=filter_string,
+                    is_melted=is_melted) as stage_result:
+                result = lookup_variants(query_args, filter_ref_genome)
+                stage_result['num_total_variants'] = result.num_total_variants
+
+
+def generate_fastq_pairs(work_dir, args):
+    """Returns a list of (fastq1, fastq2) path pairs, one per sample.
+    """
+    if args.simulate:
+        # The generator lives with its test data rather than in a package.
+        generator = imp.load_source('generate_full_vcf_test_set',
+                GENERATOR_MODULE_PATH)
+        return generator.generate_test_set(work_dir,
+                num_samples=args.num_samples, total_snps=args.num_snps,
+                coverage=args.coverage)
+
+    # Cycle through the checked-in reads.
+    num_available = len(FullVCFTestSet.FASTQ1)
+    return [(FullVCFTestSet.FASTQ1[i % num_available],
+            FullVCFTestSet.FASTQ2[i % num_available])
+            for i in range(args.num_samples)]
+
+
+if __name__ == '__main__':
+    main()
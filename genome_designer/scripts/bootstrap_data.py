@@ -47,6 +47,7 @@ from utils.import_util import copy_and_add_dataset_source
 from utils.import_util import copy_dataset_to_entity_data_dir
 from utils.import_util import import_reference_genome_from_local_file
 from utils.import_util import import_variant_set_from_vcf
+from utils.import_util import detect_phred_encoding
 from utils.import_util import run_fastqc_on_sample_fastq
 
 from settings import PWD as GD_ROOT
@@ -267,6 +268,7 @@ def bootstrap_fake_data():
             gz_backed_sample, Dataset.TYPE.FASTQ1, Dataset.TYPE.FASTQ2,
             TEST_FASTQ_GZ_2)
     run_fastqc_on_sample_fastq(gz_backed_sample, gz_fastq1_dataset)
+    detect_phred_encoding(gz_backed_sample, gz_fastq1_dataset)
     run_fastqc_on_sample_fastq(gz_backed_sample, gz_fastq2_dataset, rev=True)
 
     ### Create an alignment.
@@ -329,6 +331,7 @@ def bootstrap_fake_data():
 
         # Run FASTQC on sample reads.
         run_fastqc_on_sample_fastq(sample_obj, fastq1_dataset)
+        detect_phred_encoding(sample_obj, fastq1_dataset)
         run_fastqc_on_sample_fastq(sample_obj, fastq2_dataset, rev=True)
 
         full_vcf_samples.append(sample_obj)
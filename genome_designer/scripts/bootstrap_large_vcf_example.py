@@ -5,6 +5,7 @@ Bootstraps from the fix recoli vcf.
 import os
 import pickle
 import shutil
+import sys
 
 # Setup Django environment.
 sys.path.append(
@@ -20,7 +21,7 @@ from pipeline.variant_effects import get_snpeff_vcf_output_path
 from scripts.bootstrap_data import get_or_create_user
 from utils.import_util import import_reference_genome_from_local_file
 from settings import PWD as GD_ROOT
-from vcf_parser import parse_alignment_group_vcf
+from variants.vcf_parser import parse_alignment_group_vcf
 
 FIX_RECOLI_FCF = ''
 
@@ -47,8 +48,21 @@ def main():
     user = get_or_create_user()
     test_project = Project.objects.create(
             title=EXAMPLE_PROJECT_NAME, owner=user.get_profile())
-    ref_genome = import_reference_genome_from_local_file(test_project,
-            'mg1655', MG1655_REF_GENOME, 'genbank', move=False)
+    alignment_group = create_large_vcf_alignment_group(test_project)
+    parse_alignment_group_vcf(alignment_group,
+            Dataset.TYPE.VCF_FREEBAYES_SNPEFF)
+
+
+def create_large_vcf_alignment_group(project, vcf_path=LARGE_VCF,
+        ref_genome_path=MG1655_REF_GENOME):
+    """Sets up the ReferenceGenome, ExperimentSamples and an AlignmentGroup
+    with the vcf as its snpeff'ed freebayes output, ready for parsing.
+
+    Returns:
+        The AlignmentGroup.
+    """
+    ref_genome = import_reference_genome_from_local_file(project,
+            'mg1655', ref_genome_path, 'genbank', move=False)
 
     # Create alignment group and and relate the vcf Dataset to it.
     alignment_group = AlignmentGroup.objects.create(
@@ -57,7 +71,7 @@ def main():
             aligner=AlignmentGroup.ALIGNER.BWA)
     vcf_output_path = get_snpeff_vcf_output_path(alignment_group,
             Dataset.TYPE.BWA_ALIGN)
-    shutil.copy(LARGE_VCF, vcf_output_path)
+    shutil.copy(vcf_path, vcf_output_path)
     dataset = Dataset.objects.create(
             type=Dataset.TYPE.VCF_FREEBAYES_SNPEFF,
             label=Dataset.TYPE.VCF_FREEBAYES_SNPEFF,
@@ -72,7 +86,7 @@ def main():
         for es in es_data:
             es_obj = ExperimentSample.objects.create(
                 uid=es.uid,
-                project=test_project,
+                project=project,
                 label=es.label
             )
 
@@ -82,8 +96,27 @@ def main():
                  'num_reads':es.num_reads})
             es_obj.save()
 
-    parse_alignment_group_vcf(alignment_group,
-            Dataset.TYPE.VCF_FREEBAYES_SNPEFF)
+    return alignment_group
+
+
+def write_vcf_subset(source_vcf, output_vcf, num_records):
+    """Writes the header and first num_records records of source_vcf to
+    output_vcf, e.g. to parse a vcf of a given size.
+
+    Returns:
+        The number of records written, which is less than num_records if
+        the source has fewer.
+    """
+    num_written = 0
+    with open(source_vcf) as source_fh:
+        with open(output_vcf, 'w') as output_fh:
+            for line in source_fh:
+                if not line.startswith('#'):
+                    if num_written >= num_records:
+                        break
+                    num_written += 1
+                output_fh.write(line)
+    return num_written
 
 
 if __name__ == '__main__':
@@ -1 +1,7 @@
-python manage.py celery worker --loglevel=info
+# Sample imports get their own worker, which caps how many import tasks run at
+# once (see settings.SAMPLE_IMPORT_CONCURRENCY).
+SAMPLE_IMPORT_QUEUE=$(python -c "import settings; print settings.SAMPLE_IMPORT_QUEUE")
+SAMPLE_IMPORT_CONCURRENCY=$(python -c "import settings; print settings.SAMPLE_IMPORT_CONCURRENCY")
+python manage.py celery worker --loglevel=info -Q $SAMPLE_IMPORT_QUEUE \
+        --concurrency=$SAMPLE_IMPORT_CONCURRENCY -n sample_import.%h &
+python manage.py celery worker --loglevel=info -Q celery
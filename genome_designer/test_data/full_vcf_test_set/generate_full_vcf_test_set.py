@@ -7,6 +7,7 @@ This document describes how this test test was generated.
 """
 
 import copy
+import os
 import random
 
 from Bio import SeqIO
@@ -15,11 +16,12 @@ import vcf
 import simNGS_util
 
 
+TEST_SET_DIR = os.path.dirname(os.path.realpath(__file__))
+
 # Portion of MG1655 Genbank of size ~5.5 kB
-EXCISED_GENBANK = 'mg1655_tolC_through_zupT.gb'
+EXCISED_GENBANK = os.path.join(TEST_SET_DIR, 'mg1655_tolC_through_zupT.gb')
 
-TEMPLATE_VCF = 'template.vcf'
-VCF_TEMPLATE_READER = vcf.Reader(TEMPLATE_VCF)
+TEMPLATE_VCF = os.path.join(TEST_SET_DIR, 'template.vcf')
 
 SAMPLE_FASTA_ROOT = 'sample'
 
@@ -40,6 +42,12 @@ NUM_OTHER = TOTAL_SNPS - NUM_IN_CDS
 # We'll create this many genomes.
 NUM_SAMPLES = 6
 
+# Number of designed SNPs, and SNPs per sample.
+NUM_SNPS_PER_SUBSET = 20
+
+# Read coverage passed to simLibrary.
+COVERAGE = 50
+
 
 def is_position_in_coding_feature(position, cds_features):
     """Checks whether the given position lies inside of a coding feature
@@ -75,7 +83,7 @@ def get_subset_of_snps(all_snps, subset_size):
 
 def create_vcf_for_subset(subset, out_path):
     with open(out_path, 'w') as designed_fh:
-        writer = vcf.Writer(designed_fh, VCF_TEMPLATE_READER,
+        writer = vcf.Writer(designed_fh, vcf.Reader(filename=TEMPLATE_VCF),
                 lineterminator='\n')
         for pos, value_dict in subset.iteritems():
             writer.write_record(vcf.model._Record(
@@ -92,7 +100,22 @@ def create_vcf_for_subset(subset, out_path):
                     samples=None))
 
 
-def main():
+def generate_test_set(output_dir, num_samples=NUM_SAMPLES,
+        total_snps=TOTAL_SNPS, num_in_cds=None, coverage=COVERAGE):
+    """Generates the designed SNPs vcf, and mutated genomes and simulated
+    paired reads for each sample, in output_dir.
+
+    By default, the fraction of SNPs in coding features is the same as for
+    the checked-in test set.
+
+    Returns:
+        List of (fastq1, fastq2) path pairs, one per sample.
+    """
+    if num_in_cds is None:
+        num_in_cds = total_snps * NUM_IN_CDS / TOTAL_SNPS
+    num_other = total_snps - num_in_cds
+    subset_size = min(NUM_SNPS_PER_SUBSET, total_snps)
+
     seq_record = SeqIO.read(EXCISED_GENBANK, 'genbank')
     cds_features = [f for f in seq_record.features if f.type == 'CDS']
 
@@ -107,21 +130,21 @@ def main():
     # set above by the NUM_IN_CDS vs TOTAL_SNPS constants.
     # NOTE: These SNP positions are pythonic. We have to update them when
     # writing them out in vcf format below.
-    num_in_cds = 0
-    num_other = 0
-    while num_in_cds < NUM_IN_CDS or num_other < NUM_OTHER:
+    count_in_cds = 0
+    count_other = 0
+    while count_in_cds < num_in_cds or count_other < num_other:
         position = random.randint(0, len_seq_record - 1)
         if position in all_snps:
             continue
 
         in_cds_feature = is_position_in_coding_feature(position, cds_features)
         do_add_position = False
-        if in_cds_feature and num_in_cds < NUM_IN_CDS:
+        if in_cds_feature and count_in_cds < num_in_cds:
             do_add_position = True
-            num_in_cds += 1
-        elif not in_cds_feature and num_other < NUM_OTHER:
+            count_in_cds += 1
+        elif not in_cds_feature and count_other < num_other:
             do_add_position = True
-            num_other += 1
+            count_other += 1
 
         if do_add_position:
             ref = seq_record.seq[position]
@@ -131,20 +154,22 @@ def main():
                 'alt': [alt]
             }
 
-    assert len(all_snps) == TOTAL_SNPS, "Didn't get all the SNPs we expected."
+    assert len(all_snps) == total_snps, "Didn't get all the SNPs we expected."
 
     # Now select a subset of these SNPS to serve as designed.
-    designed_snps = get_subset_of_snps(all_snps, 20)
-    create_vcf_for_subset(designed_snps, DESIGNED_SNP_VCF)
+    designed_snps = get_subset_of_snps(all_snps, subset_size)
+    create_vcf_for_subset(designed_snps,
+            os.path.join(output_dir, DESIGNED_SNP_VCF))
 
     # Now create the samples.
-    for sample_num in range(NUM_SAMPLES):
+    fastq_pairs = []
+    for sample_num in range(num_samples):
         sample_name = SAMPLE_FASTA_ROOT + str(sample_num)
         sample_record = copy.deepcopy(seq_record)
         sample_record.id = sample_name
 
         # Grab a subset of SNPs.
-        sample_snps = get_subset_of_snps(all_snps, 20)
+        sample_snps = get_subset_of_snps(all_snps, subset_size)
 
         # Introduce the mutations.
         for position, value_dict in sample_snps.iteritems():
@@ -156,18 +181,27 @@ def main():
                 "For now we are only doing mutations.")
 
         # Write out the sample fasta.
-        sample_output = sample_name + '.fa'
+        sample_output = os.path.join(output_dir, sample_name + '.fa')
         with open(sample_output, 'w') as out_fh:
             SeqIO.write(sample_record, out_fh, 'fasta')
 
         # Generate fake reads using simNGS.
-        simLibrary_fasta = sample_name + '.simLibrary.fa'
+        simLibrary_fasta = os.path.join(output_dir,
+                sample_name + '.simLibrary.fa')
         print sample_output, simLibrary_fasta
-        simNGS_util.run_simLibrary(sample_output, simLibrary_fasta)
+        simNGS_util.run_simLibrary(sample_output, simLibrary_fasta,
+                coverage=coverage)
 
         # Generate reads using simNGS.
-        output_fq = sample_name + '.simLibrary.fq'
-        simNGS_util.run_paired_simNGS(simLibrary_fasta, output_fq)
+        output_fq = os.path.join(output_dir, sample_name + '.simLibrary.fq')
+        fastq_pairs.append(
+                tuple(simNGS_util.run_paired_simNGS(simLibrary_fasta, output_fq)))
+
+    return fastq_pairs
+
+
+def main():
+    generate_test_set(os.getcwd())
 
 
 if __name__ == '__main__':
@@ -7,7 +7,7 @@ import re
 import subprocess
 
 
-def run_simLibrary(source_fasta, output_library_fasta):
+def run_simLibrary(source_fasta, output_library_fasta, coverage=50):
     """Runs sim library on the source_fasta and writig to the output file."""
     # We store the location of the simNGS binaries in the django settings.
     import settings
@@ -20,7 +20,7 @@ def run_simLibrary(source_fasta, output_library_fasta):
         simLibrary_binary,
         '--paired',
         '--readlen', '500',
-        '--coverage', '50',
+        '--coverage', str(coverage),
     ], stdin=source_fasta_fh, stdout=output_fh)
 
     source_fasta_fh.close()
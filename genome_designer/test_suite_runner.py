@@ -47,6 +47,10 @@ class CustomTestSuiteRunner(TempFilesystemTestSuiteRunner):
         '.sa'
     ]
 
+    CLEAN_UP_DIRS_WITH_EXTENSION = [
+        '.coverage'
+    ]
+
     def setup_test_environment(self, **kwargs):
         setup_test_environment_common()
 
@@ -69,6 +73,12 @@ class CustomTestSuiteRunner(TempFilesystemTestSuiteRunner):
                 if os.path.splitext(f)[1] in self.CLEAN_UP_FILES_WITH_EXTENSION:
                     os.remove(os.path.join(root, f))
 
+            # Also per-base coverage computed next to test bams.
+            for d in list(dirs):
+                if os.path.splitext(d)[1] in self.CLEAN_UP_DIRS_WITH_EXTENSION:
+                    shutil.rmtree(os.path.join(root, d))
+                    dirs.remove(d)
+
         return super(CustomTestSuiteRunner, self).teardown_test_environment()
 
 
@@ -86,6 +86,10 @@ urlpatterns = patterns('',
 
     url(r'^_/projects/export$',
             'main.xhr_handlers.export_project'),
+    url(r'^_/projects/export/status$',
+            'main.xhr_handlers.export_project_status'),
+    url(r'^_/projects/export/stream$',
+            'main.xhr_handlers.export_project_stream'),
 
     url(r'^_/sets$',
             'main.xhr_handlers.get_variant_set_list'),
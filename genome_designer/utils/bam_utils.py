@@ -2,9 +2,13 @@
 Utility functions for working with bam files.
 """
 
+import errno
 import os
 import shutil
+import struct
 import subprocess
+import tempfile
+import time
 
 from django.conf import settings
 import pysam
@@ -14,6 +18,21 @@ from utils import convert_fasta_to_fastq
 
 BWA_BINARY = os.path.join(settings.TOOLS_DIR, 'bwa/bwa')
 
+# Size in bases of the windows in the linear index of a .bai file.
+BAM_INDEX_LINEAR_WINDOW_SIZE = 16384
+
+# Bin number used by samtools to store per-reference metadata in the index.
+BAM_INDEX_PSEUDO_BIN = 37450
+
+# Rough ratio of compressed to uncompressed bytes in a BGZF block. Used to
+# place virtual offsets that fall within the same block on the same scale as
+# offsets that fall in different blocks.
+BGZF_COMPRESSION_RATIO_ESTIMATE = 0.3
+
+# Seconds to wait for samtools to open the fifo that filter_bam_file_by_row
+# streams reads through.
+FIFO_OPEN_TIMEOUT = 60
+
 
 def clipping_stats(bam_path, sample_size=1000):
 
@@ -42,6 +61,72 @@ def clipping_stats(bam_path, sample_size=1000):
             'std': np.std(terminal_clipping)}
 
 
+def estimate_read_depth_from_bam_index(bam_path):
+    """Estimates how read data is distributed along each reference using only
+    the linear index of the bam's .bai file, without reading any alignments.
+
+    The linear index stores, for every BAM_INDEX_LINEAR_WINDOW_SIZE window,
+    the file offset of the first alignment overlapping it, so the number of
+    bytes between consecutive windows is proportional to the number of reads
+    starting in a window.
+
+    Returns:
+        Dictionary from reference name to numpy array with one estimated
+        weight (in bytes) per linear index window. References without any
+        reads map to an array of zeros.
+    """
+    samfile = pysam.AlignmentFile(bam_path, 'rb')
+    reference_names = samfile.references
+    samfile.close()
+
+    def _virtual_to_linear(virtual_offsets):
+        compressed = virtual_offsets >> 16
+        uncompressed = virtual_offsets & 0xFFFF
+        return (compressed.astype(np.float64) +
+                uncompressed * BGZF_COMPRESSION_RATIO_ESTIMATE)
+
+    weights = {}
+    with open(bam_path + '.bai', 'rb') as bai_fh:
+        magic = bai_fh.read(4)
+        assert magic == 'BAI\1', 'Not a bam index: %s.bai' % bam_path
+        (n_ref,) = struct.unpack('<i', bai_fh.read(4))
+        assert n_ref == len(reference_names)
+
+        for ref_name in reference_names:
+            # Bins. Only used to find where the last window of the reference
+            # ends.
+            ref_end_offset = 0
+            (n_bin,) = struct.unpack('<i', bai_fh.read(4))
+            for _ in range(n_bin):
+                (bin_num, n_chunk) = struct.unpack('<Ii', bai_fh.read(8))
+                chunks = np.fromstring(bai_fh.read(16 * n_chunk),
+                        dtype='<u8').reshape(n_chunk, 2)
+                if bin_num == BAM_INDEX_PSEUDO_BIN or not n_chunk:
+                    continue
+                ref_end_offset = max(ref_end_offset, int(chunks[:, 1].max()))
+
+            # Linear index.
+            (n_intv,) = struct.unpack('<i', bai_fh.read(4))
+            offsets = np.fromstring(bai_fh.read(8 * n_intv), dtype='<u8')
+            if not n_intv:
+                weights[ref_name] = np.zeros(0)
+                continue
+
+            # Windows before the first read have offset 0, and some versions
+            # of samtools leave empty windows at 0. Treat both as starting
+            # where the next read does.
+            nonzero = np.nonzero(offsets)[0]
+            if len(nonzero):
+                offsets[:nonzero[0]] = offsets[nonzero[0]]
+            offsets = np.maximum.accumulate(offsets)
+
+            boundaries = _virtual_to_linear(np.append(offsets,
+                    max(ref_end_offset, int(offsets[-1]))))
+            weights[ref_name] = np.diff(boundaries)
+
+    return weights
+
+
 def index_bam(bam):
     cmd = "{samtools} index {bam}".format(
             samtools=settings.SAMTOOLS_BINARY,
@@ -135,54 +220,117 @@ def rmdup(input_bam_file, output_bam_file):
     os.remove(output_sam)
 
 
-def filter_bam_file_by_row(input_bam_path, filter_fn, output_bam_path):
+def filter_bam_file_by_row(input_bam_path, filter_fn, output_bam_path,
+        num_threads=1):
     """Filters rows out of a bam file that don't pass a given filter function.
 
-    This function keeps all header lines.
+    Reads are streamed from the input bam to the output bam with pysam, so no
+    intermediate sam is written. This function keeps all header lines.
 
     Args:
         input_bam_path: Absolute path to input bam file.
-        filter_fn: Function applied to each row of the input bam and returns a
-            Boolean. If True, keeps the row.
-        output_bam_path: Absolute path to the output bam file.
+        filter_fn: Function applied to each pysam.AlignedSegment of the input
+            bam and returns a Boolean. If True, keeps the row.
+        output_bam_path: Absolute path to the output bam file. May be the
+            same as input_bam_path.
+        num_threads: If greater than 1, the output is compressed by samtools
+            with this many threads rather than in this process.
     """
-    output_root = os.path.splitext(output_bam_path)[0]
-    initial_sam_intermediate = output_root + '.sam'
-    filtered_sam_intermediate = output_root + '.filtered.sam'
-    final_bam = output_root + '.filtered.bam'
-
-    # Convert to SAM (preserve header with -h option).
-    with open(initial_sam_intermediate, 'w') as output_fh:
-        subprocess.call(
-                [settings.SAMTOOLS_BINARY, 'view', '-h', input_bam_path],
-                stdout=output_fh)
-
-    # Filter.
-    with open(filtered_sam_intermediate, 'w') as output_fh:
-        with open(initial_sam_intermediate) as input_fh:
-            for line in input_fh:
-                # Always write header lines.
-                if line[0] == '@':
-                    output_fh.write(line)
-                    continue
-
-                if filter_fn(line):
-                    output_fh.write(line)
-                    continue
-
-    # Write final bam.
-    with open(final_bam, 'w') as fh:
-        subprocess.call(
-                [settings.SAMTOOLS_BINARY, 'view', '-bS',
-                 filtered_sam_intermediate],
-                stdout=fh)
-
-    # Move temp file to the original file location.
-    shutil.move(final_bam, output_bam_path)
-
-    # Delete intermediate files.
-    os.remove(initial_sam_intermediate)
-    os.remove(filtered_sam_intermediate)
+    # Write to a temp file first, since the output may replace the input.
+    filtered_bam = os.path.splitext(output_bam_path)[0] + '.filtered.bam'
+
+    input_af = pysam.AlignmentFile(input_bam_path, 'rb')
+    try:
+        if num_threads > 1:
+            _write_filtered_bam_with_samtools(input_af, filter_fn,
+                    filtered_bam, num_threads)
+        else:
+            output_af = pysam.AlignmentFile(filtered_bam, 'wb',
+                    template=input_af)
+            try:
+                _write_filtered_reads(input_af, filter_fn, output_af)
+            finally:
+                output_af.close()
+    finally:
+        input_af.close()
+
+    # Move temp file to the output location.
+    shutil.move(filtered_bam, output_bam_path)
+
+
+def _write_filtered_bam_with_samtools(input_af, filter_fn, output_bam_path,
+        num_threads):
+    """Streams the reads that pass filter_fn as uncompressed bam through a
+    fifo to samtools, which compresses them with num_threads threads.
+
+    Opening a fifo for writing blocks until it has a reader, so we only open
+    it once samtools has, and fail rather than hang if samtools exits first.
+    """
+    fifo_dir = tempfile.mkdtemp(
+            dir=os.path.dirname(os.path.abspath(output_bam_path)))
+    try:
+        fifo_path = os.path.join(fifo_dir, 'filtered.bam')
+        os.mkfifo(fifo_path)
+        with open(output_bam_path, 'wb') as output_fh:
+            samtools_proc = subprocess.Popen([
+                    settings.SAMTOOLS_BINARY, 'view', '-b',
+                    '-@', str(num_threads), fifo_path],
+                    stdout=output_fh)
+            try:
+                # Holding the fifo open keeps samtools from reading an early
+                # end of file before pysam opens it.
+                fifo_fd = _open_fifo_for_writing(fifo_path, samtools_proc)
+                try:
+                    output_af = pysam.AlignmentFile(fifo_path, 'wbu',
+                            template=input_af)
+                finally:
+                    os.close(fifo_fd)
+                try:
+                    _write_filtered_reads(input_af, filter_fn, output_af)
+                finally:
+                    output_af.close()
+            except:
+                samtools_proc.kill()
+                samtools_proc.wait()
+                raise
+            returncode = samtools_proc.wait()
+            if returncode != 0:
+                raise subprocess.CalledProcessError(
+                        returncode, settings.SAMTOOLS_BINARY + ' view')
+    finally:
+        shutil.rmtree(fifo_dir)
+
+
+def _open_fifo_for_writing(fifo_path, reader_proc,
+        timeout=FIFO_OPEN_TIMEOUT):
+    """Returns a write descriptor of fifo_path once reader_proc has opened it
+    for reading.
+
+    Raises:
+        subprocess.CalledProcessError if reader_proc exits first.
+        OSError if reader_proc doesn't open the fifo within timeout seconds.
+    """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return os.open(fifo_path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as e:
+            # ENXIO means there is no reader yet.
+            if e.errno != errno.ENXIO:
+                raise
+        if reader_proc.poll() is not None:
+            raise subprocess.CalledProcessError(
+                    reader_proc.returncode, settings.SAMTOOLS_BINARY + ' view')
+        if time.time() > deadline:
+            raise OSError(errno.ETIMEDOUT,
+                    'Timed out waiting for a reader of fifo', fifo_path)
+        time.sleep(0.01)
+
+
+def _write_filtered_reads(input_af, filter_fn, output_af):
+    for read in input_af.fetch(until_eof=True):
+        if filter_fn(read):
+            output_af.write(read)
 
 
 def minimal_bwa_align(reads, ref_fasta, data_dir):
@@ -199,12 +347,11 @@ def minimal_bwa_align(reads, ref_fasta, data_dir):
 
     filename_prefix = os.path.join(data_dir, "bwa_align.alignment")
 
-    # 1. bwa index ref.fa #TODO: Check if already indexed
-    cmd = "{bwa} index {ref_path}".format(
-            bwa=BWA_BINARY,
-            ref_path=ref_fasta)
-
-    subprocess.call(cmd, shell=True, executable=settings.BASH_PATH)
+    # 1. bwa index ref.fa, reusing a cached index of the same sequence
+    # (see settings.BWA_INDEX_CACHE_DIR).
+    # NOTE: Imported here since read_alignment_util imports this module.
+    from pipeline.read_alignment_util import ensure_bwa_index
+    ensure_bwa_index(ref_fasta)
 
     # 2. bwa mem ref.fa contigs.fq > alignment.sam
     alignment_sam = filename_prefix + ".sam"
@@ -0,0 +1,174 @@
+"""
+Utilities for benchmarking stages of the pipeline.
+
+Measures wall time, peak memory and number of database queries of each
+stage, and collects them into a machine-readable report so that runs can be
+compared across releases. See scripts/benchmark_pipeline.py.
+"""
+
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.db import DEFAULT_DB_ALIAS
+from django.db.backends import util
+
+
+class BenchmarkReport(object):
+    """Collects measurements of named stages.
+
+    Usage:
+        report = BenchmarkReport(config={'num_samples': 3})
+        with report.stage('alignment', num_samples=3):
+            ...
+        report.write(output_fh)
+    """
+
+    def __init__(self, config=None):
+        self.config = config or {}
+        self.started = datetime.now()
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name, **extra):
+        """Measures the code run in the with block as the stage name.
+
+        Keyword arguments are added to the stage's entry in the report, e.g.
+        to record the size of the input. The entry itself is yielded so that
+        the block can add more.
+
+        Peak RSS can't be reset, so peak_rss_kb is the high-water mark of
+        this process up to the end of the stage, and children_peak_rss_kb
+        that of the largest child process (e.g. bwa or freebayes) waited for
+        so far. num_queries counts queries made through Django cursors
+        opened in this process during the stage.
+        """
+        result = {
+            'name': name,
+            'status': 'ok',
+        }
+        result.update(extra)
+
+        with count_queries() as query_counter:
+            start_time = time.time()
+            try:
+                yield result
+            except Exception as e:
+                result['status'] = 'failed'
+                result['error'] = str(e)
+                raise
+            finally:
+                result['wall_time_sec'] = time.time() - start_time
+                result['num_queries'] = query_counter.count
+                result['peak_rss_kb'] = get_peak_rss_kb()
+                result['children_peak_rss_kb'] = get_peak_rss_kb(
+                        children=True)
+                self.stages.append(result)
+
+    def skip(self, name, reason):
+        """Records that the stage was not run.
+        """
+        self.stages.append({
+            'name': name,
+            'status': 'skipped',
+            'reason': reason,
+        })
+
+    def as_dict(self):
+        return {
+            'started': self.started.isoformat(),
+            'git_revision': get_git_revision(),
+            'hostname': platform.node(),
+            'python_version': platform.python_version(),
+            'config': self.config,
+            'stages': self.stages,
+        }
+
+    def write(self, output_fh):
+        json.dump(self.as_dict(), output_fh, indent=2, sort_keys=True)
+        output_fh.write('\n')
+
+
+class _QueryCounter(object):
+
+    def __init__(self):
+        self.count = 0
+
+
+class _QueryCountingCursorWrapper(util.CursorWrapper):
+    """Cursor that counts the queries it executes without keeping their sql,
+    which for bulk inserts would skew memory measurements.
+
+    Unlike recording into connection.queries, the count survives calls to
+    reset_queries(), which long-running stages make to bound memory.
+    """
+
+    def __init__(self, cursor, db, query_counter):
+        super(_QueryCountingCursorWrapper, self).__init__(cursor, db)
+        self.query_counter = query_counter
+
+    def execute(self, sql, params=()):
+        self.set_dirty()
+        self.query_counter.count += 1
+        return self.cursor.execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self.set_dirty()
+        self.query_counter.count += 1
+        return self.cursor.executemany(sql, param_list)
+
+
+@contextmanager
+def count_queries():
+    """Counts queries made through cursors of the default Django connection
+    opened in the with block. Yields an object whose count attribute holds
+    the count.
+    """
+    db = connections[DEFAULT_DB_ALIAS]
+    initial_use_debug_cursor = db.use_debug_cursor
+    initial_make_debug_cursor = db.__dict__.get('make_debug_cursor')
+    query_counter = _QueryCounter()
+    db.use_debug_cursor = True
+    db.make_debug_cursor = lambda cursor: _QueryCountingCursorWrapper(
+            cursor, db, query_counter)
+    try:
+        yield query_counter
+    finally:
+        db.use_debug_cursor = initial_use_debug_cursor
+        if initial_make_debug_cursor is None:
+            del db.make_debug_cursor
+        else:
+            db.make_debug_cursor = initial_make_debug_cursor
+
+
+def get_peak_rss_kb(children=False):
+    """Returns the peak resident set size, in kilobytes, of this process or
+    of its largest terminated child process.
+    """
+    if children:
+        who = resource.RUSAGE_CHILDREN
+    else:
+        who = resource.RUSAGE_SELF
+    max_rss = resource.getrusage(who).ru_maxrss
+
+    # Reported in bytes on OS X and kilobytes on Linux.
+    if sys.platform == 'darwin':
+        max_rss /= 1024
+    return max_rss
+
+
+def get_git_revision():
+    """Returns the commit the code is at, or None if unknown.
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                cwd=settings.PWD, stderr=subprocess.PIPE).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
@@ -0,0 +1,211 @@
+"""
+Per-base coverage of alignments, computed in a single pass over the bam and
+shared by everything that needs coverage (callable loci, coverage-based
+deletion detection, coverage stats for genome finishing).
+
+Arrays are stored as .npy files in a directory next to the bam and opened
+memory-mapped, so readers only page in the parts they touch.
+"""
+
+from collections import OrderedDict
+import json
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+import numpy as np
+import pysam
+
+
+# Number of reads spanning each base, counted the way a samtools pileup does
+# (i.e. including reads with a deletion at the base).
+COVERAGE_FIELD__DEPTH = 'depth'
+
+# Number of those reads with mapping quality below min_mapq.
+COVERAGE_FIELD__LOW_MAPQ_DEPTH = 'low_mapq_depth'
+
+# Number of those reads that align equally well elsewhere (AS <= XS).
+COVERAGE_FIELD__ALTALIGN_DEPTH = 'altalign_depth'
+
+COVERAGE_FIELDS = (
+    COVERAGE_FIELD__DEPTH,
+    COVERAGE_FIELD__LOW_MAPQ_DEPTH,
+    COVERAGE_FIELD__ALTALIGN_DEPTH,
+)
+
+COVERAGE_DTYPE = np.uint32
+
+MANIFEST_FILENAME = 'manifest.json'
+
+# Number of read start/end positions to buffer before adding them to the
+# per-base counts.
+READ_BUFFER_SIZE = 1000000
+
+
+def get_coverage_dir(bam_path):
+    """Returns the directory where per-base coverage of the bam is stored.
+    """
+    return bam_path + '.coverage'
+
+
+def get_per_base_coverage(bam_path, min_mapq=None):
+    """Returns per-base coverage of the bam, computing it first if it's
+    missing or out of date.
+
+    Args:
+        bam_path: Path to a sorted and indexed bam.
+        min_mapq: Reads with mapping quality below this count towards
+            COVERAGE_FIELD__LOW_MAPQ_DEPTH. Defaults to settings.CL__MIN_MAPQ.
+
+    Returns:
+        OrderedDict from chromosome name, in bam header order, to a dictionary
+        from each of COVERAGE_FIELDS to a read-only memory-mapped numpy array
+        with one count per base.
+    """
+    if min_mapq is None:
+        min_mapq = settings.CL__MIN_MAPQ
+
+    coverage_dir = get_coverage_dir(bam_path)
+    manifest = _read_manifest(coverage_dir)
+    if not _is_manifest_current(manifest, bam_path, min_mapq):
+        compute_per_base_coverage(bam_path, min_mapq)
+        manifest = _read_manifest(coverage_dir)
+
+    chrom_to_coverage = OrderedDict()
+    for chrom_idx, (chrom, _) in enumerate(manifest['chromosomes']):
+        chrom_to_coverage[chrom] = dict(
+                (field, np.load(
+                        _get_array_path(coverage_dir, chrom_idx, field),
+                        mmap_mode='r'))
+                for field in COVERAGE_FIELDS)
+    return chrom_to_coverage
+
+
+def compute_per_base_coverage(bam_path, min_mapq=None):
+    """Computes all COVERAGE_FIELDS for the bam in one pass over its reads
+    and writes them to get_coverage_dir(bam_path), replacing anything there.
+
+    Rather than a pileup, which visits every read at every base it covers,
+    each read adds +1 at its start and -1 at its end, and counts are the
+    cumulative sum. Reads are filtered as in a default pysam pileup.
+    """
+    if min_mapq is None:
+        min_mapq = settings.CL__MIN_MAPQ
+
+    coverage_dir = get_coverage_dir(bam_path)
+    temp_dir = tempfile.mkdtemp(prefix='.coverage_',
+            dir=os.path.dirname(os.path.abspath(bam_path)))
+    try:
+        bamfile = pysam.AlignmentFile(bam_path, 'rb')
+        chromosomes = zip(bamfile.references, bamfile.lengths)
+
+        for chrom_idx, (chrom, chrom_len) in enumerate(chromosomes):
+            accumulators = dict((field, _DepthAccumulator(chrom_len))
+                    for field in COVERAGE_FIELDS)
+
+            for read in bamfile.fetch(chrom):
+                if (read.is_unmapped or read.is_secondary or
+                        read.is_qcfail or read.is_duplicate):
+                    continue
+                start = read.reference_start
+                end = read.reference_end
+                accumulators[COVERAGE_FIELD__DEPTH].add(start, end)
+                if read.mapping_quality < min_mapq:
+                    accumulators[COVERAGE_FIELD__LOW_MAPQ_DEPTH].add(
+                            start, end)
+                if (read.has_tag('AS') and read.has_tag('XS') and
+                        read.get_tag('AS') <= read.get_tag('XS')):
+                    accumulators[COVERAGE_FIELD__ALTALIGN_DEPTH].add(
+                            start, end)
+
+            for field, accumulator in accumulators.iteritems():
+                out_arr = np.lib.format.open_memmap(
+                        _get_array_path(temp_dir, chrom_idx, field),
+                        mode='w+', dtype=COVERAGE_DTYPE, shape=(chrom_len,))
+                accumulator.write_depths(out_arr)
+                out_arr.flush()
+                del out_arr
+        bamfile.close()
+
+        manifest = _make_manifest(bam_path, min_mapq)
+        manifest['chromosomes'] = chromosomes
+        with open(os.path.join(temp_dir, MANIFEST_FILENAME), 'w') as fh:
+            json.dump(manifest, fh)
+
+        # Swap the new arrays in. Readers that already have the old arrays
+        # open keep their mappings.
+        if os.path.exists(coverage_dir):
+            shutil.rmtree(coverage_dir)
+        os.rename(temp_dir, coverage_dir)
+    finally:
+        if os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir)
+
+
+class _DepthAccumulator(object):
+    """Collects read intervals on a chromosome and turns them into per-base
+    counts.
+    """
+
+    def __init__(self, chrom_len):
+        self.chrom_len = chrom_len
+        self.delta = np.zeros(chrom_len + 1, dtype=np.int32)
+        self.starts = []
+        self.ends = []
+
+    def add(self, start, end):
+        self.starts.append(start)
+        self.ends.append(end)
+        if len(self.starts) >= READ_BUFFER_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if not self.starts:
+            return
+        self.delta += np.bincount(self.starts, minlength=self.chrom_len + 1)
+        self.delta -= np.bincount(self.ends, minlength=self.chrom_len + 1)
+        self.starts = []
+        self.ends = []
+
+    def write_depths(self, out_arr):
+        self._flush()
+        out_arr[:] = np.cumsum(self.delta[:self.chrom_len])
+
+
+def _get_array_path(coverage_dir, chrom_idx, field):
+    # Chromosome names may contain characters that aren't safe in filenames,
+    # so arrays are named by the chromosome's index in the bam header.
+    return os.path.join(coverage_dir, '%d.%s.npy' % (chrom_idx, field))
+
+
+def _read_manifest(coverage_dir):
+    manifest_path = os.path.join(coverage_dir, MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as fh:
+        return json.load(fh)
+
+
+def _make_manifest(bam_path, min_mapq):
+    """Returns the fields of the manifest that identify the bam and options
+    the coverage was computed from.
+    """
+    bam_stat = os.stat(bam_path)
+    return {
+        'bam_size': bam_stat.st_size,
+        'bam_mtime': bam_stat.st_mtime,
+        'min_mapq': min_mapq,
+    }
+
+
+def _is_manifest_current(manifest, bam_path, min_mapq):
+    """Coverage is out of date if the bam or options changed since it was
+    computed.
+    """
+    if manifest is None:
+        return False
+    for key, value in _make_manifest(bam_path, min_mapq).iteritems():
+        if manifest.get(key) != value:
+            return False
+    return True
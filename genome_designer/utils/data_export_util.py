@@ -6,12 +6,19 @@ from collections import OrderedDict
 import copy
 import csv
 from datetime import datetime
+import errno
+import json
 import os
-import re
 import StringIO
+import tarfile
+import threading
+import time
+from uuid import uuid4
 import zipfile
 
 from Bio import SeqIO
+from celery import task
+from celery.result import AsyncResult
 from django.conf import settings
 import vcf
 
@@ -422,36 +429,335 @@ def export_variant_set_as_vcf(variant_set, vcf_dest_path_or_filehandle):
         vcf_writer.write_record(record)
 
 
-def export_project_as_zip(project):
-    """Compresses project and generates link for download.
+# Common root for names of exported project archives.
+PROJECT_EXPORT_ROOT = 'millstone_export'
+
+PROJECT_EXPORT_FORMAT__ZIP = 'zip'
+PROJECT_EXPORT_FORMAT__TAR = 'tar'
+PROJECT_EXPORT_FORMAT__TAR_GZ = 'tar.gz'
+PROJECT_EXPORT_FORMAT__TAR_BZ2 = 'tar.bz2'
+
+# Modes for tarfile.open() that write tar archives as a stream, so that the
+# destination doesn't need to be seekable.
+TAR_EXPORT_FORMAT_TO_STREAM_MODE = {
+    PROJECT_EXPORT_FORMAT__TAR: 'w|',
+    PROJECT_EXPORT_FORMAT__TAR_GZ: 'w|gz',
+    PROJECT_EXPORT_FORMAT__TAR_BZ2: 'w|bz2',
+}
+
+PROJECT_EXPORT_FORMATS = [
+    PROJECT_EXPORT_FORMAT__ZIP,
+    PROJECT_EXPORT_FORMAT__TAR,
+    PROJECT_EXPORT_FORMAT__TAR_GZ,
+    PROJECT_EXPORT_FORMAT__TAR_BZ2,
+]
+
+PROJECT_EXPORT_STATUS__RUNNING = 'RUNNING'
+PROJECT_EXPORT_STATUS__COMPLETED = 'COMPLETED'
+PROJECT_EXPORT_STATUS__FAILED = 'FAILED'
+
+# Minimum number of seconds between progress updates of a running export.
+PROJECT_EXPORT_PROGRESS_INTERVAL = 2
+
+# Number of seconds without a status update after which a running export is
+# assumed lost, e.g. because its worker died.
+PROJECT_EXPORT_STALE_TIMEOUT = 60 * 60
+
+# Number of seconds after which a lock left by a crashed request to start an
+# export is ignored.
+PROJECT_EXPORT_START_LOCK_TIMEOUT = 60
+
+# Celery states of tasks that will never update the export status.
+PROJECT_EXPORT_DEAD_TASK_STATES = ['FAILURE', 'REVOKED']
+
+# Size of chunks read from the archive when streaming it.
+PROJECT_EXPORT_STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+def write_project_archive(project, dest_fh,
+        archive_format=PROJECT_EXPORT_FORMAT__ZIP, progress_callback=None):
+    """Writes all of the project's data files to an archive.
+
+    Files are copied into the archive one at a time, so memory use doesn't
+    grow with the size of the project. Paths in the archive start at the
+    project uid.
+
+    Args:
+        project: The Project to export.
+        dest_fh: File-like object to write the archive to. Must be seekable
+            for zip archives. Tar archives are written as a stream, so any
+            object with a write() method will do.
+        archive_format: One of PROJECT_EXPORT_FORMATS.
+        progress_callback: Optional function called with the number of bytes
+            added so far and the total number of bytes after each file.
+    """
+    if archive_format == PROJECT_EXPORT_FORMAT__ZIP:
+        archive = zipfile.ZipFile(dest_fh, 'w', allowZip64=True)
+        add_to_archive = archive.write
+    elif archive_format in TAR_EXPORT_FORMAT_TO_STREAM_MODE:
+        archive = tarfile.open(fileobj=dest_fh,
+                mode=TAR_EXPORT_FORMAT_TO_STREAM_MODE[archive_format])
+        add_to_archive = lambda path, arcname: archive.add(path,
+                arcname=arcname, recursive=False)
+    else:
+        raise ValueError('Unsupported export format: %s' % archive_format)
+
+    project_root_dir = project.get_model_data_dir()
+    archive_root_dir = os.path.dirname(project_root_dir)
+    path_size_list = []
+    for root, dirs, files in os.walk(project_root_dir):
+        dirs.sort()
+        for filename in sorted(files):
+            full_path = os.path.join(root, filename)
+            if os.path.isfile(full_path):
+                path_size_list.append(
+                        (full_path, os.path.getsize(full_path)))
+    total_bytes = sum(size for _, size in path_size_list)
+
+    bytes_done = 0
+    try:
+        for full_path, size in path_size_list:
+            add_to_archive(full_path,
+                    os.path.relpath(full_path, archive_root_dir))
+            bytes_done += size
+            if progress_callback is not None:
+                progress_callback(bytes_done, total_bytes)
+    finally:
+        archive.close()
+
+
+def stream_project_archive(project,
+        archive_format=PROJECT_EXPORT_FORMAT__TAR_GZ):
+    """Generator that yields the chunks of a tar archive of the project's
+    data files as they are written, e.g. for a StreamingHttpResponse.
+
+    The archive is written by a separate thread into a pipe, so that no more
+    than a pipe's worth of it is ever held in memory.
+    """
+    assert archive_format in TAR_EXPORT_FORMAT_TO_STREAM_MODE, (
+            "Only tar archives can be streamed.")
+    read_fd, write_fd = os.pipe()
+    writer_errors = []
+
+    def _write():
+        try:
+            with os.fdopen(write_fd, 'wb') as write_fh:
+                write_project_archive(project, write_fh,
+                        archive_format=archive_format)
+        except Exception as e:
+            writer_errors.append(e)
+
+    writer_thread = threading.Thread(target=_write)
+    writer_thread.daemon = True
+    writer_thread.start()
+
+    # Closing the read end, e.g. if the client goes away, makes the writer
+    # fail with a broken pipe and stop.
+    with os.fdopen(read_fd, 'rb') as read_fh:
+        while True:
+            data = read_fh.read(PROJECT_EXPORT_STREAM_CHUNK_SIZE)
+            if not data:
+                break
+            yield data
+    writer_thread.join()
+    if writer_errors:
+        raise writer_errors[0]
+
+
+def get_project_export_status_path(project):
+    """Returns the path of the json file that reports the status of the
+    latest export of the project.
+    """
+    return os.path.join(settings.TEMP_FILE_ROOT, '{root}_{uid}.json'.format(
+            root=PROJECT_EXPORT_ROOT, uid=project.uid))
+
+
+def get_project_export_status(project):
+    """Returns the status of the latest export of the project, as a dict
+    with keys:
+        status: One of the PROJECT_EXPORT_STATUS__* values.
+        format: The archive format.
+        bytes_done: Number of bytes of project data archived so far.
+        total_bytes: Total number of bytes of project data.
+        download_url: Url of the archive, once the export completes.
+        error: Error message, if the export failed.
+        task_id: Id of the celery task running the export.
+        updated_at: Time of the last status update, in seconds since the
+            epoch.
+
+    Returns None if the project was never exported.
+    """
+    status_path = get_project_export_status_path(project)
+    if not os.path.exists(status_path):
+        return None
+    with open(status_path) as status_fh:
+        return json.load(status_fh)
+
+
+def _set_project_export_status(project, export_status):
+    """Replaces the status file in one step so readers never see it half
+    written.
+    """
+    export_status['updated_at'] = time.time()
+    status_path = get_project_export_status_path(project)
+    with open(status_path + '.tmp', 'w') as status_fh:
+        json.dump(export_status, status_fh)
+    os.rename(status_path + '.tmp', status_path)
+
+
+def start_project_export(project, archive_format=PROJECT_EXPORT_FORMAT__ZIP):
+    """Starts exporting the project's data files as an archive in the
+    background, unless an export is already running.
+
+    A running export whose task died, or whose status hasn't been updated in
+    PROJECT_EXPORT_STALE_TIMEOUT seconds, is marked failed and replaced.
+
+    Returns:
+        Status dict of the export. See get_project_export_status().
+    """
+    if archive_format not in PROJECT_EXPORT_FORMATS:
+        raise ValueError('Unsupported export format: %s' % archive_format)
+
+    # Only one request at a time may check and start an export, so that
+    # concurrent requests don't start exports that delete each other's files.
+    if not _acquire_project_export_start_lock(project):
+        return get_project_export_status(project)
+    try:
+        export_status = get_project_export_status(project)
+        if (export_status is not None and export_status['status'] ==
+                PROJECT_EXPORT_STATUS__RUNNING):
+            if not _is_project_export_lost(export_status):
+                return export_status
+            export_status['status'] = PROJECT_EXPORT_STATUS__FAILED
+            export_status['error'] = 'Export was interrupted.'
+            _set_project_export_status(project, export_status)
+
+        # Delete previous exports of the project to avoid overwhelming space.
+        project_export_prefix = '{root}_{uid}_'.format(
+                root=PROJECT_EXPORT_ROOT, uid=project.uid)
+        for filename in os.listdir(settings.TEMP_FILE_ROOT):
+            if filename.startswith(project_export_prefix):
+                os.remove(os.path.join(settings.TEMP_FILE_ROOT, filename))
+
+        project_export_name = (
+                '{prefix}{proj_title}_{timestamp}.{ext}'.format(
+                        prefix=project_export_prefix,
+                        proj_title=lowercase_underscore(project.title[:20]),
+                        timestamp=datetime.now().strftime('%Y_%m_%d_%H%M'),
+                        ext=archive_format))
+
+        # The task id is recorded before the task starts, since the task
+        # reads the status.
+        task_id = str(uuid4())
+        export_status = {
+            'status': PROJECT_EXPORT_STATUS__RUNNING,
+            'format': archive_format,
+            'bytes_done': 0,
+            'total_bytes': None,
+            'download_url': None,
+            'error': None,
+            'task_id': task_id
+        }
+        _set_project_export_status(project, export_status)
+    finally:
+        _release_project_export_start_lock(project)
+
+    export_project_archive.apply_async(
+            args=[project, project_export_name], task_id=task_id)
+    return get_project_export_status(project)
+
+
+def _is_project_export_lost(export_status):
+    """Returns whether the running export will never finish, because its
+    task died or it stopped reporting progress.
+    """
+    task_state = None
+    if export_status.get('task_id'):
+        task_state = AsyncResult(export_status['task_id']).state
+    if task_state in PROJECT_EXPORT_DEAD_TASK_STATES:
+        return True
+
+    # Tasks known to be running may be archiving a single large file.
+    return bool(task_state != 'STARTED' and
+            time.time() - export_status.get('updated_at', 0) >
+                    PROJECT_EXPORT_STALE_TIMEOUT)
+
+
+def _get_project_export_start_lock_path(project):
+    return get_project_export_status_path(project) + '.lock'
+
+
+def _acquire_project_export_start_lock(project):
+    """Creates the lock file for starting an export of the project.
+
+    Returns:
+        Boolean indicating whether the lock was acquired. If not, another
+        request is starting an export.
+    """
+    lock_path = _get_project_export_start_lock_path(project)
+    for attempt in range(2):
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # Break locks left by requests that crashed while holding them.
+        try:
+            lock_age = time.time() - os.path.getmtime(lock_path)
+        except OSError:
+            continue
+        if lock_age < PROJECT_EXPORT_START_LOCK_TIMEOUT:
+            return False
+        _release_project_export_start_lock(project)
+    return False
+
+
+def _release_project_export_start_lock(project):
+    try:
+        os.remove(_get_project_export_start_lock_path(project))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+@task
+def export_project_archive(project, project_export_name):
+    """Celery task that writes the archive of the project's data files to
+    settings.TEMP_FILE_ROOT, reporting progress in the project's export
+    status. See start_project_export().
     """
-    # Common root for exported zip file.
-    COMMON_EXPORT_ROOT = 'millstone_export'
-
-    # Delete previous export files to avoid overwhelming space.
-    for f in os.listdir(settings.TEMP_FILE_ROOT):
-        if re.match(COMMON_EXPORT_ROOT, f):
-            os.remove(os.path.join(settings.TEMP_FILE_ROOT, f))
-
-    project_export_zip_name = (
-            '{common_root}_{proj_title}_{timestamp}.zip'.format(
-                    common_root=COMMON_EXPORT_ROOT,
-                    proj_title=lowercase_underscore(project.title[:20]),
-                    timestamp=datetime.now().strftime('%Y_%m_%d_%H%M')))
-    project_zip_dest = os.path.join(
-            settings.TEMP_FILE_ROOT, project_export_zip_name)
-    with zipfile.ZipFile(project_zip_dest, 'w', allowZip64=True) as ziph:
-        project_root_dir = project.get_model_data_dir()
-        for root, dirs, files in os.walk(project_root_dir):
-            for file in files:
-                full_path = os.path.join(root, file)
-                # Write to destination in archive that omits part of path
-                # before project uid.
-                archive_target_path = (
-                        re.search(project.uid + '.*', full_path).group())
-                ziph.write(full_path, archive_target_path)
-
-    return os.path.join('/tmp', project_export_zip_name)
+    export_status = get_project_export_status(project)
+    archive_dest = os.path.join(settings.TEMP_FILE_ROOT, project_export_name)
+
+    last_report_time = [time.time()]
+
+    def _report_progress(bytes_done, total_bytes):
+        export_status['bytes_done'] = bytes_done
+        export_status['total_bytes'] = total_bytes
+        if (time.time() - last_report_time[0] >
+                PROJECT_EXPORT_PROGRESS_INTERVAL):
+            _set_project_export_status(project, export_status)
+            last_report_time[0] = time.time()
+
+    try:
+        # Write under a temporary name so that an incomplete archive is never
+        # downloaded.
+        with open(archive_dest + '.part', 'wb') as archive_fh:
+            write_project_archive(project, archive_fh,
+                    archive_format=export_status['format'],
+                    progress_callback=_report_progress)
+        os.rename(archive_dest + '.part', archive_dest)
+    except Exception as e:
+        export_status['status'] = PROJECT_EXPORT_STATUS__FAILED
+        export_status['error'] = str(e)
+        _set_project_export_status(project, export_status)
+        raise
+
+    export_status['status'] = PROJECT_EXPORT_STATUS__COMPLETED
+    export_status['download_url'] = os.path.join('/tmp', project_export_name)
+    _set_project_export_status(project, export_status)
 
 
 CONTIG_CSV_FIELD_NAMES = [
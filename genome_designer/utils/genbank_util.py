@@ -1,6 +1,11 @@
-from Bio import SeqIO
-import pyinter
+from bisect import bisect_left
+from bisect import bisect_right
+from collections import namedtuple
+import os
 import pickle
+import threading
+
+from Bio import SeqIO
 
 from main.model_utils import get_dataset_with_type
 
@@ -48,33 +53,154 @@ def generate_genbank_mobile_element_multifasta(genbank_path, output_fasta_path):
             fh.write('\n')
 
 
+# A genbank feature, spanning [start, end). name is None for features without
+# a gene name or mobile element type.
+GenbankFeature = namedtuple('GenbankFeature', ['start', 'end', 'type', 'name'])
+
+# Version of the pickled GenbankFeatureIndex format. Indexes written before
+# versioning are plain lists of pyinter intervals.
+GBK_FEATURE_INDEX_FORMAT_VERSION = 2
+
+
+class GenbankFeatureIndex(object):
+    """Index of genbank features that answers overlap queries with binary
+    search.
+
+    For each chromosome, features are sorted by start, along with the running
+    maximum of their ends. Features that can overlap [start, end) are those
+    that start before end, found by bisecting the starts, and after the last
+    feature whose running maximum end is at most start, found by bisecting
+    the running maximum ends. Only features in between are checked.
+    """
+
+    def __init__(self, chrom_to_features):
+        """Constructor.
+
+        Args:
+            chrom_to_features: Dictionary from chromosome id to list of
+                GenbankFeature objects.
+        """
+        self.chrom_to_sorted_features = {}
+        self.chrom_to_starts = {}
+        self.chrom_to_max_ends = {}
+        for chrom, features in chrom_to_features.iteritems():
+            sorted_features = sorted(features)
+            max_ends = []
+            max_end = None
+            for feature in sorted_features:
+                max_end = max(max_end, feature.end)
+                max_ends.append(max_end)
+            self.chrom_to_sorted_features[chrom] = sorted_features
+            self.chrom_to_starts[chrom] = [
+                    feature.start for feature in sorted_features]
+            self.chrom_to_max_ends[chrom] = max_ends
+
+    def get_overlapping_features(self, start, end, chromosome=None):
+        """Returns features overlapping [start, end), ordered by start.
+
+        Args:
+            start: Start of the query interval.
+            end: End of the query interval, exclusive.
+            chromosome: Optional chromosome id. Features on any chromosome
+                are returned if not provided.
+        """
+        if chromosome is None or None in self.chrom_to_sorted_features:
+            # Indexes in the old format don't know features' chromosomes.
+            chroms = sorted(self.chrom_to_sorted_features.keys())
+        elif chromosome in self.chrom_to_sorted_features:
+            chroms = [chromosome]
+        else:
+            chroms = []
+
+        overlapping_features = []
+        for chrom in chroms:
+            sorted_features = self.chrom_to_sorted_features[chrom]
+            lo = bisect_right(self.chrom_to_max_ends[chrom], start)
+            hi = bisect_left(self.chrom_to_starts[chrom], end)
+            overlapping_features.extend([feature
+                    for feature in sorted_features[lo:hi]
+                    if feature.end > start])
+        return overlapping_features
+
+    def save(self, output_path):
+        chrom_to_feature_tuples = dict(
+                (chrom, [tuple(feature) for feature in features])
+                for chrom, features in
+                        self.chrom_to_sorted_features.iteritems())
+        with open(output_path, 'wb') as fh:
+            pickle.dump({
+                'format_version': GBK_FEATURE_INDEX_FORMAT_VERSION,
+                'chrom_to_features': chrom_to_feature_tuples
+            }, fh, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(clazz, index_path):
+        with open(index_path, 'rb') as fh:
+            index_data = pickle.load(fh)
+
+        if isinstance(index_data, list):
+            # Old format, a flat list of pyinter intervals with no
+            # chromosome.
+            return clazz({None: [
+                    GenbankFeature(f_ivl.lower_value, f_ivl.upper_value,
+                            f_ivl.type, getattr(f_ivl, 'name', None))
+                    for f_ivl in index_data]})
+
+        assert (index_data['format_version'] ==
+                GBK_FEATURE_INDEX_FORMAT_VERSION)
+        return clazz(dict(
+                (chrom, [GenbankFeature(*feature) for feature in features])
+                for chrom, features in
+                        index_data['chrom_to_features'].iteritems()))
+
+
+_feature_index_cache = {}
+_feature_index_cache_lock = threading.Lock()
+
+
+def load_gbk_feature_index(index_path):
+    """Returns the GenbankFeatureIndex stored at index_path, reusing the one
+    loaded before unless the file has changed since.
+    """
+    cache_key = (index_path, os.path.getmtime(index_path))
+    with _feature_index_cache_lock:
+        if cache_key in _feature_index_cache:
+            return _feature_index_cache[cache_key]
+    feature_index = GenbankFeatureIndex.load(index_path)
+    with _feature_index_cache_lock:
+        # Only keep the latest version of each index.
+        for key in _feature_index_cache.keys():
+            if key[0] == index_path:
+                del _feature_index_cache[key]
+        _feature_index_cache[cache_key] = feature_index
+    return feature_index
+
+
 def generate_gbk_feature_index(genbank_path, feature_index_output_path):
     """
-    Create a pickled pyinterval index of genbank features so we can pull
+    Create a pickled GenbankFeatureIndex of genbank features so we can pull
     them quickly.
     """
-
-    gbk_feature_list = []
+    chrom_to_features = {}
     with open(genbank_path, 'r') as fh:
         for seq_record in SeqIO.parse(fh, 'genbank'):
-            interval_list = []
+            features = chrom_to_features.setdefault(seq_record.id, [])
 
             for f in seq_record.features:
 
                 if f.type not in GBK_FEATURES_TO_EXTRACT:
                     continue
 
-                f_ivl = pyinter.closedopen(
-                        f.location.start, f.location.end)
-                f_ivl.type = f.type
-
                 if 'gene' in f.qualifiers:
-                    f_ivl.name = f.qualifiers['gene'][0]
+                    name = f.qualifiers['gene'][0]
                 elif 'mobile_element_type' in f.qualifiers:
-                    f_ivl.name = f.qualifiers['mobile_element_type'][0]
-                # For now, if the gene has no '.name' or '.mobile_element_type', ignore
-                gbk_feature_list.append(f_ivl)
+                    name = f.qualifiers['mobile_element_type'][0]
+                else:
+                    # For now, if the gene has no '.name' or
+                    # '.mobile_element_type', it's not shown.
+                    name = None
 
-    with open(feature_index_output_path, 'w') as fh:
-        pickle.dump(gbk_feature_list, fh)
+                features.append(GenbankFeature(int(f.location.start),
+                        int(f.location.end), f.type, name))
 
+    GenbankFeatureIndex(chrom_to_features).save(feature_index_output_path)
@@ -15,6 +15,8 @@ from tempfile import NamedTemporaryFile
 from BCBio import GFF
 from Bio import Entrez
 from Bio import SeqIO
+from celery import chain
+from celery import chord
 from celery import task
 from django.conf import settings
 from django.db import transaction
@@ -440,7 +442,8 @@ def create_samples_from_row_data(
     """Creates ExperimentSample objects along with their respective Datasets.
 
     The data is copied to the entity location. We block until we've created the
-    models, and then go async for actual copying.
+    models, and then go async for actual copying and QC. See
+    _start_experiment_sample_data_import().
 
     Args:
         project: Project these Samples should be added to.
@@ -458,6 +461,7 @@ def create_samples_from_row_data(
         List of ExperimentSamples.
     """
     experiment_samples = []
+    sample_rows = []
     for row in data_source_list:
         # Create ExperimentSample object and then store the data relative to
         # it.
@@ -481,14 +485,15 @@ def create_samples_from_row_data(
         _update_experiment_sample_data_for_row(experiment_sample, row,
                 PRE_DEFINED_SAMPLE_SERVER_COPY_HEADER_PARTS)
 
-        # Start the async job of copying.
-        copy_experiment_sample_data.delay(
-                project, experiment_sample, row, move=move, options=options)
-
         experiment_samples.append(experiment_sample)
+        sample_rows.append((experiment_sample, row))
 
     _update_experiment_sample_parentage(experiment_samples)
 
+    # Start the async jobs of copying and QC.
+    _start_experiment_sample_data_import(project, sample_rows, move=move,
+            options=options)
+
     return experiment_samples
 
 
@@ -520,64 +525,163 @@ def _copy_dataset_data(experiment_sample, fastq_source, dataset_type,
     return dataset
 
 
+def _start_experiment_sample_data_import(project, sample_rows, move=False,
+        options={}):
+    """Starts the async workflows that copy and run QC on the read files
+    for newly created ExperimentSamples.
+
+    Each sample gets its own workflow, whose tasks run in parallel across
+    read files:
+        1) Copy each read file into the sample's data dir.
+        2) Verify the sample's data and, unless options['skip_fastqc'],
+            run FastQC on each read file, followed by phred encoding
+            detection for the forward reads.
+        3) Persist the FastQC output of the sample to S3.
+
+    The tasks run on the settings.SAMPLE_IMPORT_QUEUE queue, so that a
+    dedicated worker can cap how many of them run at once (see
+    settings.SAMPLE_IMPORT_CONCURRENCY).
+
+    Workflows of different samples don't depend on each other, so a failure
+    only affects the Datasets of the sample it happens in, which are marked
+    FAILED.
+
+    Args:
+        project: Project the samples belong to.
+        sample_rows: List of (ExperimentSample, row data) pairs.
+        move: Whether to move the source data. Else copy.
+        options: Dictionary of options. See create_samples_from_row_data().
+
+    Returns:
+        List of AsyncResults, one for each sample's workflow.
+    """
+    sample_import_results = []
+    for experiment_sample, row in sample_rows:
+        read_dataset_ids = [dataset.id for dataset in
+                experiment_sample.dataset_set.filter(type__in=[
+                        Dataset.TYPE.FASTQ1, Dataset.TYPE.FASTQ2])]
+
+        copy_task_signatures = []
+        for dataset_type, source_key in (
+                (Dataset.TYPE.FASTQ1, 'Read_1_Path'),
+                (Dataset.TYPE.FASTQ2, 'Read_2_Path')):
+            fastq_source = row.get(source_key, '')
+            if not fastq_source:
+                continue
+            copy_task_signature = copy_experiment_sample_fastq.si(
+                    experiment_sample, fastq_source, dataset_type, move=move,
+                    project=project)
+            copy_task_signature.link_error(
+                    mark_datasets_failed.si(read_dataset_ids))
+            copy_task_signatures.append(copy_task_signature)
+
+        # NOTE: If any copy task fails, the chord callback never runs, so the
+        # errbacks above fail the sample's read Datasets rather than leaving
+        # them waiting for verification.
+        qc_start_signature = start_experiment_sample_qc.si(
+                project, experiment_sample, options)
+        qc_start_signature.link_error(
+                mark_datasets_failed.si(read_dataset_ids))
+        sample_import_results.append(
+                chord(copy_task_signatures, qc_start_signature).apply_async())
+    return sample_import_results
+
+
 @task
 @project_files_needed
-def copy_experiment_sample_data(
-        project, experiment_sample, data, move=False,
-        options={'skip_fastqc': False}):
-    """Celery task that wraps the process of copying the data for an
-    ExperimentSample.
+def copy_experiment_sample_fastq(experiment_sample, fastq_source,
+        dataset_type, move=False):
+    """Celery task that copies a single read file for an ExperimentSample.
     """
+    _copy_dataset_data(experiment_sample, fastq_source, dataset_type,
+            move=move)
 
-    # Copy read1.
-    read1_dataset = _copy_dataset_data(experiment_sample, data['Read_1_Path'],
-            Dataset.TYPE.FASTQ1, move=move)
-    # Copy read2.
-    maybe_read2_path = data.get('Read_2_Path', '')
-    if maybe_read2_path:
-        read2_dataset = _copy_dataset_data(experiment_sample, maybe_read2_path,
-                Dataset.TYPE.FASTQ2, move=move)
-    else:
-        read2_dataset = None
-
-    # Verification.
-    if read2_dataset is not None:
-        # Paired reads.
-        if (read1_dataset.filesystem_location ==
-                read2_dataset.filesystem_location):
-            # Make sure the files are not the same.
-            read1_dataset.status = Dataset.STATUS.FAILED
-            read2_dataset.status = Dataset.STATUS.FAILED
-
-            # TODO: Provide way for user to get an error message, similar to
-            # how make an error link for alignments.
-        else:
-            read1_dataset.status = Dataset.STATUS.READY
-            read1_dataset.save()
-            read2_dataset.status = Dataset.STATUS.READY
-            read2_dataset.save()
 
-    else:
+@task
+def start_experiment_sample_qc(project, experiment_sample, options={}):
+    """Celery task that verifies the copied data for an ExperimentSample
+    and starts the QC phase of its import.
+
+    Returns:
+        AsyncResult for the QC phase, or None if there is nothing to run.
+    """
+    read_datasets = _verify_experiment_sample_data(experiment_sample)
+    if options.get('skip_fastqc', False):
+        for dataset in read_datasets:
+            dataset.status = Dataset.STATUS.READY
+            dataset.save(update_fields=['status'])
+        return None
+
+    qc_task_signatures = []
+    for dataset in read_datasets:
+        dataset.status = Dataset.STATUS.QC
+        dataset.save(update_fields=['status'])
+        rev = bool(dataset.type == Dataset.TYPE.FASTQ2)
+        fastqc_signature = run_fastqc_on_sample_fastq.si(
+                experiment_sample, dataset, rev=rev,
+                source_dataset_status_on_success=Dataset.STATUS.READY)
+        if not rev:
+            fastqc_signature = chain(fastqc_signature,
+                    detect_phred_encoding.si(experiment_sample, dataset))
+        fastqc_signature.link_error(mark_datasets_failed.si([dataset.id]))
+        qc_task_signatures.append(fastqc_signature)
+
+    if not qc_task_signatures:
+        return None
+    return chord(qc_task_signatures,
+            persist_experiment_sample_qc.si(project, experiment_sample)
+    ).apply_async()
+
+
+@task
+@project_files_needed
+def persist_experiment_sample_qc(project, experiment_sample):
+    """Last task of the import of an ExperimentSample, run once its QC
+    tasks are done.
+
+    It does nothing itself. Wrapping it in project_files_needed uploads the
+    FastQC output written by the QC tasks, which aren't wrapped since
+    they're also run outside of imports.
+    """
+    pass
+
+
+@task
+def mark_datasets_failed(dataset_ids):
+    """Errback for the sample import tasks, which marks the Datasets they
+    were computing FAILED, unless they got to READY.
+    """
+    Dataset.objects.filter(id__in=dataset_ids).exclude(
+            status=Dataset.STATUS.READY).update(status=Dataset.STATUS.FAILED)
+
+
+def _verify_experiment_sample_data(experiment_sample):
+    """Checks the copied read Datasets for an ExperimentSample.
+
+    Datasets that fail verification are marked FAILED.
+
+    Returns:
+        List of read Datasets that passed verification.
+    """
+    read1_dataset = experiment_sample.dataset_set.get(
+            type=Dataset.TYPE.FASTQ1)
+    read2_datasets = experiment_sample.dataset_set.filter(
+            type=Dataset.TYPE.FASTQ2)
+    if not read2_datasets:
         # Unpaired.
-        read1_dataset.status = Dataset.STATUS.READY
-        read1_dataset.save()
-
-    # Quality Control via FASTQC and save.
-    read1_dataset.status = Dataset.STATUS.QC
-    read1_dataset.save()
-    if not options.get('skip_fastqc', False):
-        run_fastqc_on_sample_fastq(experiment_sample, read1_dataset)
-    read1_dataset.status = Dataset.STATUS.READY
-    read1_dataset.save()
-
-    if read2_dataset is not None:
-        read2_dataset.status = Dataset.STATUS.QC
-        read1_dataset.save()
-        if not options.get('skip_fastqc', False):
-            run_fastqc_on_sample_fastq(experiment_sample, read2_dataset,
-                    rev=True)
-        read2_dataset.status = Dataset.STATUS.READY
-        read2_dataset.save()
+        return [read1_dataset]
+
+    # Paired reads. Make sure the files are not the same.
+    read2_dataset = read2_datasets[0]
+    if (read1_dataset.filesystem_location ==
+            read2_dataset.filesystem_location):
+        # TODO: Provide way for user to get an error message, similar to
+        # how make an error link for alignments.
+        for dataset in (read1_dataset, read2_dataset):
+            dataset.status = Dataset.STATUS.FAILED
+            dataset.save(update_fields=['status'])
+        return []
+    return [read1_dataset, read2_dataset]
 
 
 @task
@@ -627,8 +731,6 @@ def run_fastqc_on_sample_fastq(
         print 'FastQC Failed for {}:\n{}'.format(
                     fastq_filename, fastqc_output)
 
-    set_phred_encoding(fastqc_filename, experiment_sample)
-
     fastqc_dataset = add_dataset_to_entity(experiment_sample,
             dataset_type, dataset_type, fastqc_filename)
     fastqc_dataset.status = Dataset.STATUS.READY
@@ -660,6 +762,20 @@ def _get_fastqc_path(fastq_dataset):
     return unzipped_fastq_filename + '_fastqc.html'
 
 
+@task
+def detect_phred_encoding(experiment_sample, source_fastq_dataset):
+    """Celery task that sets the phred encoding for the ExperimentSample
+    from the FastQC results for the fastq dataset.
+
+    Must run after run_fastqc_on_sample_fastq() for the dataset.
+    """
+    # Re-fetch since set_phred_encoding() saves the whole object, which may
+    # have been updated since this task was scheduled.
+    experiment_sample = ExperimentSample.objects.get(id=experiment_sample.id)
+    set_phred_encoding(_get_fastqc_path(source_fastq_dataset),
+            experiment_sample)
+
+
 def set_phred_encoding(fastqc_filename, experiment_sample):
     fastqc_filename_base = os.path.splitext(fastqc_filename)[0]
     fastqc_data_zip_path = fastqc_filename_base + '.zip'
@@ -966,8 +1082,10 @@ def import_variant_set_from_vcf(ref_genome, variant_set_name,
         _read_variant_set_file_as_csv(variant_set_file, ref_genome, dataset,
                 variant_set)
 
-    # These actions invalidate the materialized view.
-    ref_genome.invalidate_materialized_view()
+    # These actions invalidate the materialized view rows of the Variants
+    # in the set.
+    ref_genome.invalidate_materialized_view_for_variants(
+            variant_set.variants.values_list('id', flat=True))
 
 
 def _read_variant_set_file(variant_set_file, ref_genome, dataset,
@@ -1062,7 +1180,8 @@ def _read_variant_set_file_as_csv(variant_set_file, reference_genome,
             record = PseudoVCF(**record)
 
             # Get or create the Variant for this record.
-            # NOTE: No samples so query_cache is not necessary.
+            # NOTE: Variant sets are small, so a QueryCache, which loads every
+            # Variant of the genome, would cost more than it saves.
             variant, alts = get_or_create_variant(
                     reference_genome, record, dataset, query_cache=None)
 
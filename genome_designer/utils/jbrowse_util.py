@@ -22,15 +22,18 @@ main directory. It assumes that there won't be anything to overwrite (like two
 {trackname}/seq dirs).
 
 We perform this compile_tracklist_json() every time a link is asked for.
+To keep that cheap, a manifest next to the compiled trackList.json records the
+modification time of each individual trackList.json along with the tracks
+compiled from it, so only changed track directories are read again, and track
+subdirectories are symlinked into the main directory rather than copied.
 
 """
 
 from distutils.dir_util import mkpath
-import glob
 import json
 import os
-import shutil
 import subprocess
+import tempfile
 
 from main.model_utils import get_dataset_with_type
 from main.models import Dataset
@@ -43,6 +46,10 @@ from settings import TOOLS_DIR
 
 TABIX_BINARY = '%s/tabix/tabix' % TOOLS_DIR
 
+# Name of the manifest of compiled individual tracks, stored in the JBrowse
+# directory of each reference genome. See compile_tracklist_json().
+TRACKLIST_MANIFEST_FILENAME = 'trackListManifest.json'
+
 # TODO: Figure out better place to put this.
 # JBrowse requires the symlink path to exist. See settings.py
 # comments for more info.
@@ -93,18 +100,67 @@ def write_tracklist_json(reference_genome, dictionary, concurrent_id=None):
     json_track_fn = os.path.join(jbrowse_path, 'trackList.json')
 
     # Create a new or overwrite an old tracklist
-    with open(json_track_fn, 'w') as json_track_fh:
-        json_track_fh.write(json.dumps(dictionary))
+    _write_json_atomically(json_track_fn, dictionary)
+
+
+def _write_json_atomically(dest, dictionary):
+    """Writes the json to a temporary file and moves it into place, so that
+    readers never see a partially written file.
+    """
+    fd, temp_fn = tempfile.mkstemp(dir=os.path.dirname(dest),
+            prefix='.' + os.path.basename(dest))
+    with os.fdopen(fd, 'w') as temp_fh:
+        temp_fh.write(json.dumps(dictionary))
+    os.chmod(temp_fn, 0644)
+    os.rename(temp_fn, dest)
 
 def compile_tracklist_json(reference_genome):
     """
     Gathers all the individual tracks in the ./indiv_tracks
     directory and creates a new 'tracks' listing, keeping
     each track label unique.
+
+    Only individual track directories whose trackList.json changed since the
+    last compile are read; the rest come from the manifest.
     """
     jbrowse_path = reference_genome.get_jbrowse_directory_path()
     indiv_tracks_path = os.path.join(jbrowse_path,'indiv_tracks')
-    track_files = glob.glob(os.path.join(indiv_tracks_path,'*','trackList.json'))
+    manifest_fn = os.path.join(jbrowse_path, TRACKLIST_MANIFEST_FILENAME)
+
+    old_manifest = {}
+    if os.path.exists(manifest_fn):
+        try:
+            with open(manifest_fn) as manifest_fh:
+                old_manifest = json.load(manifest_fh)
+        except ValueError:
+            # Rebuild from scratch.
+            pass
+
+    track_dir_names = []
+    if os.path.isdir(indiv_tracks_path):
+        track_dir_names = sorted([name for name in os.listdir(indiv_tracks_path)
+                if not name.startswith('.')])
+
+    manifest = {}
+    for track_dir_name in track_dir_names:
+        track_fn = os.path.join(indiv_tracks_path, track_dir_name,
+                'trackList.json')
+        try:
+            track_fn_stat = os.stat(track_fn)
+        except OSError:
+            continue
+        signature = [track_fn_stat.st_mtime, track_fn_stat.st_size]
+
+        manifest_entry = old_manifest.get(track_dir_name, None)
+        if manifest_entry is None or manifest_entry['signature'] != signature:
+            manifest_entry = _compile_indiv_track_dir(jbrowse_path,
+                    track_dir_name)
+            manifest_entry['signature'] = signature
+        manifest[track_dir_name] = manifest_entry
+
+    if (manifest == old_manifest and
+            os.path.exists(os.path.join(jbrowse_path, 'trackList.json'))):
+        return
 
     # a dictionary of tracks by label. We assume here that all
     # tracks are unique by 'label' (which should really be called
@@ -112,48 +168,16 @@ def compile_tracklist_json(reference_genome):
     track_dict = {}
     consolidated_track_list = {}
 
-    for track_fn in track_files:
-
-        this_track_list = json.loads(open(track_fn).read())
-
-        # First, pop out off 'tracks' list from the json, and
-        # add them to the track_dict by label
-        for track in this_track_list.pop('tracks', []):
-            track_key = track['label']
-
-            track_dict[track_key] = track
-
-            # prepend the indiv_track subdir to any relative paths
-            if 'urlTemplate' in track:
-                if track['urlTemplate'].startswith('/'): continue
-
-                track['urlTemplate'] = os.path.join(
-                    'indiv_tracks',track_key, track['urlTemplate'])
-
-
-        # Finally, symlink any subdirs (seq, etc) into the root.
-        track_dir = os.path.dirname(track_fn)
-
-        for subdir in os.listdir(track_dir):
-            abs_subdir = os.path.join(track_dir, subdir)
-            if not os.path.isdir(abs_subdir): continue
-
-            try:
-                shutil.copytree(
-                    src= abs_subdir,
-                    dst= os.path.join(jbrowse_path,subdir),
-                    symlinks=True
-                )
-            except Exception as e:
-                print e
-                print 'Skipping dir {:s} because it already exists.'.format(
-                        subdir)
+    for track_dir_name in sorted(manifest.keys()):
+        manifest_entry = manifest[track_dir_name]
+        for track in manifest_entry['tracks']:
+            track_dict[track['label']] = track
 
         # (We're assuming here that any overwriting that individual
         # files do of these fields is not important. The only field
         # that I am aware of is 'formatVersion', and is 1 for all.)
         consolidated_track_list = merge_nested_dictionaries(
-                consolidated_track_list, this_track_list)
+                consolidated_track_list, manifest_entry['track_list'])
 
     # Add back all the tracks
     consolidated_track_list['tracks'] = track_dict.values()
@@ -162,6 +186,52 @@ def compile_tracklist_json(reference_genome):
     open(os.path.join(jbrowse_path, 'tracks.conf'), 'a',).close()
 
     write_tracklist_json(reference_genome, consolidated_track_list)
+    _write_json_atomically(manifest_fn, manifest)
+
+
+def _compile_indiv_track_dir(jbrowse_path, track_dir_name):
+    """Reads the trackList.json of an individual track directory and links
+    its subdirectories into the main JBrowse directory.
+
+    Returns:
+        Manifest entry, a dictionary with the tracks, their relative paths
+        made relative to the main directory, and the rest of the track list.
+    """
+    track_dir = os.path.join(jbrowse_path, 'indiv_tracks', track_dir_name)
+    with open(os.path.join(track_dir, 'trackList.json')) as track_fh:
+        this_track_list = json.load(track_fh)
+
+    # First, pop out off 'tracks' list from the json.
+    tracks = this_track_list.pop('tracks', [])
+    for track in tracks:
+        # prepend the indiv_track subdir to any relative paths
+        if 'urlTemplate' in track:
+            if track['urlTemplate'].startswith('/'): continue
+
+            track['urlTemplate'] = os.path.join(
+                'indiv_tracks', track['label'], track['urlTemplate'])
+
+    # Finally, symlink any subdirs (seq, etc) into the root. The first track
+    # to provide a subdir wins.
+    for subdir in os.listdir(track_dir):
+        abs_subdir = os.path.join(track_dir, subdir)
+        if not os.path.isdir(abs_subdir): continue
+
+        root_subdir = os.path.join(jbrowse_path, subdir)
+        if os.path.lexists(root_subdir): continue
+        try:
+            os.symlink(os.path.join('indiv_tracks', track_dir_name, subdir),
+                    root_subdir)
+        except OSError:
+            # Linked concurrently by another compile.
+            if not os.path.lexists(root_subdir):
+                raise
+
+    return {
+        'tracks': tracks,
+        'track_list': this_track_list
+    }
+
 
 def prepare_jbrowse_ref_sequence(reference_genome, **kwargs):
     """Prepare the reference sequence and place it in the ref_genome dir.
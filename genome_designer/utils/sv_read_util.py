@@ -0,0 +1,369 @@
+"""
+Classification of the reads of an alignment that indicate structural
+variants, e.g. split, discordant or unmapped reads.
+
+All requested classes are written in a single pass over the alignment bam,
+rather than one pass (or samtools pipeline) per class.
+"""
+
+from collections import defaultdict
+import os
+import re
+
+import numpy as np
+import pysam
+
+from utils.bam_utils import clipping_stats
+
+
+# Reads that align equally well elsewhere (AS <= XS).
+READ_CLASS__ALTALIGN = 'altalign'
+
+# Clipped reads stacked at positions with unusually many clipped reads.
+READ_CLASS__PILED = 'piled'
+
+# Reads with a high quality clipped end.
+READ_CLASS__CLIPPED = 'clipped'
+
+# Reads aligned in two parts by bwa mem, as extracted for lumpy.
+READ_CLASS__SPLIT = 'split'
+
+# Unmapped reads whose pair has no low quality read.
+READ_CLASS__UNMAPPED = 'unmapped'
+
+# Mapped pairs that aren't properly paired, with both mates on the same
+# chromosome.
+READ_CLASS__DISCORDANT = 'discordant'
+
+READ_CLASSES = (
+    READ_CLASS__ALTALIGN,
+    READ_CLASS__PILED,
+    READ_CLASS__CLIPPED,
+    READ_CLASS__SPLIT,
+    READ_CLASS__UNMAPPED,
+    READ_CLASS__DISCORDANT,
+)
+
+BAM_CMATCH = 0
+BAM_CINS = 1
+BAM_CSOFT_CLIP = 4
+BAM_CHARD_CLIP = 5
+BAM_CEQUAL = 7
+BAM_CDIFF = 8
+CLIP_OPS = (BAM_CSOFT_CLIP, BAM_CHARD_CLIP)
+ALIGNED_QUERY_OPS = (BAM_CMATCH, BAM_CINS, BAM_CEQUAL, BAM_CDIFF)
+CIGAR_OP_CHARS = 'MIDNSHP=X'
+
+CIGAR_STRING_RE = re.compile(r'(\d+)([MIDNSHP=X])')
+
+# Shift of the phred scores of each encoding relative to Sanger.
+PHRED_ENCODING_TO_SHIFT = {
+    'Illumina 1.5': 31,
+    'Sanger / Illumina 1.9': 0
+}
+
+# Minimum length of clipping for a read to be clipped, and minimum average
+# phred score of the clipped bases.
+CLIPPED__MIN_CLIPPING = 8
+CLIPPED__MIN_AVG_PHRED = 20
+
+# Number of reads sampled to choose the clipping threshold of piled reads.
+PILED__CLIPPING_STATS_SAMPLE_SIZE = 10000
+
+# Clipped reads are piled if more of them are stacked at a position than
+# this many standard deviations above the mean.
+PILED__STACKING_STDEVS = 3
+
+# Split reads may have at most this many alignments, and each alignment
+# must cover at least SPLIT__MIN_NON_OVERLAP bases of the read not covered
+# by the other. These match the defaults of lumpy's extractSplitReads_BwaMem.
+SPLIT__MAX_ALIGNMENTS = 2
+SPLIT__MIN_NON_OVERLAP = 20
+
+# Unmapped reads are dropped, together with their mate, if either has an
+# average phred score below this.
+UNMAPPED__MIN_AVG_PHRED = 20
+
+
+def classify_sv_reads(input_bam_path, read_class_to_output_path,
+        combined_output_path=None, phred_encoding=None,
+        piled_clipping_threshold=None):
+    """Writes the reads of each requested class to its own bam, in a single
+    pass over the input bam.
+
+    Reads keep the order of the input, so outputs of a coordinate sorted bam
+    are coordinate sorted, except that piled reads are grouped by pile.
+
+    Args:
+        input_bam_path: Path to the alignment bam.
+        read_class_to_output_path: Dictionary from each of READ_CLASSES to
+            write to the path of its bam. A class whose path is None is only
+            written to the combined bam.
+        combined_output_path: If given, path of a bam to which each read in
+            any of the requested classes is written once.
+        phred_encoding: Phred encoding of the sample's reads, as detected by
+            fastqc. Used for clipped reads.
+        piled_clipping_threshold: Minimum clipping of piled reads. Defaults
+            to the mean plus one standard deviation of the clipping of a
+            sample of reads.
+
+    Returns:
+        Dictionary from each requested read class to the number of reads
+        written to its bam.
+    """
+    for read_class in read_class_to_output_path:
+        assert read_class in READ_CLASSES, (
+                "Unknown read class '%s'." % read_class)
+
+    if (READ_CLASS__PILED in read_class_to_output_path and
+            piled_clipping_threshold is None):
+        stats = clipping_stats(input_bam_path,
+                sample_size=PILED__CLIPPING_STATS_SAMPLE_SIZE)
+        piled_clipping_threshold = int(stats['mean'] + stats['std'])
+
+    min_clipped_phred = CLIPPED__MIN_AVG_PHRED + PHRED_ENCODING_TO_SHIFT.get(
+            phred_encoding, 0)
+
+    # The tests for each class that can be decided read by read.
+    read_class_to_test = {
+        READ_CLASS__ALTALIGN: _is_altalign,
+        READ_CLASS__CLIPPED: lambda read: _is_clipped(read,
+                CLIPPED__MIN_CLIPPING, min_clipped_phred),
+        READ_CLASS__SPLIT: _is_split,
+        READ_CLASS__DISCORDANT: _is_discordant,
+    }
+    per_read_tests = [(read_class, test)
+            for read_class, test in read_class_to_test.iteritems()
+            if read_class in read_class_to_output_path]
+    check_piled = READ_CLASS__PILED in read_class_to_output_path
+    check_unmapped = READ_CLASS__UNMAPPED in read_class_to_output_path
+
+    assert combined_output_path is not None or all(
+            read_class_to_output_path.values()), (
+            "Read classes without a bam need a combined bam.")
+
+    input_af = pysam.AlignmentFile(input_bam_path, 'rb')
+    read_class_to_output_af = dict(
+            (read_class, pysam.AlignmentFile(output_path, 'wb',
+                    template=input_af)
+                    if output_path is not None else None)
+            for read_class, output_path
+            in read_class_to_output_path.iteritems())
+    if check_unmapped:
+        # Unmapped reads are filtered by the quality of their mate, which may
+        # come later, so they are collected in a separate bam first.
+        unmapped_unfiltered_path = '_unfiltered'.join(os.path.splitext(
+                read_class_to_output_path[READ_CLASS__UNMAPPED] or
+                combined_output_path))
+        unmapped_unfiltered_af = pysam.AlignmentFile(
+                unmapped_unfiltered_path, 'wb', template=input_af)
+    if combined_output_path is not None:
+        combined_af = pysam.AlignmentFile(combined_output_path, 'wb',
+                template=input_af)
+    else:
+        combined_af = None
+
+    read_class_to_count = dict(
+            (read_class, 0) for read_class in read_class_to_output_path)
+
+    # Positions of left and right clipped piled read candidates, to lists of
+    # (read, whether written to combined_af already).
+    left_clipped = defaultdict(list)
+    right_clipped = defaultdict(list)
+
+    low_quality_unmapped_qnames = set()
+
+    for read in input_af.fetch(until_eof=True):
+        in_any_class = False
+        for read_class, test in per_read_tests:
+            if test(read):
+                output_af = read_class_to_output_af[read_class]
+                if output_af is None:
+                    pass
+                elif read_class == READ_CLASS__SPLIT:
+                    _write_split_read(output_af, read)
+                else:
+                    output_af.write(read)
+                read_class_to_count[read_class] += 1
+                in_any_class = True
+
+        if in_any_class and combined_af is not None:
+            combined_af.write(read)
+
+        if check_piled and read.cigartuples is not None:
+            left_clipping, right_clipping = _get_terminal_clipping(read)
+            if max(left_clipping, right_clipping) > piled_clipping_threshold:
+                if left_clipping > right_clipping:
+                    left_clipped[read.reference_start].append(
+                            (read, in_any_class))
+                elif right_clipping > left_clipping:
+                    right_clipped[read.reference_end].append(
+                            (read, in_any_class))
+
+        if check_unmapped and read.is_unmapped:
+            unmapped_unfiltered_af.write(read)
+            if (read.query_qualities is None or
+                    np.mean(read.query_qualities) < UNMAPPED__MIN_AVG_PHRED):
+                low_quality_unmapped_qnames.add(read.query_name)
+    input_af.close()
+
+    if check_piled:
+        piled_af = read_class_to_output_af[READ_CLASS__PILED]
+        for clipped_dict in [left_clipped, right_clipped]:
+            if not clipped_dict:
+                continue
+            stack_counts = map(len, clipped_dict.values())
+            stacking_cutoff = (np.mean(stack_counts) +
+                    PILED__STACKING_STDEVS * np.std(stack_counts))
+            for read_list in clipped_dict.values():
+                if len(read_list) <= stacking_cutoff:
+                    continue
+                for read, in_combined in read_list:
+                    if piled_af is not None:
+                        piled_af.write(read)
+                    read_class_to_count[READ_CLASS__PILED] += 1
+                    if combined_af is not None and not in_combined:
+                        combined_af.write(read)
+
+    if check_unmapped:
+        unmapped_unfiltered_af.close()
+        unmapped_unfiltered_af = pysam.AlignmentFile(
+                unmapped_unfiltered_path, 'rb')
+        unmapped_af = read_class_to_output_af[READ_CLASS__UNMAPPED]
+        for read in unmapped_unfiltered_af.fetch(until_eof=True):
+            if read.query_name in low_quality_unmapped_qnames:
+                continue
+            if unmapped_af is not None:
+                unmapped_af.write(read)
+            read_class_to_count[READ_CLASS__UNMAPPED] += 1
+            if combined_af is not None:
+                # Unmapped reads aren't in any other class.
+                combined_af.write(read)
+        unmapped_unfiltered_af.close()
+        os.remove(unmapped_unfiltered_path)
+
+    for output_af in read_class_to_output_af.itervalues():
+        if output_af is not None:
+            output_af.close()
+    if combined_af is not None:
+        combined_af.close()
+
+    return read_class_to_count
+
+
+def _get_terminal_clipping(read):
+    """Returns the number of bases clipped at the left and right end of the
+    read.
+    """
+    cigartuples = read.cigartuples
+    left_clipping = (cigartuples[0][1]
+            if cigartuples[0][0] in CLIP_OPS else 0)
+    right_clipping = (cigartuples[-1][1]
+            if cigartuples[-1][0] in CLIP_OPS else 0)
+    return left_clipping, right_clipping
+
+
+def _is_altalign(read):
+    return (read.has_tag('AS') and read.has_tag('XS') and
+            read.get_tag('AS') <= read.get_tag('XS'))
+
+
+def _is_clipped(read, min_clipping, min_avg_phred):
+    """Whether either end of the read has more than min_clipping clipped
+    bases with an average phred score above min_avg_phred.
+    """
+    # Unmapped.
+    if read.cigartuples is None:
+        return False
+
+    if read.is_secondary or read.is_supplementary:
+        return False
+
+    # TODO: Account for template length
+    # adapter_overlap = max(read.template_length - query_alignment_length, 0)
+    left_clipping, right_clipping = _get_terminal_clipping(read)
+    query_qualities = read.query_qualities
+    if query_qualities is None:
+        return False
+    if (left_clipping > min_clipping and
+            np.mean(query_qualities[:left_clipping]) > min_avg_phred):
+        return True
+    if (right_clipping > min_clipping and
+            np.mean(query_qualities[-right_clipping:]) > min_avg_phred):
+        return True
+    return False
+
+
+def _is_split(read):
+    """Whether bwa mem aligned the read in two parts, each covering enough of
+    the read, and its mate is on the same chromosome.
+
+    Follows lumpy's extractSplitReads_BwaMem, which looks at the SA tag.
+    """
+    if read.is_duplicate or not _is_mate_on_same_chromosome(read):
+        return False
+    if not read.has_tag('SA'):
+        return False
+
+    other_alignments = read.get_tag('SA').rstrip(';').split(';')
+    if len(other_alignments) + 1 > SPLIT__MAX_ALIGNMENTS:
+        return False
+
+    # SA entries are rname,pos,strand,CIGAR,mapQ,NM.
+    _, _, other_strand, other_cigar, _, _ = other_alignments[0].split(',')
+    other_cigartuples = [(CIGAR_OP_CHARS.index(op), int(length))
+            for length, op in CIGAR_STRING_RE.findall(other_cigar)]
+
+    read_start, read_end = _get_query_interval(
+            read.cigartuples, read.is_reverse)
+    other_start, other_end = _get_query_interval(
+            other_cigartuples, other_strand == '-')
+    overlap = max(0, min(read_end, other_end) - max(read_start, other_start))
+    min_non_overlap = min(
+            read_end - read_start - overlap,
+            other_end - other_start - overlap)
+    return min_non_overlap >= SPLIT__MIN_NON_OVERLAP
+
+
+def _get_query_interval(cigartuples, is_reverse):
+    """Returns the half-open interval of the original read, before reverse
+    complementing, covered by an alignment with the given cigar.
+    """
+    if is_reverse:
+        cigartuples = cigartuples[::-1]
+    start = 0
+    aligned_length = 0
+    for op, length in cigartuples:
+        if op in CLIP_OPS:
+            if aligned_length == 0:
+                start += length
+        elif op in ALIGNED_QUERY_OPS:
+            aligned_length += length
+    return start, start + aligned_length
+
+
+def _write_split_read(output_af, read):
+    """Writes the split read with the read of the pair it is appended to its
+    name, as lumpy expects, leaving the read itself unchanged.
+    """
+    query_name = read.query_name
+    read.query_name = query_name + ('_1' if read.is_read1 else '_2')
+    output_af.write(read)
+    read.query_name = query_name
+
+
+def _is_discordant(read):
+    """Whether the read is a mapped primary alignment of a pair, not properly
+    paired, with its mate mapped to the same chromosome.
+    """
+    return (not read.is_proper_pair and
+            not read.is_secondary and
+            not read.is_unmapped and
+            not read.mate_is_unmapped and
+            not read.is_duplicate and
+            _is_mate_on_same_chromosome(read))
+
+
+def _is_mate_on_same_chromosome(read):
+    return (read.reference_id >= 0 and
+            read.next_reference_id == read.reference_id)
@@ -0,0 +1,71 @@
+"""
+Tests for bam_utils.py.
+"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+
+from django.conf import settings
+from django.test import TestCase
+import pysam
+
+from utils.bam_utils import _open_fifo_for_writing
+from utils.bam_utils import filter_bam_file_by_row
+
+
+TEST_DISC_SPLIT_BAM = os.path.join(settings.PWD, 'test_data',
+        'discordant_split_reads', 'bwa_align.bam')
+
+
+def _read_keys(bam_path):
+    """Returns the list of (name, flag, position) of the reads in the bam.
+    """
+    bam_af = pysam.AlignmentFile(bam_path, 'rb')
+    keys = [(read.query_name, read.flag, read.reference_start)
+            for read in bam_af.fetch(until_eof=True)]
+    bam_af.close()
+    return keys
+
+
+class TestFilterBamFileByRow(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _assert_filters_reverse_reads(self, num_threads):
+        output_bam_path = os.path.join(self.temp_dir, 'filtered.bam')
+        filter_bam_file_by_row(TEST_DISC_SPLIT_BAM,
+                lambda read: read.is_reverse, output_bam_path,
+                num_threads=num_threads)
+
+        expected_keys = [key for key in _read_keys(TEST_DISC_SPLIT_BAM)
+                if key[1] & 0x10]
+        self.assertTrue(len(expected_keys) > 0)
+        self.assertEqual(expected_keys, _read_keys(output_bam_path))
+
+        # Header is kept and no intermediates are left behind.
+        self.assertEqual(
+                pysam.AlignmentFile(TEST_DISC_SPLIT_BAM, 'rb').references,
+                pysam.AlignmentFile(output_bam_path, 'rb').references)
+        self.assertEqual(['filtered.bam'], os.listdir(self.temp_dir))
+
+    def test_filter(self):
+        self._assert_filters_reverse_reads(1)
+
+    def test_filter__samtools_threads(self):
+        self._assert_filters_reverse_reads(2)
+
+    def test_open_fifo__reader_exits(self):
+        """Opening the fifo fails rather than hangs if samtools has exited.
+        """
+        fifo_path = os.path.join(self.temp_dir, 'fifo')
+        os.mkfifo(fifo_path)
+        reader_proc = subprocess.Popen(['true'])
+        reader_proc.wait()
+        with self.assertRaises(subprocess.CalledProcessError):
+            _open_fifo_for_writing(fifo_path, reader_proc)
@@ -0,0 +1,69 @@
+"""
+Tests for benchmark_util.py.
+"""
+
+import json
+from StringIO import StringIO
+
+from django.db import connection
+from django.db import reset_queries
+from django.test import TestCase
+
+from main.models import Project
+from utils.benchmark_util import BenchmarkReport
+from utils.benchmark_util import count_queries
+
+
+class TestBenchmarkReport(TestCase):
+
+    def test_stages(self):
+        report = BenchmarkReport(config={'num_samples': 2})
+
+        with report.stage('count_projects', num_samples=2) as stage_result:
+            stage_result['num_projects'] = Project.objects.count()
+            Project.objects.count()
+
+        with self.assertRaises(ValueError):
+            with report.stage('fails'):
+                raise ValueError('Expected.')
+
+        report.skip('skipped', 'No data.')
+
+        output = StringIO()
+        report.write(output)
+        report_dict = json.loads(output.getvalue())
+        self.assertEqual({'num_samples': 2}, report_dict['config'])
+
+        stages = report_dict['stages']
+        self.assertEqual(['count_projects', 'fails', 'skipped'],
+                [stage['name'] for stage in stages])
+
+        self.assertEqual('ok', stages[0]['status'])
+        self.assertEqual(2, stages[0]['num_queries'])
+        self.assertEqual(2, stages[0]['num_samples'])
+        self.assertEqual(0, stages[0]['num_projects'])
+        self.assertTrue(stages[0]['wall_time_sec'] >= 0)
+        self.assertTrue(stages[0]['peak_rss_kb'] > 0)
+
+        self.assertEqual('failed', stages[1]['status'])
+        self.assertEqual('Expected.', stages[1]['error'])
+        self.assertEqual(0, stages[1]['num_queries'])
+
+        self.assertEqual('skipped', stages[2]['status'])
+        self.assertFalse('wall_time_sec' in stages[2])
+
+    def test_count_queries_restores_connection(self):
+        initial_use_debug_cursor = connection.use_debug_cursor
+        initial_queries = connection.queries
+        with count_queries() as query_counter:
+            Project.objects.count()
+        self.assertEqual(1, query_counter.count)
+        self.assertEqual(initial_use_debug_cursor, connection.use_debug_cursor)
+        self.assertTrue(initial_queries is connection.queries)
+
+    def test_count_queries_survives_reset_queries(self):
+        with count_queries() as query_counter:
+            Project.objects.count()
+            reset_queries()
+            Project.objects.count()
+        self.assertEqual(2, query_counter.count)
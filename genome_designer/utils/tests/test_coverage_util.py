@@ -0,0 +1,69 @@
+"""
+Tests for coverage_util.py.
+"""
+
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.test import TestCase
+import pysam
+
+from utils.coverage_util import COVERAGE_FIELD__ALTALIGN_DEPTH
+from utils.coverage_util import COVERAGE_FIELD__DEPTH
+from utils.coverage_util import COVERAGE_FIELD__LOW_MAPQ_DEPTH
+from utils.coverage_util import get_coverage_dir
+from utils.coverage_util import get_per_base_coverage
+
+
+TEST_BAM = os.path.join(settings.PWD, 'test_data', 'genome_finish_test',
+        'small_mg1655_data', '1kb_ins_del_1000', 'bwa_align.sorted.withmd.bam')
+
+
+class TestPerBaseCoverage(TestCase):
+
+    def setUp(self):
+        # Copy the bam so coverage isn't written into test_data.
+        self.temp_dir = tempfile.mkdtemp()
+        self.bam = os.path.join(self.temp_dir, 'bwa_align.bam')
+        shutil.copy(TEST_BAM, self.bam)
+        shutil.copy(TEST_BAM + '.bai', self.bam + '.bai')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_matches_pileup(self):
+        MIN_MAPQ = 20
+        chrom_to_coverage = get_per_base_coverage(self.bam, MIN_MAPQ)
+        self.assertTrue(os.path.exists(get_coverage_dir(self.bam)))
+
+        bamfile = pysam.AlignmentFile(self.bam, 'rb')
+        self.assertEqual(list(bamfile.references), chrom_to_coverage.keys())
+
+        for chrom, chrom_len in zip(bamfile.references, bamfile.lengths):
+            coverage = chrom_to_coverage[chrom]
+            self.assertEqual(chrom_len, len(coverage[COVERAGE_FIELD__DEPTH]))
+            for pileup_col in bamfile.pileup(chrom, truncate=True):
+                pos = pileup_col.reference_pos
+                reads = [p.alignment for p in pileup_col.pileups]
+                self.assertEqual(pileup_col.nsegments,
+                        coverage[COVERAGE_FIELD__DEPTH][pos])
+                self.assertEqual(
+                        sum(r.mapping_quality < MIN_MAPQ for r in reads),
+                        coverage[COVERAGE_FIELD__LOW_MAPQ_DEPTH][pos])
+                self.assertEqual(
+                        sum(r.get_tag('AS') <= r.get_tag('XS') for r in reads
+                                if r.has_tag('AS') and r.has_tag('XS')),
+                        coverage[COVERAGE_FIELD__ALTALIGN_DEPTH][pos])
+        bamfile.close()
+
+    def test_recomputes_when_options_change(self):
+        chrom_to_coverage = get_per_base_coverage(self.bam, 255)
+        for coverage in chrom_to_coverage.values():
+            self.assertTrue(coverage[COVERAGE_FIELD__LOW_MAPQ_DEPTH].any())
+
+        # No read has mapping quality below 0.
+        chrom_to_coverage = get_per_base_coverage(self.bam, 0)
+        for coverage in chrom_to_coverage.values():
+            self.assertFalse(coverage[COVERAGE_FIELD__LOW_MAPQ_DEPTH].any())
@@ -1,7 +1,12 @@
 """Tests for data_export_util.py.
 """
 
+import json
+import os
 import StringIO
+import tarfile
+import time
+import zipfile
 
 from django.test import TestCase
 import vcf
@@ -12,7 +17,19 @@ from main.models import VariantAlternate
 from main.models import VariantSet
 from main.models import VariantToVariantSet
 from main.testing_util import create_common_entities
+from utils.data_export_util import _acquire_project_export_start_lock
+from utils.data_export_util import _release_project_export_start_lock
+from utils.data_export_util import _set_project_export_status
 from utils.data_export_util import export_variant_set_as_vcf
+from utils.data_export_util import get_project_export_status
+from utils.data_export_util import get_project_export_status_path
+from utils.data_export_util import PROJECT_EXPORT_FORMAT__TAR_GZ
+from utils.data_export_util import PROJECT_EXPORT_STALE_TIMEOUT
+from utils.data_export_util import PROJECT_EXPORT_STATUS__COMPLETED
+from utils.data_export_util import PROJECT_EXPORT_STATUS__RUNNING
+from utils.data_export_util import start_project_export
+from utils.data_export_util import stream_project_archive
+from utils.data_export_util import write_project_archive
 
 
 class TestExportVariantSetAsVcf(TestCase):
@@ -54,3 +71,102 @@ class TestExportVariantSetAsVcf(TestCase):
             row_count += 1
 
         self.assertEqual(10, row_count)
+
+
+class TestExportProject(TestCase):
+
+    def setUp(self):
+        """Override.
+        """
+        self.common_entities = create_common_entities()
+        self.project = self.common_entities['project']
+
+        # Add a file in a nested dir.
+        self.project_dir = self.project.get_model_data_dir()
+        nested_dir = os.path.join(self.project_dir, 'nested')
+        if not os.path.exists(nested_dir):
+            os.makedirs(nested_dir)
+        with open(os.path.join(nested_dir, 'data.txt'), 'w') as fh:
+            fh.write('some data')
+
+        self.expected_names = set()
+        for root, dirs, files in os.walk(self.project_dir):
+            for filename in files:
+                self.expected_names.add(os.path.relpath(
+                        os.path.join(root, filename),
+                        os.path.dirname(self.project_dir)))
+
+    def test_write_project_archive__zip(self):
+        progress = []
+        output_fh = StringIO.StringIO()
+        write_project_archive(self.project, output_fh,
+                progress_callback=lambda done, total: progress.append(
+                        (done, total)))
+
+        output_fh.seek(0)
+        archive = zipfile.ZipFile(output_fh)
+        self.assertEqual(self.expected_names, set(archive.namelist()))
+        self.assertEqual('some data', archive.read(
+                os.path.join(self.project.uid, 'nested', 'data.txt')))
+
+        # Progress is reported after each file, ending with all bytes done.
+        self.assertEqual(len(self.expected_names), len(progress))
+        self.assertEqual(progress[-1][1], progress[-1][0])
+
+    def test_stream_project_archive(self):
+        output_fh = StringIO.StringIO(''.join(stream_project_archive(
+                self.project, archive_format=PROJECT_EXPORT_FORMAT__TAR_GZ)))
+        archive = tarfile.open(fileobj=output_fh, mode='r:gz')
+        self.assertEqual(self.expected_names, set(archive.getnames()))
+
+    def test_start_project_export(self):
+        # Celery tasks run synchronously in tests.
+        start_project_export(self.project)
+        export_status = get_project_export_status(self.project)
+        self.assertEqual(PROJECT_EXPORT_STATUS__COMPLETED,
+                export_status['status'])
+        self.assertEqual(export_status['total_bytes'],
+                export_status['bytes_done'])
+        self.assertTrue(export_status['download_url'].endswith('.zip'))
+
+    def _set_running_status(self):
+        export_status = {
+            'status': PROJECT_EXPORT_STATUS__RUNNING,
+            'format': 'zip',
+            'bytes_done': 0,
+            'total_bytes': None,
+            'download_url': None,
+            'error': None,
+            'task_id': None
+        }
+        _set_project_export_status(self.project, export_status)
+        return export_status
+
+    def test_start_project_export__already_running(self):
+        self._set_running_status()
+        export_status = start_project_export(self.project)
+        self.assertEqual(PROJECT_EXPORT_STATUS__RUNNING,
+                export_status['status'])
+
+    def test_start_project_export__lost(self):
+        # An export that stopped updating its status is replaced.
+        export_status = self._set_running_status()
+        export_status['updated_at'] = (
+                time.time() - PROJECT_EXPORT_STALE_TIMEOUT - 1)
+        with open(get_project_export_status_path(self.project), 'w') as fh:
+            json.dump(export_status, fh)
+
+        export_status = start_project_export(self.project)
+        self.assertEqual(PROJECT_EXPORT_STATUS__COMPLETED,
+                export_status['status'])
+
+    def test_start_project_export__concurrent_start(self):
+        # Another request holds the lock, so no export is started.
+        self.assertTrue(_acquire_project_export_start_lock(self.project))
+        try:
+            self.assertFalse(_acquire_project_export_start_lock(self.project))
+            self.assertEqual(None, start_project_export(self.project))
+        finally:
+            _release_project_export_start_lock(self.project)
+        self.assertEqual(PROJECT_EXPORT_STATUS__COMPLETED,
+                start_project_export(self.project)['status'])
@@ -1,4 +1,6 @@
 import os
+import shutil
+import tempfile
 
 from django.conf import settings
 from django.test import TestCase
@@ -7,11 +9,15 @@ from main.model_utils import get_dataset_with_type
 from main.models import Chromosome
 from main.models import Dataset
 from main.testing_util import create_common_entities
+from utils.genbank_util import generate_gbk_feature_index
+from utils.genbank_util import load_gbk_feature_index
 from utils.import_util import import_reference_genome_from_local_file
 
 
 TEST_DATA_DIR = os.path.join(settings.PWD, 'test_data')
 TEST_GENBANK = os.path.join(TEST_DATA_DIR, 'mg1655.genbank')
+TEST_TOLC_GENBANK = os.path.join(TEST_DATA_DIR, 'genbank_aligned',
+        'mg1655_tolC_through_zupT.gb')
 
 
 class TestGenbankUtil(TestCase):
@@ -34,4 +40,38 @@ class TestGenbankUtil(TestCase):
                 Dataset.TYPE.MOBILE_ELEMENT_FASTA)
 
         assert os.path.exists(
-                me_fa_dataset.get_absolute_location())
\ No newline at end of file
+                me_fa_dataset.get_absolute_location())
+
+
+class TestGenbankFeatureIndex(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        index_path = os.path.join(self.temp_dir, 'gbk_feature_idx.pickle')
+        generate_gbk_feature_index(TEST_TOLC_GENBANK, index_path)
+        self.feature_index = load_gbk_feature_index(index_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_range_query(self):
+        # tolC CDS is [148, 1630) and ygiB CDS is [1777, 2449).
+        features = self.feature_index.get_overlapping_features(1600, 1800)
+        self.assertEqual(set([('CDS', 'tolC'), ('CDS', 'ygiB')]),
+                set([(f.type, f.name) for f in features]))
+
+        features = self.feature_index.get_overlapping_features(1600, 1800,
+                chromosome='NC_000913')
+        self.assertEqual(set(['tolC', 'ygiB']),
+                set([f.name for f in features]))
+
+        features = self.feature_index.get_overlapping_features(1600, 1800,
+                chromosome='other_chromosome')
+        self.assertEqual([], features)
+
+    def test_point_query(self):
+        # Intervals are closed-open.
+        self.assertEqual(['tolC'], [f.name for f in
+                self.feature_index.get_overlapping_features(148, 149)])
+        self.assertEqual([], [f.name for f in
+                self.feature_index.get_overlapping_features(147, 148)])
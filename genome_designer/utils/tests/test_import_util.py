@@ -23,12 +23,16 @@ from main.upload_template_views import TEMPLATE__SAMPLES_BATCH_IMPORT_FROM_SERVE
 from utils.import_util import _get_fastqc_path
 from utils.import_util import DataImportError
 from utils.import_util import copy_and_add_dataset_source
+from utils.import_util import copy_experiment_sample_fastq
 from utils.import_util import create_sample_models_for_eventual_upload
 from utils.import_util import import_reference_genome_from_local_file
 from utils.import_util import import_samples_from_targets_file
 from utils.import_util import import_variant_set_from_vcf
 from utils.import_util import import_reference_genome_from_ncbi
+from utils.import_util import mark_datasets_failed
+from utils.import_util import persist_experiment_sample_qc
 from utils.import_util import run_fastqc_on_sample_fastq
+from utils.import_util import start_experiment_sample_qc
 from utils import internet_on
 
 TEST_USERNAME = 'gmcdev'
@@ -164,6 +168,81 @@ class TestImportSamplesFromTargetsFile(TestCase):
                     rev_reads_dataset.filesystem_location,
                     "Must have different filesystem locations.")
 
+    def test_import_samples__fastqc(self):
+        """Tests that QC runs for every read file and sets phred encoding.
+        """
+        TARGETS_TEMPLATE_FILEPATH = os.path.join(settings.PWD, 'main',
+                'templates', TEMPLATE__SAMPLES_BATCH_IMPORT_FROM_SERVER)
+
+        with open(TARGETS_TEMPLATE_FILEPATH) as targets_file_fh:
+            new_samples = import_samples_from_targets_file(self.project,
+                    UploadedFile(targets_file_fh))
+
+        for sample in new_samples:
+            for fastq_type, fastqc_type in (
+                    (Dataset.TYPE.FASTQ1, Dataset.TYPE.FASTQC1_HTML),
+                    (Dataset.TYPE.FASTQ2, Dataset.TYPE.FASTQC2_HTML)):
+                self.assertEqual(Dataset.STATUS.READY,
+                        sample.dataset_set.get(type=fastq_type).status)
+                self.assertTrue(os.path.exists(get_dataset_with_type(
+                        sample, fastqc_type).get_absolute_location()))
+            self.assertTrue('phred_encoding' in
+                    ExperimentSample.objects.get(id=sample.id).data)
+
+    def test_import_samples__copy_tasks(self):
+        """Tests that the copy tasks run through the import workflow copy
+        each read file into its sample's data dir.
+        """
+        TARGETS_TEMPLATE_FILEPATH = os.path.join(settings.PWD, 'main',
+                'templates', TEMPLATE__SAMPLES_BATCH_IMPORT_FROM_SERVER)
+
+        OPTIONS = {'skip_fastqc': True}
+        with open(TARGETS_TEMPLATE_FILEPATH) as targets_file_fh:
+            new_samples = import_samples_from_targets_file(self.project,
+                    UploadedFile(targets_file_fh), OPTIONS)
+
+        self.assertTrue(len(new_samples))
+        for sample in new_samples:
+            for fastq_type in (Dataset.TYPE.FASTQ1, Dataset.TYPE.FASTQ2):
+                dataset = sample.dataset_set.get(type=fastq_type)
+                self.assertEqual(Dataset.STATUS.READY, dataset.status)
+                fastq_path = dataset.get_absolute_location()
+                self.assertTrue(fastq_path.startswith(
+                        sample.get_model_data_dir()))
+                self.assertTrue(os.path.exists(fastq_path))
+
+    def test_mark_datasets_failed(self):
+        """Tests the errback of the import tasks, which fails the Datasets
+        that didn't finish.
+        """
+        sample = ExperimentSample.objects.create(
+                project=self.project, label='sample')
+        ready_dataset = copy_and_add_dataset_source(sample,
+                Dataset.TYPE.FASTQ1, Dataset.TYPE.FASTQ1, TEST_FASTQ1)
+        ready_dataset.status = Dataset.STATUS.READY
+        ready_dataset.save()
+        copying_dataset = copy_and_add_dataset_source(sample,
+                Dataset.TYPE.FASTQ2, Dataset.TYPE.FASTQ2, TEST_FASTQ2)
+        copying_dataset.status = Dataset.STATUS.COPYING
+        copying_dataset.save()
+
+        mark_datasets_failed([ready_dataset.id, copying_dataset.id])
+
+        self.assertEqual(Dataset.STATUS.READY,
+                Dataset.objects.get(id=ready_dataset.id).status)
+        self.assertEqual(Dataset.STATUS.FAILED,
+                Dataset.objects.get(id=copying_dataset.id).status)
+
+    def test_import_tasks_routed_to_import_queue(self):
+        """Tests that the import tasks go to the queue whose worker caps
+        their concurrency.
+        """
+        for import_task in (copy_experiment_sample_fastq,
+                start_experiment_sample_qc, run_fastqc_on_sample_fastq,
+                persist_experiment_sample_qc, mark_datasets_failed):
+            self.assertEqual(settings.SAMPLE_IMPORT_QUEUE,
+                    settings.CELERY_ROUTES[import_task.name]['queue'])
+
     def test_import_samples__no_extra_cols(self):
         """Tests importing samples from a template file that doesn't have
         extra column data filled in.
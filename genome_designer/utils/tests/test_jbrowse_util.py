@@ -0,0 +1,56 @@
+"""
+Tests for jbrowse_util.py.
+"""
+
+import os
+
+from django.test import TestCase
+
+from main.testing_util import create_common_entities
+from utils.jbrowse_util import compile_tracklist_json
+from utils.jbrowse_util import get_tracklist_json
+from utils.jbrowse_util import write_tracklist_json
+
+
+class TestCompileTracklistJson(TestCase):
+
+    def setUp(self):
+        self.common_entities = create_common_entities()
+        self.reference_genome = self.common_entities['reference_genome']
+        self.jbrowse_path = self.reference_genome.get_jbrowse_directory_path()
+
+    def _write_indiv_track(self, label, url_template):
+        write_tracklist_json(self.reference_genome, {
+            'formatVersion': 1,
+            'tracks': [{'label': label, 'urlTemplate': url_template}]
+        }, concurrent_id=label)
+
+    def test_incremental(self):
+        self._write_indiv_track('seq_track', 'seq/{refseq}-')
+        os.makedirs(os.path.join(self.jbrowse_path, 'indiv_tracks',
+                'seq_track', 'seq'))
+        compile_tracklist_json(self.reference_genome)
+
+        tracklist = get_tracklist_json(self.reference_genome)
+        self.assertEqual(1, tracklist['formatVersion'])
+        self.assertEqual(['indiv_tracks/seq_track/seq/{refseq}-'],
+                [track['urlTemplate'] for track in tracklist['tracks']])
+
+        # Subdirs are linked into the main dir rather than copied.
+        self.assertTrue(os.path.islink(os.path.join(self.jbrowse_path,
+                'seq')))
+
+        # Compiling again without changes leaves the tracklist alone.
+        tracklist_fn = os.path.join(self.jbrowse_path, 'trackList.json')
+        tracklist_inode = os.stat(tracklist_fn).st_ino
+        compile_tracklist_json(self.reference_genome)
+        self.assertEqual(tracklist_inode, os.stat(tracklist_fn).st_ino)
+
+        # New tracks are picked up.
+        self._write_indiv_track('bam_track', '/absolute/path.bam')
+        compile_tracklist_json(self.reference_genome)
+        tracklist = get_tracklist_json(self.reference_genome)
+        self.assertEqual(
+                set(['indiv_tracks/seq_track/seq/{refseq}-',
+                        '/absolute/path.bam']),
+                set([track['urlTemplate'] for track in tracklist['tracks']]))
@@ -0,0 +1,212 @@
+"""
+Tests for sv_read_util.py.
+"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+
+from django.conf import settings
+from django.test import TestCase
+import numpy as np
+import pysam
+
+from genome_finish.millstone_de_novo_fns import filter_low_qual_read_pairs
+from utils.sv_read_util import classify_sv_reads
+from utils.sv_read_util import READ_CLASS__ALTALIGN
+from utils.sv_read_util import READ_CLASS__CLIPPED
+from utils.sv_read_util import READ_CLASS__DISCORDANT
+from utils.sv_read_util import READ_CLASS__SPLIT
+from utils.sv_read_util import READ_CLASS__UNMAPPED
+from utils.sv_read_util import READ_CLASSES
+
+
+TEST_DISC_SPLIT_BAM = os.path.join(settings.PWD, 'test_data',
+        'discordant_split_reads', 'bwa_align.bam')
+
+
+def _read_keys(bam_path, strip_pair_suffix=False):
+    """Returns the list of (name, flag, reference_id, position) of the reads
+    in the bam.
+    """
+    keys = []
+    bam_af = pysam.AlignmentFile(bam_path, 'rb')
+    for read in bam_af.fetch(until_eof=True):
+        query_name = read.query_name
+        if strip_pair_suffix:
+            query_name = query_name[:-2]
+        keys.append((query_name, read.flag, read.reference_id,
+                read.reference_start))
+    bam_af.close()
+    return keys
+
+
+def _write_reads(input_bam_path, output_bam_path, filter_fn):
+    input_af = pysam.AlignmentFile(input_bam_path, 'rb')
+    output_af = pysam.AlignmentFile(output_bam_path, 'wb', template=input_af)
+    for read in input_af.fetch(until_eof=True):
+        if filter_fn(read):
+            output_af.write(read)
+    output_af.close()
+    input_af.close()
+
+
+def _run_pipeline(commands, input_bam_path, output_bam_path):
+    with open(output_bam_path, 'w') as fh:
+        subprocess.check_call(' | '.join(commands).format(
+                        samtools=settings.SAMTOOLS_BINARY,
+                        bam=input_bam_path,
+                        lumpy_script=settings.LUMPY_EXTRACT_SPLIT_READS_BWA_MEM),
+                stdout=fh, shell=True, executable=settings.BASH_PATH)
+
+
+def _is_rnext_same(read):
+    return (read.reference_id >= 0 and
+            read.next_reference_id == read.reference_id)
+
+
+# The per-class extraction that get_sv_indicating_reads() did before the
+# single pass classifier, to check that the classifier gives the same reads.
+
+def _old_discordant(input_bam_path, output_bam_path):
+    unfiltered_path = output_bam_path + '.unfiltered.bam'
+    _run_pipeline([
+            '{samtools} view -u -F 0x0002 {bam}',
+            '{samtools} view -u -F 0x0100 -',
+            '{samtools} view -u -F 0x0004 -',
+            '{samtools} view -u -F 0x0008 -',
+            '{samtools} view -b -F 0x0400 -'],
+            input_bam_path, unfiltered_path)
+    _write_reads(unfiltered_path, output_bam_path, _is_rnext_same)
+
+
+def _old_split(input_bam_path, output_bam_path):
+    unfiltered_path = output_bam_path + '.unfiltered.bam'
+    _run_pipeline([
+            '{samtools} view -h {bam}',
+            'python {lumpy_script} -i stdin',
+            '{samtools} view -Sb -'],
+            input_bam_path, unfiltered_path)
+    _write_reads(unfiltered_path, output_bam_path, _is_rnext_same)
+
+
+def _old_unmapped(input_bam_path, output_bam_path):
+    unfiltered_path = output_bam_path + '.unfiltered.bam'
+    _run_pipeline(['{samtools} view -h -b -f 0x4 {bam}'],
+            input_bam_path, unfiltered_path)
+    filter_low_qual_read_pairs(unfiltered_path, output_bam_path, 20)
+
+
+def _old_altalign(input_bam_path, output_bam_path):
+    _write_reads(input_bam_path, output_bam_path,
+            lambda read: (read.has_tag('XS') and read.has_tag('AS') and
+                    read.get_tag('AS') <= read.get_tag('XS')))
+
+
+def _old_clipped(input_bam_path, output_bam_path):
+    def _is_clipped(read):
+        if read.cigartuples is None:
+            return False
+        if read.is_secondary or read.is_supplementary:
+            return False
+        left_clipping = (read.cigartuples[0][1]
+                if read.cigartuples[0][0] in [4, 5] else 0)
+        right_clipping = (read.cigartuples[-1][1]
+                if read.cigartuples[-1][0] in [4, 5] else 0)
+        if left_clipping > 8 and np.mean(
+                read.query_qualities[:left_clipping]) > 20:
+            return True
+        if right_clipping > 8 and np.mean(
+                read.query_qualities[-right_clipping:]) > 20:
+            return True
+        return False
+    _write_reads(input_bam_path, output_bam_path, _is_clipped)
+
+
+READ_CLASS_TO_OLD_EXTRACTION = {
+    READ_CLASS__ALTALIGN: _old_altalign,
+    READ_CLASS__CLIPPED: _old_clipped,
+    READ_CLASS__SPLIT: _old_split,
+    READ_CLASS__UNMAPPED: _old_unmapped,
+    READ_CLASS__DISCORDANT: _old_discordant,
+}
+
+
+class TestClassifySvReads(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _output_path(self, name):
+        return os.path.join(self.temp_dir, name + '.bam')
+
+    def test_single_pass_matches_separate_passes(self):
+        read_class_to_output_path = dict(
+                (read_class, self._output_path(read_class))
+                for read_class in READ_CLASSES)
+        combined_path = self._output_path('combined')
+        read_class_to_count = classify_sv_reads(TEST_DISC_SPLIT_BAM,
+                read_class_to_output_path,
+                combined_output_path=combined_path)
+
+        self.assertEqual(134, read_class_to_count[READ_CLASS__DISCORDANT])
+        self.assertEqual(3, read_class_to_count[READ_CLASS__SPLIT])
+
+        # Each class matches classifying it alone.
+        all_keys = set()
+        for read_class in READ_CLASSES:
+            alone_path = self._output_path(read_class + '_alone')
+            classify_sv_reads(TEST_DISC_SPLIT_BAM, {read_class: alone_path})
+            keys = _read_keys(read_class_to_output_path[read_class])
+            self.assertEqual(read_class_to_count[read_class], len(keys))
+            self.assertEqual(sorted(_read_keys(alone_path)), sorted(keys))
+
+            all_keys.update(_read_keys(read_class_to_output_path[read_class],
+                    strip_pair_suffix=(read_class == READ_CLASS__SPLIT)))
+
+        # The combined bam has each classified read once, with its original
+        # name.
+        combined_keys = _read_keys(combined_path)
+        self.assertEqual(len(set(combined_keys)), len(combined_keys))
+        self.assertEqual(all_keys, set(combined_keys))
+
+    def test_classes_without_bam_go_to_combined_bam(self):
+        combined_path = self._output_path('combined')
+        classify_sv_reads(TEST_DISC_SPLIT_BAM,
+                dict((read_class, self._output_path(read_class))
+                        for read_class in READ_CLASSES),
+                combined_output_path=combined_path)
+
+        combined_only_path = self._output_path('combined_only')
+        split_path = self._output_path('split_only')
+        read_class_to_output_path = dict(
+                (read_class, None) for read_class in READ_CLASSES)
+        read_class_to_output_path[READ_CLASS__SPLIT] = split_path
+        classify_sv_reads(TEST_DISC_SPLIT_BAM, read_class_to_output_path,
+                combined_output_path=combined_only_path)
+
+        self.assertEqual(sorted(_read_keys(combined_path)),
+                sorted(_read_keys(combined_only_path)))
+        self.assertEqual(3, len(_read_keys(split_path)))
+        self.assertEqual(
+                set(['combined.bam', 'combined_only.bam', 'split_only.bam']),
+                set(os.listdir(self.temp_dir)) - set(
+                        read_class + '.bam' for read_class in READ_CLASSES))
+
+    def test_matches_old_per_class_extraction(self):
+        read_class_to_output_path = dict(
+                (read_class, self._output_path(read_class))
+                for read_class in READ_CLASS_TO_OLD_EXTRACTION)
+        classify_sv_reads(TEST_DISC_SPLIT_BAM, read_class_to_output_path)
+
+        for read_class, old_extraction in (
+                READ_CLASS_TO_OLD_EXTRACTION.iteritems()):
+            old_path = self._output_path(read_class + '_old')
+            old_extraction(TEST_DISC_SPLIT_BAM, old_path)
+            self.assertEqual(sorted(_read_keys(old_path)),
+                    sorted(_read_keys(read_class_to_output_path[read_class])),
+                    "Read class '%s' differs." % read_class)
@@ -5,7 +5,12 @@ Helpers and utils for working with Variants.
 from collections import OrderedDict
 import re
 
+from django.db import transaction
+
+from main.model_utils import bulk_update_field
+from main.model_utils import BULK_WRITE_BATCH_SIZE
 from main.models import VariantCallerCommonData
+from main.models import VariantEvidence
 
 from materialized_view_manager import MATERIALIZED_TABLE_QUERYABLE_FIELDS_MAP
 from variants.filter_key_map_constants import MAP_KEY__VARIANT
@@ -117,22 +122,6 @@ class ParseError(Exception):
                 str(self.msg))
 
 
-def SymbolGenerator():
-    """Generator that yields characters in alphabetical order, starting with
-    'A' and continuing on to 'Z', followed by 'a' and ending with 'z'.
-
-    NOTE: The current implementation runs out of symbols after 26 * 2 symbols.
-    """
-    final_symbol_ord = ord('z')
-    current_char = 'A'
-    while True:
-        yield current_char
-        next_ord = ord(current_char) + 1
-        if next_ord > final_symbol_ord:
-            raise StopIteration()
-        current_char = chr(next_ord)
-
-
 ################################################################################
 # Utility Methods
 ################################################################################
@@ -342,6 +331,7 @@ def determine_visible_field_names(hard_coded_keys, filter_string,
     return list(set(hard_coded_keys) | set(fields_from_filter_string))
 
 
+@transaction.commit_on_success
 def update_parent_child_variant_fields(alignment_group):
     """
 
@@ -360,47 +350,59 @@ def update_parent_child_variant_fields(alignment_group):
     a task such that multiple are run in parallel, since that hoses the DB.
     """
 
-    #1. Get parent-children uid relationships for all experiment_samples
+    #1. Get parent-children id relationships for all experiment_samples
     # in alignment_group.
     samples = alignment_group.get_samples()
-    parent_uid__to__child_uid_list = {}
+    parent_id__to__child_id_list = {}
     for sample in samples:
-        child_uid_list = [child.uid for child in sample.get_children()]
-        parent_uid__to__child_uid_list[sample.uid] = child_uid_list
-
-    #2. Grab all variants and update the variant_evidence fields with data from
-    #   each pair.
-    for vcc in alignment_group.variantcallercommondata_set.all():
-        ve_set = vcc.variantevidence_set.all()
-        ve_uid__to__ve = {}
-        sample_uid__to__ve = {}
-        ve_uid__to__gt = {}
-        for ve in ve_set:
-            ve_uid__to__ve[ve.uid] = ve
-            sample_uid__to__ve[ve.experiment_sample.uid] = ve
-            ve_uid__to__gt[ve.uid] = (
-                    0 if ve.data['GT_TYPE'] is None else ve.data['GT_TYPE'])
-
-        for parent_uid, child_uids in parent_uid__to__child_uid_list.items():
-            if not parent_uid in sample_uid__to__ve:
+        child_id_list = [child.id for child in sample.get_children()]
+        parent_id__to__child_id_list[sample.id] = child_id_list
+
+    #2. Go through the variant evidence of each VariantCallerCommonData in
+    #   turn, updating the data fields in memory, and write the changed data
+    #   back in bulk.
+    ve_id__to__data = {}
+
+    def _update_ve_group(ve_group):
+        sample_id__to__ve = dict(
+                (ve.experiment_sample_id, ve) for ve in ve_group)
+        for parent_id, child_ids in parent_id__to__child_id_list.items():
+            if not parent_id in sample_id__to__ve:
                 continue
-            parent_ve = sample_uid__to__ve[parent_uid]
-
-            chldrn_ve_list = []
-            for child_uid in child_uids:
-                if child_uid in sample_uid__to__ve:
-                    chldrn_ve_list.append(sample_uid__to__ve[child_uid])
+            parent_ve = sample_id__to__ve[parent_id]
 
             # If the parent GT_TYPE is > 0, then set in_parent to 1.
-            in_parent = int(ve_uid__to__gt[parent_ve.uid] > 0)
+            parent_gt = parent_ve.data['GT_TYPE']
+            in_parent = int(parent_gt is not None and parent_gt > 0)
 
             # For each child whose GT_TYPE is > 0, increment in_children.
             in_children = 0
-            for child_ve in chldrn_ve_list:
+            for child_id in child_ids:
+                if not child_id in sample_id__to__ve:
+                    continue
+                child_ve = sample_id__to__ve[child_id]
                 child_ve.data['IN_PARENTS'] = in_parent
                 in_children += int(child_ve.data['GT_TYPE'] > 0)
-                child_ve.save(update_fields=['data'])
-
-            sample_uid__to__ve[parent_uid].data['IN_CHILDREN'] = in_children
-            sample_uid__to__ve[parent_uid].save(update_fields=['data'])
+                ve_id__to__data[child_ve.id] = child_ve.data
+
+            parent_ve.data['IN_CHILDREN'] = in_children
+            ve_id__to__data[parent_ve.id] = parent_ve.data
+
+        if len(ve_id__to__data) >= BULK_WRITE_BATCH_SIZE:
+            bulk_update_field(VariantEvidence, 'data', ve_id__to__data)
+            ve_id__to__data.clear()
+
+    ve_iterator = VariantEvidence.objects.filter(
+            variant_caller_common_data__alignment_group=alignment_group
+    ).order_by('variant_caller_common_data').iterator()
+    ve_group = []
+    for ve in ve_iterator:
+        if (ve_group and ve.variant_caller_common_data_id !=
+                ve_group[0].variant_caller_common_data_id):
+            _update_ve_group(ve_group)
+            ve_group = []
+        ve_group.append(ve)
+    if ve_group:
+        _update_ve_group(ve_group)
+    bulk_update_field(VariantEvidence, 'data', ve_id__to__data)
 
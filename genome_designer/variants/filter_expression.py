@@ -0,0 +1,390 @@
+"""
+Parsing of filter strings into an expression tree, and compilation of the
+tree into a SQL where clause over the materialized variant view.
+
+For example, the filter string
+
+    (position < 100 | position > 200) & GT_TYPE = 2
+
+is parsed into
+
+    FilterAnd([
+        FilterOr([
+            FilterCondition(('<', 'POSITION', '100')),
+            FilterCondition(('>', 'POSITION', '200'))]),
+        FilterCondition(('==', 'GT_TYPE', '2'))])
+
+which compiles to a where clause of the same shape, so compiling is linear
+in the length of the filter. Compiled where clauses are cached by filter
+text, since the same saved filters are evaluated over and over as users page
+through results.
+"""
+
+from collections import OrderedDict
+import re
+import threading
+
+from variants.common import convert_delim_key_value_triple_to_expr
+from variants.common import generate_key_to_materialized_view_parent_col
+from variants.common import get_all_key_map
+from variants.common import get_delim_key_value_triple
+from variants.common import ParseError
+from variants.melted_variant_schema import get_json_key_sql_expression
+
+
+# Maximum number of compiled filters to keep.
+COMPILED_FILTER_CACHE_SIZE = 500
+
+# Expanded names of the variant_key_map submaps stored in each json column of
+# the materialized view.
+JSON_COLUMN_TO_KEY_MAP_NAME = {
+    'vccd_data': 'snp_caller_common_data',
+    'va_data': 'snp_alternate_data',
+    'es_data': 'experiment_sample_data',
+    've_data': 'snp_evidence_data'
+}
+
+TOKEN__AND = 'AND'
+TOKEN__OR = 'OR'
+TOKEN__LEFT_PAREN = '('
+TOKEN__RIGHT_PAREN = ')'
+TOKEN__CONDITION = 'CONDITION'
+
+# Operators may be written as symbols or words.
+OPERATOR_REGEX = re.compile(r'(&|\||(?:AND|and|OR|or)(?=[\s(]|$))')
+OPERATOR_TO_TOKEN = {
+    '&': TOKEN__AND,
+    'AND': TOKEN__AND,
+    'and': TOKEN__AND,
+    '|': TOKEN__OR,
+    'OR': TOKEN__OR,
+    'or': TOKEN__OR,
+}
+
+# A condition 'key op value'. Unquoted values may contain spaces, but stop
+# before an operator word, e.g. 'EXPERIMENT_SAMPLE_LABEL = C E5 and ...'.
+CONDITION_REGEX = re.compile(
+        r'[\w-]+\s*(?:==|<=|>=|!=|<|>|=)\s*'
+        r'(?:"[^"]*"|\'[^\']*\'|'
+        r'[\w.-]+(?:\s+(?!(?:AND|and|OR|or)(?:[\s(]|$))[\w.-]+)*)')
+
+
+class FilterCondition(object):
+    """A single condition, as a (delim, key, value) triple.
+    """
+
+    def __init__(self, triple):
+        self.triple = triple
+
+    def __eq__(self, other):
+        return (isinstance(other, FilterCondition) and
+                self.triple == other.triple)
+
+    def __repr__(self):
+        return 'FilterCondition(%r)' % (self.triple,)
+
+
+class FilterAnd(object):
+    """Conjunction of child expressions.
+    """
+
+    def __init__(self, children):
+        self.children = children
+
+    def __eq__(self, other):
+        return (isinstance(other, FilterAnd) and
+                self.children == other.children)
+
+    def __repr__(self):
+        return 'FilterAnd(%r)' % (self.children,)
+
+
+class FilterOr(object):
+    """Disjunction of child expressions.
+    """
+
+    def __init__(self, children):
+        self.children = children
+
+    def __eq__(self, other):
+        return (isinstance(other, FilterOr) and
+                self.children == other.children)
+
+    def __repr__(self):
+        return 'FilterOr(%r)' % (self.children,)
+
+
+###############################################################################
+# Parsing
+###############################################################################
+
+def tokenize_filter_string(filter_string):
+    """Splits the filter string into a list of (token type, text) pairs.
+
+    Raises:
+        ParseError if some part of the string is neither an operator, a
+        parenthesis nor a condition.
+    """
+    tokens = []
+    pos = 0
+    while pos < len(filter_string):
+        if filter_string[pos].isspace():
+            pos += 1
+            continue
+
+        if filter_string[pos] in (TOKEN__LEFT_PAREN, TOKEN__RIGHT_PAREN):
+            tokens.append((filter_string[pos], filter_string[pos]))
+            pos += 1
+            continue
+
+        operator_match = OPERATOR_REGEX.match(filter_string, pos)
+        if operator_match:
+            tokens.append((OPERATOR_TO_TOKEN[operator_match.group()],
+                    operator_match.group()))
+            pos = operator_match.end()
+            continue
+
+        condition_match = CONDITION_REGEX.match(filter_string, pos)
+        if condition_match:
+            tokens.append((TOKEN__CONDITION, condition_match.group()))
+            pos = condition_match.end()
+            continue
+
+        raise ParseError(filter_string,
+                'Unexpected input at: %s' % filter_string[pos:])
+    return tokens
+
+
+def parse_filter_string(filter_string, all_key_map):
+    """Parses the filter string into an expression tree.
+
+    AND binds tighter than OR, and parentheses group as usual.
+
+    Args:
+        filter_string: The raw filter string.
+        all_key_map: List of key maps conditions may use, as returned by
+            variants.common.get_all_key_map().
+
+    Returns:
+        Root FilterCondition, FilterAnd or FilterOr, or None if the filter is
+        empty.
+
+    Raises:
+        ParseError if the filter is malformed or uses unrecognized keys.
+    """
+    tokens = tokenize_filter_string(filter_string)
+    if not tokens:
+        return None
+    parser = _FilterParser(filter_string, tokens, all_key_map)
+    return parser.parse()
+
+
+class _FilterParser(object):
+    """Recursive descent parser over the tokens of a filter string.
+    """
+
+    def __init__(self, filter_string, tokens, all_key_map):
+        self.filter_string = filter_string
+        self.tokens = tokens
+        self.all_key_map = all_key_map
+        self.pos = 0
+
+    def parse(self):
+        expression = self._parse_or()
+        if self.pos != len(self.tokens):
+            self._raise('Unexpected %s' % self.tokens[self.pos][1])
+        return expression
+
+    def _peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos][0]
+        return None
+
+    def _raise(self, msg):
+        raise ParseError(self.filter_string, msg)
+
+    def _parse_or(self):
+        children = [self._parse_and()]
+        while self._peek() == TOKEN__OR:
+            self.pos += 1
+            children.append(self._parse_and())
+        if len(children) == 1:
+            return children[0]
+        return FilterOr(_flatten(children, FilterOr))
+
+    def _parse_and(self):
+        children = [self._parse_atom()]
+        while self._peek() == TOKEN__AND:
+            self.pos += 1
+            children.append(self._parse_atom())
+        if len(children) == 1:
+            return children[0]
+        return FilterAnd(_flatten(children, FilterAnd))
+
+    def _parse_atom(self):
+        token_type = self._peek()
+        if token_type == TOKEN__LEFT_PAREN:
+            self.pos += 1
+            expression = self._parse_or()
+            if self._peek() != TOKEN__RIGHT_PAREN:
+                self._raise('Unbalanced parentheses.')
+            self.pos += 1
+            return expression
+        elif token_type == TOKEN__CONDITION:
+            condition_string = self.tokens[self.pos][1]
+            self.pos += 1
+            (delim, key, value) = get_delim_key_value_triple(
+                    condition_string, self.all_key_map)
+
+            # Clean up value.
+            value = value.replace('\'', '')
+            value = value.replace('\"', '')
+            return FilterCondition((delim, key, value))
+        elif token_type is None:
+            self._raise('Unexpected end of filter.')
+        else:
+            self._raise('Unexpected %s' % self.tokens[self.pos][1])
+
+
+def _flatten(children, node_class):
+    """Merges children of the same type into their parent, so that e.g.
+    '(a & b) & c' becomes a single conjunction.
+    """
+    flattened = []
+    for child in children:
+        if isinstance(child, node_class):
+            flattened.extend(child.children)
+        else:
+            flattened.append(child)
+    return flattened
+
+
+###############################################################################
+# Compilation
+###############################################################################
+
+_compiled_filter_cache = OrderedDict()
+_compiled_filter_cache_lock = threading.Lock()
+
+
+def compile_filter_string(filter_string, ref_genome):
+    """Returns the where clause for the filter over the materialized view of
+    the ReferenceGenome, compiling it unless it was compiled before.
+
+    Returns:
+        Tuple pair (where clause, list of arguments), or (None, []) if the
+        filter is empty.
+
+    Raises:
+        ParseError if the filter is malformed or uses unrecognized keys.
+    """
+    # Compiled filters also depend on the key map entries of the keys they
+    # use, which imports may change, so hits are checked against those.
+    cache_key = (filter_string, ref_genome.id)
+    with _compiled_filter_cache_lock:
+        cached = _compiled_filter_cache.pop(cache_key, None)
+        if cached is not None:
+            # Move to the most recently used end.
+            _compiled_filter_cache[cache_key] = cached
+    if cached is not None:
+        (key_specs, where_clause, args) = cached
+        if key_specs == _get_key_specs(
+                [key for key, _ in key_specs], ref_genome):
+            return (where_clause, list(args))
+
+    expression = parse_filter_string(filter_string,
+            get_all_key_map(ref_genome))
+    if expression is None:
+        where_clause, args = (None, [])
+        keys = []
+    else:
+        where_clause, args = compile_filter_expression(expression, ref_genome)
+        keys = _get_condition_keys(expression)
+
+    with _compiled_filter_cache_lock:
+        _compiled_filter_cache[cache_key] = (
+                _get_key_specs(keys, ref_genome), where_clause, tuple(args))
+        while len(_compiled_filter_cache) > COMPILED_FILTER_CACHE_SIZE:
+            _compiled_filter_cache.popitem(last=False)
+    return (where_clause, list(args))
+
+
+def compile_filter_expression(expression, ref_genome):
+    """Compiles the expression tree into a where clause.
+
+    Returns:
+        Tuple pair (where clause, list of arguments).
+    """
+    key_to_parent_col = generate_key_to_materialized_view_parent_col(
+            ref_genome)
+
+    def _compile(node):
+        if isinstance(node, FilterCondition):
+            (delim, key, value) = node.triple
+            rewritten_key = _rewrite_key_if_json_field(key, ref_genome,
+                    key_to_parent_col)
+            (expr, arg) = convert_delim_key_value_triple_to_expr(
+                    (delim, rewritten_key, value))
+            return (expr, [arg])
+
+        if isinstance(node, FilterAnd):
+            joiner = ' AND '
+        else:
+            joiner = ' OR '
+        child_clauses = []
+        args = []
+        for child in node.children:
+            (child_clause, child_args) = _compile(child)
+            child_clauses.append('(' + child_clause + ')')
+            args.extend(child_args)
+        return (joiner.join(child_clauses), args)
+
+    return _compile(expression)
+
+
+def _rewrite_key_if_json_field(key, ref_genome, key_to_parent_col):
+    """Returns the sql expression for the key, cast to its type, if it is
+    stored in a json column of the materialized view, else the key as is.
+
+    For example, 'INFO_AO', an integer field in ve_data, is rewritten as
+    "(ve_data->>'INFO_AO')::Integer".
+    """
+    json_column = key_to_parent_col.get(key, None)
+    key_map_name = JSON_COLUMN_TO_KEY_MAP_NAME.get(json_column, None)
+    if key_map_name:
+        # Get the type of the field from the original variant_key_map
+        key_type = ref_genome.variant_key_map[key_map_name][key]['type']
+
+        # Same expression as any index on the key. See
+        # MeltedVariantIndexManager.
+        json_key_expression = get_json_key_sql_expression(
+                json_column, key, key_type)
+        if json_key_expression is not None:
+            return json_key_expression
+    return key
+
+
+def _get_condition_keys(expression):
+    """Returns the sorted keys of all conditions in the expression tree.
+    """
+    if isinstance(expression, FilterCondition):
+        return [expression.triple[1]]
+    keys = set()
+    for child in expression.children:
+        keys.update(_get_condition_keys(child))
+    return sorted(keys)
+
+
+def _get_key_specs(keys, ref_genome):
+    """Returns, for each of the keys, the names of the variant_key_map
+    submaps that contain it and its type and count there. This is all of the
+    key map that a compiled filter using these keys depends on.
+    """
+    submaps = sorted(ref_genome.variant_key_map.iteritems())
+    return tuple(
+            (key, tuple(
+                    (submap_name, submap[key].get('type'),
+                            submap[key].get('num'))
+                    for submap_name, submap in submaps
+                    if key in submap))
+            for key in keys)
@@ -6,24 +6,18 @@ code than the original implementation; thus it makes sense to re-implement
 from scratch.
 """
 
-import re
+import random
+import time
+from uuid import uuid4
 
+from celery import task
+from django.conf import settings
 from django.db import connection
-from sympy.logic import boolalg
 
-from variants.common import EXPRESSION_REGEX
-from variants.common import SAMPLE_SCOPE_REGEX
-from variants.common import GENE_REGEX
-from variants.common import SET_REGEX
-from variants.common import convert_delim_key_value_triple_to_expr
+from main.models import SlowVariantFilterQuery
 from variants.common import generate_key_to_materialized_view_parent_col
 from variants.common import get_all_key_map
-from variants.common import get_delim_key_value_triple
-from variants.common import SymbolGenerator
-from variants.filter_key_map_constants import VARIANT_KEY_MAP_TYPE__BOOLEAN
-from variants.filter_key_map_constants import VARIANT_KEY_MAP_TYPE__FLOAT
-from variants.filter_key_map_constants import VARIANT_KEY_MAP_TYPE__INTEGER
-from variants.filter_key_map_constants import VARIANT_KEY_MAP_TYPE__STRING
+from variants.filter_expression import compile_filter_string
 from variants.materialized_view_manager import MATERIALIZED_TABLE_QUERY_SELECT_CLAUSE_COMPONENTS
 from variants.materialized_view_manager import MeltedVariantMaterializedViewManager
 from variants.melted_variant_schema import CAST_SCHEMA_KEY__TOTAL_SAMPLE_COUNT
@@ -31,6 +25,9 @@ from variants.melted_variant_schema import MELTED_SCHEMA_KEY__POSITION
 from variants.melted_variant_schema import MELTED_SCHEMA_KEY__UID
 from variants.melted_variant_schema import MELTED_SCHEMA_KEY__ALT
 from variants.melted_variant_schema import MELTED_SCHEMA_KEY__ES_UID
+from variants.melted_variant_schema import MELTED_SCHEMA_KEY__VA_ID
+from variants.melted_variant_schema import MELTED_SCHEMA_KEY__VCCD_ID
+from variants.melted_variant_schema import MELTED_SCHEMA_KEY__VE_ID
 from variants.melted_variant_schema import MELTED_SCHEMA_KEY__VS_UID
 from variants.melted_variant_schema import MELTED_SCHEMA_KEY__VS_LABEL
 from variants.filter_scope import FilterScope
@@ -41,6 +38,26 @@ from variants.filter_scope import FilterScope
 # LOGGER = logging.getLogger('debug_logger')
 
 
+# Number of rows fetched per round trip when acting as a generator.
+GENERATOR_FETCH_SIZE = 2000
+
+# Columns that identify a row when sorting by position, used both to make the
+# order total and as the key for keyset pagination. NULL ids sort first.
+MELTED_PAGINATION_KEY_COLUMNS = [
+    (MELTED_SCHEMA_KEY__POSITION, MELTED_SCHEMA_KEY__POSITION),
+    ('id', 'ID'),
+    ('COALESCE(%s, 0)' % MELTED_SCHEMA_KEY__VCCD_ID, MELTED_SCHEMA_KEY__VCCD_ID),
+    ('COALESCE(%s, 0)' % MELTED_SCHEMA_KEY__VE_ID, MELTED_SCHEMA_KEY__VE_ID),
+    ('COALESCE(%s, 0)' % MELTED_SCHEMA_KEY__VA_ID, MELTED_SCHEMA_KEY__VA_ID),
+]
+
+# When cast, rows are grouped by uid, which shares a single position.
+CAST_PAGINATION_KEY_COLUMNS = [
+    (MELTED_SCHEMA_KEY__POSITION, MELTED_SCHEMA_KEY__POSITION),
+    (MELTED_SCHEMA_KEY__UID, MELTED_SCHEMA_KEY__UID),
+]
+
+
 class VariantFilterEvaluator(object):
     """Evaluator for a single scoped expression, e.g. of the form:
         '(position > 5) in ALL(sample1, sample2)'
@@ -57,6 +74,10 @@ class VariantFilterEvaluator(object):
                 sort_by_column: A column name to sort by, or an empty string otherwise.
                 pagination_start: Offset of the returned query
                 pagination_len: Maximum number of returned variants, or -1 for no limit
+                pagination_key: Optional key of the last row of the previous
+                    page, from get_pagination_key(). If provided, and sorting
+                    by position, results start after that row and
+                    pagination_start is ignored.
             ref_genome: ReferenceGenome these variants are relative to.
             alignment_group: If provided, filter results to Variants that are
                 called in this AlignmentGroup.
@@ -81,6 +102,7 @@ class VariantFilterEvaluator(object):
         self.sort_by_direction = query_args.get('sort_by_direction', True)
         self.pagination_start = query_args.get('pagination_start', 0)
         self.pagination_len = query_args.get('pagination_len', -1)
+        self.pagination_key = query_args.get('pagination_key', None)
         self.visible_key_names = query_args.get('visible_key_names', [])
         self.act_as_generator = query_args.get('act_as_generator', False)
         self.get_uids_only = query_args.get('get_uids_only', False)
@@ -95,73 +117,16 @@ class VariantFilterEvaluator(object):
         self.all_key_map = get_all_key_map(self.ref_genome)
         self.scope = scope
 
-        # Generator object that provides symbols in alphabetical order.
-        self.symbol_maker = SymbolGenerator()
-
-        # Catch trivial, no filter case.
-        if self.filter_string == '':
-            self.sympy_representation = ''
-        else:
-            self._create_symbolic_representation()
-
-    def _create_symbolic_representation(self):
-        """Creates a symbolic representation of the query to enable, among
-        other things, manipulation with sympy so we can get to disjunctive
-        normal form (DNF).
-        """
-        # Find all the expressions and replace them with symbols.
-        self.symbol_to_expression_map = {}
-
-        symbolified_string = self.filter_string
-        for regex in [SAMPLE_SCOPE_REGEX, EXPRESSION_REGEX, SET_REGEX,
-                GENE_REGEX]:
-            symbolified_string = self._symbolify_string_for_regex(
-                    symbolified_string, regex)
-
-        symbolified_string = re.sub('AND|and', '&', symbolified_string)
-        symbolified_string = re.sub('OR|or', '|', symbolified_string)
-
-        self.sympy_representation = boolalg.to_dnf(symbolified_string)
-
-
-    def _symbolify_string_for_regex(self, start_string, regex):
-        """Iterates through the string tokenized by the regex and replaces
-        the matching tokens with symbols.
-        """
-        tokens = regex.split(start_string)
-        symbolified_tokens = []
-        for token in tokens:
-            if regex.match(token):
-                symbol = self.symbol_maker.next()
-                self.symbol_to_expression_map[symbol] = token
-                symbolified_tokens.append(symbol)
-            else:
-                symbolified_tokens.append(token)
-        symbolified_string = ''.join(symbolified_tokens)
-        return symbolified_string
-
-
-    def get_condition_string_for_symbol(self, symbol):
-        """Returns the condition string that the symbol replaced.
-
-        Args:
-            symbol: A sympy.core.symbol.Symbol or string.
-
-        Returns:
-            A string representing a query condition.
-        """
-        if isinstance(symbol, str):
-            symbol_str = symbol
-        else:
-            symbol_str = str(symbol)
-        return self.symbol_to_expression_map[symbol_str]
-
+        # Compile the filter into a where clause up front, so that malformed
+        # filters raise ParseError on construction.
+        (self.filter_where_clause, self.filter_where_clause_args) = (
+                compile_filter_string(self.filter_string, self.ref_genome))
 
     def evaluate(self):
         """Evaluates the given database query.
 
         Returns:
-            A FilterEvalResult object.
+            A list of dictionaries, or a generator of them if act_as_generator.
         """
         if self.get_uids_only:
             if self.is_melted:
@@ -177,20 +142,132 @@ class VariantFilterEvaluator(object):
         else:
             select_clause = self._select_clause()
 
-        # We also need the full count of results for pagination purposes, so
-        # we use something called window functions.
-        select_clause += ', count(*) OVER() AS full_count '
-
         # Minimal sql_statement has select clause.
         sql_statement = 'SELECT %s FROM %s ' % (select_clause,
                 self.materialized_view_manager.get_table_name())
 
-        # Maybe construct WHERE clause.
-        if self.sympy_representation:
-            where_clause, where_clause_args = self._where_clause()
+        where_clause, where_clause_args = self._full_where_clause()
+
+        # Seek past the previous page rather than skipping over it.
+        if self.uses_keyset_pagination():
+            keyset_part, keyset_args = self._keyset_pagination_clause()
+            if where_clause:
+                where_clause = '({where_clause}) AND {keyset_part}'.format(
+                        where_clause=where_clause,
+                        keyset_part=keyset_part)
+            else:
+                where_clause = keyset_part
+            where_clause_args = where_clause_args + keyset_args
+
+        # Add WHERE clause to SQL statement.
+        if where_clause:
+            sql_statement += 'WHERE (' + where_clause + ') '
+
+        # If cast, need to group by position for array_agg to work.
+        if not self.is_melted:
+            sql_statement += 'GROUP BY %s ' % MELTED_SCHEMA_KEY__UID
+
+        # Add optional sort clause, defaulting to position.
+        order_direction = ''
+        if self.sort_by_direction == 'desc':
+            order_direction = 'DESC '
+        if self.sort_by_column:
+            sql_statement += 'ORDER BY %s %s' % (
+                    self.sort_by_column, order_direction)
         else:
-            where_clause = None
-            where_clause_args = []
+            sql_statement += 'ORDER BY ' + ', '.join([
+                    '%s %s' % (col, order_direction)
+                    for col, _ in self._pagination_key_columns()]) + ' '
+
+        # Add limit and offset clause. Only if no optimization limit.
+        if self.optimization_uid_list is None:
+            if self.pagination_len != -1:
+                sql_statement += 'LIMIT %d ' % self.pagination_len
+            if not self.uses_keyset_pagination():
+                sql_statement += 'OFFSET %d ' % self.pagination_start
+
+        # DEBUG
+        # LOGGER.debug(sql_statement)
+
+        # Either act as a generator, or return all results.
+        if self.act_as_generator:
+            return self._execute_as_generator(sql_statement, where_clause_args)
+
+        # Execute the query and store the results in hashable representation
+        # so that they can be combined through boolean operators with other
+        # evaluations.
+        cursor, rows = self._execute(sql_statement, where_clause_args)
+
+        # Column header data.
+        col_descriptions = [col[0].upper() for col in cursor.description]
+
+        return [dict(zip(col_descriptions, row)) for row in rows]
+
+    def count(self):
+        """Returns the total number of results that match the filter,
+        ignoring pagination.
+        """
+        if self.is_melted:
+            select_clause = 'count(*)'
+        else:
+            select_clause = 'count(DISTINCT %s)' % MELTED_SCHEMA_KEY__UID
+        sql_statement = 'SELECT %s FROM %s ' % (select_clause,
+                self.materialized_view_manager.get_table_name())
+
+        where_clause, where_clause_args = self._full_where_clause()
+        if where_clause:
+            sql_statement += 'WHERE (' + where_clause + ') '
+
+        _, rows = self._execute(sql_statement, where_clause_args)
+        return rows[0][0]
+
+    def uses_keyset_pagination(self):
+        """Keyset pagination is only possible when sorting by position, since
+        arbitrary sort columns may be NULL or not totally ordered.
+        """
+        return (self.pagination_key is not None and
+                not self.sort_by_column and
+                self.optimization_uid_list is None)
+
+    def get_pagination_key(self, row):
+        """Returns the key to pass as pagination_key to get the page starting
+        after the given result row.
+        """
+        return [row[result_key] or 0
+                for _, result_key in self._pagination_key_columns()]
+
+    def _pagination_key_columns(self):
+        """Returns list of (sql expression, result key) pairs that define the
+        default order of results.
+        """
+        if self.is_melted:
+            return MELTED_PAGINATION_KEY_COLUMNS
+        else:
+            return CAST_PAGINATION_KEY_COLUMNS
+
+    def _keyset_pagination_clause(self):
+        key_columns = self._pagination_key_columns()
+        assert len(self.pagination_key) == len(key_columns)
+        if self.sort_by_direction == 'desc':
+            comparator = '<'
+        else:
+            comparator = '>'
+
+        # When cast, all rows of a uid share a position, so filtering rows
+        # before grouping is the same as filtering groups.
+        keyset_part = '(({cols}) {comparator} ({placeholders}))'.format(
+                cols=', '.join([col for col, _ in key_columns]),
+                comparator=comparator,
+                placeholders=', '.join(['%s'] * len(key_columns)))
+        return (keyset_part, list(self.pagination_key))
+
+    def _full_where_clause(self):
+        """Returns tuple pair (where clause or None, arguments), combining the
+        filter, AlignmentGroup and optimization UID conditions.
+        """
+        # Maybe construct WHERE clause.
+        where_clause = self.filter_where_clause
+        where_clause_args = list(self.filter_where_clause_args)
 
         # Optimization UID part.
         if self.optimization_uid_list is not None:
@@ -220,50 +297,92 @@ class VariantFilterEvaluator(object):
         else:
             where_clause = where_clause_alignment_group_part
 
-        # Add WHERE clause to SQL statement.
-        if where_clause:
-            sql_statement += 'WHERE (' + where_clause + ') '
-
-        # If cast, need to group by position for array_agg to work.
-        if not self.is_melted:
-            sql_statement += 'GROUP BY %s ' % MELTED_SCHEMA_KEY__UID
+        return (where_clause, where_clause_args)
 
-        # Add optional sort clause, defaulting to position.
-        if self.sort_by_column:
-            sql_statement += 'ORDER BY %s ' % self.sort_by_column
-        else:
-            sql_statement += 'ORDER BY %s ' % MELTED_SCHEMA_KEY__POSITION
-        if self.sort_by_direction == 'desc':
-            sql_statement += 'DESC '
+    def _execute(self, sql_statement, args):
+        """Runs the query and fetches all result rows, sampling the query
+        plan if the query is slow. See _maybe_record_slow_query().
 
-        # Add limit and offset clause. Only if no optimization limit.
-        if self.optimization_uid_list is None:
-            if self.pagination_len != -1:
-                sql_statement += 'LIMIT %d ' % self.pagination_len
-            sql_statement += 'OFFSET %d ' % self.pagination_start
-
-        # DEBUG
-        # LOGGER.debug(sql_statement)
-
-        # Execute the query and store the results in hashable representation
-        # so that they can be combined through boolean operators with other
-        # evaluations.
+        Returns:
+            Tuple pair (cursor, list of rows).
+        """
         cursor = connection.cursor()
-        cursor.execute(sql_statement, where_clause_args)
-
-        # Column header data.
-        col_descriptions = [col[0].upper() for col in cursor.description]
-
-        # Either act as a generator, or return all results.
-        if self.act_as_generator:
-            def as_generator():
-              next_row = cursor.fetchone()
-              while next_row:
-                  yield dict(zip(col_descriptions, next_row))
-                  next_row = cursor.fetchone()
-            return as_generator()
-        else:
-            return [dict(zip(col_descriptions, row)) for row in cursor.fetchall()]
+        start_time = time.time()
+        cursor.execute(sql_statement, args)
+        rows = cursor.fetchall()
+        duration = time.time() - start_time
+        self._maybe_record_slow_query(sql_statement, args, duration,
+                len(rows))
+        return (cursor, rows)
+
+    def _maybe_record_slow_query(self, sql_statement, args, duration,
+            num_rows):
+        """Records a SlowVariantFilterQuery if the query took longer than
+        settings.SLOW_VARIANT_FILTER_QUERY_THRESHOLD seconds, and starts
+        record_slow_variant_filter_query_plan() to fill in its plan.
+
+        Since getting the plan runs the query again, only a
+        settings.SLOW_VARIANT_FILTER_QUERY_SAMPLE_RATE fraction of slow
+        queries are recorded.
+        """
+        threshold = settings.SLOW_VARIANT_FILTER_QUERY_THRESHOLD
+        if threshold is None or duration < threshold:
+            return
+        if random.random() >= settings.SLOW_VARIANT_FILTER_QUERY_SAMPLE_RATE:
+            return
+
+        # Use a separate cursor so that the one holding the results is left
+        # alone.
+        slow_query = SlowVariantFilterQuery.objects.create(
+                reference_genome=self.ref_genome,
+                filter_string=self.filter_string,
+                is_melted=self.is_melted,
+                sql=connection.cursor().mogrify(sql_statement, args),
+                duration=duration,
+                num_rows=num_rows,
+                query_plan='')
+        record_slow_variant_filter_query_plan.delay(slow_query.id)
+
+    def _execute_as_generator(self, sql_statement, args):
+        """Runs the query with a named (server-side) cursor and returns a
+        generator over the result rows, fetched GENERATOR_FETCH_SIZE at a
+        time.
+        """
+        # Make sure the underlying connection is open.
+        connection.cursor()
+
+        # WITH HOLD so the cursor survives any commit while the caller is
+        # still consuming rows.
+        cursor = connection.connection.cursor(
+                name='variant_filter_' + uuid4().hex, withhold=True)
+        start_time = time.time()
+        cursor.execute(sql_statement, args)
+        query_time = [time.time() - start_time]
+
+        def as_generator():
+            # Only time spent in the database counts towards the duration,
+            # not time the caller spends on each row.
+            num_rows = 0
+            try:
+                col_descriptions = None
+                while True:
+                    fetch_start_time = time.time()
+                    rows = cursor.fetchmany(GENERATOR_FETCH_SIZE)
+                    query_time[0] += time.time() - fetch_start_time
+                    if col_descriptions is None:
+                        # Only available after the first fetch.
+                        col_descriptions = [col[0].upper()
+                                for col in cursor.description]
+                    if not rows:
+                        break
+                    num_rows += len(rows)
+                    for row in rows:
+                        yield dict(zip(col_descriptions, row))
+            finally:
+                cursor.close()
+            self._maybe_record_slow_query(sql_statement, args, query_time[0],
+                    num_rows)
+        return as_generator()
 
     def _select_clause(self):
         """Determines the SELECT clause for the materialized view.
@@ -319,149 +438,6 @@ class VariantFilterEvaluator(object):
                 cols_to_fetch.add(col)
         return list(cols_to_fetch)
 
-    def _where_clause(self):
-        # Returns None if no where clause, or
-        #   a tuple (where clause, arguments)
-        if not self.sympy_representation:
-            return None
-
-        # On a high level, the algorithm breaks down into doing as much
-        # filtering on the SQL side, and then doing the rest in application
-        # memory. Fields that we currently handle in memory include those that
-        # are part of the catch-all serialized data field, as well as SQL
-        # fields which we must then use to establish the specific relationship
-        # between Variants and ExperimentSamples.
-
-        # First we bin the individual symbols in the clause according to how
-        # they should be handled. The binning decision works according to:
-        #     * Symbols that can be handled in SQL are picked out.
-        #         * They are all turned into Q objects.
-        #         * Those that are relevant to per-sample filtering are saved
-        #           for further analysis along with remaining triples below.
-        #     * Symbols that are a scoped expression are handled recursively
-        #       and the FilterEvalResult object returned.
-        #     * Non-SQL triples (part of serialized string) are saved for
-        #       for processing in-memory at the end.
-        #
-        # Order doesn't matter since this is a conjunction (AND) clause.
-
-        def _conjuntion_clause(conjunction_clause):
-
-            # Store the results of binning in these data structures.
-            filter_eval_results = []
-            sql_ready_symbol_list = []
-            remaining_triples = []
-
-            # Bin the parts of the query, potentially making recursive calls
-            # if we have scoped filters (e.g. per-sample).
-            if not conjunction_clause == '':
-                # Handle the case where a conjunction might be a single condition.
-                if not conjunction_clause.is_Boolean:
-                    symbol_list = [conjunction_clause]
-                else:
-                    symbol_list = conjunction_clause.args
-
-                # Bin.
-                for symbol in symbol_list:
-                    updated_structs = self._single_symbol_mux(
-                            symbol, filter_eval_results, sql_ready_symbol_list,
-                            remaining_triples)
-                    (filter_eval_results, sql_ready_symbol_list,
-                            remaining_triples) = updated_structs
-
-            where_clause_conjunctive_expr_list = []
-            where_clause_args = []
-            for triple in remaining_triples:
-                (expr, arg) = convert_delim_key_value_triple_to_expr(triple)
-                where_clause_conjunctive_expr_list.append(expr)
-                where_clause_args.append(arg)
-            return (' AND '.join(where_clause_conjunctive_expr_list),
-                    where_clause_args)
-
-        # If only one conjunction clause, evaluate directly
-        if not isinstance(self.sympy_representation, boolalg.Or):
-            return _conjuntion_clause(self.sympy_representation)
-        else:
-            conjunction_clause_info = [_conjuntion_clause(conjunction_clause)
-                    for conjunction_clause in self.sympy_representation.args]
-            where_clause = ' OR '.join(['(' + info[0] + ')'
-                for info in conjunction_clause_info])
-            args = []
-            for info in conjunction_clause_info:
-                args.extend(info[1])
-            return (where_clause, args)
-
-
-    def _single_symbol_mux(self, symbol, filter_eval_results, q_list,
-            remaining_triples):
-        """Helper method for evaluating a single symbol.
-        """
-        result = self._handle_single_symbol(symbol)
-        remaining_triples.append(result)
-        return (filter_eval_results, q_list, remaining_triples)
-
-
-    def _handle_single_symbol(self, symbol):
-        """Returns one of:
-            * A FilterEvalResult object if the symbol represents a scoped
-                filter condition.
-            * A Tuple pair (Q_OBJ_TYPE, Django Q object), if the symbol
-                represents a condition that
-            can be evaluated against the SQL database.
-            * A triple of delim, key, value if the condition must be evaluated
-                in-memory.
-        """
-        # Look up the expression that the symbol represents.
-        condition_string = self.get_condition_string_for_symbol(symbol)
-
-        # Finally, if here, then this should be a basic, delimiter-separated
-        # expression.
-        (delim, key, value) = get_delim_key_value_triple(condition_string,
-                self.all_key_map)
-
-        # Clean up value.
-        value = value.replace('\'', '')
-        value = value.replace('\"', '')
-
-        # Rewrite the key if it is in a json field of the materialized view
-        rewritten_key = self._rewrite_arg_if_json_field(key)
-
-        return (delim, rewritten_key, value)
-
-
-    def _rewrite_arg_if_json_field(self, arg):
-        # Check if arg is a special json field, and rewrite if so, using the appropriate type cast
-        # For example, if arg = 'INFO_AO', which is an integer field under snp_alternate_data (ve_data)
-        #   then this function will return "(ve_data->>INFO_AO)::Integer"
-
-        json_field = generate_key_to_materialized_view_parent_col(
-                self.ref_genome).get(arg, None)
-        json_field_expanded = {
-                'vccd_data': 'snp_caller_common_data',
-                'va_data': 'snp_alternate_data',
-                'es_data': 'experiment_sample_data',
-                've_data': 'snp_evidence_data'}.get(json_field, None)
-
-        if json_field_expanded:
-            # Get the type of the field from the original variant_key_map
-            field_type = self.ref_genome.variant_key_map[
-                    json_field_expanded][arg]['type']
-
-            # support these data types
-            # string doesn't need to be cast
-            field_type_expanded = {
-                    VARIANT_KEY_MAP_TYPE__INTEGER: '::Integer',
-                    VARIANT_KEY_MAP_TYPE__FLOAT: '::Float',
-                    VARIANT_KEY_MAP_TYPE__BOOLEAN: '::Boolean',
-                    VARIANT_KEY_MAP_TYPE__STRING: ''}.get(field_type, None)
-
-            if field_type_expanded is not None:
-                return "(%s->>'%s')%s" % (
-                    json_field, arg, field_type_expanded)
-
-        # default to returning arg exactly as is
-        return arg
-
 
 ###############################################################################
 # Main client methods.
@@ -474,16 +450,32 @@ class LookupVariantsResult(object):
         result_list: List of cast or melted Variant objects.
         num_total_variants: Total number of variants that match query.
             For pagination.
+        next_pagination_key: Value to pass as pagination_key to get the next
+            page, or None if there is no next page or the sort order doesn't
+            support keyset pagination.
     """
-    def __init__(self, result_list, num_total_variants):
+    def __init__(self, result_list, num_total_variants,
+            next_pagination_key=None):
         self.result_list = result_list
         self.num_total_variants = num_total_variants
+        self.next_pagination_key = next_pagination_key
 
 
-def lookup_variants(query_args, reference_genome, alignment_group=None):
+def lookup_variants(query_args, reference_genome, alignment_group=None,
+        num_total_variants=None):
     """Manages the end-to-end flow of looking up Variants that match the
     given filter.
 
+    Args:
+        query_args: Dictionary of query arguments. See
+            get_variants_that_pass_filter().
+        reference_genome: The ReferenceGenome the Variants belong to.
+        alignment_group: If provided, limit results to Variants called in
+            this AlignmentGroup.
+        num_total_variants: Total number of Variants that match the filter, if
+            already known from a previous page. Saves counting all matches
+            again.
+
     Returns:
         LookupVariantsResult object which contains the list of matching
         Variant objects as dictionaries and a count of total results.
@@ -500,40 +492,59 @@ def lookup_variants(query_args, reference_genome, alignment_group=None):
     assert not 'get_uids_only' in query_args
     assert not 'optimization_uid_list' in query_args
 
-    # If cast view, set num_total_variants after initial uids-only call.
-    # If melted, set num_total_variants after full data call.
-    num_total_variants = None
-
+    # The evaluator that applies pagination. Its results determine the total
+    # count and the key of the next page.
     if not query_args.get('is_melted', True):
         query_args['get_uids_only'] = True
-        uid_only_results = get_variants_that_pass_filter(
-                query_args, reference_genome, alignment_group=alignment_group)
+        paginated_evaluator = VariantFilterEvaluator(query_args,
+                reference_genome, alignment_group=alignment_group)
+        paginated_results = paginated_evaluator.evaluate()
         query_args['optimization_uid_list'] = [
-                r['UID'] for r in uid_only_results]
-        if len(uid_only_results):
-            num_total_variants = uid_only_results[0]['FULL_COUNT']
-        else:
-            num_total_variants = 0
+                r['UID'] for r in paginated_results]
 
-    # If we did a first uids-only call, only do the second call if there were
-    # any results.
-    if num_total_variants is None or num_total_variants > 0:
-        # Query full data.
-        query_args['get_uids_only'] = False
-        page_results = get_variants_that_pass_filter(query_args, reference_genome,
-                alignment_group=alignment_group)
-
-        # Figure out number of total variants by parsing one of the above results,
-        # Only if not set in 1st call. This code should only run for melted results.
-        if num_total_variants is None:
-            if len(page_results):
-                num_total_variants = page_results[0]['FULL_COUNT']
-            else:
-                num_total_variants = 0
+        # Only do the second call if there were any results.
+        if len(paginated_results):
+            query_args['get_uids_only'] = False
+            page_results = get_variants_that_pass_filter(query_args,
+                    reference_genome, alignment_group=alignment_group)
+        else:
+            page_results = []
     else:
-        page_results = []
+        query_args['get_uids_only'] = False
+        paginated_evaluator = VariantFilterEvaluator(query_args,
+                reference_genome, alignment_group=alignment_group)
+        paginated_results = page_results = paginated_evaluator.evaluate()
 
-    return LookupVariantsResult(page_results, num_total_variants)
+    if num_total_variants is None:
+        num_total_variants = _get_num_total_variants(
+                paginated_evaluator, paginated_results)
+
+    next_pagination_key = None
+    if (not paginated_evaluator.sort_by_column and
+            paginated_evaluator.pagination_len != -1 and
+            len(paginated_results) == paginated_evaluator.pagination_len):
+        next_pagination_key = paginated_evaluator.get_pagination_key(
+                paginated_results[-1])
+
+    return LookupVariantsResult(page_results, num_total_variants,
+            next_pagination_key=next_pagination_key)
+
+
+def _get_num_total_variants(evaluator, paginated_results):
+    """Returns the total number of results matching the evaluator's filter.
+
+    When the page was reached by offset and isn't full, the total follows
+    from the offset, so we avoid counting all matches. Otherwise this is a
+    full count, so callers paging through results should count once and pass
+    the total to lookup_variants() for later pages.
+    """
+    if not evaluator.uses_keyset_pagination():
+        start = evaluator.pagination_start
+        is_last_page = (evaluator.pagination_len == -1 or
+                len(paginated_results) < evaluator.pagination_len)
+        if is_last_page and (len(paginated_results) or start == 0):
+            return start + len(paginated_results)
+    return evaluator.count()
 
 
 def get_variants_that_pass_filter(query_args, ref_genome, alignment_group=None):
@@ -566,3 +577,18 @@ def get_variants_that_pass_filter(query_args, ref_genome, alignment_group=None):
     evaluator = VariantFilterEvaluator(query_args, ref_genome,
             alignment_group=alignment_group)
     return evaluator.evaluate()
+
+
+@task
+def record_slow_variant_filter_query_plan(slow_query_id):
+    """Celery task that runs EXPLAIN (ANALYZE, BUFFERS) for a recorded
+    SlowVariantFilterQuery and saves the plan, so that the query isn't run a
+    second time within the request.
+    """
+    slow_query = SlowVariantFilterQuery.objects.get(id=slow_query_id)
+    cursor = connection.cursor()
+    # The sql already has its arguments filled in, so escape any literal %.
+    cursor.execute('EXPLAIN (ANALYZE, BUFFERS) ' +
+            slow_query.sql.replace('%', '%%'))
+    slow_query.query_plan = '\n'.join([row[0] for row in cursor.fetchall()])
+    slow_query.save(update_fields=['query_plan'])
@@ -2,18 +2,76 @@
 Manages the Materialized view of the Variant data for filtering.
 """
 
+from contextlib import contextmanager
+import hashlib
+import re
+import threading
+
+from django.conf import settings
 from django.db import connection
+from django.db import DatabaseError
+from django.db import IntegrityError
 from django.db import transaction
 
 from main.consistency import ensure_all_ref_genome_variant_set_consistency
+from main.consistency import ensure_variant_set_consistency_for_variants
 from melted_variant_schema import *
 
 
+# The following tables are shared by the melted variant views of all
+# ReferenceGenomes. They are created by a migration (see main/migrations) so
+# that reads never have to run DDL.
+
+# Table of Variants whose rows in their ReferenceGenome's melted variant view
+# must be recomputed on the next refresh.
+MELTED_VARIANT_STALE_TABLE = 'materialized_melted_variant_stale'
+
+# Table recording the current version of each ReferenceGenome's melted variant
+# view. The version changes whenever the view's data may have changed, so
+# results computed from the view can be cached by version. Versions come from
+# the table's sequence, so they never repeat, even across drops.
+MELTED_VARIANT_VIEW_VERSION_TABLE = 'materialized_melted_variant_version'
+
+# Table recording, for each melted variant table, a hash of the filter key
+# index definitions last applied to it and the indexes that failed to build.
+# See MeltedVariantIndexManager.
+MELTED_VARIANT_INDEX_STATE_TABLE = 'materialized_melted_variant_index_state'
+
+# Per-thread state of batch_version_bumps().
+_version_bump_batch = threading.local()
+
+
+@contextmanager
+def batch_version_bumps():
+    """Context manager that defers version bumps until the block exits, so
+    that a change made up of many small steps, e.g. one signal per
+    VariantToVariantSet, bumps each ReferenceGenome's version only once.
+
+    Blocks may be nested. Bumps are applied when the outermost one exits.
+    """
+    is_outermost = not hasattr(_version_bump_batch, 'reference_genomes')
+    if is_outermost:
+        _version_bump_batch.reference_genomes = {}
+    try:
+        yield
+    finally:
+        if is_outermost:
+            reference_genomes = _version_bump_batch.reference_genomes
+            del _version_bump_batch.reference_genomes
+            for reference_genome in reference_genomes.itervalues():
+                MeltedVariantMaterializedViewManager(
+                        reference_genome).bump_version()
+
+
 class AbstractMaterializedViewManager(object):
     """Base class for object acting as wrapper for a Postgresql materialized
     view (available starting Postgresql 9.3)
     """
 
+    # Kind of relation backing the view, as stored in pg_class.relkind.
+    # 'm' for materialized view, 'r' for an ordinary table.
+    RELKIND = 'm'
+
     def __init(self):
         """Child classes should implement at least these two fields.
         """
@@ -67,9 +125,10 @@ class AbstractMaterializedViewManager(object):
         """Creates the table if it doesn't exist or is not valid.
 
         NOTE: There is also a refresh() method, which would prevent having
-        to create the materialized view. As of this note, we are not using
-        refresh() anywhere.  It's not clear whether a refresh is any faster
-        than just dropping the table and create it again.
+        to create the materialized view. It's not clear whether a
+        REFRESH MATERIALIZED VIEW is any faster than just dropping the table
+        and create it again. See MeltedVariantMaterializedViewManager for
+        a child class that refreshes incrementally instead.
         """
         if not self.check_table_exists() or not self.is_valid():
             self.create()
@@ -95,19 +154,37 @@ class AbstractMaterializedViewManager(object):
             'FROM pg_catalog.pg_class c '
             'WHERE c.relkind=%s AND c.relname=%s '
         )
-        self.cursor.execute(raw_sql, ('m', self.view_table_name))
+        self.cursor.execute(raw_sql, (self.RELKIND, self.view_table_name))
         return bool(self.cursor.fetchone())
 
 
 class MeltedVariantMaterializedViewManager(AbstractMaterializedViewManager):
     """Interface for objects providing a wrapper for a Postgresql materialized
     view.
+
+    Unlike a plain materialized view, the melted variant data is stored in
+    an ordinary table so that it can be maintained incrementally. Changes
+    that only affect some Variants mark them stale with mark_variants_stale()
+    or mark_alignment_group_stale(), and refresh() then recomputes only the
+    rows for those Variants. A full rebuild with create() is still needed
+    when the view is invalidated as a whole.
+
+    Any change to the view's data, including marking Variants stale, bumps
+    the version returned by get_version().
+
+    Stale Variants and versions live in tables shared by all
+    ReferenceGenomes, so marking Variants stale works whether or not the view
+    exists yet.
     """
 
+    RELKIND = 'r'
+
     def __init__(self, reference_genome):
         self.reference_genome = reference_genome
         self.view_table_name = self.get_table_name()
         self.cursor = connection.cursor()
+        self.index_manager = MeltedVariantIndexManager(reference_genome,
+                self.view_table_name, self.cursor)
 
     def get_table_name(self):
         """Override.
@@ -119,15 +196,241 @@ class MeltedVariantMaterializedViewManager(AbstractMaterializedViewManager):
         """
         return self.reference_genome.is_materialized_variant_view_valid
 
+    def create_if_not_exists_or_invalid(self):
+        """Override to apply pending incremental changes when a full rebuild
+        isn't needed.
+        """
+        if not self.is_valid() or not self.check_table_exists():
+            self.create()
+        else:
+            self._refresh_stale_variants()
+
+    def drop(self):
+        """Override.
+
+        Also forgets the stale Variants, since the next create() computes all
+        rows. Installations from before incremental maintenance may have a
+        materialized view by this name, so drop that too if present.
+        """
+        assert self.view_table_name
+        assert self.cursor
+        self.bump_version()
+        self.cursor.execute(
+                'DELETE FROM %s WHERE reference_genome_id = %%s' % (
+                        MELTED_VARIANT_STALE_TABLE,),
+                (self.reference_genome.id,))
+        self.index_manager.clear_state()
+        raw_sql = (
+            'SELECT c.relkind '
+            'FROM pg_catalog.pg_class c '
+            'WHERE c.relname=%s '
+        )
+        self.cursor.execute(raw_sql, (self.view_table_name,))
+        for (relkind,) in self.cursor.fetchall():
+            if relkind == 'm':
+                self.cursor.execute('DROP MATERIALIZED VIEW IF EXISTS %s' % (
+                        self.view_table_name,))
+            elif relkind == 'r':
+                self.cursor.execute('DROP TABLE IF EXISTS %s' % (
+                        self.view_table_name,))
+        transaction.commit_unless_managed()
+
     def create_internal(self):
         """Override.
         """
         ensure_all_ref_genome_variant_set_consistency(self.reference_genome)
 
+        create_sql_statement = 'CREATE TABLE %s AS (%s)' % (
+                self.view_table_name, self._get_melted_variant_select_sql())
+        self.cursor.execute(create_sql_statement)
+
+        # Incremental refreshes delete and re-insert rows by Variant id.
+        self.cursor.execute('CREATE INDEX ON %s (id)' % self.view_table_name)
+
+        # Results are sorted by position by default, and paged by seeking to
+        # the (position, id, ...) key of the last row of the previous page.
+        self.cursor.execute('CREATE INDEX ON %s (position, id)' %
+                self.view_table_name)
+
+        self.index_manager.ensure_indexes()
+        transaction.commit_unless_managed()
+
+        # Set the valid bit.
+        self.reference_genome.is_materialized_variant_view_valid = True
+        self.reference_genome.save()
+
+    def refresh(self):
+        """Override.
+
+        Recomputes the rows of Variants marked stale since the last create()
+        or refresh(). Rows of all other Variants are left untouched, so this
+        costs time proportional to the size of the change rather than the
+        size of the project. Readers keep seeing the previous rows until the
+        refresh commits.
+        """
+        assert self.view_table_name
+        assert self.cursor
+        if not self.check_table_exists():
+            return
+        self._refresh_stale_variants()
+
+    def _refresh_stale_variants(self):
+        """Does the work of refresh(), assuming the table exists.
+        """
+        # Most reads find nothing stale, so check before taking the lock.
+        self.cursor.execute(
+                'SELECT EXISTS (SELECT 1 FROM %s '
+                'WHERE reference_genome_id = %%s)' % (
+                        MELTED_VARIANT_STALE_TABLE,),
+                (self.reference_genome.id,))
+        if not self.cursor.fetchone()[0]:
+            return
+
+        with transaction.commit_on_success():
+            # Serialize concurrent refreshes of the same table so the same
+            # Variant isn't re-inserted twice.
+            self.cursor.execute('SELECT pg_advisory_xact_lock(%s)',
+                    (self.reference_genome.id,))
+
+            self.cursor.execute(
+                    'DELETE FROM %s WHERE reference_genome_id = %%s '
+                    'RETURNING variant_id' % (MELTED_VARIANT_STALE_TABLE,),
+                    (self.reference_genome.id,))
+            stale_variant_ids = list(set(
+                    [row[0] for row in self.cursor.fetchall()]))
+            if not stale_variant_ids:
+                return
+
+            # Imports that add keys to the key map also mark the Variants
+            # they touch stale, so this is where new keys get indexes.
+            self.index_manager.ensure_indexes_if_changed()
+
+            ensure_variant_set_consistency_for_variants(
+                    self.reference_genome, stale_variant_ids)
+
+            self.cursor.execute(
+                    'DELETE FROM %s WHERE id = ANY(%%s)' % (
+                            self.view_table_name,),
+                    (stale_variant_ids,))
+
+            variant_filter_sql = ' AND (main_variant.id = ANY(%s))'
+            insert_sql_statement = 'INSERT INTO %s (%s)' % (
+                    self.view_table_name,
+                    self._get_melted_variant_select_sql(variant_filter_sql))
+            self.cursor.execute(insert_sql_statement,
+                    (stale_variant_ids, stale_variant_ids))
+
+    def mark_variants_stale(self, variant_ids):
+        """Marks Variants whose rows should be recomputed on next refresh().
+
+        Args:
+            variant_ids: Iterable of Variant ids.
+        """
+        variant_ids = list(variant_ids)
+        if not variant_ids:
+            return
+        self.cursor.execute(
+                'INSERT INTO %s (reference_genome_id, variant_id) '
+                'SELECT %%s, unnest(%%s)' % (MELTED_VARIANT_STALE_TABLE,),
+                (self.reference_genome.id, variant_ids))
+        self.bump_version()
+
+    def mark_alignment_group_stale(self, alignment_group):
+        """Marks all Variants called in the AlignmentGroup stale, as well as
+        any Variants that currently have rows for it.
+        """
+        stale_variants_sql = (
+            'INSERT INTO %s (reference_genome_id, variant_id) '
+                'SELECT %%s, variant_id FROM main_variantcallercommondata '
+                'WHERE alignment_group_id = %%s' % (
+                        MELTED_VARIANT_STALE_TABLE,))
+        params = [self.reference_genome.id, alignment_group.id]
+        if self.check_table_exists():
+            stale_variants_sql += (
+                ' UNION SELECT %%s, id FROM %s WHERE ag_id = %%s' % (
+                        self.view_table_name,))
+            params.extend([self.reference_genome.id, alignment_group.id])
+        self.cursor.execute(stale_variants_sql, params)
+        self.bump_version()
+
+    def get_version(self):
+        """Returns the current version of the view's data, or 0 if it has
+        never changed.
+        """
+        self.cursor.execute(
+                'SELECT version FROM %s WHERE reference_genome_id = %%s' % (
+                        MELTED_VARIANT_VIEW_VERSION_TABLE,),
+                (self.reference_genome.id,))
+        row = self.cursor.fetchone()
+        if row is None:
+            return 0
+        return row[0]
+
+    def bump_version(self):
+        """Records that the view's data has changed, so that results cached
+        for the previous version are no longer used.
+
+        Inside batch_version_bumps(), the bump is deferred until the batch
+        ends. Otherwise this commits, along with any stale Variants just
+        marked, unless the caller manages the transaction.
+        """
+        batch = getattr(_version_bump_batch, 'reference_genomes', None)
+        if batch is not None:
+            batch[self.reference_genome.id] = self.reference_genome
+            return
+
+        # Each ReferenceGenome has a single row, which is created by the
+        # first bump.
+        if not self._advance_version():
+            # Concurrent first bumps can both get here. The row is unique, so
+            # the insert that loses waits for the other one to commit, then
+            # fails, and that bump advances the new row instead.
+            self.cursor.execute('SAVEPOINT insert_view_version')
+            try:
+                self.cursor.execute(
+                        'INSERT INTO %s (reference_genome_id) VALUES (%%s)' % (
+                                MELTED_VARIANT_VIEW_VERSION_TABLE,),
+                        (self.reference_genome.id,))
+            except IntegrityError:
+                self.cursor.execute(
+                        'ROLLBACK TO SAVEPOINT insert_view_version')
+                self._advance_version()
+            else:
+                self.cursor.execute('RELEASE SAVEPOINT insert_view_version')
+        transaction.commit_unless_managed()
+
+    def _advance_version(self):
+        """Advances the version in the ReferenceGenome's row.
+
+        Returns:
+            Boolean indicating whether the row exists.
+        """
+        self.cursor.execute(
+                "UPDATE %s SET version = nextval(pg_get_serial_sequence("
+                "'%s', 'version')) WHERE reference_genome_id = %%s" % (
+                        MELTED_VARIANT_VIEW_VERSION_TABLE,
+                        MELTED_VARIANT_VIEW_VERSION_TABLE),
+                (self.reference_genome.id,))
+        return self.cursor.rowcount > 0
+
+    def _get_melted_variant_select_sql(self, variant_filter_sql=''):
+        """Returns the SELECT statement that computes the melted variant rows.
+
+        Args:
+            variant_filter_sql: Optional additional condition, starting with
+                AND, to restrict the Variants that rows are computed for.
+                It appears once in each half of the UNION.
+        """
+        # Optionally store the key-value columns as jsonb so that they are
+        # parsed once here rather than by every filter.
+        if settings.MATERIALIZED_VIEW_JSONB:
+            data_cast = '::jsonb'
+        else:
+            data_cast = ''
+
         # Query all columns except the catch-all key value fields first,
         # then join with the key-value columns.
-        create_sql_statement = (
-            'CREATE MATERIALIZED VIEW %s AS ('
+        return (
                 'WITH melted_variant_data AS ('
                     '('
                         'SELECT %s FROM main_variant '
@@ -159,7 +462,7 @@ class MeltedVariantMaterializedViewManager(AbstractMaterializedViewManager):
                             'LEFT JOIN main_variantevidence_variantalternate_set ON ('
                                     'main_variantevidence.id = main_variantevidence_variantalternate_set.variantevidence_id) '
                             'LEFT JOIN main_variantalternate ON main_variantevidence_variantalternate_set.variantalternate_id = main_variantalternate.id '
-                        'WHERE (main_variant.reference_genome_id = %d) '
+                        'WHERE (main_variant.reference_genome_id = %d)%s '
                         'GROUP BY %s'
                     ') '
                     'UNION '
@@ -169,22 +472,22 @@ class MeltedVariantMaterializedViewManager(AbstractMaterializedViewManager):
                             'INNER JOIN main_varianttovariantset ON main_variant.id = main_varianttovariantset.variant_id '
                             'INNER JOIN main_variantset ON main_varianttovariantset.variant_set_id = main_variantset.id '
                             'INNER JOIN main_chromosome ON (main_variant.chromosome_id = main_chromosome.id) '
-                        'WHERE (main_variant.reference_genome_id = %d) '
+                        'WHERE (main_variant.reference_genome_id = %d)%s '
                         'GROUP BY %s'
                     ') '
                     'ORDER BY POSITION, EXPERIMENT_SAMPLE_UID DESC '
                 ') ' # melted_variant_data
                 ', va_data_table AS ('
-                    'SELECT id, data AS va_data from main_variantalternate'
+                    'SELECT id, data%s AS va_data from main_variantalternate'
                 ') ' # va_data_table
                 ', es_data_table AS ('
-                    'SELECT id, data AS es_data from main_experimentsample'
+                    'SELECT id, data%s AS es_data from main_experimentsample'
                 ') ' # es_data_table
                 ', vccd_data_table AS ('
-                    'SELECT id, data AS vccd_data from main_variantcallercommondata'
+                    'SELECT id, data%s AS vccd_data from main_variantcallercommondata'
                 ') ' # vccd_data_table
                 ', ve_data_table AS ('
-                    'SELECT id, data AS ve_data from main_variantevidence'
+                    'SELECT id, data%s AS ve_data from main_variantevidence'
                 ') ' # ve_data_table
                 'SELECT melted_variant_data.*, va_data, vccd_data, ve_data, es_data '
                     'FROM melted_variant_data '
@@ -192,22 +495,198 @@ class MeltedVariantMaterializedViewManager(AbstractMaterializedViewManager):
                         'LEFT JOIN es_data_table ON es_data_table.id = melted_variant_data.es_id '
                         'LEFT JOIN ve_data_table ON ve_data_table.id = melted_variant_data.ve_id '
                         'LEFT JOIN vccd_data_table ON vccd_data_table.id = melted_variant_data.vccd_id'
-            ')'
             % (
-                    self.view_table_name,
-
                     MATERIALIZED_TABLE_SELECT_CLAUSE,
                     self.reference_genome.id,
+                    variant_filter_sql,
                     MATERIALIZED_TABLE_GROUP_BY_CLAUSE,
 
                     MATERIALIZED_TABLE_VTVS_SELECT_CLAUSE,
                     self.reference_genome.id,
-                    MATERIALIZED_TABLE_VTVS_GROUP_BY_CLAUSE)
+                    variant_filter_sql,
+                    MATERIALIZED_TABLE_VTVS_GROUP_BY_CLAUSE,
+
+                    data_cast, data_cast, data_cast, data_cast)
             )
 
-        self.cursor.execute(create_sql_statement)
-        transaction.commit_unless_managed()
 
-        # Set the valid bit.
-        self.reference_genome.is_materialized_variant_view_valid = True
-        self.reference_genome.save()
+class MeltedVariantIndexManager(object):
+    """Maintains indexes on the key-value data columns of the melted variant
+    table, so that filters on them don't parse the json of every row.
+
+    Each filterable key in the ReferenceGenome's variant_key_map gets an
+    expression index on the same expression that VariantFilterEvaluator
+    generates when filtering on that key.
+
+    The definitions last applied to the table, and any indexes that failed to
+    build, are recorded in MELTED_VARIANT_INDEX_STATE_TABLE, so that refreshes
+    only touch the indexes when the key map has changed and don't retry
+    failed builds. Refreshes only compare definitions when they have stale
+    Variants to apply.
+    """
+
+    # Prefix, after the table name, of the names of indexes managed here.
+    INDEX_NAME_INFIX = '_k_'
+
+    # Keys are interpolated into index definitions.
+    VALID_KEY_REGEX = re.compile(r'^[A-Za-z0-9_]+$')
+
+    def __init__(self, reference_genome, table_name, cursor):
+        self.reference_genome = reference_genome
+        self.table_name = table_name
+        self.cursor = cursor
+
+    def ensure_indexes_if_changed(self):
+        """Calls ensure_indexes() if the index definitions have changed
+        since they were last applied, e.g. because an import added keys.
+        """
+        definitions_hash, _ = self._get_state()
+        if definitions_hash != self._get_definitions_hash(
+                self.get_index_definitions()):
+            self.ensure_indexes()
+
+    def ensure_indexes(self):
+        """Creates any missing indexes, and drops ones that are no longer
+        wanted, e.g. because a key's type changed.
+
+        Indexes that previously failed to build aren't attempted again.
+        Index names are a hash of what's indexed, so a changed definition
+        gets a new attempt.
+        """
+        index_name_prefix = self.table_name + self.INDEX_NAME_INFIX
+        self.cursor.execute(
+                'SELECT indexname FROM pg_indexes WHERE tablename = %s',
+                (self.table_name,))
+        existing_index_names = set([
+                row[0] for row in self.cursor.fetchall()
+                if row[0].startswith(index_name_prefix)])
+
+        _, failed_index_names = self._get_state()
+        index_definitions = self.get_index_definitions()
+        wanted_index_names = set(
+                [definition[0] for definition in index_definitions])
+        failed_index_names &= wanted_index_names
+        for index_name, create_index_sql in index_definitions:
+            if (index_name in existing_index_names or
+                    index_name in failed_index_names):
+                continue
+            if not self._create_index(create_index_sql):
+                failed_index_names.add(index_name)
+
+        for index_name in existing_index_names - wanted_index_names:
+            self.cursor.execute('DROP INDEX IF EXISTS %s' % index_name)
+
+        self._set_state(self._get_definitions_hash(index_definitions),
+                failed_index_names)
+
+    def clear_state(self):
+        """Forgets the recorded state, e.g. when the table is dropped.
+        """
+        self.cursor.execute(
+                'DELETE FROM %s WHERE table_name = %%s' % (
+                        MELTED_VARIANT_INDEX_STATE_TABLE,),
+                (self.table_name,))
+
+    def get_index_definitions(self):
+        """Returns list of (index name, CREATE INDEX statement) pairs for
+        all the indexes that should exist.
+        """
+        index_definitions = []
+        for data_col, key, key_type in self.get_filterable_keys():
+            expression = get_json_key_sql_expression(data_col, key, key_type)
+            index_name = self._get_index_name(expression)
+            index_definitions.append((index_name,
+                    'CREATE INDEX %s ON %s ((%s))' % (
+                            index_name, self.table_name, expression)))
+
+        return index_definitions
+
+    def get_filterable_keys(self):
+        """Returns sorted list of (data column, key, type) triples for the keys
+        in settings.MATERIALIZED_VIEW_INDEXED_KEYS that filters can compare in
+        SQL, i.e. that hold a single value per row of the melted table.
+
+        Per-alternate keys ('num' of -1) are stored with one value per
+        VariantAlternate, so they count.
+        """
+        # Avoid circular import.
+        from variants.common import VARIANT_KEY_TO_MATERIALIZED_VIEW_COL_MAP
+        from variants.filter_key_map_constants import MAP_KEY__ALTERNATE
+
+        indexed_keys = set(settings.MATERIALIZED_VIEW_INDEXED_KEYS)
+        if not indexed_keys:
+            return []
+
+        filterable_keys = []
+        for submap_name, submap in (
+                self.reference_genome.variant_key_map.iteritems()):
+            data_col = VARIANT_KEY_TO_MATERIALIZED_VIEW_COL_MAP.get(
+                    submap_name, None)
+            if data_col is None:
+                continue
+            for key, key_info in submap.iteritems():
+                # Keys that are also columns are filtered on the column.
+                if key in MATERIALIZED_TABLE_QUERYABLE_FIELDS_MAP:
+                    continue
+                if not self.VALID_KEY_REGEX.match(key):
+                    continue
+                if key not in indexed_keys:
+                    continue
+                if (key_info.get('num') != 1 and
+                        submap_name != MAP_KEY__ALTERNATE):
+                    continue
+                if key_info.get('type') not in JSON_KEY_TYPE_TO_SQL_CAST:
+                    continue
+                filterable_keys.append((data_col, key, key_info['type']))
+        return sorted(filterable_keys)
+
+    def _get_index_name(self, index_key):
+        # Postgres truncates identifiers to 63 characters, so use a hash of
+        # what's indexed rather than the key itself.
+        return '%s%s%s' % (self.table_name, self.INDEX_NAME_INFIX,
+                hashlib.md5(index_key).hexdigest()[:12])
+
+    def _get_definitions_hash(self, index_definitions):
+        return hashlib.md5('\n'.join(
+                [sql for _, sql in sorted(index_definitions)])).hexdigest()
+
+    def _get_state(self):
+        """Returns pair (definitions hash, set of failed index names), with
+        a hash of None if no state is recorded.
+        """
+        self.cursor.execute(
+                'SELECT definitions_hash, failed_index_names FROM %s '
+                'WHERE table_name = %%s' % (MELTED_VARIANT_INDEX_STATE_TABLE,),
+                (self.table_name,))
+        row = self.cursor.fetchone()
+        if row is None:
+            return (None, set())
+        return (row[0], set(row[1] or []))
+
+    def _set_state(self, definitions_hash, failed_index_names):
+        self.clear_state()
+        self.cursor.execute(
+                'INSERT INTO %s '
+                '(table_name, definitions_hash, failed_index_names) '
+                'VALUES (%%s, %%s, %%s::text[])' % (
+                        MELTED_VARIANT_INDEX_STATE_TABLE,),
+                (self.table_name, definitions_hash,
+                        sorted(failed_index_names)))
+
+    def _create_index(self, create_index_sql):
+        """Creates the index, unless building it fails, e.g. because a stored
+        value can't be cast to the key's type. Filters on the key then still
+        work, just without an index.
+
+        Returns:
+            Boolean indicating whether the index was created.
+        """
+        self.cursor.execute('SAVEPOINT create_filter_key_index')
+        try:
+            self.cursor.execute(create_index_sql)
+        except DatabaseError:
+            self.cursor.execute(
+                    'ROLLBACK TO SAVEPOINT create_filter_key_index')
+            return False
+        self.cursor.execute('RELEASE SAVEPOINT create_filter_key_index')
+        return True
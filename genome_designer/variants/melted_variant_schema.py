@@ -5,6 +5,11 @@ materialized view of the melted variant data.
 Build the schema used to build the materialized view.
 """
 
+from variants.filter_key_map_constants import VARIANT_KEY_MAP_TYPE__BOOLEAN
+from variants.filter_key_map_constants import VARIANT_KEY_MAP_TYPE__FLOAT
+from variants.filter_key_map_constants import VARIANT_KEY_MAP_TYPE__INTEGER
+from variants.filter_key_map_constants import VARIANT_KEY_MAP_TYPE__STRING
+
 
 class SchemaBuilder(object):
     """Builder object for the schema.
@@ -208,3 +213,27 @@ MATERIALIZED_TABLE_QUERYABLE_FIELDS_MAP = dict([
 for key, query_schema in MATERIALIZED_TABLE_QUERYABLE_FIELDS_MAP.iteritems():
     assert query_schema is not None, (
             "Missing query schema for queryable %s" % key)
+
+# Casts applied to values in the key-value data columns (va_data, vccd_data,
+# ve_data, es_data) when filtering, by variant_key_map type. Strings are
+# compared as text.
+JSON_KEY_TYPE_TO_SQL_CAST = {
+    VARIANT_KEY_MAP_TYPE__INTEGER: '::Integer',
+    VARIANT_KEY_MAP_TYPE__FLOAT: '::Float',
+    VARIANT_KEY_MAP_TYPE__BOOLEAN: '::Boolean',
+    VARIANT_KEY_MAP_TYPE__STRING: '',
+}
+
+
+def get_json_key_sql_expression(data_col, key, key_type):
+    """Returns the SQL expression for the value of key in the key-value data
+    column data_col, cast according to key_type, or None if the type isn't
+    supported.
+
+    Filters and expression indexes must use the exact same expression for
+    Postgres to use the index.
+    """
+    cast = JSON_KEY_TYPE_TO_SQL_CAST.get(key_type, None)
+    if cast is None:
+        return None
+    return "(%s->>'%s')%s" % (data_col, key, cast)
@@ -17,7 +17,6 @@ from variants.dynamic_snp_filter_key_map import update_filter_key_map
 from settings import PWD as GD_ROOT
 from variants.common import determine_visible_field_names
 from variants.common import extract_filter_keys
-from variants.common import SymbolGenerator
 from variants.common import update_parent_child_variant_fields
 
 
@@ -99,14 +98,3 @@ class TestCommon(TestCase):
 
         self.assertEqual(ve_sample_3.data['GT_TYPE'],2)
         self.assertEqual(ve_sample_2.data['IN_CHILDREN'],1)
-
-
-class TestSymbolGenerator(TestCase):
-    """Tests the symbol generator used for symbolic manipulation.
-    """
-
-    def test_generator(self):
-        symbol_maker = SymbolGenerator()
-        self.assertEqual('A', symbol_maker.next())
-        self.assertEqual('B', symbol_maker.next())
-        self.assertEqual('C', symbol_maker.next())
@@ -0,0 +1,117 @@
+"""
+Tests for filter_expression.py.
+"""
+
+from django.test import TestCase
+
+from main.testing_util import create_common_entities
+from variants.common import ParseError
+from variants.filter_expression import compile_filter_string
+from variants.filter_expression import FilterAnd
+from variants.filter_expression import FilterCondition
+from variants.filter_expression import FilterOr
+from variants.filter_expression import parse_filter_string
+from variants.filter_expression import tokenize_filter_string
+from variants.filter_expression import TOKEN__AND
+from variants.filter_expression import TOKEN__CONDITION
+from variants.filter_expression import TOKEN__OR
+from variants.melted_variant_schema import MATERIALIZED_TABLE_QUERYABLE_FIELDS_MAP
+
+
+ALL_KEY_MAP = [MATERIALIZED_TABLE_QUERYABLE_FIELDS_MAP]
+
+
+class TestTokenizeFilterString(TestCase):
+
+    def test_word_operators(self):
+        """Unquoted values may contain spaces, but not operator words.
+        """
+        tokens = tokenize_filter_string(
+                'EXPERIMENT_SAMPLE_LABEL = C E5 and position>5 OR '
+                'position < 2')
+        self.assertEqual([
+            (TOKEN__CONDITION, 'EXPERIMENT_SAMPLE_LABEL = C E5'),
+            (TOKEN__AND, 'and'),
+            (TOKEN__CONDITION, 'position>5'),
+            (TOKEN__OR, 'OR'),
+            (TOKEN__CONDITION, 'position < 2'),
+        ], tokens)
+
+    def test_operator_prefix_in_value(self):
+        tokens = tokenize_filter_string(
+                'EXPERIMENT_SAMPLE_LABEL = android | position=1')
+        self.assertEqual([
+            (TOKEN__CONDITION, 'EXPERIMENT_SAMPLE_LABEL = android'),
+            (TOKEN__OR, '|'),
+            (TOKEN__CONDITION, 'position=1'),
+        ], tokens)
+
+    def test_unexpected_input(self):
+        with self.assertRaises(ParseError):
+            tokenize_filter_string('position > 5 $ position < 2')
+
+
+class TestParseFilterString(TestCase):
+
+    def test_precedence(self):
+        """AND binds tighter than OR.
+        """
+        expression = parse_filter_string(
+                'position = 1 | position = 2 & chromosome = c1',
+                ALL_KEY_MAP)
+        self.assertEqual(FilterOr([
+            FilterCondition(('==', 'POSITION', '1')),
+            FilterAnd([
+                FilterCondition(('==', 'POSITION', '2')),
+                FilterCondition(('==', 'CHROMOSOME', 'c1'))])
+        ]), expression)
+
+    def test_flatten(self):
+        expression = parse_filter_string(
+                '((position > 1) & position < 5) & (chromosome = "c1")',
+                ALL_KEY_MAP)
+        self.assertEqual(FilterAnd([
+            FilterCondition(('>', 'POSITION', '1')),
+            FilterCondition(('<', 'POSITION', '5')),
+            FilterCondition(('==', 'CHROMOSOME', 'c1'))
+        ]), expression)
+
+    def test_empty(self):
+        self.assertEqual(None, parse_filter_string('  ', ALL_KEY_MAP))
+
+    def test_invalid(self):
+        for filter_string in ['position > 5 &', '(position > 5',
+                'position > 5)', '()', 'nonexistent_key = 2']:
+            with self.assertRaises(ParseError):
+                parse_filter_string(filter_string, ALL_KEY_MAP)
+
+
+class TestCompileFilterString(TestCase):
+
+    def setUp(self):
+        self.ref_genome = create_common_entities()['reference_genome']
+
+    def test_cache_keeps_whitespace_in_values(self):
+        (_, args) = compile_filter_string(
+                'EXPERIMENT_SAMPLE_LABEL = C  E5', self.ref_genome)
+        self.assertEqual(['C  E5'], args)
+        (_, args) = compile_filter_string(
+                'EXPERIMENT_SAMPLE_LABEL = C E5', self.ref_genome)
+        self.assertEqual(['C E5'], args)
+
+    def test_cache_checks_key_map(self):
+        self.ref_genome.variant_key_map['snp_evidence_data']['DP'] = {
+            'type': 'Integer',
+            'num': 1
+        }
+        (where_clause, _) = compile_filter_string('DP > 5', self.ref_genome)
+        self.assertTrue('::Integer' in where_clause)
+
+        self.ref_genome.variant_key_map['snp_evidence_data']['DP']['type'] = (
+                'Float')
+        (where_clause, _) = compile_filter_string('DP > 5', self.ref_genome)
+        self.assertTrue('::Float' in where_clause)
+
+        del self.ref_genome.variant_key_map['snp_evidence_data']['DP']
+        with self.assertRaises(ParseError):
+            compile_filter_string('DP > 5', self.ref_genome)
@@ -7,7 +7,7 @@ import os
 from django.db import connection
 from django.contrib.auth.models import User
 from django.test import TestCase
-from sympy.core.function import sympify
+from django.test.utils import override_settings
 
 from main.models import AlignmentGroup
 from main.models import Chromosome
@@ -15,6 +15,7 @@ from main.models import Dataset
 from main.models import ExperimentSample
 from main.models import Project
 from main.models import ReferenceGenome
+from main.models import SlowVariantFilterQuery
 from main.models import Variant
 from main.models import VariantAlternate
 from main.models import VariantCallerCommonData
@@ -28,6 +29,7 @@ from settings import PWD as GD_ROOT
 from variants.common import determine_visible_field_names
 from variants.common import ParseError
 from variants.materialized_variant_filter import get_variants_that_pass_filter
+from variants.materialized_variant_filter import lookup_variants
 from variants.materialized_variant_filter import VariantFilterEvaluator
 from variants.materialized_view_manager import MeltedVariantMaterializedViewManager
 from variants.melted_variant_schema import MELTED_SCHEMA_KEY__CHROMOSOME
@@ -135,6 +137,67 @@ class TestVariantFilter(BaseTestVariantFilterTestCase):
             self.assertTrue(var[MELTED_SCHEMA_KEY__POSITION] >= 5)
 
 
+    def test_keyset_pagination(self):
+        """Test that paging with pagination keys returns the same pages as
+        paging by offset.
+        """
+        # Create several Variants with positions:
+        # 0, 0, 1, 1, 2, 2, 3, 3, 4, 4
+        for pos in range(10):
+            var = Variant.objects.create(
+                type=Variant.TYPE.TRANSITION,
+                reference_genome=self.ref_genome,
+                chromosome=self.chromosome1,
+                position=pos / 2,
+                ref_value='A')
+
+            var.variantalternate_set.add(
+                    VariantAlternate.objects.create(
+                            variant=var,
+                            alt_value='G'))
+
+            VariantToVariantSet.objects.create(variant=var,
+                    variant_set=self.catchall_variant_set)
+
+        for is_melted in [True, False]:
+            def get_page(pagination_start, pagination_key=None):
+                query_args = {
+                    'filter_string': '',
+                    'is_melted': is_melted,
+                    'pagination_start': pagination_start,
+                    'pagination_len': 3,
+                }
+                if pagination_key is not None:
+                    query_args['pagination_key'] = pagination_key
+                return lookup_variants(query_args, self.ref_genome)
+
+            pagination_key = None
+            seen_uids = []
+            for pagination_start in range(0, 12, 3):
+                offset_page = get_page(pagination_start)
+                keyset_page = get_page(pagination_start, pagination_key)
+                self.assertEqual(10, offset_page.num_total_variants)
+                self.assertEqual(10, keyset_page.num_total_variants)
+                self.assertEqual(
+                        [r['UID'] for r in offset_page.result_list],
+                        [r['UID'] for r in keyset_page.result_list])
+                seen_uids.extend(r['UID'] for r in keyset_page.result_list)
+                pagination_key = keyset_page.next_pagination_key
+
+            # The last page was not full.
+            self.assertEqual(None, pagination_key)
+            self.assertEqual(10, len(set(seen_uids)))
+
+            # A total known from an earlier page isn't counted again.
+            second_page = lookup_variants({
+                'filter_string': '',
+                'is_melted': is_melted,
+                'pagination_start': 3,
+                'pagination_len': 3,
+            }, self.ref_genome, num_total_variants=42)
+            self.assertEqual(3, len(second_page.result_list))
+            self.assertEqual(42, second_page.num_total_variants)
+
     def test_filter__by_chromosome(self):
         """Test filtering by chromosome.
         """
@@ -590,6 +653,57 @@ class TestVariantFilter(BaseTestVariantFilterTestCase):
         self.assertEqual(1, len(passing_variants))
 
 
+class TestSlowVariantFilterQuery(BaseTestVariantFilterTestCase):
+
+    def test_record_slow_query(self):
+        for pos in range(10):
+            var = Variant.objects.create(
+                type=Variant.TYPE.TRANSITION,
+                reference_genome=self.ref_genome,
+                chromosome=self.chromosome1,
+                position=pos,
+                ref_value='A')
+            VariantAlternate.objects.create(variant=var, alt_value='G')
+            VariantToVariantSet.objects.create(variant=var,
+                    variant_set=self.catchall_variant_set)
+
+        with override_settings(SLOW_VARIANT_FILTER_QUERY_THRESHOLD=None):
+            run_query('position > 5', self.ref_genome)
+        self.assertEqual(0, SlowVariantFilterQuery.objects.count())
+
+        with override_settings(SLOW_VARIANT_FILTER_QUERY_THRESHOLD=0,
+                SLOW_VARIANT_FILTER_QUERY_SAMPLE_RATE=1.0):
+            variants_above_5 = run_query('position > 5', self.ref_genome)
+
+        # Recording doesn't change the results.
+        self.assertEqual(4, len(variants_above_5))
+        for var in variants_above_5:
+            self.assertTrue(var[MELTED_SCHEMA_KEY__POSITION] > 5)
+
+        slow_query = SlowVariantFilterQuery.objects.get()
+        self.assertEqual(self.ref_genome, slow_query.reference_genome)
+        self.assertEqual('position > 5', slow_query.filter_string)
+        self.assertEqual(4, slow_query.num_rows)
+        self.assertTrue('actual time' in slow_query.query_plan)
+
+        # Queries run as a generator are recorded once consumed.
+        query_args = {
+            'filter_string': 'position > 7',
+            'act_as_generator': True
+        }
+        with override_settings(SLOW_VARIANT_FILTER_QUERY_THRESHOLD=0,
+                SLOW_VARIANT_FILTER_QUERY_SAMPLE_RATE=1.0):
+            variants_above_7 = list(VariantFilterEvaluator(
+                    query_args, self.ref_genome).evaluate())
+        self.assertEqual(2, len(variants_above_7))
+        for var in variants_above_7:
+            self.assertTrue(var[MELTED_SCHEMA_KEY__POSITION] > 7)
+        slow_query = SlowVariantFilterQuery.objects.get(
+                filter_string='position > 7')
+        self.assertEqual(2, slow_query.num_rows)
+        self.assertTrue('actual time' in slow_query.query_plan)
+
+
 class TestVariantFilterEvaluator(BaseTestVariantFilterTestCase):
     """Tests for the object that encapsulates evaluation of the filter string.
     """
@@ -599,44 +713,79 @@ class TestVariantFilterEvaluator(BaseTestVariantFilterTestCase):
         """
         query_args = {'filter_string': 'position > 5'}
         evaluator = VariantFilterEvaluator(query_args, self.ref_genome)
-        EXPECTED_SYMBOLIC_REP = sympify('A')
-        self.assertEqual(EXPECTED_SYMBOLIC_REP, evaluator.sympy_representation)
-        self.assertEqual('position > 5',
-                evaluator.symbol_to_expression_map['A'])
+        self.assertEqual('POSITION>%s', evaluator.filter_where_clause)
+        self.assertEqual(['5'], evaluator.filter_where_clause_args)
 
         # Test &.
-        query_args = {'filter_string': 'position>5 & GT= 2'}
+        query_args = {'filter_string': 'position>5 & GT_TYPE= 2'}
         evaluator = VariantFilterEvaluator(query_args, self.ref_genome)
-        EXPECTED_SYMBOLIC_REP = sympify('A & B')
-        self.assertEqual(EXPECTED_SYMBOLIC_REP, evaluator.sympy_representation)
-        self.assertEqual('position>5 ',
-                evaluator.symbol_to_expression_map['A'])
-        self.assertEqual('GT= 2',
-                evaluator.symbol_to_expression_map['B'])
+        self.assertEqual(
+                "(POSITION>%s) AND ((ve_data->>'GT_TYPE')::Integer=%s)",
+                evaluator.filter_where_clause)
+        self.assertEqual(['5', '2'], evaluator.filter_where_clause_args)
 
         # Test decimals.
-        query_args = {'filter_string': 'AF > 0.5'}
+        self.ref_genome.variant_key_map[MAP_KEY__ALTERNATE]['INFO_AF'] = {
+            u'num': -1,
+            u'type': u'Float'
+        }
+        self.ref_genome.save()
+        query_args = {'filter_string': 'INFO_AF > 0.5'}
         evaluator = VariantFilterEvaluator(query_args, self.ref_genome)
-        EXPECTED_SYMBOLIC_REP = sympify('A')
-        self.assertEqual(EXPECTED_SYMBOLIC_REP, evaluator.sympy_representation)
-        self.assertEqual('AF > 0.5',
-                evaluator.symbol_to_expression_map['A'])
+        self.assertEqual("(va_data->>'INFO_AF')::Float>%s",
+                evaluator.filter_where_clause)
+        self.assertEqual(['0.5'], evaluator.filter_where_clause_args)
 
         # Test hyphens
         QUERY = 'EXPERIMENT_SAMPLE_LABEL = C-E5-2'
         query_args = {'filter_string': QUERY}
         evaluator = VariantFilterEvaluator(query_args, self.ref_genome)
-        EXPECTED_SYMBOLIC_REP = sympify('A')
-        self.assertEqual(EXPECTED_SYMBOLIC_REP, evaluator.sympy_representation)
-        self.assertEqual(QUERY, evaluator.symbol_to_expression_map['A'])
+        self.assertEqual('EXPERIMENT_SAMPLE_LABEL=%s',
+                evaluator.filter_where_clause)
+        self.assertEqual(['C-E5-2'], evaluator.filter_where_clause_args)
 
         # Test quotes
         QUERY = 'EXPERIMENT_SAMPLE_LABEL = "C-E5-2"'
         query_args = {'filter_string': QUERY}
         evaluator = VariantFilterEvaluator(query_args, self.ref_genome)
-        EXPECTED_SYMBOLIC_REP = sympify('A')
-        self.assertEqual(EXPECTED_SYMBOLIC_REP, evaluator.sympy_representation)
-        self.assertEqual(QUERY, evaluator.symbol_to_expression_map['A'])
+        self.assertEqual('EXPERIMENT_SAMPLE_LABEL=%s',
+                evaluator.filter_where_clause)
+        self.assertEqual(['C-E5-2'], evaluator.filter_where_clause_args)
+
+        # No filter.
+        evaluator = VariantFilterEvaluator({}, self.ref_genome)
+        self.assertEqual(None, evaluator.filter_where_clause)
+        self.assertEqual([], evaluator.filter_where_clause_args)
+
+    def test_variant_filter_constructor__nested(self):
+        """Nested conditions compile to a where clause of the same shape.
+        """
+        query_args = {'filter_string':
+                '(position < 5 OR position > 10) and (chromosome = c1 | '
+                '(chromosome = c2 & position < 100))'}
+        evaluator = VariantFilterEvaluator(query_args, self.ref_genome)
+        self.assertEqual(
+                '((POSITION<%s) OR (POSITION>%s)) AND '
+                '((CHROMOSOME=%s) OR ((CHROMOSOME=%s) AND (POSITION<%s)))',
+                evaluator.filter_where_clause)
+        self.assertEqual(['5', '10', 'c1', 'c2', '100'],
+                evaluator.filter_where_clause_args)
+
+    def test_variant_filter_constructor__many_conditions(self):
+        """There is no limit on the number of conditions.
+        """
+        filter_string = ' | '.join(
+                ['position = %d' % i for i in range(100)])
+        evaluator = VariantFilterEvaluator({'filter_string': filter_string},
+                self.ref_genome)
+        self.assertEqual(100, len(evaluator.filter_where_clause_args))
+
+    def test_variant_filter_constructor__invalid(self):
+        for filter_string in ['position > 5 &', '(position > 5',
+                'position > 5)', 'nonexistent_key = 2']:
+            with self.assertRaises(ParseError):
+                VariantFilterEvaluator({'filter_string': filter_string},
+                        self.ref_genome)
 
 
 class TestMinimal(BaseTestVariantFilterTestCase):
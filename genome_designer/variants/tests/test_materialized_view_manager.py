@@ -4,6 +4,7 @@ Tests for materialized_view_manager.py.
 
 from django.db import connection
 from django.test import TestCase
+from django.test.utils import override_settings
 
 from main.models import Chromosome
 from main.models import Dataset
@@ -16,6 +17,7 @@ from main.models import VariantToVariantSet
 from main.testing_util import create_common_entities
 from variants.melted_variant_schema import MELTED_SCHEMA_KEY__VS_LABEL
 from variants.melted_variant_schema import MELTED_SCHEMA_KEY__VS_UID
+from variants.materialized_view_manager import batch_version_bumps
 from variants.materialized_view_manager import MeltedVariantMaterializedViewManager
 
 
@@ -28,6 +30,16 @@ class TestMaterializedViewManager(TestCase):
 
         self.cursor = connection.cursor()
 
+    def _create_variant(self):
+        ref_genome = self.common_entities['reference_genome']
+        return Variant.objects.create(
+                type=Variant.TYPE.TRANSITION,
+                reference_genome=ref_genome,
+                chromosome=Chromosome.objects.get(reference_genome=ref_genome),
+                position=2,
+                ref_value='A'
+        )
+
     def test_multiple_variant_sets(self):
         mvm = MeltedVariantMaterializedViewManager(
                 self.common_entities['reference_genome'])
@@ -146,3 +158,164 @@ class TestMaterializedViewManager(TestCase):
             if data_row[MELTED_SCHEMA_KEY__VS_UID][0] is not None:
                 observed_rows_with_variant_set_data += 1
         self.assertEqual(1, observed_rows_with_variant_set_data)
+
+    def test_incremental_refresh(self):
+        ref_genome = self.common_entities['reference_genome']
+        mvm = MeltedVariantMaterializedViewManager(ref_genome)
+        mvm.create()
+        self.cursor.execute('SELECT * FROM %s' % mvm.get_table_name())
+        self.assertEqual(0, len(self.cursor.fetchall()))
+
+        variant = Variant.objects.create(
+                type=Variant.TYPE.TRANSITION,
+                reference_genome=ref_genome,
+                chromosome=Chromosome.objects.get(reference_genome=ref_genome),
+                position=2,
+                ref_value='A'
+        )
+        VariantAlternate.objects.create(
+                variant=variant,
+                alt_value='T',
+        )
+        variant_set = VariantSet.objects.create(
+                label='vs1',
+                reference_genome=ref_genome
+        )
+
+        # Adding the Variant to a set marks only its rows stale.
+        VariantToVariantSet.objects.create(
+                variant=variant,
+                variant_set=variant_set
+        )
+        self.assertTrue(mvm.is_valid())
+
+        mvm.create_if_not_exists_or_invalid()
+        self.assertTrue(mvm.is_valid())
+        self.cursor.execute('SELECT * FROM %s' % mvm.get_table_name())
+        results = [dict(zip([col[0].upper() for col in self.cursor.description], row))
+                for row in self.cursor.fetchall()]
+        self.assertEqual(1, len(results))
+        self.assertEqual(variant.id, results[0]['ID'])
+        self.assertEqual(['vs1'], results[0][MELTED_SCHEMA_KEY__VS_LABEL])
+
+        # Refreshing again without changes is a no-op.
+        mvm.refresh()
+        self.cursor.execute('SELECT * FROM %s' % mvm.get_table_name())
+        self.assertEqual(1, len(self.cursor.fetchall()))
+
+        # Removing from the set removes the row.
+        VariantToVariantSet.objects.get(
+                variant=variant, variant_set=variant_set).delete()
+        mvm.create_if_not_exists_or_invalid()
+        self.cursor.execute('SELECT * FROM %s' % mvm.get_table_name())
+        self.assertEqual(0, len(self.cursor.fetchall()))
+
+    def _get_index_defs(self, mvm):
+        self.cursor.execute(
+                'SELECT indexdef FROM pg_indexes WHERE tablename = %s',
+                (mvm.get_table_name(),))
+        return [row[0] for row in self.cursor.fetchall()]
+
+    def test_filter_key_indexes__opt_in(self):
+        """No keys are indexed unless listed in the settings.
+        """
+        ref_genome = self.common_entities['reference_genome']
+        mvm = MeltedVariantMaterializedViewManager(ref_genome)
+        mvm.create()
+        self.assertEqual([], mvm.index_manager.get_filterable_keys())
+        self.assertEqual([], [index_def
+                for index_def in self._get_index_defs(mvm)
+                if 'GT_TYPE' in index_def])
+
+    @override_settings(MATERIALIZED_VIEW_INDEXED_KEYS=['GT_TYPE', 'DP'])
+    def test_filter_key_indexes(self):
+        ref_genome = self.common_entities['reference_genome']
+        mvm = MeltedVariantMaterializedViewManager(ref_genome)
+
+        def get_index_defs():
+            return self._get_index_defs(mvm)
+
+        # Listed keys in the variant_key_map get expression indexes that
+        # match the filter expressions.
+        mvm.create()
+        gt_type_index_defs = [index_def for index_def in get_index_defs()
+                if 'GT_TYPE' in index_def]
+        self.assertEqual(1, len(gt_type_index_defs))
+        self.assertTrue('ve_data' in gt_type_index_defs[0])
+
+        # Keys added to the map after creation are indexed on the next
+        # refresh that applies changes, as after an import.
+        ref_genome.variant_key_map['snp_evidence_data']['DP'] = {
+            'type': 'Integer',
+            'num': 1
+        }
+        ref_genome.save()
+        mvm.mark_variants_stale([self._create_variant().id])
+        mvm.refresh()
+        self.assertEqual(1, len([index_def for index_def in get_index_defs()
+                if "'DP'" in index_def]))
+
+    @override_settings(MATERIALIZED_VIEW_INDEXED_KEYS=['GT_TYPE', 'DP'])
+    def test_filter_key_indexes__only_on_change(self):
+        ref_genome = self.common_entities['reference_genome']
+        mvm = MeltedVariantMaterializedViewManager(ref_genome)
+        mvm.create()
+        index_manager = mvm.index_manager
+
+        # Refreshing without key map changes leaves the indexes alone.
+        def fail_ensure_indexes():
+            self.fail('Indexes ensured without key map change.')
+        index_manager.ensure_indexes = fail_ensure_indexes
+        mvm.refresh()
+        del index_manager.ensure_indexes
+
+        # Failed builds are recorded and not retried.
+        ref_genome.variant_key_map['snp_evidence_data']['DP'] = {
+            'type': 'Integer',
+            'num': 1
+        }
+        ref_genome.save()
+        create_index_calls = []
+        def fail_create_index(create_index_sql):
+            create_index_calls.append(create_index_sql)
+            return False
+        index_manager._create_index = fail_create_index
+        mvm.mark_variants_stale([self._create_variant().id])
+        mvm.refresh()
+        self.assertEqual(1, len(create_index_calls))
+        _, failed_index_names = index_manager._get_state()
+        self.assertEqual(1, len(failed_index_names))
+
+        index_manager.ensure_indexes()
+        self.assertEqual(1, len(create_index_calls))
+
+    def test_version(self):
+        ref_genome = self.common_entities['reference_genome']
+        mvm = MeltedVariantMaterializedViewManager(ref_genome)
+        mvm.create()
+        version = mvm.get_version()
+
+        # Refreshing without changes keeps the version.
+        mvm.refresh()
+        self.assertEqual(version, mvm.get_version())
+
+        # Anything that changes the view's data bumps it.
+        variant = self._create_variant()
+        mvm.mark_variants_stale([variant.id])
+        self.assertTrue(mvm.get_version() > version)
+        version = mvm.get_version()
+
+        # Changes in a batch bump it once, when the batch ends.
+        with batch_version_bumps():
+            mvm.mark_variants_stale([variant.id])
+            mvm.mark_variants_stale([variant.id])
+            self.assertEqual(version, mvm.get_version())
+        self.assertEqual(version + 1, mvm.get_version())
+        version = mvm.get_version()
+
+        ref_genome.invalidate_materialized_view()
+        self.assertTrue(mvm.get_version() > version)
+        version = mvm.get_version()
+
+        mvm.create()
+        self.assertTrue(mvm.get_version() > version)
@@ -168,6 +168,20 @@ class TestAddVariantsToSetFromBed(TestCase):
                     raise AssertionError(
                             'bad variant set %s made.' % variant_set.label)
 
+            # Each variant is added once, associated with the sample.
+            vtvs_list = VariantToVariantSet.objects.filter(
+                    variant_set=variant_set)
+            self.assertEqual(set([v.id for v in variants]),
+                    set([vtvs.variant_id for vtvs in vtvs_list]))
+            for vtvs in vtvs_list:
+                self.assertEqual([self.sample_1],
+                        list(vtvs.sample_variant_set_association.all()))
+
+        # Adding again doesn't add duplicates.
+        num_vtvs = VariantToVariantSet.objects.count()
+        add_variants_to_set_from_bed(sample_alignment, bed_dataset)
+        self.assertEqual(num_vtvs, VariantToVariantSet.objects.count())
+
 
 class TestAddAndRemoveVariantsFromSet(TestCase):
 
@@ -2,6 +2,7 @@
 Tests for vcf_parser.py
 """
 
+import json
 import os
 
 from django.conf import settings
@@ -23,6 +24,7 @@ from utils.import_util import copy_and_add_dataset_source
 from utils.import_util import import_reference_genome_from_local_file
 from variants.vcf_parser import parse_alignment_group_vcf
 from variants.vcf_parser import parse_vcf
+from variants.vcf_parser import QueryCache
 
 
 TEST_FASTA = os.path.join(settings.PWD, 'test_data', 'fake_genome_and_reads',
@@ -314,3 +316,112 @@ class TestVCFParser(TestCase):
         on the output.
         """
         create_recoli_sv_data_from_vcf(self.project)
+
+    def test_parser__bulk_matches_per_record(self):
+        """Tests that bulk ingestion creates the same rows as parsing one
+        record at a time.
+        """
+        with open(TEST_GENOME_SNPS) as fh:
+            experiment_sample_uids = vcf.Reader(fh).samples
+        for sample_uid in experiment_sample_uids:
+            ExperimentSample.objects.create(
+                uid=sample_uid,
+                project=self.project,
+                label='fakename:' + sample_uid
+            )
+
+        def _parse_and_summarize(use_bulk_ingest):
+            reference_genome = import_reference_genome_from_local_file(
+                    self.project, 'ref_genome', TEST_FASTA, 'fasta')
+            alignment_group = AlignmentGroup.objects.create(
+                    label='test alignment',
+                    reference_genome=reference_genome)
+            vcf_dataset = copy_and_add_dataset_source(alignment_group,
+                    Dataset.TYPE.VCF_FREEBAYES, Dataset.TYPE.VCF_FREEBAYES,
+                    TEST_GENOME_SNPS)
+            parse_vcf(vcf_dataset, alignment_group,
+                    use_bulk_ingest=use_bulk_ingest)
+
+            summary = set()
+            for variant in Variant.objects.filter(
+                    reference_genome=reference_genome):
+                for va in variant.variantalternate_set.all():
+                    summary.add(('alt', variant.position, variant.ref_value,
+                            va.alt_value, json.dumps(va.data, sort_keys=True),
+                            tuple(sorted([ve.experiment_sample.uid
+                                    for ve in va.variantevidence_set.all()]))))
+                for vccd in variant.variantcallercommondata_set.all():
+                    summary.add(('vccd', variant.position, variant.ref_value,
+                            variant.type, vccd.data['IS_SV'],
+                            vccd.variantevidence_set.count()))
+            return summary
+
+        per_record_summary = _parse_and_summarize(False)
+        self.assertTrue(len(per_record_summary))
+        self.assertEqual(per_record_summary, _parse_and_summarize(True))
+
+    def test_parser__reparse_reuses_variants(self):
+        """Tests that parsing a vcf again resolves existing Variants and
+        VariantAlternates rather than creating new ones.
+        """
+        with open(TEST_GENOME_SNPS) as fh:
+            experiment_sample_uids = vcf.Reader(fh).samples
+        for sample_uid in experiment_sample_uids:
+            ExperimentSample.objects.create(
+                uid=sample_uid,
+                project=self.project,
+                label='fakename:' + sample_uid
+            )
+
+        alignment_group = AlignmentGroup.objects.create(
+                label='test alignment', reference_genome=self.reference_genome)
+        vcf_dataset = copy_and_add_dataset_source(alignment_group,
+                Dataset.TYPE.VCF_FREEBAYES, Dataset.TYPE.VCF_FREEBAYES,
+                TEST_GENOME_SNPS)
+
+        def _get_ids():
+            return (
+                set(Variant.objects.filter(
+                        reference_genome=self.reference_genome).values_list(
+                                'id', flat=True)),
+                set(VariantAlternate.objects.filter(
+                        variant__reference_genome=self.reference_genome
+                        ).values_list('id', flat=True)))
+
+        parse_vcf(vcf_dataset, alignment_group, use_bulk_ingest=False)
+        variant_ids, alt_ids = _get_ids()
+        self.assertTrue(len(variant_ids))
+
+        parse_vcf(vcf_dataset, alignment_group, use_bulk_ingest=False)
+        self.assertEqual((variant_ids, alt_ids), _get_ids())
+
+        parse_vcf(vcf_dataset, alignment_group, use_bulk_ingest=True)
+        self.assertEqual((variant_ids, alt_ids), _get_ids())
+
+
+class TestQueryCache(TestCase):
+
+    def test_long_alternate(self):
+        common_entities = create_common_entities()
+        reference_genome = common_entities['reference_genome']
+        variant = Variant.objects.create(
+                type=Variant.TYPE.INSERTION,
+                reference_genome=reference_genome,
+                chromosome=common_entities['chromosome'],
+                position=10,
+                ref_value='A')
+        long_alt = 'A' + 'C' * 20
+        var_alt = VariantAlternate.objects.create(
+                variant=variant, alt_value=long_alt)
+
+        query_cache = QueryCache(reference_genome)
+        self.assertEqual(var_alt.id,
+                query_cache.get_alternate_id(variant.id, long_alt))
+
+        # Stored alt values are already normalized.
+        self.assertNotEqual(long_alt, var_alt.alt_value)
+        self.assertEqual(var_alt.id,
+                query_cache.get_alternate_id_by_normalized_alt(
+                        variant.id, var_alt.alt_value))
+        self.assertEqual(None,
+                query_cache.get_alternate_id(variant.id, var_alt.alt_value))
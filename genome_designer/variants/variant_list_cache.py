@@ -0,0 +1,77 @@
+"""
+Cache of variant list results.
+
+Users page back and forth through the same results and re-run the same saved
+filters, so results are cached by query. Keys include the version of the
+ReferenceGenome's melted variant view, which is bumped whenever the view's
+data changes (see MeltedVariantMaterializedViewManager.bump_version()), so
+entries computed from old data are never served and simply expire.
+"""
+
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import get_cache
+
+from variants.materialized_view_manager import MeltedVariantMaterializedViewManager
+
+
+def get_variant_list_cache():
+    return get_cache(settings.VARIANT_LIST_CACHE)
+
+
+# Arguments to lookup_variants() that only choose the page of results, and so
+# don't change the total number of matching variants.
+PAGINATION_QUERY_ARGS = [
+    'sortCol',
+    'sort_by_column',
+    'sort_by_direction',
+    'pagination_start',
+    'pagination_len',
+    'pagination_key',
+]
+
+
+def get_variant_list_cache_key(reference_genome, query_args,
+        alignment_group=None):
+    """Returns the cache key for results of the query against the current
+    version of the ReferenceGenome's melted variant view.
+
+    Args:
+        reference_genome: ReferenceGenome queried.
+        query_args: Dictionary of arguments to lookup_variants(), including
+            the filter string, sorting and pagination. Must be json
+            serializable.
+        alignment_group: Optional AlignmentGroup the results are limited to.
+    """
+    return _get_cache_key('variant_list', reference_genome, query_args,
+            alignment_group)
+
+
+def get_num_total_variants_cache_key(reference_genome, query_args,
+        alignment_group=None):
+    """Returns the cache key for the total number of variants matching the
+    query against the current version of the ReferenceGenome's melted variant
+    view.
+
+    The key ignores sorting and pagination, so that the total is counted once
+    and then shared by every page of results.
+    """
+    filter_query_args = dict((key, value)
+            for key, value in query_args.iteritems()
+            if key not in PAGINATION_QUERY_ARGS)
+    return _get_cache_key('num_total_variants', reference_genome,
+            filter_query_args, alignment_group)
+
+
+def _get_cache_key(prefix, reference_genome, query_args, alignment_group):
+    view_version = MeltedVariantMaterializedViewManager(
+            reference_genome).get_version()
+    query_hash = hashlib.sha1(json.dumps({
+        'query_args': query_args,
+        'alignment_group_id': (
+                alignment_group.id if alignment_group is not None else None)
+    }, sort_keys=True)).hexdigest()
+    return '%s:%d:%d:%s' % (prefix, reference_genome.id, view_version,
+            query_hash)
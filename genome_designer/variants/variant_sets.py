@@ -6,14 +6,17 @@ from collections import defaultdict
 import re
 
 from django.core.exceptions import ObjectDoesNotExist
-import pyinter
 
 from main.constants import UNDEFINED_STRING
+from main.model_utils import BULK_WRITE_BATCH_SIZE
+from main.model_utils import reserve_ids
+from main.models import Chromosome
 from main.models import ExperimentSample
 from main.models import Variant
 from main.models import VariantSet
 from main.models import VariantToVariantSet
 from variants.materialized_variant_filter import lookup_variants
+from variants.materialized_view_manager import batch_version_bumps
 from variants.melted_variant_schema import MELTED_SCHEMA_KEY__ES_UID
 from variants.melted_variant_schema import MELTED_SCHEMA_KEY__UID
 
@@ -77,16 +80,21 @@ def update_variant_in_set_memberships(ref_genome, uid_data_str_list,
     (variant_uid_to_obj_map, sample_uid_to_obj_map) = (
             _get_cached_uid_to_object_maps(ref_genome, grouped_uid_dict_list))
 
-    # Perform modification.
-    if action == MODIFY_VARIANT_SET_MEMBERSHIP__ADD:
-        _perform_add(grouped_uid_dict_list, variant_set,
-                variant_uid_to_obj_map, sample_uid_to_obj_map)
-    else: # action == MODIFY_VARIANT_SET_MEMBERSHIP__REMOVE
-        _perform_remove(grouped_uid_dict_list, variant_set,
-                variant_uid_to_obj_map, sample_uid_to_obj_map)
-
-    # These actions invalidate the materialized view.
-    ref_genome.invalidate_materialized_view()
+    # Perform modification. Each VariantToVariantSet saved or deleted marks
+    # its Variant stale, so bump the materialized view version once for all
+    # of them.
+    with batch_version_bumps():
+        if action == MODIFY_VARIANT_SET_MEMBERSHIP__ADD:
+            _perform_add(grouped_uid_dict_list, variant_set,
+                    variant_uid_to_obj_map, sample_uid_to_obj_map)
+        else: # action == MODIFY_VARIANT_SET_MEMBERSHIP__REMOVE
+            _perform_remove(grouped_uid_dict_list, variant_set,
+                    variant_uid_to_obj_map, sample_uid_to_obj_map)
+
+        # These actions invalidate the materialized view rows of the affected
+        # Variants.
+        ref_genome.invalidate_materialized_view_for_variants(
+                [variant.id for variant in variant_uid_to_obj_map.values()])
 
     # Return success response if we got here.
     return {
@@ -144,39 +152,43 @@ def add_variants_to_set_from_bed(sample_alignment, bed_dataset):
     reference_genome = sample_alignment.alignment_group.reference_genome
     experiment_sample = sample_alignment.experiment_sample
 
-    # 1. Create a dictionary of disjoint intervals, recursive defaultdict
-    feature_disj_intervals = defaultdict(
-            lambda: defaultdict(pyinter.IntervalSet))
-    variants_to_add = defaultdict(list)
-
+    # 1. Collect the intervals of each feature, by chromosome.
+    feature_to_chrom_to_intervals = defaultdict(lambda: defaultdict(list))
     with open(bed_dataset_fn) as bed_dataset_fh:
 
         for i, line in enumerate(bed_dataset_fh):
             try:
                 chrom, start, end, feature = line.strip().split('\t')
-                # make a new interval from start to end
-                new_ivl = pyinter.closedopen(int(start), int(end))
-
-                # add new ivl to old ivls
-                feature_disj_intervals[feature][chrom].add(new_ivl)
+                # Intervals are closed-open, as in the bed.
+                feature_to_chrom_to_intervals[feature][chrom].append(
+                        (int(start), int(end)))
             except:
                 print ('WARNING: Callable Loci line ' +
                         '%d: (%s) couldnt be parsed.') % (i, line)
 
-    # 2. Associate variants with these intervals
+    # 2. Associate variants with these intervals, sweeping through the
+    # variants and the intervals of each feature on each chromosome in order
+    # of position.
+    chromosome_id_to_label = dict(Chromosome.objects.filter(
+            reference_genome=reference_genome).values_list('id', 'label'))
+    chrom_to_variants = defaultdict(list)
     variants = Variant.objects.filter(
             variantcallercommondata__alignment_group=\
-                    sample_alignment.alignment_group)
-
+                    sample_alignment.alignment_group).distinct().only(
+                            'id', 'uid', 'position', 'chromosome')
     for v in variants:
-        for feat, chrom_ivls in feature_disj_intervals.items():
-
-            # Skip if there is no interval in this chromosome
-            if v.chromosome.label not in chrom_ivls: continue
-            if not chrom_ivls[v.chromosome.label]: continue
-
-            if v.position in chrom_ivls[v.chromosome.label]:
-                variants_to_add[feat].append(v)
+        chrom_to_variants[chromosome_id_to_label[v.chromosome_id]].append(v)
+    for chrom_variants in chrom_to_variants.itervalues():
+        chrom_variants.sort(key=lambda v: v.position)
+
+    variants_to_add = {}
+    for feat, chrom_to_intervals in feature_to_chrom_to_intervals.items():
+        feat_variants = []
+        for chrom, intervals in chrom_to_intervals.items():
+            feat_variants.extend(_get_variants_in_intervals(
+                    chrom_to_variants.get(chrom, []), intervals))
+        if feat_variants:
+            variants_to_add[feat] = feat_variants
 
     # 3. Make new variant sets for any features with variants,
     # and add the variants to them.
@@ -189,20 +201,89 @@ def add_variants_to_set_from_bed(sample_alignment, bed_dataset):
                 reference_genome=reference_genome,
                 label=feat)
 
-        grouped_uid_dict_list = [{
-                'sample_uid': experiment_sample.uid,
-                'variant_uid': v.uid} for v in variants]
-
-        variant_uid_to_obj_map = dict([(v.uid,v) for v in variants])
-        sample_uid_to_obj_map = {experiment_sample.uid: experiment_sample}
-
-        _perform_add(grouped_uid_dict_list, feat_variant_set,
-                variant_uid_to_obj_map, sample_uid_to_obj_map)
+        _bulk_add_to_variant_set(feat_variant_set,
+                [v.id for v in variants], experiment_sample)
 
         variant_set_to_variant_map[feat_variant_set] = variants
 
     return variant_set_to_variant_map
 
+
+def _get_variants_in_intervals(sorted_variants, intervals):
+    """Returns the variants whose positions lie in any of the closed-open
+    intervals, in one sweep through both in order of position.
+
+    Args:
+        sorted_variants: List of Variants on one chromosome, sorted by
+            position.
+        intervals: List of (start, end) tuples on the same chromosome, in any
+            order and possibly overlapping.
+    """
+    variants_in_intervals = []
+    sorted_intervals = sorted(intervals)
+    interval_idx = 0
+    # End of the union of the intervals starting at or before the current
+    # variant. Positions are never negative, so 0 covers nothing.
+    covered_end = 0
+    for v in sorted_variants:
+        while (interval_idx < len(sorted_intervals) and
+                sorted_intervals[interval_idx][0] <= v.position):
+            covered_end = max(covered_end,
+                    sorted_intervals[interval_idx][1])
+            interval_idx += 1
+        if v.position < covered_end:
+            variants_in_intervals.append(v)
+    return variants_in_intervals
+
+
+def _bulk_add_to_variant_set(variant_set, variant_ids, experiment_sample):
+    """Adds the Variants to the VariantSet, associated with the
+    ExperimentSample, the way _perform_add() does but with a few queries in
+    total rather than a few per Variant.
+    """
+    variant_id_to_vtvs_id = dict(VariantToVariantSet.objects.filter(
+            variant_set=variant_set).values_list('variant_id', 'id'))
+
+    # Create missing VariantToVariantSets.
+    new_variant_ids = [variant_id for variant_id in set(variant_ids)
+            if not variant_id in variant_id_to_vtvs_id]
+    new_vtvs_list = []
+    for variant_id, vtvs_id in zip(new_variant_ids,
+            reserve_ids(VariantToVariantSet, len(new_variant_ids))):
+        new_vtvs_list.append(VariantToVariantSet(
+                id=vtvs_id,
+                variant_id=variant_id,
+                variant_set=variant_set))
+        variant_id_to_vtvs_id[variant_id] = vtvs_id
+    VariantToVariantSet.objects.bulk_create(new_vtvs_list,
+            batch_size=BULK_WRITE_BATCH_SIZE)
+
+    # Add missing sample associations.
+    SampleAssociation = (
+            VariantToVariantSet.sample_variant_set_association.through)
+    associated_vtvs_ids = set(SampleAssociation.objects.filter(
+            varianttovariantset__variant_set=variant_set,
+            experimentsample=experiment_sample).values_list(
+                    'varianttovariantset_id', flat=True))
+    new_associations = []
+    associated_variant_ids = []
+    for variant_id in set(variant_ids):
+        vtvs_id = variant_id_to_vtvs_id[variant_id]
+        if vtvs_id in associated_vtvs_ids:
+            continue
+        new_associations.append(SampleAssociation(
+                varianttovariantset_id=vtvs_id,
+                experimentsample_id=experiment_sample.id))
+        associated_variant_ids.append(variant_id)
+    SampleAssociation.objects.bulk_create(new_associations,
+            batch_size=BULK_WRITE_BATCH_SIZE)
+
+    # bulk_create() doesn't send the post_save signal, which would otherwise
+    # invalidate the materialized view for each new VariantToVariantSet.
+    if associated_variant_ids:
+        variant_set.reference_genome.invalidate_materialized_view_for_variants(
+                associated_variant_ids)
+
 def _initial_validation(uid_data_str_list, action):
     """Initial validation, or why statically compiled languages have their
     upsides.
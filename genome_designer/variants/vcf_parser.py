@@ -4,11 +4,22 @@ Methods for reading vcf files and importing it in our database representation.
 We leverage pyvcf as much as possible.
 """
 
-from django.db import reset_queries
+from collections import namedtuple
+import logging
+import os
+import time
 
+from django.conf import settings
+from django.db import reset_queries
+from django.db.models import Q
+from django.db import transaction
 import vcf
 
+from main.model_utils import BULK_WRITE_BATCH_SIZE
+from main.model_utils import bulk_update_field
 from main.model_utils import get_dataset_with_type
+from main.model_utils import get_normalized_alt_representation
+from main.model_utils import reserve_ids
 from main.models import Chromosome
 from main.models import ExperimentSample
 from main.models import ReferenceGenome
@@ -19,6 +30,7 @@ from main.models import VariantEvidence
 from variants.common import update_parent_child_variant_fields
 from variants.dynamic_snp_filter_key_map import update_filter_key_map
 
+logger = logging.getLogger('vcf_parser')
 
 SV_TYPES = {
     'DEL': 'DELETION',
@@ -38,15 +50,170 @@ IGNORE_VCF_RECORD_KEYS = [
     'ID'
 ]
 
+# The parts of a vcf record needed to create a Variant and its relations.
+ParsedVcfRecord = namedtuple('ParsedVcfRecord', [
+    'type',
+    'chromosome_label',
+    'position',
+    'ref_value',
+    'alt_values',
+    'alt_data_list',
+    'common_data'
+])
+
+
+class VcfParseProgress(object):
+    """Logs the progress of a single pass through a vcf, at most every
+    settings.VCF_PARSER_PROGRESS_INTERVAL seconds.
+
+    Progress is measured in bytes read from the file, so the records don't
+    have to be counted up front. Messages are key=value pairs so they can
+    be grepped and parsed from the worker logs.
+    """
+
+    def __init__(self, vcf_dataset, fh):
+        self.vcf_dataset = vcf_dataset
+        self.fh = fh
+        self.total_bytes = os.fstat(fh.fileno()).st_size
+        self.num_records = 0
+        self.num_skipped = 0
+        self.start_time = time.time()
+        self.last_report_time = self.start_time
+
+    def update(self):
+        """Counts a record, logging progress if it's been long enough since
+        the last message.
+        """
+        self.num_records += 1
+        now = time.time()
+        if now - self.last_report_time >= (
+                settings.VCF_PARSER_PROGRESS_INTERVAL):
+            self.last_report_time = now
+            self._log('parsing', now)
+
+    def finish(self):
+        self._log('done', time.time())
+
+    def _log(self, status, now):
+        # NOTE: The file position is that of the read-ahead buffer, so it
+        # slightly leads the record being parsed.
+        bytes_read = min(self.fh.tell(), self.total_bytes)
+        elapsed = now - self.start_time
+        logger.info(
+                'vcf_parse status=%s dataset=%s records=%d skipped=%d '
+                'bytes=%d total_bytes=%d percent=%.1f elapsed=%.1f '
+                'records_per_sec=%.1f',
+                status, self.vcf_dataset.uid, self.num_records,
+                self.num_skipped, bytes_read, self.total_bytes,
+                100.0 * bytes_read / self.total_bytes
+                        if self.total_bytes else 100.0,
+                elapsed, self.num_records / elapsed if elapsed else 0.0)
+
 
 class QueryCache(object):
-    """Manual caching for queries to avoid excessive db calls.
+    """Identity map of the rows that parsing a vcf into a ReferenceGenome
+    looks up, to avoid excessive db calls.
+
+    The ReferenceGenome's Chromosomes, and its Variants along with their
+    VariantAlternates, are each loaded with a single query the first time
+    they are needed, after which records are resolved in memory. Rows created
+    during the parse are added with add_variant() and add_alternate() so that
+    later records resolve to the same objects.
+
+    Only what's needed to resolve records is loaded: Variants without their
+    data, and just the ids of VariantAlternates. Callers that merge into a
+    VariantAlternate's data fetch it first, since other tasks may have
+    updated it since.
+
+    A miss doesn't mean the row doesn't exist, since other tasks may be
+    parsing into the same ReferenceGenome. Callers should fall back to the
+    database on a miss.
 
-    NOTE: Only trying this with one model so far. Haven't determined how
-    useful this really is.
+    ExperimentSamples are cached by uid in uid_to_experiment_sample_map.
     """
-    def __init__(self):
+    # Variant fields loaded into the cache.
+    VARIANT_FIELDS = ('id', 'type', 'reference_genome', 'chromosome',
+            'position', 'ref_value')
+
+    def __init__(self, reference_genome):
+        self.reference_genome = reference_genome
         self.uid_to_experiment_sample_map = {}
+        self._seqrecord_id_to_chromosome = None
+
+        # Map from (chromosome id, position, ref_value) to Variant.
+        self._key_to_variant = None
+
+        # Map from (variant id, normalized alt value) to VariantAlternate id.
+        self._key_to_alternate_id = None
+
+    def get_seqrecord_id_to_chromosome(self):
+        """Returns dictionary from seqrecord_id to Chromosome.
+        """
+        if self._seqrecord_id_to_chromosome is None:
+            self._seqrecord_id_to_chromosome = dict(
+                    (chrom.seqrecord_id, chrom) for chrom in
+                    Chromosome.objects.filter(
+                            reference_genome=self.reference_genome))
+        return self._seqrecord_id_to_chromosome
+
+    def get_variant(self, chromosome_id, position, ref_value):
+        """Returns the Variant with the given key, or None if it isn't
+        cached.
+        """
+        self._ensure_variants_loaded()
+        return self._key_to_variant.get((chromosome_id, position, ref_value))
+
+    def add_variant(self, variant):
+        self._ensure_variants_loaded()
+        self._key_to_variant.setdefault(
+                (variant.chromosome_id, variant.position, variant.ref_value),
+                variant)
+
+    def get_alternate_id(self, variant_id, alt_value):
+        """Returns the id of the VariantAlternate of the Variant with the
+        given alt value, or None if it isn't cached.
+        """
+        return self.get_alternate_id_by_normalized_alt(variant_id,
+                get_normalized_alt_representation(alt_value))
+
+    def get_alternate_id_by_normalized_alt(self, variant_id, normalized_alt):
+        """Like get_alternate_id(), but for an alt value that is already
+        normalized, e.g. as stored in VariantAlternate.alt_value.
+        """
+        self._ensure_variants_loaded()
+        return self._key_to_alternate_id.get((variant_id, normalized_alt))
+
+    def add_alternate(self, var_alt):
+        """Adds a saved VariantAlternate. It must already have its normalized
+        alt_value, as it does after construction.
+        """
+        self._ensure_variants_loaded()
+        self._key_to_alternate_id.setdefault(
+                (var_alt.variant_id, var_alt.alt_value), var_alt.id)
+
+    def _ensure_variants_loaded(self):
+        # Variants and alternates are loaded together, before anything is
+        # added, so that rows created during the parse aren't loaded twice.
+        if self._key_to_variant is not None:
+            return
+
+        self._key_to_variant = {}
+        for variant in Variant.objects.filter(
+                reference_genome=self.reference_genome).only(
+                        *self.VARIANT_FIELDS):
+            variant.reference_genome = self.reference_genome
+            self._key_to_variant.setdefault(
+                    (variant.chromosome_id, variant.position,
+                            variant.ref_value),
+                    variant)
+
+        self._key_to_alternate_id = {}
+        for var_alt_id, variant_id, alt_value in (
+                VariantAlternate.objects.filter(
+                        variant__reference_genome=self.reference_genome)
+                .values_list('id', 'variant_id', 'alt_value')):
+            self._key_to_alternate_id.setdefault(
+                    (variant_id, alt_value), var_alt_id)
 
 
 def parse_alignment_group_vcf(alignment_group, vcf_dataset_type):
@@ -57,7 +224,8 @@ def parse_alignment_group_vcf(alignment_group, vcf_dataset_type):
 
 
 def parse_vcf(vcf_dataset, alignment_group,
-            should_update_parent_child_relationships=True):
+            should_update_parent_child_relationships=True,
+            use_bulk_ingest=None):
     """
     Parses the VCF and creates Variant models relative to ReferenceGenome.
 
@@ -66,26 +234,26 @@ def parse_vcf(vcf_dataset, alignment_group,
             not diploid, these variants are likely to be just poorly mapped
             reads, so discard the variants created by them. In the future, this
             option will be moved to an alignment_group options dictionary.
+
+    If use_bulk_ingest is True, records are buffered and written with
+    BulkVariantWriter rather than one at a time with get_or_create_variant().
+    Both create the same rows. Defaults to settings.VCF_PARSER_BULK_INGEST.
     """
+    if use_bulk_ingest is None:
+        use_bulk_ingest = settings.VCF_PARSER_BULK_INGEST
+
     reference_genome = alignment_group.reference_genome
 
     # This helper object will help prevent repeated calls to the database.
-    # We'll use it at least for ExperimentSamples.
-    query_cache = QueryCache()
+    query_cache = QueryCache(reference_genome)
 
-    # First count the number of records to give helpful status debug output.
-    record_count = 0
-    with open(vcf_dataset.get_absolute_location()) as fh:
-        vcf_reader = vcf.Reader(fh)
-        for record in vcf_reader:
-            record_count += 1
-
-    # Now iterate through the vcf file again and parse the data.
+    # Iterate through the vcf file once and parse the data.
     # NOTE: Do not save handles to the Variants, else suffer the wrath of a
     # memory leak when parsing a large vcf file.
     variant_list = []
     with open(vcf_dataset.get_absolute_location()) as fh:
         vcf_reader = vcf.Reader(fh)
+        progress = VcfParseProgress(vcf_dataset, fh)
 
         # First, update the reference_genome's key list with any new
         # keys from this VCF.
@@ -93,10 +261,16 @@ def parse_vcf(vcf_dataset, alignment_group,
         # Update the reference genome and grab it from the db again.
         update_filter_key_map(reference_genome, vcf_reader)
         reference_genome = ReferenceGenome.objects.get(id=reference_genome.id)
+        query_cache.reference_genome = reference_genome
 
-        for record_idx, record in enumerate(vcf_reader):
-            print 'vcf_parser: Parsing %d out of %d' % (
-                    record_idx + 1, record_count)
+        if use_bulk_ingest:
+            bulk_writer = BulkVariantWriter(reference_genome, vcf_dataset,
+                    alignment_group, query_cache)
+        else:
+            bulk_writer = None
+
+        for record in vcf_reader:
+            progress.update()
 
             # Make sure the QueryCache object has experiment samples populated.
             # Assumes every row has same samples. (Pretty sure this is true
@@ -112,9 +286,15 @@ def parse_vcf(vcf_dataset, alignment_group,
             # If the record has no GT_TYPE = 2 samples, then skip by default
             if alignment_group.alignment_options['skip_het_only']:
                 if sum([s.gt_type == 2 for s in record.samples]) == 0:
-                    print 'HET only, skipping record %d' % (record_idx + 1)
+                    progress.num_skipped += 1
                     continue
 
+            # In bulk mode, the record is only written once the buffer is
+            # full, at which point all buffered Variants are returned.
+            if bulk_writer is not None:
+                variant_list.extend(bulk_writer.add(record))
+                continue
+
             # Get or create the Variant for this record. This step
             # also generates the alternate objects and assigns their
             # data fields as well.
@@ -126,6 +306,12 @@ def parse_vcf(vcf_dataset, alignment_group,
             # so we explicitly clear them here. Our efficiency doesn't really suffer.
             reset_queries()
 
+        # Write whatever is left in the buffer.
+        if bulk_writer is not None:
+            variant_list.extend(bulk_writer.flush())
+
+        progress.finish()
+
     # Finally, update the parent/child relationships for these new
     # created variants.
     # We don't want to do this in the case of SVs, since they are called separately
@@ -134,8 +320,15 @@ def parse_vcf(vcf_dataset, alignment_group,
     if should_update_parent_child_relationships:
         update_parent_child_variant_fields(alignment_group)
 
-    # Force invalidate materialized view here.
-    reference_genome.invalidate_materialized_view()
+    # Mark the materialized view rows affected by this parse as stale.
+    # Updating parent/child relationships touches every Variant in the
+    # AlignmentGroup, otherwise only the parsed Variants changed.
+    if should_update_parent_child_relationships:
+        reference_genome.invalidate_materialized_view_for_alignment_group(
+                alignment_group)
+    else:
+        reference_genome.invalidate_materialized_view_for_variants(
+                [parsed_variant.id for parsed_variant in variant_list])
 
     return variant_list
 
@@ -178,27 +371,19 @@ def populate_common_data_info(data_dict, vcf_record):
         data_dict[effective_key] = value
 
 
-def get_or_create_variant(reference_genome, vcf_record, vcf_dataset,
-        alignment_group=None, query_cache=None):
-    """Create a variant and its relations.
-
-    A new Variant is only created if it doesn't exist already. The following
-    relations are created:
-        * VariantCallerCommonData
-        * VariantEvidence
-        * VariantAlternate
-
-    Also go through all per-alt keys and add them as a json field
-    to the VariantAlternate object.
+def parse_vcf_record(reference_genome, vcf_record, alt_keys=None):
+    """Extracts the Variant, VariantAlternate and VariantCallerCommonData
+    values from a pyvcf Record, without touching the database.
 
     Args:
-        reference_genome: The ReferenceGenome.
+        reference_genome: The ReferenceGenome. Its variant key map determines
+            which INFO keys are per-alt.
         vcf_record: pyvcf Record object.
-        vcf_dataset: Source Dataset for this data.
-        query_cache: QueryCache helper object for making queries.
+        alt_keys: Optional precomputed list of per-alt keys from
+            reference_genome.get_variant_alternate_map().
 
     Returns:
-        Tuple (Variant, List<VariantAlt>)
+        A ParsedVcfRecord.
     """
     # Build a dictionary of data for this record.
     raw_data_dict = extract_raw_data_dict(vcf_record)
@@ -220,75 +405,152 @@ def get_or_create_variant(reference_genome, vcf_record, vcf_dataset,
     if len(ref_value) > 10:
         ref_value = 'LONG:{size}bp'.format(size=len(ref_value))
 
-    # Make sure the chromosome cited in the VCF exists for
-    # the reference genome variant is being added to
-    if not chromosome_label in [chrom.seqrecord_id for chrom in
-            Chromosome.objects.filter(reference_genome=reference_genome)]:
+    # Whether or not this is an (structural variant) SV is determined in
+    # VariantAlternate data. Still, we want to expose this on the Variant
+    # level, so we check whether this is SV internally.
+    is_sv = False
+
+    if alt_keys is None:
+        alt_keys = reference_genome.get_variant_alternate_map().keys()
+    raw_alt_keys = [k for k in raw_data_dict.keys() if k in alt_keys]
+
+    # Grab the alt data for each alt index.
+    alt_data_list = []
+    for alt_idx in range(len(alt_values)):
+        alt_data = dict([(k, raw_data_dict[k][alt_idx]) for k in raw_alt_keys])
+        if 'INFO_SVTYPE' in alt_data:
+            is_sv = True
+        alt_data_list.append(alt_data)
+
+    # Remove all per-alt keys from raw_data_dict before passing to VCC create.
+    [raw_data_dict.pop(k, None) for k in raw_alt_keys]
+
+    # Indicate whether this is SV type, making it queryable.
+    raw_data_dict['IS_SV'] = is_sv
+
+    return ParsedVcfRecord(
+            type=type,
+            chromosome_label=chromosome_label,
+            position=position,
+            ref_value=ref_value,
+            alt_values=alt_values,
+            alt_data_list=alt_data_list,
+            common_data=raw_data_dict)
+
+
+def _raise_unknown_chromosome(reference_genome, parsed_record,
+        chromosome_seqrecord_ids):
+    """Raises an Exception describing a record whose CHROM doesn't match any
+    Chromosome of the reference genome.
+    """
+    alt_values = parsed_record.alt_values
+    variant_string = ('TYPE: ' + str(parsed_record.type) +
+    '   CHROM: ' + str(parsed_record.chromosome_label) +
+    '   POS: ' + str(parsed_record.position) +
+    '   REF: ' + str(parsed_record.ref_value) +
+    '   ALT: ' + str(alt_values if len(alt_values)-1 else alt_values[0]))
+
+    raise Exception(('The CHROM field of the following variant does not match any of '
+            'the chromosomes belonging to its reference genome:' + variant_string + '\n'
+            'Chromosomes belonging to reference genome ' + str(reference_genome.label) +
+            ' are: ' + str([str(seqrecord_id) for seqrecord_id in
+                    chromosome_seqrecord_ids]).strip('[]')))
+
 
-        variant_string = ('TYPE: ' + str(type) + '   CHROM: ' + str(chromosome_label) +
-        '   POS: ' + str(position) + '   REF: ' + str(ref_value) +
-        '   ALT: ' + str(alt_values if len(alt_values)-1 else alt_values[0]))
+def get_or_create_variant(reference_genome, vcf_record, vcf_dataset,
+        alignment_group=None, query_cache=None):
+    """Create a variant and its relations.
+
+    A new Variant is only created if it doesn't exist already. The following
+    relations are created:
+        * VariantCallerCommonData
+        * VariantEvidence
+        * VariantAlternate
 
-        raise Exception(('The CHROM field of the following variant does not match any of '
-                'the chromosomes belonging to its reference genome:' + variant_string + '\n'
-                'Chromosomes belonging to reference genome ' + str(reference_genome.label) +
-                ' are: ' + str([str(chrom.seqrecord_id) for chrom in
-                        Chromosome.objects.filter(reference_genome=reference_genome)]).strip('[]')))
+    Also go through all per-alt keys and add them as a json field
+    to the VariantAlternate object.
+
+    Args:
+        reference_genome: The ReferenceGenome.
+        vcf_record: pyvcf Record object.
+        vcf_dataset: Source Dataset for this data.
+        query_cache: QueryCache helper object for making queries.
+
+    Returns:
+        Tuple (Variant, List<VariantAlt>)
+    """
+    parsed_record = parse_vcf_record(reference_genome, vcf_record)
+    type = parsed_record.type
+    chromosome_label = parsed_record.chromosome_label
+    position = parsed_record.position
+    ref_value = parsed_record.ref_value
+    alt_values = parsed_record.alt_values
+
+    # Make sure the chromosome cited in the VCF exists for
+    # the reference genome variant is being added to
+    if query_cache is not None:
+        seqrecord_id_to_chromosome = (
+                query_cache.get_seqrecord_id_to_chromosome())
+    else:
+        seqrecord_id_to_chromosome = dict(
+                (chrom.seqrecord_id, chrom) for chrom in
+                Chromosome.objects.filter(reference_genome=reference_genome))
+    chromosome = seqrecord_id_to_chromosome.get(chromosome_label)
+    if chromosome is None:
+        _raise_unknown_chromosome(reference_genome, parsed_record,
+                seqrecord_id_to_chromosome.keys())
 
     # Try to find an existing Variant, or create it.
-    variant, created = Variant.objects.get_or_create(
-            reference_genome=reference_genome,
-            chromosome=Chromosome.objects.filter(
+    variant = None
+    if query_cache is not None:
+        variant = query_cache.get_variant(chromosome.id, position, ref_value)
+    if variant is None:
+        variant, _ = Variant.objects.get_or_create(
                 reference_genome=reference_genome,
-                seqrecord_id=chromosome_label)[0],
-            position=position,
-            ref_value=ref_value
-    )
+                chromosome=chromosome,
+                position=position,
+                ref_value=ref_value
+        )
+        if query_cache is not None:
+            query_cache.add_variant(variant)
 
     # We don't want to search by type above, but we do want to save
     # the type here. There are weird cases where we might be overwriting
     # the type (i.e. two SNVs with identical ref/alt but different types),
     # but I think this is OK for now.
-    if type:
+    if type and variant.type != type:
         variant.type = type
         variant.save()
 
-    # Whether or not this is an (structural variant) SV is determined in
-    # VariantAlternate data. Still, we want to expose this on the Variant
-    # level, so we check whether this is SV internally.
-    is_sv = False
-
     alts = []
-    all_alt_keys = reference_genome.get_variant_alternate_map().keys()
-    raw_alt_keys = [k for k in raw_data_dict.keys() if k in all_alt_keys]
+    for alt_value, alt_data in zip(alt_values, parsed_record.alt_data_list):
+        var_alt = None
+        if query_cache is not None:
+            var_alt_id = query_cache.get_alternate_id(
+                    variant.id, str(alt_value))
+            if var_alt_id is not None:
+                # Fetch the current data to merge into, since other tasks may
+                # have updated it.
+                var_alt = VariantAlternate.objects.get(id=var_alt_id)
+        if var_alt is None:
+            var_alt, var_created = VariantAlternate.objects.get_or_create(
+                    variant=variant,
+                    alt_value=alt_value)
+
+            # If this is a new alternate, initialize the data dictionary
+            if var_created:
+                var_alt.data = {}
 
-    for alt_idx, alt_value in enumerate(alt_values):
-
-        # Grab the alt data for this alt index.
-        alt_data = dict([(k, raw_data_dict[k][alt_idx]) for k in raw_alt_keys])
-
-        var_alt, var_created = VariantAlternate.objects.get_or_create(
-                variant=variant,
-                alt_value=alt_value)
-
-        # If this is a new alternate, initialize the data dictionary
-        if var_created:
-            var_alt.data = {}
+            if query_cache is not None:
+                query_cache.add_alternate(var_alt)
 
         # TODO: We are overwriting keys here. Is this desired?
         var_alt.data.update(alt_data)
-        var_alt.save()
-
-        if 'INFO_SVTYPE' in alt_data:
-            is_sv = True
+        var_alt.save(update_fields=['data'])
 
         alts.append(var_alt)
 
-    # Remove all per-alt keys from raw_data_dict before passing to VCC create.
-    [raw_data_dict.pop(k, None) for k in raw_alt_keys]
-
-    # Indicate whether this is SV type, making it queryable.
-    raw_data_dict['IS_SV'] = is_sv
+    raw_data_dict = parsed_record.common_data
 
     # Create a common data object for this variant.
     # NOTE: raw_data_dict only contains the values that were not popped until
@@ -328,6 +590,312 @@ def get_or_create_variant(reference_genome, vcf_record, vcf_dataset,
     return (variant, alts)
 
 
+class BulkVariantWriter(object):
+    """Buffers vcf records and writes their Variant, VariantAlternate,
+    VariantCallerCommonData and VariantEvidence rows in batches.
+
+    Creates the same rows and relationships as calling get_or_create_variant()
+    on each record, including the VariantEvidence to VariantAlternate links
+    normally created by the post_save signal on VariantEvidence, but with a
+    handful of queries per batch rather than a dozen or more per record.
+
+    NOTE: bulk_create() doesn't retry on the rare uid clash the way
+    SafeCreateModelManager.create() does. A clash fails the whole batch.
+    """
+
+    def __init__(self, reference_genome, vcf_dataset, alignment_group=None,
+            query_cache=None, batch_size=None):
+        self.reference_genome = reference_genome
+        self.vcf_dataset = vcf_dataset
+        self.alignment_group = alignment_group
+        if query_cache is None:
+            query_cache = QueryCache(reference_genome)
+        self.query_cache = query_cache
+        if batch_size is None:
+            batch_size = settings.VCF_PARSER_BULK_BATCH_SIZE
+        self.batch_size = batch_size
+
+        self.alt_keys = reference_genome.get_variant_alternate_map().keys()
+        self.seqrecord_id_to_chromosome = (
+                query_cache.get_seqrecord_id_to_chromosome())
+
+        # List of (ParsedVcfRecord, [(ExperimentSample, data), ...]) pairs
+        # waiting to be written.
+        self.pending = []
+
+    def add(self, vcf_record):
+        """Buffers a pyvcf Record, writing the buffer if it is full.
+
+        Returns:
+            List of Variants written by this call, one per buffered record,
+            in the order the records were added. Empty unless the buffer
+            was written.
+        """
+        parsed_record = parse_vcf_record(self.reference_genome, vcf_record,
+                alt_keys=self.alt_keys)
+        if not parsed_record.chromosome_label in (
+                self.seqrecord_id_to_chromosome):
+            _raise_unknown_chromosome(self.reference_genome, parsed_record,
+                    self.seqrecord_id_to_chromosome.keys())
+
+        sample_data_list = []
+        if self.alignment_group:
+            for sample in vcf_record.samples:
+                sample_uid = sample.sample
+                sample_obj = self.query_cache.uid_to_experiment_sample_map.get(
+                        sample_uid)
+                if sample_obj is None:
+                    sample_obj = ExperimentSample.objects.get(uid=sample_uid)
+                sample_data_list.append(
+                        (sample_obj, extract_sample_data_dict(sample)))
+
+        self.pending.append((parsed_record, sample_data_list))
+
+        if len(self.pending) >= self.batch_size:
+            return self.flush()
+        return []
+
+    def flush(self):
+        """Writes all buffered records.
+
+        Returns:
+            List of Variants, one per buffered record, in order.
+        """
+        if not self.pending:
+            return []
+
+        pending = self.pending
+        self.pending = []
+
+        with transaction.commit_on_success():
+            record_variants = self._write_variants(pending)
+            key_to_alt = self._write_alternates(pending, record_variants)
+            if self.alignment_group:
+                self._write_common_data_and_evidence(
+                        pending, record_variants, key_to_alt)
+
+        # For large VCFs, the cached SQL object references can exhaust memory
+        # so we explicitly clear them here.
+        reset_queries()
+
+        return record_variants
+
+    def _get_chromosome(self, parsed_record):
+        return self.seqrecord_id_to_chromosome[parsed_record.chromosome_label]
+
+    def _write_variants(self, pending):
+        """Looks up existing Variants for the buffered records and creates
+        the missing ones.
+
+        Returns:
+            List of Variants, one per buffered record.
+        """
+        def _variant_key(parsed_record):
+            return (self._get_chromosome(parsed_record).id,
+                    parsed_record.position, parsed_record.ref_value)
+
+        # Resolve what we can from the QueryCache, and only look up the
+        # misses, which may have been created by another parse.
+        key_to_variant = {}
+        missed_positions = set()
+        for parsed_record, _ in pending:
+            key = _variant_key(parsed_record)
+            variant = self.query_cache.get_variant(*key)
+            if variant is not None:
+                key_to_variant[key] = variant
+            else:
+                missed_positions.add(parsed_record.position)
+        if missed_positions:
+            for variant in Variant.objects.filter(
+                    reference_genome=self.reference_genome,
+                    position__in=missed_positions).only(
+                            *QueryCache.VARIANT_FIELDS):
+                variant.reference_genome = self.reference_genome
+                key_to_variant.setdefault(
+                        (variant.chromosome_id, variant.position,
+                                variant.ref_value),
+                        variant)
+                self.query_cache.add_variant(variant)
+
+        # Like get_or_create_variant(), the last record for a Variant
+        # determines its type.
+        new_variants = []
+        key_to_type = {}
+        for parsed_record, _ in pending:
+            key = _variant_key(parsed_record)
+            if not key in key_to_variant:
+                variant = Variant(
+                        reference_genome=self.reference_genome,
+                        chromosome=self._get_chromosome(parsed_record),
+                        position=parsed_record.position,
+                        ref_value=parsed_record.ref_value)
+                key_to_variant[key] = variant
+                new_variants.append(variant)
+            if parsed_record.type:
+                key_to_type[key] = parsed_record.type
+
+        for variant, variant_id in zip(new_variants,
+                reserve_ids(Variant, len(new_variants))):
+            variant.id = variant_id
+
+        # Update the type of existing Variants, one query per distinct type.
+        new_variant_ids = set([variant.id for variant in new_variants])
+        type_to_existing_ids = {}
+        for key, type in key_to_type.iteritems():
+            variant = key_to_variant[key]
+            if variant.id in new_variant_ids:
+                variant.type = type
+            elif variant.type != type:
+                variant.type = type
+                type_to_existing_ids.setdefault(type, []).append(variant.id)
+
+        Variant.objects.bulk_create(new_variants,
+                batch_size=BULK_WRITE_BATCH_SIZE)
+        for variant in new_variants:
+            self.query_cache.add_variant(variant)
+        for type, variant_ids in type_to_existing_ids.iteritems():
+            Variant.objects.filter(id__in=variant_ids).update(type=type)
+
+        return [key_to_variant[_variant_key(parsed_record)]
+                for parsed_record, _ in pending]
+
+    def _write_alternates(self, pending, record_variants):
+        """Creates missing VariantAlternates and merges per-alt data into
+        existing ones.
+
+        Returns:
+            Dictionary from (variant id, normalized alt value) to
+            VariantAlternate, for the alternates in the buffered records.
+        """
+        # The QueryCache only has ids, so fetch the alternates it resolves in
+        # order to merge into their current data. Also fetch all alternates
+        # of Variants with misses, which may have been created by another
+        # parse.
+        key_to_alt = {}
+        cached_alt_ids = set()
+        missed_variant_ids = set()
+        for (parsed_record, _), variant in zip(pending, record_variants):
+            for alt_value in parsed_record.alt_values:
+                var_alt_id = self.query_cache.get_alternate_id(
+                        variant.id, str(alt_value))
+                if var_alt_id is not None:
+                    cached_alt_ids.add(var_alt_id)
+                else:
+                    missed_variant_ids.add(variant.id)
+        if cached_alt_ids or missed_variant_ids:
+            for var_alt in VariantAlternate.objects.filter(
+                    Q(id__in=cached_alt_ids) |
+                    Q(variant__in=missed_variant_ids)):
+                key = (var_alt.variant_id, var_alt.alt_value)
+                if not key in key_to_alt:
+                    key_to_alt[key] = var_alt
+                    self.query_cache.add_alternate(var_alt)
+
+        new_alts = []
+        updated_alt_ids = set()
+        for (parsed_record, _), variant in zip(pending, record_variants):
+            for alt_value, alt_data in zip(parsed_record.alt_values,
+                    parsed_record.alt_data_list):
+                alt_value = str(alt_value)
+                key = (variant.id,
+                        get_normalized_alt_representation(alt_value))
+                var_alt = key_to_alt.get(key)
+                if var_alt is None:
+                    # NOTE: The constructor writes long alts to disk.
+                    var_alt = VariantAlternate(
+                            variant=variant,
+                            alt_value=alt_value)
+                    var_alt.data = {}
+                    key_to_alt[key] = var_alt
+                    new_alts.append(var_alt)
+                elif var_alt.id is not None:
+                    updated_alt_ids.add(var_alt.id)
+
+                # TODO: We are overwriting keys here. Is this desired?
+                var_alt.data.update(alt_data)
+
+        for var_alt, alt_id in zip(new_alts,
+                reserve_ids(VariantAlternate, len(new_alts))):
+            var_alt.id = alt_id
+        VariantAlternate.objects.bulk_create(new_alts,
+                batch_size=BULK_WRITE_BATCH_SIZE)
+        for var_alt in new_alts:
+            self.query_cache.add_alternate(var_alt)
+
+        bulk_update_field(VariantAlternate, 'data', dict(
+                (var_alt.id, var_alt.data) for var_alt in key_to_alt.values()
+                if var_alt.id in updated_alt_ids))
+
+        return key_to_alt
+
+    def _write_common_data_and_evidence(self, pending, record_variants,
+            key_to_alt):
+        """Creates a VariantCallerCommonData per record and a VariantEvidence
+        per record and sample, linking each VariantEvidence to the alternates
+        called for it.
+        """
+        common_data_ids = reserve_ids(VariantCallerCommonData, len(pending))
+        evidence_ids = iter(reserve_ids(VariantEvidence, sum(
+                [len(sample_data_list) for _, sample_data_list in pending])))
+
+        common_data_objs = []
+        evidence_objs = []
+        for (parsed_record, sample_data_list), variant, common_data_id in zip(
+                pending, record_variants, common_data_ids):
+            common_data_obj = VariantCallerCommonData(
+                    id=common_data_id,
+                    alignment_group=self.alignment_group,
+                    variant=variant,
+                    source_dataset=self.vcf_dataset,
+                    data=parsed_record.common_data)
+            common_data_objs.append(common_data_obj)
+            for sample_obj, sample_data_dict in sample_data_list:
+                evidence_objs.append(VariantEvidence(
+                        id=next(evidence_ids),
+                        experiment_sample=sample_obj,
+                        variant_caller_common_data=common_data_obj,
+                        data=sample_data_dict))
+
+        VariantCallerCommonData.objects.bulk_create(common_data_objs,
+                batch_size=BULK_WRITE_BATCH_SIZE)
+        VariantEvidence.objects.bulk_create(evidence_objs,
+                batch_size=BULK_WRITE_BATCH_SIZE)
+
+        # Equivalent of VariantEvidence.create_variant_alternate_association(),
+        # which the post_save signal would otherwise call per object.
+        EvidenceToAlternate = VariantEvidence.variantalternate_set.through
+        evidence_alt_links = []
+        for evidence_obj in evidence_objs:
+            if not 'GT_BASES' in evidence_obj.data:
+                continue
+            variant_id = evidence_obj.variant_caller_common_data.variant_id
+            linked_alt_ids = set()
+            for alt_value in VariantEvidence.get_called_alt_values(
+                    evidence_obj.data):
+                var_alt = key_to_alt.get((variant_id, alt_value))
+                if var_alt is not None:
+                    var_alt_id = var_alt.id
+                else:
+                    # Called alt values are already normalized.
+                    var_alt_id = (
+                            self.query_cache.get_alternate_id_by_normalized_alt(
+                                    variant_id, alt_value))
+                if var_alt_id is None:
+                    # Should not happen.
+                    logger.error('Attempt to add a SampleEvidence with an '
+                            'alternate allele that is not present for this '
+                            'variant!')
+                    raise VariantAlternate.DoesNotExist
+                if var_alt_id in linked_alt_ids:
+                    continue
+                linked_alt_ids.add(var_alt_id)
+                evidence_alt_links.append(EvidenceToAlternate(
+                        variantevidence_id=evidence_obj.id,
+                        variantalternate_id=var_alt_id))
+        EvidenceToAlternate.objects.bulk_create(evidence_alt_links,
+                batch_size=BULK_WRITE_BATCH_SIZE)
+
+
 def extract_sample_data_dict(s):
     """Extract sample data from the pyvcf _Call object.
 